@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+Compare throughput and ratio of the compression codecs, with and without
+storing of already compressed data
+
+Usage::
+
+    python -m benchmarks.bench_compression --files 2000 --file-size 65536 --workers 1 2 4
+    python -m benchmarks.bench_compression --incompressible 0.8 --codecs gz
+
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from sbackup.compress import CODECS, Compressor
+from sbackup.seekable import IndexedTarFile
+
+from .datasets import make_tree
+
+
+class NullWriter(object):
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        return len(data)
+
+
+def run(source, codec, level, workers, skip_compressed=True):
+    sink = NullWriter()
+    compressor = Compressor(codec=codec, level=level, workers=workers,
+                            skip_compressed=skip_compressed)
+    started = time.perf_counter()
+    with compressor.open_writer(sink) as writer:
+        with IndexedTarFile.open(fileobj=writer, mode='w|', compress_writer=writer) as tar:
+            tar.add(source, arcname=os.path.basename(source))
+    elapsed = time.perf_counter() - started
+    return writer.bytes_in, sink.size, writer.stored_bytes, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=2000)
+    parser.add_argument('--file-size', type=int, default=64 * 1024)
+    parser.add_argument('--incompressible', type=float, default=0.2)
+    parser.add_argument('--codecs', nargs='+', default=list(CODECS))
+    parser.add_argument('--workers', nargs='+', type=int, default=[1, 2, 4])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        source = os.path.join(root, 'data')
+        os.mkdir(source)
+        make_tree(source, files=args.files, file_size=args.file_size,
+                  incompressible=args.incompressible)
+        print('%-6s %-6s %-8s %-5s %10s %8s %8s' % (
+            'codec', 'level', 'workers', 'skip', 'MB/s', 'ratio', 'stored'))
+        for codec in args.codecs:
+            if not CODECS[codec].is_available():
+                print('%-6s is not installed' % codec)
+                continue
+            level = CODECS[codec].default_level
+            for workers in args.workers:
+                for skip_compressed in (False, True):
+                    size_in, size_out, stored, elapsed = run(source, codec, level, workers,
+                                                             skip_compressed)
+                    print('%-6s %-6s %-8s %-5s %10.1f %8.3f %8.3f' % (
+                        codec, level, workers, 'yes' if skip_compressed else 'no',
+                        size_in / elapsed / 2 ** 20, size_out / size_in, stored / size_in))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Measure the cost of the encryption: the throughput of ciphers by segment
+sizes and the overhead of the encryption on the archive of a synthetic tree
+
+Usage::
+
+    python -m benchmarks.bench_encryption --files 2000 --file-size 65536 --codecs gz zstd
+
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from sbackup.compress import CODECS, Compressor
+from sbackup.encryption import CIPHERS, EncryptWriter
+from sbackup.seekable import IndexedTarFile
+
+from .bench_compression import NullWriter
+from .datasets import make_tree
+
+KEY = b'k' * 32
+
+
+def run_cipher(cipher, segment_size, size):
+    data = os.urandom(1024 * 1024)
+    started = time.perf_counter()
+    with EncryptWriter(NullWriter(), KEY, cipher, segment_size) as writer:
+        for _ in range(size // len(data)):
+            writer.write(data)
+    return time.perf_counter() - started
+
+
+def run_archive(source, codec, cipher=None):
+    sink = NullWriter()
+    compressor = Compressor(codec=codec)
+    started = time.perf_counter()
+    fileobj = sink if cipher is None else EncryptWriter(sink, KEY, cipher)
+    with compressor.open_writer(fileobj) as writer:
+        with IndexedTarFile.open(fileobj=writer, mode='w|', compress_writer=writer) as tar:
+            tar.add(source, arcname=os.path.basename(source))
+    if cipher is not None:
+        fileobj.close()
+    return writer.bytes_in, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=2000)
+    parser.add_argument('--file-size', type=int, default=64 * 1024)
+    parser.add_argument('--incompressible', type=float, default=0.2)
+    parser.add_argument('--codecs', nargs='+', default=['gz', 'zstd'])
+    parser.add_argument('--segment-sizes', nargs='+', type=int, default=[16384, 65536, 1048576])
+    parser.add_argument('--size', type=int, default=256 * 1024 ** 2)
+    args = parser.parse_args()
+
+    print('%-18s %-10s %10s' % ('cipher', 'segment', 'MB/s'))
+    for cipher in CIPHERS:
+        for segment_size in args.segment_sizes:
+            elapsed = run_cipher(cipher, segment_size, args.size)
+            print('%-18s %-10d %10.1f' % (cipher, segment_size, args.size / elapsed / 2 ** 20))
+
+    with tempfile.TemporaryDirectory() as root:
+        source = os.path.join(root, 'data')
+        os.mkdir(source)
+        make_tree(source, files=args.files, file_size=args.file_size,
+                  incompressible=args.incompressible)
+        print('%-6s %-18s %10s %10s' % ('codec', 'cipher', 'MB/s', 'overhead'))
+        for codec in args.codecs:
+            if not CODECS[codec].is_available():
+                print('%-6s is not installed' % codec)
+                continue
+            size, plain = run_archive(source, codec)
+            print('%-6s %-18s %10.1f %10s' % (codec, '-', size / plain / 2 ** 20, '-'))
+            for cipher in CIPHERS:
+                size, elapsed = run_archive(source, codec, cipher)
+                print('%-6s %-18s %10.1f %9.1f%%' % (
+                    codec, cipher, size / elapsed / 2 ** 20, (elapsed / plain - 1) * 100))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Measure the cost of include and exclude rules per million paths, the compiled
+filter against a loop of fnmatch over every pattern
+
+Usage::
+
+    python -m benchmarks.bench_filters --paths 1000000 --patterns 50
+
+"""
+import argparse
+import fnmatch
+import os
+import random
+import stat
+import time
+
+from sbackup.rules import PathFilter
+from sbackup.walker import Entry
+
+EXTENSIONS = ('.py', '.js', '.html', '.css', '.png', '.log', '.tmp', '.json', '.txt', '.map')
+BASE_PATTERNS = ['node_modules/', '.cache/', '__pycache__/', '*.log', '*.tmp', '*.map',
+                 '/build/', 'media/**/thumbs/', 'tmp*', '!keep.log']
+
+
+def make_entries(count, seed=0):
+    rand = random.Random(seed)
+    file_stat = os.stat_result((stat.S_IFREG | 0o644, 0, 0, 1, 0, 0, 1024, 0, 0, 0))
+    dir_stat = os.stat_result((stat.S_IFDIR | 0o755, 0, 0, 1, 0, 0, 4096, 0, 0, 0))
+    entries = []
+    for number in range(count):
+        depth = rand.randint(1, 6)
+        parts = ['dir%d' % rand.randint(0, 50) for _ in range(depth)]
+        if number % 10:
+            parts.append('file%d%s' % (number, rand.choice(EXTENSIONS)))
+            info = file_stat
+        else:
+            info = dir_stat
+        arcname = 'site/' + '/'.join(parts)
+        entries.append(Entry('/srv/' + arcname, arcname, info))
+    return entries
+
+
+def make_patterns(count):
+    patterns = list(BASE_PATTERNS)
+    for number in range(count - len(patterns)):
+        patterns.append(('name%d' if number % 2 else '*.ext%d') % number)
+    return patterns[:max(count, len(BASE_PATTERNS))]
+
+
+def fnmatch_filter(patterns):
+    # A naive matcher which translates globs on every call, without the gitignore semantics
+    def accept(entry):
+        path = entry.arcname.partition('/')[2]
+        name = path.rpartition('/')[2]
+        excluded = False
+        for pattern in patterns:
+            negated = pattern.startswith('!')
+            pattern = pattern.lstrip('!').strip('/').replace('**/', '')
+            if fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(path, pattern):
+                excluded = not negated
+        return not excluded
+    return accept
+
+
+def run(accept, entries):
+    started = time.perf_counter()
+    accepted = sum(1 for entry in entries if accept(entry))
+    return time.perf_counter() - started, accepted
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--paths', type=int, default=1000000)
+    parser.add_argument('--patterns', nargs='+', type=int, default=[10, 50, 200])
+    parser.add_argument('--skip-fnmatch', action='store_true')
+    args = parser.parse_args()
+
+    entries = make_entries(args.paths)
+    print('%-9s %-10s %12s %14s %10s' % ('patterns', 'matcher', 'ns/path', 's/1M paths',
+                                         'accepted'))
+    for count in args.patterns:
+        patterns = make_patterns(count)
+        path_filter = PathFilter(exclude=patterns)
+        path_filter.validate()
+        matchers = [('compiled', path_filter)]
+        if not args.skip_fnmatch:
+            matchers.append(('fnmatch', fnmatch_filter(patterns)))
+        for name, accept in matchers:
+            elapsed, accepted = run(accept, entries)
+            print('%-9d %-10s %12.0f %14.2f %10d' % (
+                len(patterns), name, elapsed / len(entries) * 1e9,
+                elapsed / len(entries) * 1e6, accepted))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""
+End to end benchmark of create, restore, list and retention on synthetic trees
+
+Trees are generated from a seed, so runs on the same machine are comparable.
+By default it runs against the in-process moto S3 stand-in, its objects are
+kept in the memory of the benchmark, use ``--endpoint-url`` of a local S3
+server (moto_server, MinIO) for a meaningful peak RSS, the bucket has to exist there.
+
+Every operation records MB/s, files/s, the CPU time and the peak RSS.
+``--save`` stores the results as a baseline, ``--baseline`` compares with it
+and exits with the code 1 if a throughput dropped or the CPU time or the
+peak RSS grew by more than ``--tolerance``.
+
+Usage::
+
+    python -m benchmarks.bench_pipeline --save baseline.json
+    python -m benchmarks.bench_pipeline --baseline baseline.json --tolerance 0.2
+    python -m benchmarks.bench_pipeline --datasets small text --scale 0.1 --stream
+
+"""
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+
+from sbackup.task import DirBackupTask
+
+from .datasets import DATASETS
+
+LIST_OBJECTS = 1000
+# Metrics which are better when they are higher, the rest are better when they are lower
+HIGHER_IS_BETTER = ('mb_s', 'files_s')
+LOWER_IS_BETTER = ('cpu_seconds', 'peak_rss')
+
+
+@contextlib.contextmanager
+def stand_in(args):
+    if args.endpoint_url:
+        yield
+        return
+    from moto import mock_aws
+    with mock_aws():
+        yield
+
+
+def reset_peak_rss():
+    """
+    Reset the peak RSS of the process, Linux only, elsewhere the peak is the one of the process
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as fileobj:
+            fileobj.write('5')
+    except OSError:
+        pass
+
+
+def get_peak_rss():
+    """
+    Return the peak RSS in bytes
+    """
+    try:
+        with open('/proc/self/status') as fileobj:
+            for line in fileobj:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def get_cpu_time():
+    usage = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    return sum(item.ru_utime + item.ru_stime for item in usage)
+
+
+@contextlib.contextmanager
+def measure(results, name, size, files):
+    """
+    Measure the block and store the result by the name
+    """
+    reset_peak_rss()
+    cpu = get_cpu_time()
+    started = time.perf_counter()
+    yield
+    elapsed = time.perf_counter() - started
+    results[name] = {
+        'seconds': elapsed,
+        'mb_s': size / elapsed / 1024 ** 2,
+        'files_s': files / elapsed,
+        'cpu_seconds': get_cpu_time() - cpu,
+        'peak_rss': get_peak_rss(),
+    }
+
+
+def make_task(args, name, source, tmp_dir):
+    return DirBackupTask.create_task({
+        'name': name,
+        'type': 'dir',
+        'source': source,
+        'tmp_dir': tmp_dir,
+        'stream': args.stream,
+        'walk_workers': args.walk_workers,
+        'compression': {'codec': args.codec, 'workers': args.workers},
+        'dst_backend': {
+            's3': {
+                'access_key_id': args.access_key_id,
+                'secret_access_key': args.secret_access_key,
+                'bucket': args.bucket,
+                'location': 'bench-%s' % name,
+                'endpoint_url': args.endpoint_url,
+            }
+        }
+    })
+
+
+def run_dataset(args, name, results):
+    with tempfile.TemporaryDirectory() as root:
+        source = os.path.join(root, name)
+        tmp_dir = os.path.join(root, 'tmp')
+        os.mkdir(source)
+        os.mkdir(tmp_dir)
+        size, files = DATASETS[name](source, args.scale)
+        task = make_task(args, name, source, tmp_dir)
+        backend = task.dst_backend
+        if not args.endpoint_url:
+            backend.bucket.create()
+
+        with measure(results, '%s/create' % name, size, files):
+            backup_file = task.execute()
+        results['%s/create' % name]['ratio'] = task.metrics.compression_ratio
+
+        with measure(results, '%s/restore' % name, size, files):
+            task.restore(backup_file)
+
+        for number in range(LIST_OBJECTS):
+            backend.put_object('backup-%s-%06d.tar.gz' % (name, number), b'')
+        with measure(results, '%s/list' % name, 0, LIST_OBJECTS):
+            names = list(backend)
+        assert len(names) == LIST_OBJECTS + 1
+
+        tomorrow = datetime.date.today() + datetime.timedelta(days=1)
+        with measure(results, '%s/retention' % name, 0, LIST_OBJECTS + 1):
+            result = backend.delete_older(tomorrow)
+        assert not result.errors
+
+
+def compare(results, baseline, tolerance):
+    """
+    Print the changes against the baseline
+
+    Returns:
+        regressions(list): Names of worse metrics
+    """
+    regressions = []
+    print('%-18s %-12s %14s %14s %9s' % ('operation', 'metric', 'baseline', 'current', 'change'))
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        for metric in HIGHER_IS_BETTER + LOWER_IS_BETTER:
+            old, new = baseline[name].get(metric), result[metric]
+            if not old:
+                continue
+            change = (new - old) / old
+            worse = change < -tolerance if metric in HIGHER_IS_BETTER else change > tolerance
+            if worse:
+                regressions.append('%s %s' % (name, metric))
+            print('%-18s %-12s %14.2f %14.2f %+8.1f%%%s' % (
+                name, metric, old, new, change * 100, ' !' if worse else ''))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--datasets', nargs='+', default=list(DATASETS), choices=list(DATASETS))
+    parser.add_argument('--scale', type=float, default=1.0, help='A size factor of datasets')
+    parser.add_argument('--codec', default='gz')
+    parser.add_argument('--workers', type=int, default=2, help='Compression workers')
+    parser.add_argument('--walk-workers', type=int, default=4)
+    parser.add_argument('--stream', action='store_true')
+    parser.add_argument('--baseline', help='Compare with the baseline file')
+    parser.add_argument('--save', help='Save results as a baseline file')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--endpoint-url')
+    parser.add_argument('--bucket', default='bench')
+    parser.add_argument('--access-key-id', default='FAKE_KEY_ID')
+    parser.add_argument('--secret-access-key', default='FAKE_KEY')
+    args = parser.parse_args()
+
+    results = {}
+    with stand_in(args):
+        for name in args.datasets:
+            run_dataset(args, name, results)
+
+    print('%-18s %10s %12s %8s %10s %10s' % (
+        'operation', 'MB/s', 'files/s', 'seconds', 'cpu s', 'RSS MB'))
+    for name, result in sorted(results.items()):
+        print('%-18s %10.1f %12.0f %8.2f %10.2f %10.1f' % (
+            name, result['mb_s'], result['files_s'], result['seconds'], result['cpu_seconds'],
+            result['peak_rss'] / 1024 ** 2))
+
+    if args.save:
+        with open(args.save, 'wt') as fileobj:
+            json.dump(results, fileobj, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline, 'rt') as fileobj:
+            baseline = json.load(fileobj)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print('Regressions: %s' % ', '.join(regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+Measure how the upload and download throughput scales with the concurrency
+
+By default it runs against the in-process moto S3 stand-in, use
+``--endpoint-url`` for a local S3 server (moto_server, MinIO), the bucket
+has to exist there.
+
+Usage::
+
+    python -m benchmarks.bench_transfer --size 256MB --concurrency 1 2 4 8
+    python -m benchmarks.bench_transfer --endpoint-url http://127.0.0.1:5000 --bucket bench
+
+"""
+import argparse
+import contextlib
+import os
+import tempfile
+import time
+
+from sbackup.dest_backend.aws import S3Backend
+from sbackup.utils import parse_size
+
+
+@contextlib.contextmanager
+def stand_in(args):
+    if args.endpoint_url:
+        yield
+        return
+    from moto import mock_aws
+    with mock_aws():
+        yield
+
+
+def make_backend(args, concurrency):
+    return S3Backend(args.access_key_id, args.secret_access_key, args.bucket,
+                     location='bench', endpoint_url=args.endpoint_url, transfer={
+                         'multipart_threshold': args.chunk_size,
+                         'multipart_chunksize': args.chunk_size,
+                         'max_concurrency': concurrency,
+                     })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size', default='128MB')
+    parser.add_argument('--chunk-size', default='8MB')
+    parser.add_argument('--concurrency', nargs='+', type=int, default=[1, 2, 4, 8])
+    parser.add_argument('--endpoint-url')
+    parser.add_argument('--bucket', default='bench')
+    parser.add_argument('--access-key-id', default='FAKE_KEY_ID')
+    parser.add_argument('--secret-access-key', default='FAKE_KEY')
+    args = parser.parse_args()
+    size = parse_size(args.size)
+
+    with stand_in(args), tempfile.TemporaryDirectory() as root:
+        src_path = os.path.join(root, 'bench.bin')
+        dst_dir = os.path.join(root, 'download')
+        os.mkdir(dst_dir)
+        with open(src_path, 'wb') as fileobj:
+            for _ in range(0, size, 2 ** 20):
+                fileobj.write(os.urandom(2 ** 20))
+        if not args.endpoint_url:
+            make_backend(args, 1).bucket.create()
+        print('%-12s %14s %14s %14s' % ('concurrency', 'upload MB/s', 'stream MB/s', 'download MB/s'))
+        for concurrency in args.concurrency:
+            backend = make_backend(args, concurrency)
+
+            started = time.perf_counter()
+            backend.upload(src_path)
+            upload = size / (time.perf_counter() - started) / 2 ** 20
+
+            started = time.perf_counter()
+            with open(src_path, 'rb') as src, backend.open_writer('bench-stream.bin') as dst:
+                for data in iter(lambda: src.read(2 ** 20), b''):
+                    dst.write(data)
+            stream = size / (time.perf_counter() - started) / 2 ** 20
+
+            started = time.perf_counter()
+            os.remove(backend.download('bench.bin', dst_dir))
+            download = size / (time.perf_counter() - started) / 2 ** 20
+            print('%-12s %14.1f %14.1f %14.1f' % (concurrency, upload, stream, download))
+
+
+if __name__ == '__main__':
+    main()
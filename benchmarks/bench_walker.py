@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Compare tarfile.add with the parallel walker on many tiny files and on a few huge files
+
+Usage::
+
+    python -m benchmarks.bench_walker --files 1000000 --file-size 512 --workers 1 4 16
+    python -m benchmarks.bench_walker --huge-files 2 --huge-size 4294967296
+
+"""
+import argparse
+import os
+import tarfile
+import tempfile
+import time
+
+from sbackup.walker import Walker, add_entries, read_ahead
+
+from .bench_compression import NullWriter
+from .datasets import make_huge_files, make_tree
+
+
+def run_tarfile(source):
+    started = time.perf_counter()
+    with tarfile.open(fileobj=NullWriter(), mode='w|') as tar:
+        tar.add(source, arcname=os.path.basename(source))
+    return time.perf_counter() - started
+
+
+def run_walker(source, workers):
+    started = time.perf_counter()
+    with tarfile.open(fileobj=NullWriter(), mode='w|') as tar, Walker(workers) as walker:
+        add_entries(tar, read_ahead(walker, walker.walk(source, os.path.basename(source))))
+    return time.perf_counter() - started
+
+
+def report(name, source, workers, total_size, files):
+    elapsed = run_tarfile(source)
+    print('%-6s %-10s %10.2f %12.0f %8.2f' % (
+        name, 'tarfile', total_size / elapsed / 1024 ** 2, files / elapsed, elapsed))
+    for number in workers:
+        elapsed = run_walker(source, number)
+        print('%-6s %-10s %10.2f %12.0f %8.2f' % (
+            name, 'walker-%d' % number, total_size / elapsed / 1024 ** 2, files / elapsed, elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, default=20000)
+    parser.add_argument('--file-size', type=int, default=512)
+    parser.add_argument('--huge-files', type=int, default=2)
+    parser.add_argument('--huge-size', type=int, default=256 * 1024 ** 2)
+    parser.add_argument('--workers', nargs='+', type=int, default=[1, 4, 16])
+    args = parser.parse_args()
+
+    print('%-6s %-10s %10s %12s %8s' % ('tree', 'method', 'MB/s', 'files/s', 'seconds'))
+    with tempfile.TemporaryDirectory() as root:
+        source = os.path.join(root, 'tiny')
+        os.mkdir(source)
+        total_size = make_tree(source, files=args.files, file_size=args.file_size,
+                               dirs_per_level=100)
+        report('tiny', source, args.workers, total_size, args.files)
+    with tempfile.TemporaryDirectory() as root:
+        source = os.path.join(root, 'huge')
+        os.mkdir(source)
+        total_size = make_huge_files(source, files=args.huge_files, file_size=args.huge_size)
+        report('huge', source, args.workers, total_size, args.huge_files)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+Reproducible synthetic directory trees for benchmarks
+"""
+import os
+import random
+
+WORDS = (
+    b'backup', b'server', b'request', b'response', b'config', b'session', b'user',
+    b'error', b'warning', b'debug', b'nginx', b'python', b'storage', b'archive',
+)
+
+
+def compressible_data(rnd, size):
+    """
+    Text-like data, compresses well
+    """
+    chunks = []
+    length = 0
+    while length < size:
+        line = b' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(4, 16))) + b'\n'
+        chunks.append(line)
+        length += len(line)
+    return b''.join(chunks)[:size]
+
+
+def incompressible_data(rnd, size):
+    return rnd.randbytes(size)
+
+
+def make_tree(root, files=1000, file_size=4096, dirs_per_level=10, incompressible=0.0,
+              seed=42):
+    """
+    Create a tree of files
+
+    Args:
+        root(str): A root directory, it has to exist
+        files(int): A number of files
+        file_size(int): A size of every file in bytes
+        dirs_per_level(int): A number of sub directories in every directory
+        incompressible(float): A part of files with random data, from 0 to 1
+        seed(int): A random seed
+    Returns:
+        total_size(int): A size of generated files
+    """
+    rnd = random.Random(seed)
+    total_size = 0
+    for index in range(files):
+        parts = []
+        number = index // dirs_per_level
+        while number:
+            number, rest = divmod(number, dirs_per_level)
+            parts.append('d%d' % rest)
+        directory = os.path.join(root, *parts)
+        os.makedirs(directory, exist_ok=True)
+        if rnd.random() < incompressible:
+            data = incompressible_data(rnd, file_size)
+        else:
+            data = compressible_data(rnd, file_size)
+        with open(os.path.join(directory, 'f%d.dat' % index), 'wb') as fileobj:
+            fileobj.write(data)
+        total_size += len(data)
+    return total_size
+
+
+def make_huge_files(root, files=2, file_size=1024 ** 3, seed=42):
+    """
+    Create a few big files, they are written by 1MiB blocks
+
+    Returns:
+        total_size(int): A size of generated files
+    """
+    rnd = random.Random(seed)
+    block = compressible_data(rnd, 1024 * 1024)
+    for index in range(files):
+        with open(os.path.join(root, 'huge%d.dat' % index), 'wb') as fileobj:
+            left = file_size
+            while left > 0:
+                fileobj.write(block[:left])
+                left -= len(block)
+    return files * file_size
+
+
+def make_small_files(root, scale=1.0):
+    files = max(int(20000 * scale), 1)
+    return make_tree(root, files=files, file_size=512, dirs_per_level=100), files
+
+
+def make_big_files(root, scale=1.0):
+    return make_huge_files(root, files=2, file_size=max(int(128 * 1024 ** 2 * scale), 1)), 2
+
+
+def make_random_files(root, scale=1.0):
+    files = max(int(100 * scale), 1)
+    return make_tree(root, files=files, file_size=1024 ** 2, incompressible=1.0), files
+
+
+def make_text_files(root, scale=1.0):
+    files = max(int(100 * scale), 1)
+    return make_tree(root, files=files, file_size=1024 ** 2, incompressible=0.0), files
+
+
+# Datasets of end to end benchmarks, a function(root, scale) returns the size and the number of files
+_datasets = (
+    ('small', make_small_files),
+    ('huge', make_big_files),
+    ('random', make_random_files),
+    ('text', make_text_files),
+)
+DATASETS = dict(_datasets)
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import datetime
+import os
+import time
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from .dest_backend.aio import ThreadedAsyncBackend
+from .exception import SBackupException
+from .metrics import RunReport, profiler
+from .task import TASK_CLASSES
+from .task_executor import TaskExecutor
+
+
+def make_archive(task, tmp_dir):
+    """
+    Create an archive of the task in a worker process
+
+    Args:
+        task(dict): A task config
+        tmp_dir(str)
+    Returns:
+        backup_file(str), counters(dict): Counters of the task metrics
+    """
+    obj = TASK_CLASSES[task['type']].create_task(task)
+    return obj.make_tarfile(tmp_dir), obj.metrics.counters
+
+
+class AsyncTaskExecutor(TaskExecutor):
+    """
+    The asyncio executor, archives are created in a process pool of
+    `max_archive_jobs` workers, uploads run on the event loop, at most
+    `max_uploads` at the same time
+
+    Usage::
+
+        executor = AsyncTaskExecutor({
+            'executor': {'engine': 'async', 'max_uploads': 8, 'max_archive_jobs': 4},
+            'tasks': [...]
+        })
+        executor.create()
+
+    """
+
+    def create(self, logger=None, **kwargs):
+        return asyncio.run(self.create_async(logger))
+
+    async def create_async(self, logger=None):
+        archive_jobs = self.settings['max_archive_jobs']
+        uploads = self.settings['max_uploads']
+        archive_slots = asyncio.Semaphore(archive_jobs)
+        upload_slots = asyncio.Semaphore(uploads)
+        started = datetime.datetime.now()
+        names = []
+        jobs = []
+        metrics = []
+        with ProcessPoolExecutor(max_workers=archive_jobs) as process_pool, \
+                ThreadPoolExecutor(max_workers=uploads + archive_jobs) as io_pool:
+            for task in self.tasks:
+                try:
+                    handler = self.get_handler(task['type'], logger)
+                except SBackupException:
+                    continue
+                obj = handler.create_task(task)
+                names.append(task['name'])
+                metrics.append(obj.metrics)
+                jobs.append(self.measure_task(task, obj, process_pool, io_pool,
+                                              archive_slots, upload_slots))
+            results = await asyncio.gather(*jobs, return_exceptions=True)
+        self.write_report(RunReport(metrics, started))
+        for task_name, result in zip(names, results):
+            if isinstance(result, Exception):
+                print('%s generated an exception: %s' % (task_name, result))
+            else:
+                print('Task %s, finished' % task_name)
+        return dict(zip(names, results))
+
+    @classmethod
+    async def measure_task(cls, task, obj, process_pool, io_pool, archive_slots, upload_slots):
+        obj.metrics.name = obj.name
+        try:
+            with profiler(obj.name, obj.profile, obj.profile_dir, obj.metrics), obj.metrics.measure():
+                obj.metrics.backup_file = await cls.run_task(
+                    task, obj, process_pool, io_pool, archive_slots, upload_slots)
+        finally:
+            obj.metrics.add('retries', obj.dst_backend.get_retries())
+        return obj.metrics.backup_file
+
+    @staticmethod
+    async def run_task(task, obj, process_pool, io_pool, archive_slots, upload_slots):
+        loop = asyncio.get_running_loop()
+        queued = time.monotonic()
+        if not obj.has_archive_stage():
+            # The task archives and uploads at the same time
+            async with archive_slots, upload_slots:
+                obj.metrics.queue_wait = time.monotonic() - queued
+                return await loop.run_in_executor(io_pool, obj.create)
+        await loop.run_in_executor(io_pool, obj.validate)
+        async with upload_slots:
+            backup_file = await loop.run_in_executor(io_pool, obj.resume_upload)
+        if backup_file:
+            if obj.verify:
+                await loop.run_in_executor(io_pool, obj.verify_backup, backup_file)
+            return backup_file
+        backend = ThreadedAsyncBackend(obj.dst_backend, executor=io_pool)
+        with obj.archive_dir() as tmp_dir:
+            async with archive_slots:
+                obj.metrics.queue_wait = time.monotonic() - queued
+                with obj.metrics.stage('archive'):
+                    backup_file, counters = await loop.run_in_executor(
+                        process_pool, make_archive, task, tmp_dir)
+            obj.metrics.update(counters)
+            async with upload_slots:
+                with obj.metrics.stage('upload'):
+                    await backend.upload(backup_file)
+                    await loop.run_in_executor(io_pool, obj.upload_index, backup_file)
+                obj.metrics.add('bytes_uploaded', os.path.getsize(backup_file))
+                if obj.verify:
+                    await loop.run_in_executor(io_pool, obj.verify_backup,
+                                               os.path.basename(backup_file))
+        return os.path.basename(backup_file)
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+Content-defined chunking with the gear rolling hash
+
+A cut point depends only on the last bytes before it, so an insert in
+a file shifts the cut points around the change only and the rest of the
+chunks stay the same.
+
+The hashes of a block of positions are computed by numpy at once. Without
+numpy files are split by fixed-size chunks of ``avg_size`` bytes, they are
+deduplicated only while the data doesn't shift.
+"""
+import logging
+import random
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+logger = logging.getLogger(__name__)
+
+MIN_SIZE = 256 * 1024
+AVG_SIZE = 1024 * 1024
+MAX_SIZE = 4 * 1024 * 1024
+
+
+def _gear_table(seed=0x5B4C):
+    rnd = random.Random(seed)
+    return tuple(rnd.getrandbits(64) for _ in range(256))
+
+
+GEAR = _gear_table()
+# The hash of a position is the sum of gear values of the last WINDOW bytes
+WINDOW = 64
+# Positions hashed at once, the buffers of the hash stay in the CPU cache
+BLOCK_SIZE = 16 * 1024
+
+
+class Chunker(object):
+    """
+    Split a stream to chunks of ``min_size``..``max_size`` bytes, the
+    average size is about ``avg_size``, it has to be a power of two
+
+    Usage::
+
+        chunker = Chunker()
+        with open('/var/www/site1/video.mp4', 'rb') as fileobj:
+            for chunk in chunker.iter_chunks(fileobj):
+                ...
+
+    """
+
+    def __init__(self, min_size=MIN_SIZE, avg_size=AVG_SIZE, max_size=MAX_SIZE):
+        if avg_size & (avg_size - 1) or not min_size < avg_size < max_size:
+            raise ValueError('avg_size has to be a power of two between min_size and max_size')
+        self.min_size = min_size
+        self.avg_size = avg_size
+        self.max_size = max_size
+        bits = avg_size.bit_length() - 1
+        # The top bits of the hash depend on the last 64 bytes
+        self._mask = ((1 << bits) - 1) << (64 - bits)
+        if numpy is None:
+            logger.warning("numpy is not installed, files are split by fixed-size chunks")
+            self._gear = None
+        else:
+            self._gear = numpy.array(GEAR, dtype=numpy.uint64)
+        self._values = self._shifted = None
+
+    def cut_point(self, data):
+        """
+        Return a length of the first chunk of the data
+        """
+        length = len(data)
+        if length <= self.min_size:
+            return length
+        end = min(length, self.max_size)
+        if self._gear is None:
+            return min(end, self.avg_size)
+        view = numpy.frombuffer(data, dtype=numpy.uint8, count=end)
+        mask = numpy.uint64(self._mask)
+        # The bytes before min_size never make a cut point, a block is
+        # hashed only if the blocks before it have no cut point
+        position = self.min_size
+        while position < end:
+            stop = min(position + BLOCK_SIZE, end)
+            start = max(position - WINDOW + 1, 0)
+            values = self._hash(view[start:stop])
+            found = numpy.flatnonzero((values[position - start:] & mask) == 0)
+            if len(found):
+                return position + int(found[0]) + 1
+            position = stop
+        return end
+
+    def _hash(self, codes):
+        """
+        Return the rolling hash of every position: the window of every
+        value doubles on every step, the sum wraps at 64 bits. The buffers
+        are reused, a chunker is used by one thread
+        """
+        size = len(codes)
+        if self._values is None:
+            self._values = numpy.empty(BLOCK_SIZE + WINDOW, dtype=numpy.uint64)
+            self._shifted = numpy.empty_like(self._values)
+        values, shifted = self._values[:size], self._shifted
+        numpy.take(self._gear, codes, out=values)
+        width = 1
+        while width < WINDOW:
+            count = size - width
+            numpy.left_shift(values[:count], numpy.uint64(width), out=shifted[:count])
+            numpy.add(values[width:], shifted[:count], out=values[width:])
+            width *= 2
+        return values
+
+    def iter_chunks(self, fileobj):
+        buffer = bytearray()
+        eof = False
+        while True:
+            while not eof and len(buffer) < self.max_size:
+                data = fileobj.read(self.max_size)
+                if not data:
+                    eof = True
+                buffer.extend(data)
+            if not buffer:
+                return
+            cut = self.cut_point(buffer)
+            yield bytes(buffer[:cut])
+            del buffer[:cut]
@@ -1,11 +1,13 @@
 # -*- coding: utf-8 -*-
 import logging
 import sys
+import time
 
 import click
 
+from .async_executor import AsyncTaskExecutor
 from .exception import SBackupException
-from .task_executor import TaskExecutor
+from .task_executor import TaskExecutor, split_config
 from .utils import load_config
 
 
@@ -25,7 +27,11 @@ def setup_log(ctx, param, value):
 def load_executor(ctx, param, value):
     try:
         config = load_config(value)
-        executor = TaskExecutor(config)
+        settings, _ = split_config(config)
+        if settings['engine'] == 'async':
+            executor = AsyncTaskExecutor(config)
+        else:
+            executor = TaskExecutor(config)
     except SBackupException as error:
         logger.error(error.message)
         sys.exit(2)
@@ -55,6 +61,15 @@ def choice_task(tasks):
     return tasks[tasks_position[name]]
 
 
+def get_title(task, backend_name):
+    """
+    Return a title of the task output, the destination is shown if the task has several
+    """
+    if len(task['dst_backend']) > 1:
+        return 'Task: %s (%s)' % (task['name'], backend_name)
+    return 'Task: %s' % task['name']
+
+
 # ==================================
 # click options
 
@@ -79,6 +94,26 @@ option_delete_older = click.option(
     '--older', default=30, metavar='<int>',
     help='Delete files older than n days'
 )
+option_restore_path = click.option(
+    '-p', '--path', 'paths', multiple=True,
+    help='Restore only the path, relative to the source'
+)
+option_sample = click.option(
+    '--sample', type=int, metavar='<int>',
+    help='Verify n random backups of every task'
+)
+option_time_budget = click.option(
+    '--time-budget', type=int, metavar='<seconds>',
+    help="Don't start new verifications after n seconds"
+)
+option_stale_hours = click.option(
+    '--older-than', default=24, metavar='<int>',
+    help='Abort uploads started more than n hours ago'
+)
+option_dry_run = click.option(
+    '--dry-run', is_flag=True,
+    help='Show files which will be deleted'
+)
 
 # ==================================
 # click commands
@@ -103,11 +138,10 @@ def create(debug, executor):
 def ls(debug, executor):
     """list of backups"""
     for task in executor.tasks:
-        click.echo('Task: %s' % task['name'])
-        data = task['dst_backend'].copy()
-        backend_name, backend_conf = data.popitem()
-        for item in executor.ls(backend_name, backend_conf):
-            click.echo(item)
+        for backend_name, backend_conf in task['dst_backend'].items():
+            click.echo(get_title(task, backend_name))
+            for item in executor.ls(backend_name, backend_conf, task['name']):
+                click.echo(item)
 
 
 @main.command()
@@ -115,26 +149,93 @@ def ls(debug, executor):
 @option_config
 @option_backup_file
 @option_delete_older
-def delete(debug, executor, backup_file, older):
+@option_dry_run
+def delete(debug, executor, backup_file, older, dry_run):
     """Delete backup"""
     if backup_file:
         task = choice_task(executor.tasks)
-        backend_name, backend_conf = task['dst_backend'].popitem()
-        executor.delete(backend_name, backend_conf, backup_file)
+        for backend_name, backend_conf in task['dst_backend'].items():
+            executor.delete(backend_name, backend_conf, backup_file)
     else:
         for task in executor.tasks:
-            backend = task['dst_backend'].copy()
-            backend_name, backend_conf = backend.popitem()
-            executor.delete_older(backend_name, backend_conf, older)
+            # The retention is applied to every destination separately
+            for backend_name, backend_conf in task['dst_backend'].items():
+                started = time.monotonic()
+                result, chunks = executor.delete_older(backend_name, backend_conf, older,
+                                                       dry_run=dry_run)
+                elapsed = time.monotonic() - started
+                click.echo(get_title(task, backend_name))
+                for name in result.deleted:
+                    click.echo('%s %s' % ('Will delete' if dry_run else 'Deleted', name))
+                for name, error in sorted(result.errors.items()):
+                    click.echo("Can't delete %s: %s" % (name, error))
+                click.echo('%s %s files, %s failed, %s unreferenced chunks in %.2fs' % (
+                    'Found' if dry_run else 'Deleted', len(result.deleted), len(result.errors),
+                    len(chunks), elapsed))
+
+
+@main.command()
+@option_debug
+@option_config
+@option_stale_hours
+@option_dry_run
+def cleanup(debug, executor, older_than, dry_run):
+    """abort stale unfinished uploads"""
+    for task in executor.tasks:
+        for backend_name, backend_conf in task['dst_backend'].items():
+            click.echo(get_title(task, backend_name))
+            try:
+                result = executor.abort_stale_uploads(backend_name, backend_conf, older_than,
+                                                      dry_run=dry_run)
+            except NotImplementedError:
+                click.echo('The backend has no unfinished uploads')
+                continue
+            for name in result.deleted:
+                click.echo('%s %s' % ('Will abort' if dry_run else 'Aborted', name))
+            for name, error in sorted(result.errors.items()):
+                click.echo("Can't abort %s: %s" % (name, error))
 
 
 @main.command()
 @option_debug
 @option_config
 @option_backup_file
-def restore(debug, executor, backup_file):
+@option_restore_path
+def restore(debug, executor, backup_file, paths):
     task = choice_task(executor.tasks)
-    executor.restore(task, backup_file)
+    executor.restore(task, backup_file, paths=paths)
+
+
+@main.command()
+@option_debug
+@option_config
+@option_backup_file
+@option_sample
+@option_time_budget
+def verify(debug, executor, backup_file, sample, time_budget):
+    """verify backups in the storage"""
+    tasks = [choice_task(executor.tasks)] if backup_file else executor.tasks
+    started = time.monotonic()
+    failed = 0
+    for task in tasks:
+        budget = None
+        if time_budget is not None:
+            budget = time_budget - (time.monotonic() - started)
+            if budget <= 0:
+                break
+        results = executor.verify(task, backup_file, sample=sample, time_budget=budget)
+        for backend_name, backend_results in results.items():
+            click.echo(get_title(task, backend_name))
+            for result in backend_results:
+                if result.ok:
+                    click.echo('OK %s, %s members, %s bytes in %.2fs%s' % (
+                        result.filename, result.members, result.size, result.elapsed,
+                        '' if result.checked else ', no checksums'))
+                else:
+                    failed += 1
+                    click.echo('FAILED %s: %s' % (result.filename, '; '.join(result.errors)))
+    if failed:
+        sys.exit(1)
 
 
 @main.command()
@@ -144,8 +245,11 @@ def restore(debug, executor, backup_file):
 @option_download_path
 def download(debug, executor, backup_file, dst_path):
     task = choice_task(executor.tasks)
-    backend_name, backend_conf = task['dst_backend'].popitem()
-    try:
-        executor.download(backend_name, backend_conf, backup_file, dst_path)
-    except SBackupException as error:
-        print(error.message)
+    # The first destination which has the backup
+    for backend_name, backend_conf in task['dst_backend'].items():
+        try:
+            executor.download(backend_name, backend_conf, backup_file, dst_path,
+                              encryption=task.get('encryption'))
+            break
+        except SBackupException as error:
+            print(error.message)
@@ -0,0 +1,507 @@
+# -*- coding: utf-8 -*-
+"""
+Block based compression
+
+The stream is cut into independent blocks, every block is compressed in
+a worker pool (like pigz does) and the results are written in the original
+order. Every block is a complete gzip member (zstd/lz4 frame), the
+concatenation of them is a valid stream that any reader can open.
+
+Already compressed data is stored by the store level of the codec (stored
+deflate blocks for gzip): tar members are checked by the extension, the
+magic bytes and a trial compression of a few samples, their data becomes
+separate gzip members (frames) of the block, other segments of the block
+are checked by a trial compression in the worker. Blocks keep the size
+of the uncompressed data, so the seekable index doesn't change.
+The adaptive level goes down while the writer waits for the compression
+and goes back up to the configured level while it waits for the fileobj
+(the upload).
+"""
+import collections
+import gzip
+import hashlib
+import logging
+import time
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from .exception import SBackupValidationError
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:  # pragma: no cover
+    lz4_frame = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+# Extensions of formats which are compressed already
+COMPRESSED_EXTENSIONS = frozenset((
+    '.7z', '.aac', '.avi', '.br', '.bz2', '.docx', '.flac', '.gif', '.gz', '.heic', '.jar',
+    '.jpeg', '.jpg', '.lz4', '.lzma', '.m4a', '.m4v', '.mkv', '.mov', '.mp3', '.mp4', '.odt',
+    '.ogg', '.opus', '.png', '.pptx', '.rar', '.tgz', '.txz', '.webm', '.webp', '.whl', '.woff',
+    '.woff2', '.xlsx', '.xz', '.zip', '.zst',
+))
+# (offset, magic bytes) of compressed formats
+COMPRESSED_MAGIC = (
+    (0, b'\x1f\x8b'),  # gzip
+    (0, b'\x28\xb5\x2f\xfd'),  # zstd
+    (0, b'\x04\x22\x4d\x18'),  # lz4
+    (0, b'\xfd7zXZ\x00'),  # xz
+    (0, b'BZh'),  # bzip2
+    (0, b'PK\x03\x04'),  # zip, jar, docx
+    (0, b'7z\xbc\xaf\x27\x1c'),  # 7z
+    (0, b'Rar!\x1a\x07'),  # rar
+    (0, b'\x89PNG\r\n\x1a\n'),  # png
+    (0, b'\xff\xd8\xff'),  # jpeg
+    (0, b'GIF8'),  # gif
+    (0, b'OggS'),  # ogg
+    (0, b'fLaC'),  # flac
+    (0, b'ID3'),  # mp3
+    (0, b'\x1a\x45\xdf\xa3'),  # mkv, webm
+    (4, b'ftyp'),  # mp4, mov, heic
+)
+# Compressed members closer than the gap (tar headers, the padding) are one stored segment
+MAX_GAP = 2048
+# Shorter compressed segments are not worth a separate gzip member
+MIN_STORED_SIZE = 16 * 1024
+# Samples of the trial compression and the ratio of incompressible samples
+SAMPLE_SIZE = 4096
+SAMPLES = 8
+INCOMPRESSIBLE_RATIO = 0.95
+# Blocks between changes of the adaptive level
+ADAPT_BLOCKS = 16
+
+
+def is_compressed(name, head=b''):
+    """
+    Check the extension and the magic bytes of a file
+
+    Args:
+        name(str): A file name
+        head(bytes): The first bytes of the file
+    Returns:
+        bool: True if the file is compressed already
+    """
+    extension = name[name.rfind('.'):].lower() if '.' in name else ''
+    if extension in COMPRESSED_EXTENSIONS:
+        return True
+    return any(head.startswith(magic, offset) for offset, magic in COMPRESSED_MAGIC)
+
+
+def is_incompressible(data, sample_size=SAMPLE_SIZE, samples=SAMPLES):
+    """
+    Compress a few samples of the data by the fastest zlib level, data is
+    incompressible if samples don't get smaller
+    """
+    if not data:
+        return False
+    step = max(len(data) // samples, sample_size)
+    size = compressed = 0
+    for start in range(0, len(data), step):
+        sample = data[start:start + sample_size]
+        size += len(sample)
+        compressed += len(zlib.compress(sample, 1))
+    return compressed >= size * INCOMPRESSIBLE_RATIO
+
+
+class GzipCodec(object):
+    name = 'gz'
+    extension = '.gz'
+    default_level = 6
+    levels = (0, 9)
+    # Stored deflate blocks
+    store_level = 0
+    fast_level = 1
+    skip_level = 1
+
+    @staticmethod
+    def is_available():
+        return True
+
+    @staticmethod
+    def compress(data, level):
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+
+    @staticmethod
+    def open_reader(fileobj):
+        return gzip.GzipFile(fileobj=fileobj, mode='rb')
+
+
+class ZstdCodec(object):
+    name = 'zstd'
+    extension = '.zst'
+    default_level = 3
+    levels = (1, 22)
+    # zstd stores incompressible blocks raw, only slow levels spend time on them
+    store_level = 1
+    fast_level = 1
+    skip_level = 10
+
+    @staticmethod
+    def is_available():
+        return zstandard is not None
+
+    @staticmethod
+    def compress(data, level):
+        return zstandard.ZstdCompressor(level=level).compress(data)
+
+    @staticmethod
+    def open_reader(fileobj):
+        return zstandard.ZstdDecompressor().stream_reader(fileobj, read_across_frames=True)
+
+
+class Lz4Codec(object):
+    name = 'lz4'
+    extension = '.lz4'
+    default_level = 0
+    levels = (0, 16)
+    store_level = 0
+    fast_level = 0
+    # High compression levels
+    skip_level = 3
+
+    @staticmethod
+    def is_available():
+        return lz4_frame is not None
+
+    @staticmethod
+    def compress(data, level):
+        return lz4_frame.compress(data, compression_level=level)
+
+    @staticmethod
+    def open_reader(fileobj):
+        return lz4_frame.LZ4FrameFile(fileobj, mode='rb')
+
+
+_codecs = (
+    ('gz', GzipCodec),
+    ('zstd', ZstdCodec),
+    ('lz4', Lz4Codec),
+)
+CODECS = dict(_codecs)
+
+_pools = (
+    ('thread', ThreadPoolExecutor),
+    ('process', ProcessPoolExecutor),
+)
+POOLS = dict(_pools)
+
+
+def get_codec(name):
+    """
+    Args:
+        name(str): A codec name
+    Returns:
+        A codec class
+    Raises:
+        SBackupValidationError: An error occur if the codec is unknown or isn't installed
+    """
+    if name not in CODECS:
+        raise SBackupValidationError(
+            "Unknown compression codec %s, use one of: %s" % (name, ', '.join(CODECS)))
+    codec = CODECS[name]
+    if not codec.is_available():
+        raise SBackupValidationError(
+            "The %s codec requires an extra package, run: pip install sbackup[%s]" % (name, name))
+    return codec
+
+
+def get_codec_by_filename(filename):
+    """
+    Detect a codec by the archive extension, gzip is the default
+    """
+    for codec in CODECS.values():
+        if filename.endswith(codec.extension):
+            return get_codec(codec.name)
+    return GzipCodec
+
+
+def compress_block(codec_name, level, data, stored=(), detect=False):
+    """
+    Compress the block by segments, every segment is a gzip member (a frame),
+    stored segments and incompressible ones if detect is True are written by
+    the store level of the codec
+
+    Args:
+        codec_name(str)
+        level(int)
+        data(bytes): A block
+        stored(list): Sorted (start, end) of compressed data in the block
+        detect(bool): Check other segments by a trial compression
+    Returns:
+        (data, stored_size)
+    """
+    codec = CODECS[codec_name]
+    segments = []
+    position = 0
+    for start, end in stored:
+        if start > position:
+            segments.append((position, start, False))
+        segments.append((start, end, True))
+        position = end
+    if position < len(data) or not segments:
+        segments.append((position, len(data), False))
+    stored_size = 0
+    output = []
+    for start, end, store in segments:
+        segment = data[start:end]
+        if not store and detect and level != codec.store_level:
+            store = is_incompressible(segment)
+        if store:
+            stored_size += len(segment)
+        output.append(codec.compress(segment, codec.store_level if store else level))
+    return b''.join(output), stored_size
+
+
+class ParallelCompressWriter(object):
+    """
+    A write-only file object, compresses blocks in a pool and writes them
+    in order to the fileobj
+
+    At most ``workers * 2`` blocks are waiting for the compression, so the
+    memory usage stays bounded when the fileobj is slower than the pool.
+
+    Attributes:
+       stored_bytes(int): Bytes of already compressed data which were stored
+    """
+
+    def __init__(self, fileobj, codec, level, workers=1,
+                 block_size=DEFAULT_BLOCK_SIZE, pool='thread', skip_compressed=False,
+                 adaptive=False, min_level=None):
+        self.fileobj = fileobj
+        self.codec = codec
+        self.level = level
+        self.max_level = level
+        self.min_level = codec.fast_level if min_level is None else min_level
+        self.workers = workers
+        self.block_size = block_size
+        # Fast levels of zstd and lz4 skip incompressible data themselves
+        self.skip_compressed = skip_compressed and level >= codec.skip_level
+        self.adaptive = adaptive
+        self.closed = False
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.stored_bytes = 0
+        # Offsets of compressed blocks in the fileobj
+        self.offsets = []
+        self.checksum = hashlib.sha256()
+        self._buffer = bytearray()
+        self._pending = collections.deque()
+        # (start, end) of compressed members in the stream
+        self._compressed = collections.deque()
+        self._submitted = 0
+        self._compress_wait = 0
+        self._write_time = 0
+        self._blocks = 0
+        self._executor = POOLS[pool](max_workers=workers)
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('I/O operation on closed file.')
+        self._buffer.extend(data)
+        self.bytes_in += len(data)
+        while len(self._buffer) >= self.block_size:
+            block = bytes(self._buffer[:self.block_size])
+            del self._buffer[:self.block_size]
+            self._submit(block)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def add_member(self, name, fileobj, start, size):
+        """
+        Check a member of the tar stream by the name, the magic bytes and a
+        trial compression of the head, data of a compressed file is stored
+
+        Args:
+            name(str): A member name
+            fileobj: A seekable file object of the member data
+            start(int): The offset of the member data in the stream
+            size(int): A size of the member data
+        """
+        if not self.skip_compressed or size < MIN_STORED_SIZE or not fileobj.seekable():
+            return
+        position = fileobj.tell()
+        head = fileobj.read(SAMPLE_SIZE)
+        compressed = is_compressed(name, head)
+        if not compressed and is_incompressible(head, samples=1):
+            # A random head may be a header only, the middle of the file has to be random too
+            fileobj.seek(position + size // 2)
+            compressed = is_incompressible(fileobj.read(SAMPLE_SIZE), samples=1)
+        fileobj.seek(position)
+        if not compressed:
+            return
+        if self._compressed and start - self._compressed[-1][1] <= MAX_GAP:
+            start = self._compressed.pop()[0]
+        self._compressed.append((start, start + size))
+
+    def _stored_ranges(self, block_size):
+        """
+        Return (start, end) of compressed members in the next block
+        """
+        start = self._submitted
+        end = start + block_size
+        ranges = []
+        for range_start, range_end in self._compressed:
+            if range_start >= end:
+                break
+            range_start, range_end = max(range_start, start), min(range_end, end)
+            if range_end - range_start >= MIN_STORED_SIZE:
+                ranges.append((range_start - start, range_end - start))
+        while self._compressed and self._compressed[0][1] <= end:
+            self._compressed.popleft()
+        return ranges
+
+    def _submit(self, block):
+        stored = self._stored_ranges(len(block)) if self._compressed else []
+        self._pending.append(self._executor.submit(
+            compress_block, self.codec.name, self.level, block, stored, self.skip_compressed))
+        self._submitted += len(block)
+        while len(self._pending) > self.workers * 2:
+            self._write_next()
+
+    def _write_next(self):
+        started = time.perf_counter()
+        data, stored_size = self._pending.popleft().result()
+        written = time.perf_counter()
+        self.stored_bytes += stored_size
+        self.offsets.append(self.bytes_out)
+        self.checksum.update(data)
+        self.fileobj.write(data)
+        self.bytes_out += len(data)
+        if self.adaptive:
+            self._adapt(written - started, time.perf_counter() - written)
+
+    def _adapt(self, compress_wait, write_time):
+        """
+        Lower the level if the writer waits for the compression more than
+        for the fileobj, raise it back if the compression has spare time
+        """
+        self._compress_wait += compress_wait
+        self._write_time += write_time
+        self._blocks += 1
+        if self._blocks < ADAPT_BLOCKS:
+            return
+        level = self.level
+        if self._compress_wait > self._write_time and level > self.min_level:
+            level -= 1
+        elif self._compress_wait * 4 < self._write_time and level < self.max_level:
+            level += 1
+        if level != self.level:
+            logger.debug("Change the {codec} level from {old} to {new}, compression wait: "
+                         "{wait:.3f}s, write: {write:.3f}s".format(
+                             codec=self.codec.name, old=self.level, new=level,
+                             wait=self._compress_wait, write=self._write_time))
+            self.level = level
+        self._compress_wait = self._write_time = 0
+        self._blocks = 0
+
+    def close(self):
+        """
+        Compress the rest of data, the fileobj stays opened
+        """
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if self._buffer or not self.bytes_in:
+                self._submit(bytes(self._buffer))
+                self._buffer = bytearray()
+            while self._pending:
+                self._write_next()
+        finally:
+            self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            self.closed = True
+            self._executor.shutdown(wait=True, cancel_futures=True)
+        else:
+            self.close()
+
+
+class Compressor(object):
+    """
+    Compression settings of a task
+    Attributes:
+       codec(str): gz, zstd or lz4, default is gz
+       level(int): A compression level, default depends on the codec
+       workers(int): A number of compression workers, default is 1
+       block_size(int): A size of an independent block in bytes
+       pool(str): thread or process, default is thread
+       skip_compressed(bool): Store blocks of already compressed data, default is True
+       adaptive(bool): Lower the level while the compression is slower than
+           the upload, the level is the maximum, default is False
+       min_level(int): The minimum of the adaptive level, default is the fastest level
+
+    Usage::
+
+        compressor = Compressor(codec='zstd', level=3, workers=4)
+        with open('backup.tar.zst', 'wb') as fileobj:
+            with compressor.open_writer(fileobj) as writer:
+                writer.write(data)
+
+    """
+
+    def __init__(self, codec='gz', level=None, workers=1, block_size=DEFAULT_BLOCK_SIZE,
+                 pool='thread', skip_compressed=True, adaptive=False, min_level=None):
+        self.codec = get_codec(codec)
+        self.level = self.codec.default_level if level is None else level
+        self.workers = workers
+        self.block_size = block_size
+        self.pool = pool
+        self.skip_compressed = skip_compressed
+        self.adaptive = adaptive
+        self.min_level = min_level
+
+    def validate(self):
+        min_level, max_level = self.codec.levels
+        if not isinstance(self.level, int) or not min_level <= self.level <= max_level:
+            raise SBackupValidationError(
+                "The %s level has to be from %s to %s" % (self.codec.name, min_level, max_level))
+        if not isinstance(self.workers, int) or self.workers < 1:
+            raise SBackupValidationError('The compression workers has to be a positive number')
+        if not isinstance(self.block_size, int) or self.block_size < 64 * 1024:
+            raise SBackupValidationError('The compression block_size has to be at least 64 KiB')
+        if self.pool not in POOLS:
+            raise SBackupValidationError(
+                "The compression pool has to be one of: %s" % ', '.join(POOLS))
+        for name in ('skip_compressed', 'adaptive'):
+            if not isinstance(getattr(self, name), bool):
+                raise SBackupValidationError('The compression %s has to be a boolean' % name)
+        if self.min_level is not None and (not isinstance(self.min_level, int) or
+                                           not min_level <= self.min_level <= self.level):
+            raise SBackupValidationError(
+                "The %s min_level has to be from %s to the level %s" % (
+                    self.codec.name, min_level, self.level))
+
+    @property
+    def extension(self):
+        return '.tar' + self.codec.extension
+
+    def open_writer(self, fileobj):
+        return ParallelCompressWriter(fileobj, self.codec, self.level, workers=self.workers,
+                                      block_size=self.block_size, pool=self.pool,
+                                      skip_compressed=self.skip_compressed,
+                                      adaptive=self.adaptive, min_level=self.min_level)
+
+    def open_reader(self, fileobj):
+        return self.codec.open_reader(fileobj)
+
+    def __repr__(self):
+        return "%s:%s" % (self.codec.name, self.level)
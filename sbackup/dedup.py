@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+"""
+The deduplicated storage format
+
+Files are split by the content-defined chunker, every chunk is stored once
+as ``chunks/<id[:2]>/<id>`` where the id is the SHA-256 of the chunk data.
+A snapshot is a small gzipped JSON manifest with the tree and the chunk ids
+of every file, it is stored as ``<backup name>-<time>.manifest``.
+
+A backup reuses chunks which the backend already has, so the garbage
+collection must not run at the same time. Both hold a lock object in
+``locks/`` and check for the lock of the other side after writing their own.
+"""
+import datetime
+import gzip
+import hashlib
+import json
+import logging
+import os
+import stat
+import socket
+import threading
+import time
+import uuid
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from .chunker import Chunker
+from .compress import is_incompressible
+from .exception import SBackupException
+
+logger = logging.getLogger(__name__)
+
+CHUNKS_PREFIX = 'chunks/'
+MANIFEST_EXTENSION = '.manifest'
+MANIFEST_VERSION = 1
+LOCKS_PREFIX = 'locks/'
+# A lock of a crashed process is ignored after LOCK_TTL seconds
+LOCK_TTL = 24 * 3600
+BACKUP_LOCK = 'backup'
+GC_LOCK = 'gc'
+
+
+def get_chunk_name(chunk_id):
+    return '{prefix}{dir}/{id}'.format(prefix=CHUNKS_PREFIX, dir=chunk_id[:2], id=chunk_id)
+
+
+def is_manifest(filename):
+    return filename.endswith(MANIFEST_EXTENSION)
+
+
+@contextmanager
+def hold_lock(backend, kind):
+    """
+    Put a lock object of the kind in the backend while the block runs
+
+    Usage::
+
+        with hold_lock(backend, BACKUP_LOCK):
+            if get_locks(backend, GC_LOCK):
+                ...
+
+    """
+    name = '{prefix}{kind}-{id}'.format(prefix=LOCKS_PREFIX, kind=kind, id=uuid.uuid4().hex)
+    backend.put_object(name, json.dumps({
+        'created': time.time(),
+        'host': socket.gethostname(),
+        'pid': os.getpid(),
+    }).encode('utf-8'))
+    try:
+        yield name
+    finally:
+        errors = backend.delete_objects([name])
+        for error in errors.values():
+            logger.error("Can't delete the lock %s: %s" % (name, error))
+
+
+def get_locks(backend, kind):
+    """
+    Return names of live locks of the kind, expired locks are skipped
+    """
+    prefix = '{prefix}{kind}-'.format(prefix=LOCKS_PREFIX, kind=kind)
+    locks = []
+    for name in backend.list_objects(prefix):
+        try:
+            info = json.loads(backend.get_object(name).decode('utf-8'))
+        except SBackupException:
+            # The lock was released after the listing
+            continue
+        if time.time() - info['created'] < LOCK_TTL:
+            locks.append(name)
+        else:
+            logger.warning("Ignore the expired lock %s of %s" % (name, info.get('host')))
+    return locks
+
+
+class ChunkStore(object):
+    """
+    Chunks of a backend, uploads only chunks which the backend doesn't have
+
+    Usage::
+
+        with ChunkStore(backend) as store:
+            chunk_id = store.put(data)
+        data = store.get(chunk_id)
+
+    """
+
+    def __init__(self, backend, max_concurrency=4):
+        self.backend = backend
+        self.max_concurrency = max_concurrency
+        self.uploaded_chunks = 0
+        self.uploaded_bytes = 0
+        self.reused_chunks = 0
+        self._known = None
+        self._futures = []
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._executor = None
+
+    @property
+    def known(self):
+        if self._known is None:
+            self._known = set(
+                name.rsplit('/', 1)[-1] for name in self.backend.list_objects(CHUNKS_PREFIX))
+        return self._known
+
+    def put(self, data):
+        """
+        Args:
+            data(bytes): A chunk
+        Returns:
+            chunk_id(str)
+        """
+        chunk_id = hashlib.sha256(data).hexdigest()
+        if chunk_id in self.known:
+            self.reused_chunks += 1
+            return chunk_id
+        self.known.add(chunk_id)
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+        # A chunk of compressed data is stored, zlib.decompress reads it as well
+        body = zlib.compress(data, 0 if is_incompressible(data) else zlib.Z_DEFAULT_COMPRESSION)
+        self._slots.acquire()
+        future = self._executor.submit(self.backend.put_object, get_chunk_name(chunk_id), body)
+        future.add_done_callback(lambda _: self._slots.release())
+        self._futures.append(future)
+        self.uploaded_chunks += 1
+        self.uploaded_bytes += len(body)
+        return chunk_id
+
+    def get(self, chunk_id):
+        data = zlib.decompress(self.backend.get_object(get_chunk_name(chunk_id)))
+        if hashlib.sha256(data).hexdigest() != chunk_id:
+            raise SBackupException("The chunk %s is damaged" % chunk_id)
+        return data
+
+    def flush(self):
+        """
+        Wait for the uploads, raises the first error
+        """
+        futures, self._futures = self._futures, []
+        errors = [future.exception() for future in futures]
+        for error in errors:
+            if error is not None:
+                # The chunk state is unknown, read it again next time
+                self._known = None
+                raise error
+        self.backend.flush()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def create_snapshot(entries, store, chunker=None):
+    """
+    Store files in the chunk store
+
+    Args:
+        entries: An iterable of sbackup.walker.Entry
+        store(ChunkStore)
+        chunker(sbackup.chunker.Chunker)
+    Returns:
+        manifest(dict)
+    """
+    chunker = chunker or Chunker()
+    items = []
+    for entry in entries:
+        path, info = entry.path, entry.stat
+        item = {
+            'name': entry.arcname,
+            'mode': stat.S_IMODE(info.st_mode),
+            'mtime': info.st_mtime,
+        }
+        if stat.S_ISDIR(info.st_mode):
+            item['type'] = 'dir'
+        elif stat.S_ISLNK(info.st_mode):
+            item['type'] = 'symlink'
+            item['target'] = os.readlink(path)
+        elif stat.S_ISREG(info.st_mode):
+            item['type'] = 'file'
+            item['size'] = info.st_size
+            with open(path, 'rb') as fileobj:
+                item['chunks'] = [store.put(chunk) for chunk in chunker.iter_chunks(fileobj)]
+        else:
+            logger.debug("Skip the special file %s" % path)
+            continue
+        items.append(item)
+    store.flush()
+    return {
+        'version': MANIFEST_VERSION,
+        'created': datetime.datetime.now().isoformat(),
+        'entries': items,
+    }
+
+
+def dump_manifest(manifest):
+    return gzip.compress(json.dumps(manifest).encode('utf-8'), mtime=0)
+
+
+def load_manifest(data):
+    manifest = json.loads(gzip.decompress(data).decode('utf-8'))
+    if manifest.get('version') != MANIFEST_VERSION:
+        raise SBackupException("Unsupported manifest version %s" % manifest.get('version'))
+    return manifest
+
+
+def get_chunk_ids(manifest):
+    for item in manifest['entries']:
+        for chunk_id in item.get('chunks', ()):
+            yield chunk_id
+
+
+def restore_snapshot(manifest, store, path):
+    """
+    Restore files of the manifest in the path
+
+    Args:
+        manifest(dict)
+        store(ChunkStore)
+        path(str): A destination directory
+    """
+    dirs = []
+    for item in manifest['entries']:
+        parts = item['name'].split('/')
+        if '..' in parts or os.path.isabs(item['name']):
+            logger.error("Skip the %s, it is outside of the destination" % item['name'])
+            continue
+        target = os.path.join(path, item['name'])
+        if item['type'] == 'dir':
+            os.makedirs(target, exist_ok=True)
+            dirs.append((target, item))
+            continue
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if os.path.lexists(target):
+            os.remove(target)
+        if item['type'] == 'symlink':
+            os.symlink(item['target'], target)
+            continue
+        with open(target, 'wb') as fileobj:
+            for chunk_id in item['chunks']:
+                fileobj.write(store.get(chunk_id))
+        os.chmod(target, item['mode'])
+        os.utime(target, (item['mtime'], item['mtime']))
+    # Directory times change while files are created, set them at the end
+    for target, item in reversed(dirs):
+        os.chmod(target, item['mode'])
+        os.utime(target, (item['mtime'], item['mtime']))
+
+
+def collect_garbage(backend):
+    """
+    Delete chunks that are not referenced by any manifest of the backend
+
+    Returns:
+        deleted(list): Names of deleted chunks, nothing is deleted while
+            a backup of the backend runs
+    """
+    if not next(iter(backend.list_objects(CHUNKS_PREFIX)), None):
+        return []
+    with hold_lock(backend, GC_LOCK):
+        if get_locks(backend, BACKUP_LOCK):
+            logger.warning("Skip the garbage collection, a backup of %s is running" % backend)
+            return []
+        chunks = {name.rsplit('/', 1)[-1]: name for name in backend.list_objects(CHUNKS_PREFIX)}
+        referenced = set()
+        for name in backend:
+            if is_manifest(name):
+                referenced.update(get_chunk_ids(load_manifest(backend.get_object(name))))
+        garbage = [name for chunk_id, name in chunks.items() if chunk_id not in referenced]
+        errors = backend.delete_objects(garbage)
+    for name, error in errors.items():
+        logger.error("Can't delete the chunk %s: %s" % (name, error))
+    logger.debug("Deleted %s unreferenced chunks" % (len(garbage) - len(errors)))
+    return [name for name in garbage if name not in errors]
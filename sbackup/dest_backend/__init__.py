@@ -1,12 +1,16 @@
 from .aws import S3Backend
+from .fanout import FanOutBackend
+from .local import LocalBackend
 
 __all__ = (
     'get_backend',
+    'get_destination',
     'DST_BACKEND'
 )
 
 _dst_backend = (
     ('s3', S3Backend),
+    ('local', LocalBackend),
 )
 DST_BACKEND = dict(_dst_backend)
 
@@ -14,12 +18,29 @@ DST_BACKEND = dict(_dst_backend)
 def get_backend(backend_name, backend_conf):
     """
     Args:
-        backend_name(str): A backend name
+        backend_name(str): A backend name, it may have a label after a colon ``s3:eu``
         backend_conf(dict): A backend configuration
     Returns:
         A backend instance
     Raises:
         TypeError: An error occur if configuration is incorrect
     """
-    obj = DST_BACKEND[backend_name]
+    obj = DST_BACKEND[backend_name.split(':', 1)[0]]
     return obj(**backend_conf)
+
+
+def get_destination(config):
+    """
+    Args:
+        config(dict): The dst_backend configuration, a backend name -> a backend configuration
+    Returns:
+        A backend instance, a FanOutBackend if the config has several backends
+    Raises:
+        TypeError: An error occur if configuration is incorrect
+    """
+    backends = {name: get_backend(name, conf) for name, conf in config.items()}
+    if not backends:
+        raise TypeError('The configuration has no backend')
+    if len(backends) == 1:
+        return backends.popitem()[1]
+    return FanOutBackend(backends)
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+The asyncio interface of backends
+"""
+import abc
+import asyncio
+import functools
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AsyncBackendWrapper(metaclass=abc.ABCMeta):
+    """
+        AsyncBackendWrapper, the coroutine version of the BackendWrapper
+    """
+
+    @abc.abstractmethod
+    async def upload(self, src_path, *args, **kwargs):
+        return NotImplementedError
+
+    @abc.abstractmethod
+    async def download(self, src_filename, dst_dir, *args, **kwargs):
+        return NotImplementedError
+
+    @abc.abstractmethod
+    async def ls(self):
+        return NotImplementedError
+
+    @abc.abstractmethod
+    async def delete(self, filename):
+        return NotImplementedError
+
+    @abc.abstractmethod
+    async def delete_older(self, retention_date, dry_run=False, **kwargs):
+        return NotImplementedError
+
+    @abc.abstractmethod
+    async def get_last_backup(self, *args, **kwargs):
+        return NotImplementedError
+
+
+class ThreadedAsyncBackend(AsyncBackendWrapper):
+    """
+    Runs methods of a blocking backend in a thread pool, boto3 has no
+    asyncio API, so the event loop only waits for the threads
+
+    Usage::
+
+        backend = ThreadedAsyncBackend(S3Backend('mykey', 'mysecretkey', 'mybucket'))
+        await backend.upload('/tmp/my_file.csv')
+        names = await backend.ls()
+
+    """
+
+    def __init__(self, backend, executor=None, max_workers=4):
+        self.backend = backend
+        self._own_executor = executor is None
+        self.executor = executor or ThreadPoolExecutor(max_workers=max_workers)
+
+    async def _run(self, method, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, functools.partial(method, *args, **kwargs))
+
+    async def validate(self):
+        return await self._run(self.backend.validate)
+
+    async def upload(self, src_path, *args, **kwargs):
+        return await self._run(self.backend.upload, src_path, *args, **kwargs)
+
+    async def download(self, src_filename, dst_dir, *args, **kwargs):
+        return await self._run(self.backend.download, src_filename, dst_dir, *args, **kwargs)
+
+    async def ls(self):
+        return await self._run(list, self.backend)
+
+    async def delete(self, filename):
+        return await self._run(self.backend.delete, filename)
+
+    async def delete_older(self, retention_date, dry_run=False, **kwargs):
+        return await self._run(self.backend.delete_older, retention_date, dry_run=dry_run,
+                               **kwargs)
+
+    async def get_last_backup(self, *args, **kwargs):
+        return await self._run(self.backend.get_last_backup, *args, **kwargs)
+
+    def close(self):
+        if self._own_executor:
+            self.executor.shutdown(wait=True)
+
+    def __repr__(self):
+        return repr(self.backend)
@@ -1,20 +1,60 @@
 # -*- coding: utf-8 -*-
+import collections
+import datetime
 import logging
 import os
+import threading
 
+from concurrent.futures import ThreadPoolExecutor
 from boto3 import Session
 from boto3.exceptions import S3UploadFailedError
-from botocore.exceptions import ClientError
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import BotoCoreError, ClientError
 from urllib.parse import urljoin
 
 from sbackup.exception import (
     SBackupValidationError,
     SBackupException
 )
-from .base import BackendWrapper, validated
+from sbackup.utils import get_backup_name, parse_size
+from .base import BackendWrapper, DeleteResult, validated
+from .catalog import Catalog, DEFAULT_TTL as DEFAULT_CATALOG_TTL
+from .journal import UploadJournal
+from .transfer import Progress, Retry, Throttle, iter_ordered
 
 logger = logging.getLogger(__name__)
 
+# DeleteObjects accepts up to 1000 keys
+DELETE_BATCH_SIZE = 1000
+DEFAULT_DELETE_WORKERS = 4
+# S3 rejects multipart parts smaller than 5 MiB (except the last one)
+MIN_PART_SIZE = 5 * 1024 * 1024
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+MAX_PART_SIZE = 5 * 1024 * 1024 * 1024
+MAX_PARTS = 10000
+# The part size of a stream of unknown size doubles every PART_SIZE_STEP parts
+PART_SIZE_STEP = 1000
+DEFAULT_MAX_CONCURRENCY = 4
+# The keys of the transfer settings
+TRANSFER_SIZES = ('multipart_threshold', 'multipart_chunksize', 'max_bandwidth')
+TRANSFER_NUMBERS = ('max_concurrency', 'num_download_attempts')
+# Listings return up to 1000 keys by a request
+LIST_PAGE_SIZE = 1000
+# Pages of a partition listed ahead of the consumer
+LIST_QUEUE_SIZE = 2
+# Backups are named backup-<task>-<date>, their listings are split by tasks and parts of dates
+BACKUP_PREFIX = get_backup_name('')
+BACKUP_DELIMITER = '-'
+MAX_PARTITION_DEPTH = 3
+# A key after all keys of a prefix
+LAST_CHAR = '\U0010ffff'
+# Errors of an overloaded S3, a request may succeed later
+RETRYABLE_ERRORS = ('SlowDown', 'RequestTimeout', 'Throttling', 'ThrottlingException',
+                    'InternalError', 'ServiceUnavailable')
+
+
+ListedObject = collections.namedtuple('ListedObject', ('key', 'last_modified', 'size'))
+
 
 def safe_join(base_path, *paths):
     """
@@ -48,6 +88,370 @@ class S3BackendException(SBackupException):
     pass
 
 
+def is_retryable(error):
+    """
+    Network errors, throttling and 5xx responses are retried
+    """
+    if not isinstance(error, ClientError):
+        return True
+    status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode') or 0
+    return status >= 500 or error.response['Error'].get('Code') in RETRYABLE_ERRORS
+
+
+def _call(func, *args, **kwargs):
+    return func(*args, **kwargs)
+
+
+class S3MultipartWriter(object):
+    """
+    A write-only file object that streams data to S3 as a multipart upload
+
+    Data is collected in an in-memory buffer, every full part is handed to
+    a thread pool, so the producer and the upload work at the same time.
+    The producer is blocked while ``max_concurrency`` parts are in flight,
+    the peak memory usage is about ``(max_concurrency + 1) * part_size``.
+    The ``on_state`` callback receives the upload id and completed parts
+    after every part, a resumed writer skips parts which S3 already has.
+
+    S3 accepts at most ``MAX_PARTS`` parts. The part size of a stream with
+    a known ``expected_size`` is fixed to fit into this limit, otherwise it
+    doubles every ``PART_SIZE_STEP`` parts, so 8MB parts reach about 8TB.
+
+    Usage::
+
+        with S3MultipartWriter(client, 'mybucket', 'backup.tar.gz') as fileobj:
+            fileobj.write(data)
+
+    """
+
+    def __init__(self, client, bucket_name, key, part_size=DEFAULT_PART_SIZE,
+                 max_concurrency=DEFAULT_MAX_CONCURRENCY, throttle=None, callback=None,
+                 retry=None, progress=None, on_state=None, abort_on_error=True,
+                 expected_size=None):
+        self.client = client
+        self.throttle = throttle
+        self.callback = callback
+        self.retry = retry or _call
+        self.progress = progress
+        self.on_state = on_state
+        self.abort_on_error = abort_on_error
+        self.bucket_name = bucket_name
+        self.key = key
+        self.part_size = max(int(part_size), MIN_PART_SIZE)
+        self.expected_size = expected_size
+        if expected_size is not None:
+            self.part_size = max(self.part_size, -(-int(expected_size) // MAX_PARTS))
+        self.max_concurrency = max(int(max_concurrency), 1)
+        self.upload_id = None
+        self.closed = False
+        self.bytes_written = 0
+        self._buffer = bytearray()
+        self._part_number = 0
+        self._parts = {}
+        self._futures = []
+        self._slots = threading.BoundedSemaphore(self.max_concurrency)
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('I/O operation on closed file.')
+        self._buffer.extend(data)
+        self.bytes_written += len(data)
+        while len(self._buffer) >= self.part_size:
+            part = bytes(self._buffer[:self.part_size])
+            del self._buffer[:self.part_size]
+            self._submit_part(part)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def _start(self):
+        try:
+            response = self.client.create_multipart_upload(
+                Bucket=self.bucket_name, Key=self.key)
+        except ClientError as error:
+            logger.debug("Can't create a multipart upload", exc_info=True)
+            raise S3BackendException("Can't start an upload: %s" % error)
+        self.upload_id = response['UploadId']
+        self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+        logger.debug("Start the multipart upload %s for %s" % (self.upload_id, self.key))
+        self._save_state()
+
+    def _save_state(self):
+        if self.on_state:
+            with self._lock:
+                self.on_state(self.upload_id, dict(self._parts))
+
+    def resume(self, upload_id, parts):
+        """
+        Continue the multipart upload
+
+        Args:
+            upload_id(str)
+            parts(dict): Part numbers and ETags of completed parts
+        """
+        self.upload_id = upload_id
+        self._parts = dict(parts)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+        logger.debug("Resume the multipart upload %s for %s, %s parts are uploaded" % (
+            upload_id, self.key, len(parts)))
+
+    def skip(self, size):
+        """
+        Count the next part as uploaded, the producer doesn't send its data
+        """
+        if self._buffer:
+            raise ValueError("Can't skip a part after a partial part")
+        self._next_part()
+        self.bytes_written += size
+        if self.progress:
+            self.progress.update(size)
+
+    def _submit_part(self, data):
+        if self.upload_id is None:
+            self._start()
+        self._check_errors()
+        self._next_part()
+        self._slots.acquire()
+        future = self._executor.submit(self._upload_part, self._part_number, data)
+        future.add_done_callback(lambda _: self._slots.release())
+        self._futures.append(future)
+
+    def _next_part(self):
+        if self._part_number >= MAX_PARTS:
+            raise S3BackendException(
+                "The upload of %s exceeds the limit of %s parts after %s bytes, "
+                "increase the multipart_chunksize" % (self.key, MAX_PARTS, self.bytes_written))
+        self._part_number += 1
+        if self.expected_size is None and self._part_number % PART_SIZE_STEP == 0:
+            self.part_size = min(self.part_size * 2, MAX_PART_SIZE)
+
+    def _upload_part(self, part_number, data):
+        if self.throttle:
+            self.throttle.consume(len(data))
+        response = self.retry(
+            self.client.upload_part,
+            Bucket=self.bucket_name,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            Body=data
+        )
+        with self._lock:
+            self._parts[part_number] = response['ETag']
+        self._save_state()
+        if self.progress:
+            self.progress.update(len(data))
+
+    def _check_errors(self):
+        for future in [item for item in self._futures if item.done()]:
+            self._futures.remove(future)
+            error = future.exception()
+            if error is not None:
+                raise S3BackendException("Can't upload a part of %s: %s" % (self.key, error))
+
+    def _wait(self):
+        futures, self._futures = self._futures, []
+        errors = [future.exception() for future in futures]
+        self._executor.shutdown(wait=True)
+        for error in errors:
+            if error is not None:
+                raise S3BackendException("Can't upload a part of %s: %s" % (self.key, error))
+
+    def close(self):
+        """
+        Upload the rest of the buffer and complete the upload
+        """
+        if self.closed:
+            return
+        self.closed = True
+        if self.upload_id is None:
+            # The whole stream fits into one part
+            try:
+                self.client.put_object(Bucket=self.bucket_name, Key=self.key,
+                                       Body=bytes(self._buffer))
+            except ClientError as error:
+                logger.debug("Can't upload file to S3", exc_info=True)
+                raise S3BackendException("%s" % error)
+            finally:
+                self._buffer = bytearray()
+            self._done()
+            return
+        try:
+            if self._buffer:
+                self._submit_part(bytes(self._buffer))
+                self._buffer = bytearray()
+            self._wait()
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket_name,
+                Key=self.key,
+                UploadId=self.upload_id,
+                MultipartUpload={'Parts': [
+                    {'ETag': self._parts[number], 'PartNumber': number}
+                    for number in sorted(self._parts)
+                ]}
+            )
+        except Exception as error:
+            if self.abort_on_error:
+                self.abort()
+            else:
+                self.suspend()
+            if isinstance(error, S3BackendException):
+                raise
+            raise S3BackendException("Can't complete the upload of %s: %s" % (self.key, error))
+        self._done()
+
+    def _done(self):
+        if self.progress:
+            self.progress.finish()
+        if self.callback:
+            self.callback(self.bytes_written)
+
+    def suspend(self):
+        """
+        Wait for parts in flight, the upload stays in S3 and may be resumed
+        """
+        self.closed = True
+        self._buffer = bytearray()
+        if self._executor:
+            self._executor.shutdown(wait=True)
+
+    def abort(self):
+        """
+        Abort the upload, S3 drops all uploaded parts
+        """
+        self.closed = True
+        self._buffer = bytearray()
+        if self.upload_id is None:
+            return
+        if self._executor:
+            self._executor.shutdown(wait=True)
+        try:
+            self.client.abort_multipart_upload(
+                Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id)
+        except ClientError:
+            logger.error("Can't abort the multipart upload %s" % self.upload_id, exc_info=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+
+class S3RangeReader(object):
+    """
+    A read-only file object that downloads an S3 object by ranged GETs
+
+    Parts are downloaded by a thread pool ahead of the consumer, at most
+    ``max_concurrency`` parts are in flight, so the download and the
+    decompression work at the same time with bounded memory. The ETag pins
+    the object version, a replaced object fails the read.
+
+    Usage::
+
+        with S3RangeReader(client, 'mybucket', 'backup.tar.gz', size) as fileobj:
+            data = fileobj.read(1024)
+
+    """
+
+    def __init__(self, client, bucket_name, key, size, etag=None, part_size=DEFAULT_PART_SIZE,
+                 max_concurrency=DEFAULT_MAX_CONCURRENCY, throttle=None, retry=None, progress=None):
+        self.client = client
+        self.retry = retry or _call
+        self.progress = progress
+        self.bucket_name = bucket_name
+        self.key = key
+        self.size = size
+        self.etag = etag
+        self.part_size = max(int(part_size), 1)
+        self.max_concurrency = max(int(max_concurrency), 1)
+        self.throttle = throttle
+        self.closed = False
+        self.bytes_read = 0
+        self._offset = 0
+        self._buffer = b''
+        self._position = 0
+        self._futures = collections.deque()
+        self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+
+    def readable(self):
+        return True
+
+    def _get_range(self, start, end):
+        options = {'IfMatch': self.etag} if self.etag else {}
+        data = self.retry(self._read, start, end, **options)
+        if self.throttle:
+            self.throttle.consume(len(data))
+        if self.progress:
+            self.progress.update(len(data))
+        return data
+
+    def _read(self, start, end, **options):
+        response = self.client.get_object(Bucket=self.bucket_name, Key=self.key,
+                                          Range='bytes=%d-%d' % (start, end), **options)
+        return response['Body'].read()
+
+    def _fill(self):
+        while len(self._futures) < self.max_concurrency and self._offset < self.size:
+            end = min(self._offset + self.part_size, self.size) - 1
+            self._futures.append(self._executor.submit(self._get_range, self._offset, end))
+            self._offset = end + 1
+
+    def _next_part(self):
+        self._fill()
+        if not self._futures:
+            return False
+        future = self._futures.popleft()
+        self._fill()
+        try:
+            self._buffer = future.result()
+        except ClientError as error:
+            logger.debug("Can't download a part", exc_info=True)
+            raise S3BackendException("Can't download a part of %s: %s" % (self.key, error))
+        self._position = 0
+        return True
+
+    def read(self, size=-1):
+        if self.closed:
+            raise ValueError('I/O operation on closed file.')
+        chunks = []
+        while size != 0:
+            if self._position >= len(self._buffer) and not self._next_part():
+                break
+            end = len(self._buffer) if size < 0 else min(self._position + size, len(self._buffer))
+            chunk = self._buffer[self._position:end]
+            self._position = end
+            chunks.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+        data = b''.join(chunks)
+        self.bytes_read += len(data)
+        return data
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._buffer = b''
+        self._futures.clear()
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
 class S3Backend(BackendWrapper):
     """
     The S3 Backend
@@ -55,6 +459,13 @@ class S3Backend(BackendWrapper):
        access_key_id(basestring): YOUR_ACCESS_KEY
        secret_access_key(basestring): YOUR_SECRET_KEY
        bucket(basestring): A bucket name
+       location(basestring): A path in the bucket
+       transfer(dict): multipart_threshold, multipart_chunksize, max_concurrency,
+           max_bandwidth (bytes per second), sizes may have units: 64MB
+       endpoint_url(basestring): An URL of a S3 compatible storage
+       catalog(dict): Cache the list of backups locally: ttl (seconds), path (a directory)
+       resume(dict): Journal multipart uploads of files in a local directory (path),
+           an interrupted upload continues from its completed parts
 
     Usage::
 
@@ -69,6 +480,10 @@ class S3Backend(BackendWrapper):
         ## Upload a file to S3
         s3.upload('/tmp/my_file.csv')
 
+        ## Stream data to S3
+        with s3.open_writer('my_file.csv') as fileobj:
+            fileobj.write(data)
+
         ## Download a file from S3
         s3.download('my_file.csv', '/tmp')
 
@@ -78,10 +493,12 @@ class S3Backend(BackendWrapper):
     """
 
     def __init__(self, access_key_id, secret_access_key, bucket,
-                 location='', *args, **kwargs):
+                 location='', transfer=None, endpoint_url=None, catalog=None, resume=None,
+                 *args, **kwargs):
         self.access_key_id = access_key_id
         self.secret_access_key = secret_access_key
         self.bucket_name = bucket
+        self.endpoint_url = endpoint_url
         self._session = Session(
             aws_access_key_id=self.access_key_id,
             aws_secret_access_key=self.secret_access_key
@@ -89,23 +506,74 @@ class S3Backend(BackendWrapper):
         self.is_validated = False
         self._bucket = None
         self.location = (location or '').lstrip('/')
+        self.transfer_config = self.get_transfer_config(transfer or {})
+        max_bandwidth = self.transfer_config.max_bandwidth
+        self.throttle = Throttle(max_bandwidth) if max_bandwidth else None
+        self.retry = Retry(attempts=self.transfer_config.num_download_attempts,
+                           exceptions=(ClientError, BotoCoreError), is_retryable=is_retryable)
+        self.list_requests = 0
+        self._list_lock = threading.Lock()
+        self.catalog = None
+        if catalog:
+            settings = catalog if isinstance(catalog, dict) else {}
+            self.catalog = Catalog.for_location(self.bucket_name, self.location,
+                                                ttl=settings.get('ttl', DEFAULT_CATALOG_TTL),
+                                                directory=settings.get('path'))
+        self.journal = None
+        self.resumable = bool(resume)
+        if resume:
+            settings = resume if isinstance(resume, dict) else {}
+            self.journal = UploadJournal(settings.get('path'))
+
+    @staticmethod
+    def get_transfer_config(settings):
+        """
+        Args:
+            settings(dict): The transfer settings of the backend
+        Returns:
+            boto3.s3.transfer.TransferConfig
+        Raises:
+            SBackupValidationError
+        """
+        options = {}
+        for key, value in settings.items():
+            try:
+                if key in TRANSFER_SIZES:
+                    options[key] = parse_size(value)
+                elif key in TRANSFER_NUMBERS:
+                    options[key] = int(value)
+                else:
+                    raise SBackupValidationError("Unknown transfer setting %s" % key)
+            except (SBackupException, ValueError) as error:
+                raise SBackupValidationError("Incorrect transfer setting %s: %s" % (key, error))
+            if options[key] <= 0:
+                raise SBackupValidationError("The transfer setting %s has to be positive" % key)
+        if options.get('multipart_chunksize', MIN_PART_SIZE) < MIN_PART_SIZE:
+            raise SBackupValidationError("The multipart_chunksize has to be at least 5MB")
+        return TransferConfig(**options)
+
+    def _get_resource(self):
+        if self.endpoint_url:
+            return self._session.resource('s3', endpoint_url=self.endpoint_url)
+        return self._session.resource('s3')
 
     @property
     def bucket(self):
         if self._bucket:
             return self._bucket
-        self._bucket = self._session.resource('s3').Bucket(self.bucket_name)
+        self._bucket = self._get_resource().Bucket(self.bucket_name)
         return self._bucket
 
     def validate(self):
         try:
-            self._session.client('sts').get_caller_identity()
+            if not self.endpoint_url:
+                self._session.client('sts').get_caller_identity()
         except ClientError as error:
             raise SBackupValidationError(
                 "Can't connect to AWS, error: %s" % error
             )
         try:
-            s3 = self._session.resource('s3')
+            s3 = self._get_resource()
             s3.meta.client.head_bucket(Bucket=self.bucket_name)
         except ClientError as error:
             logger.error('Failed to connect to S3', exc_info=True)
@@ -154,16 +622,239 @@ class S3Backend(BackendWrapper):
             raise S3BackendException("Can't find a path")
         filename = os.path.basename(src_path)
         name = self._normalize_name(filename)
+        if self.journal and os.path.getsize(src_path) >= self.transfer_config.multipart_threshold:
+            self._upload_resumable(src_path, filename, name)
+            return
         try:
             logger.debug("Start uploading the %s to S3" % filename)
-            self.bucket.upload_file(src_path, name)
+            progress = Progress(filename, total=os.path.getsize(src_path))
+            self.bucket.upload_file(src_path, name, Config=self.transfer_config,
+                                    Callback=progress.update)
+            progress.finish()
         except S3UploadFailedError as error:
             logger.debug("Can't upload file to S3", exc_info=True)
             raise S3BackendException("%s" % error)
+        self._add_to_catalog(filename, os.path.getsize(src_path))
+
+    def _list_parts(self, key, upload_id):
+        """
+        Return part numbers and ETags of uploaded parts, None if the upload doesn't exist
+        """
+        client = self.bucket.meta.client
+        parts = {}
+        kwargs = {}
+        try:
+            while True:
+                response = client.list_parts(Bucket=self.bucket_name, Key=key,
+                                             UploadId=upload_id, **kwargs)
+                for part in response.get('Parts', []):
+                    parts[part['PartNumber']] = (part['ETag'], part['Size'])
+                if not response.get('IsTruncated'):
+                    return parts
+                kwargs['PartNumberMarker'] = response['NextPartNumberMarker']
+        except ClientError as error:
+            if error.response['Error']['Code'] == 'NoSuchUpload':
+                return None
+            raise S3BackendException("Can't list parts of the upload %s: %s" % (upload_id, error))
+
+    def _get_resumable_parts(self, src_path, key, stat, part_size):
+        """
+        Return the upload id and completed parts of the journal record of the file,
+        uploads of another version of the file are aborted
+        """
+        record = self.journal.load(self.bucket_name, key)
+        if record is None:
+            return None, {}
+        if (record['path'], record['size'], record['mtime'], record['part_size']) != (
+                os.path.abspath(src_path), stat.st_size, stat.st_mtime, part_size):
+            logger.info("The file of the upload %s changed, it starts again" % record['upload_id'])
+            self._abort_upload(key, record['upload_id'])
+            return None, {}
+        uploaded = self._list_parts(key, record['upload_id'])
+        if uploaded is None:
+            self.journal.remove(self.bucket_name, key)
+            return None, {}
+        parts = {}
+        for number, (etag, size) in uploaded.items():
+            # Only whole parts of the file, the last one may be shorter
+            expected = min(part_size, stat.st_size - (number - 1) * part_size)
+            if size == expected:
+                parts[number] = etag
+        return record['upload_id'], parts
+
+    def _upload_resumable(self, src_path, filename, key):
+        stat = os.stat(src_path)
+        # Parts of a big file grow to fit into the part limit, the journal keeps the size
+        part_size = max(self.transfer_config.multipart_chunksize, -(-stat.st_size // MAX_PARTS))
+        upload_id, parts = self._get_resumable_parts(src_path, key, stat, part_size)
+        record = {
+            'bucket': self.bucket_name,
+            'key': key,
+            'path': os.path.abspath(src_path),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'part_size': part_size,
+        }
+
+        def save(upload_id, parts):
+            self.journal.save(dict(record, upload_id=upload_id, parts=parts))
+
+        progress = Progress(filename, total=stat.st_size)
+        writer = S3MultipartWriter(
+            self.bucket.meta.client, self.bucket_name, key,
+            part_size=part_size,
+            max_concurrency=self.transfer_config.max_concurrency,
+            throttle=self.throttle,
+            callback=lambda size: self._add_to_catalog(filename, size),
+            retry=self.retry,
+            progress=progress,
+            on_state=save,
+            abort_on_error=False,
+            expected_size=stat.st_size
+        )
+        if upload_id:
+            writer.resume(upload_id, parts)
+            logger.info("Resume the upload of %s, %s of %s bytes are uploaded" % (
+                filename, sum(min(part_size, stat.st_size - (number - 1) * part_size)
+                              for number in parts), stat.st_size))
+        try:
+            with open(src_path, 'rb') as fileobj:
+                number = 0
+                for offset in range(0, stat.st_size, part_size):
+                    number += 1
+                    size = min(part_size, stat.st_size - offset)
+                    if number in parts:
+                        writer.skip(size)
+                        fileobj.seek(size, os.SEEK_CUR)
+                    else:
+                        writer.write(fileobj.read(size))
+        except BaseException:
+            writer.suspend()
+            raise
+        writer.close()
+        self.journal.remove(self.bucket_name, key)
+
+    def _abort_upload(self, key, upload_id):
+        try:
+            self.bucket.meta.client.abort_multipart_upload(
+                Bucket=self.bucket_name, Key=key, UploadId=upload_id)
+        except ClientError as error:
+            if error.response['Error']['Code'] != 'NoSuchUpload':
+                raise S3BackendException("Can't abort the upload %s: %s" % (upload_id, error))
+        if self.journal:
+            self.journal.remove(self.bucket_name, key)
+
+    def get_pending_uploads(self):
+        """
+        Return local paths of files whose uploads were interrupted in the location
+        """
+        if not self.journal:
+            return []
+        location = self._get_location()
+        return [record['path'] for record in self.journal
+                if record['bucket'] == self.bucket_name and record['key'].startswith(location) and
+                os.path.isfile(record['path'])]
+
+    def get_retries(self):
+        return self.retry.retries
+
+    def abort_stale_uploads(self, older_than, dry_run=False):
+        """
+        Abort multipart uploads in the location which were started before the older_than,
+        S3 keeps and bills parts of unfinished uploads until they are aborted
+
+        Args:
+            older_than(datetime.datetime): An aware datetime
+            dry_run(bool): Only find uploads
+        Returns:
+            DeleteResult: Keys of aborted uploads
+        """
+        location = self._get_location()
+        paginator = self.bucket.meta.client.get_paginator('list_multipart_uploads')
+        stale = []
+        try:
+            for page in paginator.paginate(Bucket=self.bucket_name, Prefix=location):
+                for upload in page.get('Uploads', []):
+                    if upload['Initiated'] < older_than:
+                        stale.append((upload['Key'], upload['UploadId']))
+        except ClientError as error:
+            logger.debug("Can't list multipart uploads", exc_info=True)
+            raise S3BackendException("Can't list multipart uploads: %s" % error)
+        names = ['%s (%s)' % (key[len(location):], upload_id) for key, upload_id in stale]
+        if dry_run:
+            return DeleteResult(deleted=names, dry_run=True)
+        deleted = []
+        errors = {}
+        for name, (key, upload_id) in zip(names, stale):
+            try:
+                self._abort_upload(key, upload_id)
+            except S3BackendException as error:
+                errors[name] = '%s' % error
+            else:
+                deleted.append(name)
+        return DeleteResult(deleted=deleted, errors=errors)
+
+    def open_writer(self, filename, part_size=None, max_concurrency=None):
+        """
+        Open a file object which streams data to S3
+        Args:
+            filename(basestring): A file name
+            part_size(int): A size of the multipart upload part,
+                default is the multipart_chunksize setting
+            max_concurrency(int): A number of parts uploaded at the same time,
+                default is the max_concurrency setting
+        Returns:
+            S3MultipartWriter
+        """
+        name = self._normalize_name(filename)
+        logger.debug("Start streaming the %s to S3" % filename)
+        return S3MultipartWriter(
+            self.bucket.meta.client, self.bucket_name, name,
+            part_size=part_size or self.transfer_config.multipart_chunksize,
+            max_concurrency=max_concurrency or self.transfer_config.max_concurrency,
+            throttle=self.throttle,
+            callback=lambda size: self._add_to_catalog(filename, size),
+            retry=self.retry,
+            progress=Progress(filename)
+        )
+
+    def open_reader(self, filename, part_size=None, max_concurrency=None):
+        """
+        Open a file object which downloads the file by parallel ranged GETs
+        Args:
+            filename(basestring): A file name
+            part_size(int): A size of a range, default is the multipart_chunksize setting
+            max_concurrency(int): A number of ranges downloaded ahead,
+                default is the max_concurrency setting
+        Returns:
+            S3RangeReader
+        Raises:
+            S3BackendException
+        """
+        name = self._normalize_name(filename)
+        client = self.bucket.meta.client
+        try:
+            response = client.head_object(Bucket=self.bucket_name, Key=name)
+        except ClientError as error:
+            logger.debug("Can't get an object from S3", exc_info=True)
+            if error.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                raise S3BackendException("The file %s does not exist" % filename)
+            raise S3BackendException("Can't download the file %s, error: %s" % (filename, error))
+        logger.debug("Start streaming the %s from S3" % filename)
+        return S3RangeReader(
+            client, self.bucket_name, name, response['ContentLength'],
+            etag=response.get('ETag'),
+            part_size=part_size or self.transfer_config.multipart_chunksize,
+            max_concurrency=max_concurrency or self.transfer_config.max_concurrency,
+            throttle=self.throttle,
+            retry=self.retry,
+            progress=Progress(filename, total=response['ContentLength'])
+        )
 
     def download(self, src_filename, dst_dir, dst_filename=None, **kwargs):
         """
-        Download item from AWS
+        Download item from AWS, objects bigger than multipart_threshold
+        are downloaded by parallel ranged GETs of multipart_chunksize bytes
         Args:
             src_filename(basestring): A source file name
             dst_dir(basestring): A dst dir
@@ -185,7 +876,7 @@ class S3Backend(BackendWrapper):
         name = self._normalize_name(src_filename)
         try:
             logger.debug("Start download the %s" % src_filename)
-            self.bucket.download_file(name, dst_path)
+            self.bucket.download_file(name, dst_path, Config=self.transfer_config)
         except ClientError as error:
             logger.debug("Can't download file from S3", exc_info=True)
             error_code = int(error.response['Error']['Code'])
@@ -199,23 +890,248 @@ class S3Backend(BackendWrapper):
                 )
         return dst_path
 
+    def put_object(self, name, data):
+        key = self._normalize_name(name)
+        try:
+            self.bucket.put_object(Key=key, Body=data)
+        except ClientError as error:
+            logger.debug("Can't put an object to S3", exc_info=True)
+            raise S3BackendException("Can't put the object %s: %s" % (name, error))
+        self._add_to_catalog(name, len(data))
+
+    def get_object(self, name):
+        key = self._normalize_name(name)
+        try:
+            return self.bucket.Object(key).get()['Body'].read()
+        except ClientError as error:
+            logger.debug("Can't get an object from S3", exc_info=True)
+            if error.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                raise S3BackendException("The file %s does not exist" % name)
+            raise S3BackendException("Can't get the object %s: %s" % (name, error))
+
+    def read_range(self, name, start, end):
+        key = self._normalize_name(name)
+        try:
+            data = self.retry(self._read_range, key, start, end)
+        except ClientError as error:
+            logger.debug("Can't get an object from S3", exc_info=True)
+            if error.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                raise S3BackendException("The file %s does not exist" % name)
+            raise S3BackendException("Can't get the object %s: %s" % (name, error))
+        if self.throttle:
+            self.throttle.consume(len(data))
+        return data
+
+    def _read_range(self, key, start, end):
+        return self.bucket.Object(key).get(Range='bytes=%d-%d' % (start, end - 1))['Body'].read()
+
+    def _list_pages(self, prefix, delimiter=None, start_after=None):
+        """
+        Yields pages of the listing lazily, a page is a list of ListedObject and
+        a list of common prefixes, keys below the delimiter are grouped by S3
+        """
+        client = self.bucket.meta.client
+        params = {'Bucket': self.bucket_name, 'Prefix': prefix, 'MaxKeys': LIST_PAGE_SIZE}
+        if delimiter:
+            params['Delimiter'] = delimiter
+        if start_after:
+            params['StartAfter'] = start_after
+        while True:
+            try:
+                response = self.retry(client.list_objects_v2, **params)
+            except (ClientError, BotoCoreError) as error:
+                logger.debug("Can't get objects from S3", exc_info=True)
+                raise S3BackendException("%s" % error)
+            with self._list_lock:
+                self.list_requests += 1
+            yield ([ListedObject(item['Key'], item['LastModified'], item['Size'])
+                    for item in response.get('Contents', ())],
+                   [item['Prefix'] for item in response.get('CommonPrefixes', ())])
+            if not response.get('IsTruncated'):
+                return
+            params['ContinuationToken'] = response['NextContinuationToken']
+
+    def _discover(self, prefix, delimiter):
+        """
+        Return keys without the delimiter and common prefixes under the prefix,
+        None if there are more than a page of such keys
+        """
+        found = []
+        keys = 0
+        for objects, prefixes in self._list_pages(prefix, delimiter):
+            keys += len(objects)
+            if keys > LIST_PAGE_SIZE:
+                return None
+            found.extend(objects)
+            found.extend(prefixes)
+        return found
+
+    def _split(self, prefix, delimiter, depth=MAX_PARTITION_DEPTH):
+        """
+        Split the key space of the prefix into partitions by the delimiter,
+        partitions are split again while they are fewer than max_concurrency
+
+        Returns:
+            parts(list): Sorted ListedObject and prefixes
+        """
+        parts = [prefix]
+        final = set()
+        for _ in range(depth):
+            prefixes = [part for part in parts if isinstance(part, str) and part not in final]
+            if not prefixes or len([part for part in parts if isinstance(part, str)]) >= \
+                    self.transfer_config.max_concurrency:
+                break
+            split = [part for part in parts if part not in prefixes]
+            for part in prefixes:
+                found = self._discover(part, delimiter)
+                if found is None:
+                    final.add(part)
+                    split.append(part)
+                else:
+                    split.extend(found)
+            parts = split
+        return sorted(parts, key=lambda part: part if isinstance(part, str) else part.key)
+
+    def _iter_parts(self, parts, delimiter=None):
+        """
+        Yields pages of objects of the parts in order, prefixes are listed
+        by max_concurrency threads
+        """
+        def listing(prefix):
+            return lambda: (objects for objects, _ in self._list_pages(prefix, delimiter))
+
+        functions = []
+        keys = []
+        for part in parts:
+            if not isinstance(part, str):
+                keys.append(part)
+                continue
+            if keys:
+                functions.append(lambda keys=keys: iter([keys]))
+                keys = []
+            functions.append(listing(part))
+        if keys:
+            functions.append(lambda keys=keys: iter([keys]))
+        if len(functions) == 1:
+            return functions[0]()
+        return iter_ordered(functions, max_workers=self.transfer_config.max_concurrency,
+                            queue_size=LIST_QUEUE_SIZE)
+
+    def list_objects(self, prefix):
+        """
+        Yields names of all objects under the prefix, sub directories of the
+        prefix (chunks/00/ ... chunks/ff/) are listed in parallel
+        """
+        location = self._get_location()
+        parts = self._split(location + prefix, '/', depth=1) if prefix.endswith('/') else \
+            [location + prefix]
+        for objects in self._iter_parts(parts):
+            for item in objects:
+                yield item.key[len(location):]
+
+    def _delete_batch(self, names):
+        keys = {self._normalize_name(name): name for name in names}
+        try:
+            response = self.bucket.meta.client.delete_objects(
+                Bucket=self.bucket_name,
+                Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True}
+            )
+        except ClientError as error:
+            logger.debug("Can't delete objects from S3", exc_info=True)
+            return {name: str(error) for name in names}
+        return {
+            keys.get(item['Key'], item['Key']): item.get('Message', item.get('Code'))
+            for item in response.get('Errors', [])
+        }
+
+    def delete_objects(self, names, max_workers=DEFAULT_DELETE_WORKERS):
+        """
+        Delete objects by DeleteObjects requests of 1000 keys, the requests
+        are sent by a pool of max_workers threads
+
+        Args:
+            names(list): Names of objects
+            max_workers(int)
+        Returns:
+            errors(dict): Names which were not deleted and errors
+        """
+        names = list(names)
+        batches = [names[start:start + DELETE_BATCH_SIZE]
+                   for start in range(0, len(names), DELETE_BATCH_SIZE)]
+        errors = {}
+        if len(batches) > 1 and max_workers > 1:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for batch_errors in executor.map(self._delete_batch, batches):
+                    errors.update(batch_errors)
+        else:
+            for batch in batches:
+                errors.update(self._delete_batch(batch))
+        if self.catalog:
+            self.catalog.remove(*[name for name in names if name not in errors])
+        return errors
+
+    def _add_to_catalog(self, name, size):
+        # Only files of the location are backups
+        if self.catalog and '/' not in name:
+            self.catalog.add(name, datetime.datetime.now(datetime.timezone.utc), size)
+
+    def get_catalog(self):
+        """
+        Return the catalog, reloads it from S3 if the ttl is expired,
+        None if the catalog is disabled
+        """
+        if self.catalog is None:
+            return None
+        self.catalog.refresh()
+        if not self.catalog.is_fresh():
+            logger.debug("Refresh the catalog %s" % self.catalog.path)
+            self.catalog.replace(
+                (name, item.last_modified, item.size) for item, name in self._ls())
+        return self.catalog
+
     def __iter__(self):
+        catalog = self.get_catalog()
+        if catalog is not None:
+            for item in catalog:
+                yield item
+            return
         for _, item in self._ls():
             yield item
 
-    def _ls(self):
-        name = self._normalize_name('')
-        base_parts = name.split("/")[:-1]
-        try:
-            for item in self.bucket.objects.filter(Prefix=self._get_location()):
-                parts = item.key.split("/")
-                parts = parts[len(base_parts):]
-                # Only work with files
-                if len(parts) == 1:
-                    yield item, parts[0]
-        except ClientError as error:
-            logger.debug("Can't get objects from S3", exc_info=True)
-            raise S3BackendException("%s" % error)
+    def _ls(self, prefix=''):
+        """
+        Yields (ListedObject, name) of files of the location whose names start
+        with the prefix, in the order of names. Sub directories (chunks/, index/)
+        are skipped by S3, backups are listed by partitions of tasks and dates
+        in parallel, pages are fetched while they are consumed.
+        """
+        location = self._get_location()
+
+        def files(pages):
+            for objects in pages:
+                for item in objects:
+                    name = item.key[len(location):]
+                    if '/' not in name:
+                        yield item, name
+
+        def pages(prefix, start_after=None):
+            return (objects for objects, _ in self._list_pages(prefix, '/', start_after))
+
+        if prefix.startswith(BACKUP_PREFIX):
+            parts = self._split(location + prefix, BACKUP_DELIMITER)
+            yield from files(self._iter_parts(parts, '/'))
+            return
+        if prefix:
+            yield from files(pages(location + prefix))
+            return
+        # Files before backups, backups, files after backups
+        backups = location + BACKUP_PREFIX
+        for item, name in files(pages(location)):
+            if item.key >= backups:
+                break
+            yield item, name
+        yield from self._ls(BACKUP_PREFIX)
+        yield from files(pages(location, start_after=backups + LAST_CHAR))
 
     def get_last_backup(self, name=None):
         """
@@ -224,34 +1140,65 @@ class S3Backend(BackendWrapper):
         Args:
             name(srt)
         """
+        catalog = self.get_catalog()
+        if catalog is not None:
+            return catalog.get_last(name)
         backup_file = None
         max_date = None
-        for item, file_name in self._ls():
-            if name and not file_name.startswith(name):
-                continue
+        for item, file_name in self._ls(name or ''):
             if not max_date or max_date < item.last_modified:
                 max_date, backup_file = item.last_modified, file_name
         return backup_file
 
-    def delete_older(self, retention_date):
+    def list_backups(self, name=None):
+        catalog = self.get_catalog()
+        if catalog is not None:
+            return (item for item in catalog if not name or item.startswith(name))
+        return (file_name for _, file_name in self._ls(name or ''))
+
+    def delete_older(self, retention_date, dry_run=False, max_workers=DEFAULT_DELETE_WORKERS,
+                     keep=None):
         """
         Delete files than older
         Args:
             retention_date(datetime.date)
+            dry_run(bool): Only find files
+            max_workers(int): A number of parallel DeleteObjects requests
+            keep(callable): Receives all names and expired names, returns
+                expired names which must stay
+        Returns:
+            DeleteResult
         """
-        for item, _ in self._ls():
-            if item.last_modified.date() < retention_date:
-                item.delete()
+        catalog = self.get_catalog()
+        if catalog is not None:
+            names = list(catalog.get_older(retention_date))
+            existing = list(catalog)
+        else:
+            items = list(self._ls())
+            names = [name for item, name in items if item.last_modified.date() < retention_date]
+            existing = [name for _, name in items]
+        if keep is not None:
+            kept = keep(existing, names)
+            names = [name for name in names if name not in kept]
+        if dry_run:
+            return DeleteResult(deleted=names, dry_run=True)
+        errors = self.delete_objects(names, max_workers=max_workers)
+        for name, error in errors.items():
+            logger.error("Can't delete the %s: %s" % (name, error))
+        return DeleteResult(deleted=[name for name in names if name not in errors], errors=errors)
 
     def delete(self, filename):
-        for item, name in self._ls():
-            if name == filename:
-                try:
-                    item.delete()
-                except ClientError as error:
-                    logger.debug("Can't delete a object from S3", exc_info=True)
-                    raise S3BackendException("Can't delete a object: %s" % error)
-                break
+        """
+        Delete a file, deleting of a missing file is not an error
+        """
+        name = self._normalize_name(filename)
+        try:
+            self.bucket.Object(name).delete()
+        except ClientError as error:
+            logger.debug("Can't delete a object from S3", exc_info=True)
+            raise S3BackendException("Can't delete a object: %s" % error)
+        if self.catalog:
+            self.catalog.remove(filename)
 
     def __repr__(self):
         return "S3"
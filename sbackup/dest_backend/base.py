@@ -5,10 +5,31 @@ import abc
 from sbackup.exception import SBackupValidationError
 
 
+class DeleteResult(object):
+    """
+    A result of the retention
+    Attributes:
+       deleted(list): Deleted names, names to delete in the dry run mode
+       errors(dict): Names which were not deleted and errors
+       dry_run(bool)
+    """
+
+    def __init__(self, deleted=None, errors=None, dry_run=False):
+        self.deleted = deleted or []
+        self.errors = errors or {}
+        self.dry_run = dry_run
+
+    def __repr__(self):
+        return "<DeleteResult deleted=%s errors=%s dry_run=%s>" % (
+            len(self.deleted), len(self.errors), self.dry_run)
+
+
 class BackendWrapper(metaclass=abc.ABCMeta):
     """
         BackendWrapper
     """
+    # upload() continues interrupted uploads of the same file
+    resumable = False
 
     def validate(self):
         return NotImplementedError('subclasses of BackendWrapper may require a validate() method')
@@ -21,6 +42,79 @@ class BackendWrapper(metaclass=abc.ABCMeta):
     def upload(self, src_path, *args, **kwargs):
         return NotImplementedError
 
+    def open_writer(self, filename, *args, **kwargs):
+        """
+        Return a file object, the data written to it is stored as the filename
+        """
+        raise NotImplementedError('%r does not support streaming uploads' % self)
+
+    def open_reader(self, filename, *args, **kwargs):
+        """
+        Return a file object which reads the filename from the backend
+        """
+        raise NotImplementedError('%r does not support streaming downloads' % self)
+
+    def put_object(self, name, data):
+        """
+        Store the bytes as the name, the name may contain a subdirectory
+        """
+        raise NotImplementedError('%r does not support objects' % self)
+
+    def get_object(self, name):
+        """
+        Return the bytes of the name
+        """
+        raise NotImplementedError('%r does not support objects' % self)
+
+    def read_range(self, name, start, end):
+        """
+        Return bytes from start to end (exclusive) of the name
+        """
+        raise NotImplementedError('%r does not support ranged reads' % self)
+
+    def list_objects(self, prefix):
+        """
+        Return a generator of names which start with the prefix, including subdirectories
+        """
+        raise NotImplementedError('%r does not support objects' % self)
+
+    def delete_objects(self, names, max_workers=1):
+        """
+        Delete the names, returns a dict of names which were not deleted and errors
+        """
+        raise NotImplementedError('%r does not support objects' % self)
+
+    def flush(self):
+        """
+        Make stored objects durable, backends which batch syncs override it
+        """
+
+    def get_pending_uploads(self):
+        """
+        Return local paths of interrupted uploads which upload() resumes
+        """
+        return []
+
+    def abort_stale_uploads(self, older_than, dry_run=False):
+        """
+        Abort unfinished uploads started before the older_than (datetime.datetime),
+        returns DeleteResult
+        """
+        raise NotImplementedError('%r does not support unfinished uploads' % self)
+
+    def list_backups(self, name=None):
+        """
+        Return names of backups which start with the name, backends which
+        filter names on the server override it
+        """
+        return (item for item in self if not name or item.startswith(name))
+
+    def get_retries(self):
+        """
+        Return a number of retried requests
+        """
+        return 0
+
     @abc.abstractclassmethod
     def download(self, src_filename, dst_dir, *args, **kwargs):
         return NotImplementedError
@@ -30,7 +124,12 @@ class BackendWrapper(metaclass=abc.ABCMeta):
         return NotImplementedError
 
     @abc.abstractclassmethod
-    def delete_older(self, *args, **kwargs):
+    def delete_older(self, retention_date, dry_run=False, **kwargs):
+        """
+        Delete files modified before the retention_date, returns DeleteResult.
+        The keep callable receives all names and expired names and returns
+        expired names which must stay
+        """
         return NotImplementedError
 
     @abc.abstractclassmethod
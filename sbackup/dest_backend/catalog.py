@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""
+A local cache of backups in a backend
+"""
+import bisect
+import datetime
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CATALOG_DIR = '~/.sbackup/catalog'
+DEFAULT_TTL = 3600
+
+# backup-<task>-<time>.<extension>
+_backup_re = re.compile(r'^(?P<task>.+)-(?P<date>\d{4}-\d\d-\d\d)-\d\d-\d\d[.]')
+
+
+class Catalog(object):
+    """
+    Backups of a backend location: name -> (last_modified, size)
+
+    The catalog keeps the index by the task name (``backup-<name>``) and
+    the sorted index by the modification time, so the last backup and
+    the backups older than a date don't need a listing of the bucket.
+    The catalog is loaded from the backend again when it is older than
+    the ``ttl`` seconds. Tasks of several processes share the file: every
+    change reloads it under an exclusive ``flock`` of ``<path>.lock`` and
+    writes it back, ``refresh()`` picks up changes of other processes.
+
+    Usage::
+
+        catalog = Catalog.for_location('mybucket', 'site1', ttl=3600)
+        if not catalog.is_fresh():
+            catalog.replace((name, item.last_modified, item.size) for ...)
+        catalog.get_last('backup-site1')
+
+    """
+
+    def __init__(self, path, ttl=DEFAULT_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.updated = None
+        self._items = {}
+        self._by_task = {}
+        self._by_time = []
+        self._stamp = None
+        self._lock = threading.RLock()
+        self.load()
+
+    @classmethod
+    def for_location(cls, bucket_name, location, ttl=DEFAULT_TTL, directory=None):
+        key = hashlib.sha1(('%s/%s' % (bucket_name, location)).encode('utf-8')).hexdigest()
+        directory = os.path.expanduser(directory or DEFAULT_CATALOG_DIR)
+        return cls(os.path.join(directory, '%s.json' % key), ttl=ttl)
+
+    @staticmethod
+    def get_task(name):
+        match = _backup_re.match(name)
+        return match.group('task') if match else None
+
+    def _get_stamp(self):
+        try:
+            info = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return info.st_ino, info.st_mtime_ns, info.st_size
+
+    def load(self):
+        self._stamp = self._get_stamp()
+        self.updated = None
+        self._set_items([])
+        try:
+            with open(self.path, 'rt') as fileobj:
+                data = json.load(fileobj)
+        except FileNotFoundError:
+            return
+        except ValueError:
+            logger.error("The catalog %s is damaged, it will be rebuilt" % self.path)
+            return
+        self.updated = data['updated']
+        self._set_items(
+            (name, datetime.datetime.fromisoformat(modified), size)
+            for name, (modified, size) in data['items'].items()
+        )
+
+    def refresh(self):
+        """
+        Load the file again if another process changed it
+        """
+        with self._lock:
+            if self._get_stamp() != self._stamp:
+                self.load()
+
+    @contextmanager
+    def _locked(self):
+        """
+        Hold the file lock, the changes of other processes are loaded
+        """
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open('%s.lock' % self.path, 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    self.refresh()
+                    yield
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, exist_ok=True)
+        data = {
+            'updated': self.updated,
+            'items': {name: (modified.isoformat(), size)
+                      for name, (modified, size) in self._items.items()},
+        }
+        tmp_path = '%s.%s.%s.tmp' % (self.path, os.getpid(), threading.get_ident())
+        with open(tmp_path, 'wt') as fileobj:
+            json.dump(data, fileobj)
+        os.replace(tmp_path, self.path)
+        self._stamp = self._get_stamp()
+
+    def is_fresh(self):
+        return self.updated is not None and time.time() - self.updated < self.ttl
+
+    def _set_items(self, items):
+        self._items = {}
+        self._by_task = {}
+        self._by_time = []
+        for name, modified, size in items:
+            self._add(name, modified, size)
+
+    def _add(self, name, modified, size):
+        if name in self._items:
+            self._remove(name)
+        self._items[name] = (modified, size)
+        self._by_task.setdefault(self.get_task(name), set()).add(name)
+        bisect.insort(self._by_time, (modified, name))
+
+    def _remove(self, name):
+        modified, _ = self._items.pop(name)
+        names = self._by_task.get(self.get_task(name))
+        if names:
+            names.discard(name)
+        index = bisect.bisect_left(self._by_time, (modified, name))
+        if index < len(self._by_time) and self._by_time[index] == (modified, name):
+            del self._by_time[index]
+
+    def replace(self, items):
+        """
+        Replace the catalog by a listing of the backend
+
+        Args:
+            items: An iterable of (name, last_modified, size)
+        """
+        items = list(items)
+        with self._locked():
+            self._set_items(items)
+            self.updated = time.time()
+            self.save()
+
+    def add(self, name, modified, size):
+        with self._locked():
+            self._add(name, modified, size)
+            if self.updated is not None:
+                self.save()
+
+    def remove(self, *names):
+        with self._locked():
+            for name in names:
+                if name in self._items:
+                    self._remove(name)
+            if self.updated is not None:
+                self.save()
+
+    def invalidate(self):
+        with self._locked():
+            self.updated = None
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            self._stamp = None
+
+    def __iter__(self):
+        return iter(sorted(self._items))
+
+    def __contains__(self, name):
+        return name in self._items
+
+    def get(self, name):
+        return self._items.get(name)
+
+    def get_last(self, name=None):
+        """
+        Return the newest backup which name starts with the name
+        """
+        if name is None:
+            return self._by_time[-1][1] if self._by_time else None
+        if name in self._by_task:
+            names = self._by_task[name]
+        else:
+            names = [item for item in self._items if item.startswith(name)]
+        if not names:
+            return None
+        return max(names, key=lambda item: (self._items[item][0], item))
+
+    def get_older(self, date):
+        """
+        Return backups modified before the date
+
+        Args:
+            date(datetime.date)
+        """
+        for modified, name in self._by_time:
+            if modified.date() >= date:
+                break
+            yield name
@@ -0,0 +1,385 @@
+# -*- coding: utf-8 -*-
+import logging
+import queue
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from sbackup.exception import (
+    SBackupValidationError,
+    SBackupException
+)
+from .base import BackendWrapper, DeleteResult
+
+logger = logging.getLogger(__name__)
+
+# Blocks in the queue of every destination, a block is about the compression block size
+DEFAULT_QUEUE_SIZE = 8
+_CLOSE = object()
+_ABORT = object()
+
+
+class FanOutException(SBackupException):
+    """
+    FanOutBackend Exception, every destination failed
+    """
+    pass
+
+
+class _Destination(threading.Thread):
+    """
+    Writes blocks of the queue to the writer of a destination
+    """
+
+    def __init__(self, name, writer, queue_size):
+        super(_Destination, self).__init__(name='fanout-%s' % name, daemon=True)
+        self.destination = name
+        self.writer = writer
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.error = None
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is _CLOSE or item is _ABORT:
+                break
+            if self.error is not None:
+                # Drain the queue, the producer must not wait for a failed destination
+                continue
+            try:
+                self.writer.write(item)
+            except Exception as error:
+                logger.error("Can't write to %s: %s" % (self.destination, error))
+                self.error = error
+        if item is _ABORT or self.error is not None:
+            if self.error is None:
+                self.error = FanOutException('The upload was aborted')
+            try:
+                self.writer.abort()
+            except Exception as error:
+                logger.debug("Can't abort the upload to %s: %s" % (self.destination, error))
+            return
+        try:
+            self.writer.close()
+        except Exception as error:
+            logger.error("Can't complete the upload to %s: %s" % (self.destination, error))
+            self.error = error
+
+
+class TeeWriter(object):
+    """
+    A write-only file object which sends the same stream to writers of a few
+    destinations at the same time
+
+    Every destination has a thread and a bounded queue, the producer waits
+    when the queue of the slowest destination is full. A failed destination
+    is dropped, the stream fails only if every destination failed.
+
+    Usage::
+
+        with TeeWriter({'s3': s3.open_writer(name), 'nas': local.open_writer(name)}) as fileobj:
+            fileobj.write(data)
+        fileobj.errors  # {'nas': OSError(...)}
+
+    """
+
+    def __init__(self, writers, queue_size=DEFAULT_QUEUE_SIZE):
+        """
+        Args:
+            writers(dict): A destination name -> a writable file object
+            queue_size(int): Blocks in the queue of every destination
+        """
+        self.closed = False
+        self.bytes_written = 0
+        self.errors = {}
+        self._destinations = [_Destination(name, writer, queue_size)
+                              for name, writer in writers.items()]
+        for destination in self._destinations:
+            destination.start()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('I/O operation on closed file.')
+        data = bytes(data)
+        alive = [destination for destination in self._destinations if destination.error is None]
+        if not alive:
+            raise FanOutException("Can't write to any destination: %s" % self._describe())
+        for destination in alive:
+            destination.queue.put(data)
+        self.bytes_written += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def _finish(self, item):
+        self.closed = True
+        for destination in self._destinations:
+            destination.queue.put(item)
+        for destination in self._destinations:
+            destination.join()
+        self.errors = {destination.destination: destination.error
+                       for destination in self._destinations if destination.error is not None}
+
+    def _describe(self):
+        return '; '.join('%s: %s' % (destination.destination, destination.error)
+                         for destination in self._destinations)
+
+    def close(self):
+        if self.closed:
+            return
+        self._finish(_CLOSE)
+        if len(self.errors) == len(self._destinations):
+            raise FanOutException("Can't upload to any destination: %s" % self._describe())
+
+    def abort(self):
+        if not self.closed:
+            self._finish(_ABORT)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+
+class FanOutBackend(BackendWrapper):
+    """
+    A few destinations of one task, the archive is created once and sent
+    to all of them. Reads use the first destination which works.
+
+    Attributes:
+       backends(dict): A destination name -> a backend, in the config order
+       failed(dict): A destination name -> the last error of a write
+
+    Usage::
+
+        backend = FanOutBackend({'s3': S3Backend(...), 'local': LocalBackend('/mnt/nas')})
+        with backend.open_writer('backup.tar.gz') as fileobj:
+            fileobj.write(data)
+
+    """
+
+    def __init__(self, backends, queue_size=DEFAULT_QUEUE_SIZE):
+        self.backends = backends
+        self.queue_size = queue_size
+        self.failed = {}
+
+    def _check(self, errors, action, attempted):
+        """
+        Log errors of destinations, raises if every attempted destination failed
+        """
+        for name, error in errors.items():
+            logger.error("Can't %s in the %s: %s" % (action, name, error))
+        self.failed.update(errors)
+        if len(errors) == len(attempted):
+            raise FanOutException("Can't %s in any destination: %s" % (
+                action, '; '.join('%s: %s' % item for item in errors.items()) or
+                'no destination is available'))
+
+    def get_available(self):
+        """
+        Return backends which have not failed in this run
+        """
+        return {name: backend for name, backend in self.backends.items()
+                if name not in self.failed}
+
+    def _each(self, backends, method, *args, **kwargs):
+        """
+        Call the method of the backends in parallel
+
+        Returns:
+            results(dict), errors(dict)
+        """
+        def call(backend):
+            try:
+                return getattr(backend, method)(*args, **kwargs), None
+            except NotImplementedError:
+                raise
+            except Exception as error:
+                return None, error
+
+        if not backends:
+            return {}, {}
+        with ThreadPoolExecutor(max_workers=len(backends)) as executor:
+            items = list(zip(backends, executor.map(call, backends.values())))
+        results = {name: result for name, (result, error) in items if error is None}
+        errors = {name: error for name, (result, error) in items if error is not None}
+        return results, errors
+
+    def _first(self, function, action):
+        """
+        Return the result of the function of the first backend which works
+        """
+        errors = []
+        for name, backend in self.backends.items():
+            try:
+                return function(backend)
+            except SBackupException as error:
+                logger.debug("Can't %s in the %s: %s" % (action, name, error))
+                errors.append('%s: %s' % (name, error))
+        raise FanOutException("Can't %s: %s" % (action, '; '.join(errors)))
+
+    @property
+    def resumable(self):
+        return any(backend.resumable for backend in self.backends.values())
+
+    def get_pending_uploads(self):
+        paths = []
+        for backend in self.get_available().values():
+            paths.extend(path for path in backend.get_pending_uploads() if path not in paths)
+        return paths
+
+    def get_retries(self):
+        return sum(backend.get_retries() for backend in self.backends.values())
+
+    def abort_stale_uploads(self, older_than, dry_run=False):
+        results, errors = self._each(self.backends, 'abort_stale_uploads', older_than,
+                                     dry_run=dry_run)
+        self._check(errors, 'abort uploads', self.backends)
+        return self._merge(results, dry_run)
+
+    def _merge(self, results, dry_run):
+        """
+        Merge DeleteResult of destinations, errors are keyed by ``<destination>:<name>``
+        """
+        deleted = set()
+        failed = {}
+        for destination, result in results.items():
+            deleted.update(result.deleted)
+            for name, error in result.errors.items():
+                failed['%s:%s' % (destination, name)] = error
+        return DeleteResult(deleted=sorted(deleted), errors=failed, dry_run=dry_run)
+
+    def validate(self):
+        errors = {}
+        for name, backend in self.backends.items():
+            try:
+                backend.validate()
+            except SBackupValidationError as error:
+                errors[name] = error
+        for name, error in errors.items():
+            logger.error("The destination %s is not available: %s" % (name, error))
+        if len(errors) == len(self.backends):
+            raise SBackupValidationError("No destination is available")
+        self.failed.update(errors)
+
+    def upload(self, src_path, *args, **kwargs):
+        """
+        Upload a file to the destinations in parallel, every destination reads the file
+        """
+        backends = self.get_available()
+        _, errors = self._each(backends, 'upload', src_path, *args, **kwargs)
+        self._check(errors, 'upload %s' % src_path, backends)
+
+    def open_writer(self, filename, *args, **kwargs):
+        """
+        Returns:
+            TeeWriter
+        """
+        backends = self.get_available()
+        writers = {}
+        errors = {}
+        for name, backend in backends.items():
+            try:
+                writers[name] = backend.open_writer(filename, *args, **kwargs)
+            except SBackupException as error:
+                errors[name] = error
+        try:
+            self._check(errors, 'open %s' % filename, backends)
+        except FanOutException:
+            for writer in writers.values():
+                writer.abort()
+            raise
+        return _FanOutWriter(self, writers, self.queue_size)
+
+    def put_object(self, name, data):
+        backends = self.get_available()
+        _, errors = self._each(backends, 'put_object', name, data)
+        self._check(errors, 'put %s' % name, backends)
+
+    def delete_objects(self, names, max_workers=1):
+        names = list(names)
+        results, errors = self._each(self.backends, 'delete_objects', names,
+                                     max_workers=max_workers)
+        failed = {}
+        for destination, error in errors.items():
+            for name in names:
+                failed.setdefault(name, '%s: %s' % (destination, error))
+        for destination, result in results.items():
+            for name, error in result.items():
+                failed.setdefault(name, '%s: %s' % (destination, error))
+        return failed
+
+    def flush(self):
+        backends = self.get_available()
+        _, errors = self._each(backends, 'flush')
+        self._check(errors, 'flush', backends)
+
+    def delete(self, filename):
+        _, errors = self._each(self.backends, 'delete', filename)
+        self._check(errors, 'delete %s' % filename, self.backends)
+
+    def delete_older(self, retention_date, dry_run=False, **kwargs):
+        """
+        Apply the retention to every destination
+
+        Returns:
+            DeleteResult: Errors are keyed by ``<destination>:<name>``
+        """
+        results, errors = self._each(self.backends, 'delete_older', retention_date,
+                                     dry_run=dry_run, **kwargs)
+        self._check(errors, 'delete old files', self.backends)
+        return self._merge(results, dry_run)
+
+    def __iter__(self):
+        return iter(self._first(list, 'list backups'))
+
+    def download(self, src_filename, dst_dir, *args, **kwargs):
+        return self._first(lambda backend: backend.download(src_filename, dst_dir, *args, **kwargs),
+                           'download %s' % src_filename)
+
+    def open_reader(self, filename, *args, **kwargs):
+        return self._first(lambda backend: backend.open_reader(filename, *args, **kwargs),
+                           'read %s' % filename)
+
+    def get_object(self, name):
+        return self._first(lambda backend: backend.get_object(name), 'get %s' % name)
+
+    def read_range(self, name, start, end):
+        return self._first(lambda backend: backend.read_range(name, start, end),
+                           'read %s' % name)
+
+    def list_objects(self, prefix):
+        return iter(self._first(lambda backend: list(backend.list_objects(prefix)),
+                                'list %s' % prefix))
+
+    def list_backups(self, name=None):
+        return iter(self._first(lambda backend: list(backend.list_backups(name)),
+                                'list backups of %s' % name))
+
+    def get_last_backup(self, *args, **kwargs):
+        return self._first(lambda backend: backend.get_last_backup(*args, **kwargs),
+                           'get the last backup')
+
+    def __repr__(self):
+        return ', '.join(repr(backend) for backend in self.backends.values())
+
+
+class _FanOutWriter(TeeWriter):
+
+    def __init__(self, backend, writers, queue_size):
+        self.backend = backend
+        super(_FanOutWriter, self).__init__(writers, queue_size)
+
+    def close(self):
+        try:
+            super(_FanOutWriter, self).close()
+        finally:
+            self.backend.failed.update(self.errors)
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+A local journal of multipart uploads
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_JOURNAL_DIR = '~/.sbackup/uploads'
+
+
+class UploadJournal(object):
+    """
+    The state of unfinished multipart uploads: the upload id, the local
+    file and the ETags of completed parts. A record is saved after every
+    part, so an upload which was interrupted by a crash or a network error
+    continues from the completed parts.
+
+    Usage::
+
+        journal = UploadJournal('~/.sbackup/uploads')
+        journal.save({'bucket': 'mybucket', 'key': 'site/backup.tar.gz',
+                      'upload_id': upload_id, 'path': path, 'parts': {}})
+        record = journal.load('mybucket', 'site/backup.tar.gz')
+        journal.remove('mybucket', 'site/backup.tar.gz')
+
+    """
+
+    def __init__(self, directory=None):
+        self.directory = os.path.expanduser(directory or DEFAULT_JOURNAL_DIR)
+        self._lock = threading.Lock()
+
+    def get_path(self, bucket_name, key):
+        name = hashlib.sha1(('%s/%s' % (bucket_name, key)).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, '%s.json' % name)
+
+    def load(self, bucket_name, key):
+        """
+        Returns:
+            record(dict): None if the key has no unfinished upload
+        """
+        return self._read(self.get_path(bucket_name, key))
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path, 'rt') as fileobj:
+                record = json.load(fileobj)
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            logger.error("The upload journal %s is damaged, it is ignored" % path)
+            return None
+        # JSON keys are strings
+        record['parts'] = {int(number): etag for number, etag in record.get('parts', {}).items()}
+        return record
+
+    def save(self, record):
+        record = dict(record, updated=time.time())
+        path = self.get_path(record['bucket'], record['key'])
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_path = '%s.%s.tmp' % (path, os.getpid())
+            with open(tmp_path, 'wt') as fileobj:
+                json.dump(record, fileobj)
+                fileobj.flush()
+                os.fsync(fileobj.fileno())
+            os.replace(tmp_path, path)
+
+    def remove(self, bucket_name, key):
+        with self._lock:
+            try:
+                os.remove(self.get_path(bucket_name, key))
+            except FileNotFoundError:
+                pass
+
+    def __iter__(self):
+        try:
+            names = sorted(os.listdir(self.directory))
+        except FileNotFoundError:
+            return
+        for name in names:
+            if name.endswith('.json'):
+                record = self._read(os.path.join(self.directory, name))
+                if record is not None:
+                    yield record
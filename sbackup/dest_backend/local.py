@@ -0,0 +1,383 @@
+# -*- coding: utf-8 -*-
+import datetime
+import logging
+import os
+import tempfile
+import threading
+
+from sbackup.exception import (
+    SBackupValidationError,
+    SBackupException
+)
+from sbackup.utils import parse_size
+from .base import BackendWrapper, DeleteResult
+from .transfer import Progress, Throttle, copy_fd
+
+logger = logging.getLogger(__name__)
+
+# Directories are synced after this number of stored objects
+FSYNC_BATCH_SIZE = 64
+TMP_SUFFIX = '.part'
+
+
+class LocalBackendException(SBackupException):
+    """
+    LocalBackend Exception
+    """
+    pass
+
+
+class LocalWriter(object):
+    """
+    A write-only file object, the data is written to a temporary file
+    which is renamed to the name when the writer is closed, a reader
+    never sees a partial file
+
+    Usage::
+
+        with backend.open_writer('backup.tar.gz') as fileobj:
+            fileobj.write(data)
+
+    """
+
+    def __init__(self, backend, filename, progress=None):
+        self.backend = backend
+        self.filename = filename
+        self.path = backend.get_path(filename)
+        self.progress = progress
+        self.closed = False
+        self.bytes_written = 0
+        self._fileobj = backend.create_temp(self.path)
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('I/O operation on closed file.')
+        if self.backend.throttle:
+            self.backend.throttle.consume(len(data))
+        self._fileobj.write(data)
+        self.bytes_written += len(data)
+        if self.progress:
+            self.progress.update(len(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.backend.commit_temp(self._fileobj, self.path)
+        except OSError as error:
+            raise LocalBackendException("Can't store the %s: %s" % (self.filename, error))
+        self.backend.sync_dirs()
+        if self.progress:
+            self.progress.finish()
+
+    def abort(self):
+        self.closed = True
+        self.backend.discard_temp(self._fileobj)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+
+class LocalBackend(BackendWrapper):
+    """
+    A directory on a local disk or a mounted file system (NAS)
+
+    Files are written to temporary files, synced and renamed, so a backup
+    is complete or absent after a crash. Files are copied by
+    ``copy_file_range``/``sendfile`` where the platform supports it.
+    Directories of many small objects (chunks) are synced by batches.
+
+    Usage::
+
+        backend = LocalBackend('/mnt/nas/backups', max_bandwidth='100MB')
+        backend.validate()
+        backend.upload('/tmp/my_file.csv')
+
+    """
+
+    def __init__(self, path, fsync=True, max_bandwidth=None, *args, **kwargs):
+        """
+        Args:
+            path(str): A directory of backups
+            fsync(bool): Sync files and directories, default is True
+            max_bandwidth(int|str): Bytes per second, the size may have a unit
+        """
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self.fsync = fsync
+        self.is_validated = False
+        try:
+            rate = parse_size(max_bandwidth) if max_bandwidth else None
+        except SBackupException as error:
+            raise SBackupValidationError("Incorrect max_bandwidth: %s" % error)
+        self.throttle = Throttle(rate) if rate else None
+        self._lock = threading.Lock()
+        self._dirty_dirs = set()
+        self._pending = 0
+
+    def validate(self):
+        if not os.path.isdir(self.path):
+            raise SBackupValidationError("The directory %s does not exist" % self.path)
+        if not os.access(self.path, os.W_OK):
+            raise SBackupValidationError("User doesn't have access to write in the %s" % self.path)
+        self.is_validated = True
+
+    def get_path(self, name):
+        """
+        Return a path of the name, the path must be located inside of the backend directory
+        """
+        path = os.path.normpath(os.path.join(self.path, name))
+        if not path.startswith(self.path + os.sep):
+            raise LocalBackendException("Attempted access to '%s' denied." % name)
+        return path
+
+    def create_temp(self, path):
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix='.%s.' % os.path.basename(path),
+                                        suffix=TMP_SUFFIX, dir=directory)
+        os.close(fd)
+        return open(tmp_path, 'wb')
+
+    def commit_temp(self, fileobj, path):
+        """
+        Sync the temporary file and rename it to the path
+        """
+        try:
+            fileobj.flush()
+            if self.fsync:
+                os.fsync(fileobj.fileno())
+            fileobj.close()
+            os.replace(fileobj.name, path)
+        except BaseException:
+            self.discard_temp(fileobj)
+            raise
+        with self._lock:
+            self._dirty_dirs.add(os.path.dirname(path))
+            self._pending += 1
+
+    @staticmethod
+    def discard_temp(fileobj):
+        fileobj.close()
+        if os.path.exists(fileobj.name):
+            os.remove(fileobj.name)
+
+    def sync_dirs(self, force=True):
+        """
+        Sync directories with new names, by batches of FSYNC_BATCH_SIZE objects
+        unless the force is set
+        """
+        with self._lock:
+            if not force and self._pending < FSYNC_BATCH_SIZE:
+                return
+            dirs, self._dirty_dirs = self._dirty_dirs, set()
+            self._pending = 0
+        if not self.fsync:
+            return
+        for directory in dirs:
+            fd = os.open(directory, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def flush(self):
+        self.sync_dirs()
+
+    def __iter__(self):
+        try:
+            names = sorted(os.listdir(self.path))
+        except OSError as error:
+            raise LocalBackendException("%s" % error)
+        for name in names:
+            if not name.startswith('.') and os.path.isfile(os.path.join(self.path, name)):
+                yield name
+
+    def _get_mtime(self, name):
+        return datetime.datetime.fromtimestamp(os.path.getmtime(os.path.join(self.path, name)))
+
+    def upload(self, src_path, *args, **kwargs):
+        """
+        Copy a file to the backend directory
+        Args:
+            src_path(basestring): A path to file
+        Raises:
+            LocalBackendException
+        """
+        if not src_path or not os.path.isfile(src_path):
+            logger.debug("Can't find a path %s" % src_path)
+            raise LocalBackendException("Can't find a path")
+        filename = os.path.basename(src_path)
+        progress = Progress(filename, total=os.path.getsize(src_path))
+        with open(src_path, 'rb') as src, self.open_writer(filename, progress=progress) as writer:
+            writer.bytes_written = copy_fd(src.fileno(), writer._fileobj.fileno(),
+                                           throttle=self.throttle, progress=progress)
+
+    def open_writer(self, filename, progress=None, *args, **kwargs):
+        """
+        Returns:
+            LocalWriter
+        """
+        return LocalWriter(self, filename, progress=progress)
+
+    def download(self, src_filename, dst_dir, dst_filename=None, **kwargs):
+        """
+        Copy a file from the backend directory
+        Args:
+            src_filename(basestring): A source file name
+            dst_dir(basestring): A dst dir
+            dst_filename(basestring): A dst file
+        Raises:
+            LocalBackendException
+        """
+        if not os.path.isdir(dst_dir):
+            logger.error("Can't find a directory %s" % dst_dir)
+            raise LocalBackendException("Can't find a directory")
+        src_path = self.get_path(src_filename)
+        dst_path = os.path.join(dst_dir, dst_filename or src_filename)
+        progress = Progress(src_filename)
+        try:
+            with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+                progress.total = os.fstat(src.fileno()).st_size
+                copy_fd(src.fileno(), dst.fileno(), throttle=self.throttle, progress=progress)
+        except FileNotFoundError:
+            raise LocalBackendException("The file %s does not exist" % src_filename)
+        progress.finish()
+        return dst_path
+
+    def open_reader(self, filename, *args, **kwargs):
+        try:
+            return open(self.get_path(filename), 'rb')
+        except FileNotFoundError:
+            raise LocalBackendException("The file %s does not exist" % filename)
+
+    def put_object(self, name, data):
+        path = self.get_path(name)
+        fileobj = self.create_temp(path)
+        try:
+            fileobj.write(data)
+        except BaseException:
+            self.discard_temp(fileobj)
+            raise
+        self.commit_temp(fileobj, path)
+        self.sync_dirs(force=False)
+
+    def get_object(self, name):
+        try:
+            with open(self.get_path(name), 'rb') as fileobj:
+                return fileobj.read()
+        except FileNotFoundError:
+            raise LocalBackendException("The file %s does not exist" % name)
+
+    def read_range(self, name, start, end):
+        try:
+            with open(self.get_path(name), 'rb') as fileobj:
+                return os.pread(fileobj.fileno(), end - start, start)
+        except FileNotFoundError:
+            raise LocalBackendException("The file %s does not exist" % name)
+
+    def list_objects(self, prefix):
+        directory = os.path.dirname(prefix)
+        top = os.path.join(self.path, directory) if directory else self.path
+        for root, dirs, files in os.walk(top):
+            dirs.sort()
+            for name in sorted(files):
+                if name.startswith('.'):
+                    continue
+                relative = os.path.relpath(os.path.join(root, name), self.path)
+                if relative.startswith(prefix):
+                    yield relative
+
+    def delete_objects(self, names, max_workers=1):
+        errors = {}
+        for name in names:
+            try:
+                os.remove(self.get_path(name))
+            except FileNotFoundError:
+                pass
+            except (OSError, LocalBackendException) as error:
+                errors[name] = '%s' % error
+        return errors
+
+    def delete(self, filename):
+        """
+        Delete a file, deleting of a missing file is not an error
+        """
+        errors = self.delete_objects([filename])
+        if errors:
+            raise LocalBackendException("Can't delete a file: %s" % errors[filename])
+
+    def delete_older(self, retention_date, dry_run=False, keep=None, **kwargs):
+        """
+        Delete files modified before the retention_date
+        Args:
+            retention_date(datetime.date)
+            dry_run(bool): Only find files
+            keep(callable): Receives all names and expired names, returns
+                expired names which must stay
+        Returns:
+            DeleteResult
+        """
+        existing = list(self)
+        names = [name for name in existing if self._get_mtime(name).date() < retention_date]
+        if keep is not None:
+            kept = keep(existing, names)
+            names = [name for name in names if name not in kept]
+        if dry_run:
+            return DeleteResult(deleted=names, dry_run=True)
+        errors = self.delete_objects(names)
+        for name, error in errors.items():
+            logger.error("Can't delete the %s: %s" % (name, error))
+        return DeleteResult(deleted=[name for name in names if name not in errors], errors=errors)
+
+    def abort_stale_uploads(self, older_than, dry_run=False):
+        """
+        Remove temporary files of writers which were not closed, a crashed process leaves them
+
+        Args:
+            older_than(datetime.datetime): An aware datetime
+            dry_run(bool): Only find files
+        Returns:
+            DeleteResult
+        """
+        timestamp = older_than.timestamp()
+        names = []
+        for root, dirs, files in os.walk(self.path):
+            dirs.sort()
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                if (name.startswith('.') and name.endswith(TMP_SUFFIX) and
+                        os.path.getmtime(path) < timestamp):
+                    names.append(os.path.relpath(path, self.path))
+        if dry_run:
+            return DeleteResult(deleted=names, dry_run=True)
+        errors = self.delete_objects(names)
+        return DeleteResult(deleted=[name for name in names if name not in errors], errors=errors)
+
+    def get_last_backup(self, name=None):
+        """
+        Get last backup
+
+        Args:
+            name(srt)
+        """
+        names = [item for item in self if not name or item.startswith(name)]
+        if not names:
+            return None
+        return max(names, key=lambda item: (self._get_mtime(item), item))
+
+    def __repr__(self):
+        return "local:%s" % self.path
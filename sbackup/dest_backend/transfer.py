@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+"""
+Transfer helpers shared by backends: the bandwidth limit, retries of
+failed parts, the progress, the zero-copy file copy and ordered parallel
+iteration of listings
+"""
+import collections
+import errno
+import logging
+import os
+import queue
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ATTEMPTS = 5
+DEFAULT_DELAY = 0.5
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+DEFAULT_PROGRESS_INTERVAL = 30.0
+# copy_file_range and sendfile don't work for these files, copy them in the user space
+_ZERO_COPY_ERRORS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP,
+                     errno.ENOTSUP, errno.EBADF, errno.EPERM)
+
+
+class Throttle(object):
+    """
+    Limits a bandwidth of a few threads, every thread calls ``consume``
+    before it sends the data
+
+    Usage::
+
+        throttle = Throttle(10 * 1024 * 1024)  # 10 MiB/s
+        throttle.consume(len(data))
+        send(data)
+
+    """
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def consume(self, amount):
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + amount / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+
+class Retry(object):
+    """
+    Calls a function again after errors, the delay grows exponentially
+
+    Usage::
+
+        retry = Retry(attempts=5, exceptions=(OSError,))
+        data = retry(read_part, 1)
+
+    """
+
+    def __init__(self, attempts=DEFAULT_ATTEMPTS, delay=DEFAULT_DELAY, backoff=2.0,
+                 exceptions=(OSError,), is_retryable=None):
+        """
+        Args:
+            attempts(int): A number of calls
+            delay(float): Seconds before the second call
+            backoff(float): A multiplier of the delay
+            exceptions(tuple): Exception classes to retry
+            is_retryable: A callable(error) -> bool, all errors are retried by default
+        """
+        self.attempts = max(int(attempts), 1)
+        self.delay = delay
+        self.backoff = backoff
+        self.exceptions = exceptions
+        self.is_retryable = is_retryable
+        self.retries = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, func, *args, **kwargs):
+        for attempt in range(1, self.attempts + 1):
+            try:
+                return func(*args, **kwargs)
+            except self.exceptions as error:
+                if attempt == self.attempts or (
+                        self.is_retryable is not None and not self.is_retryable(error)):
+                    raise
+                delay = self.delay * self.backoff ** (attempt - 1)
+                with self._lock:
+                    self.retries += 1
+                logger.debug("Retry in %.1fs after the error: %s" % (delay, error))
+                time.sleep(delay)
+
+
+class Progress(object):
+    """
+    Counts transferred bytes of a few threads and logs the progress
+    every ``interval`` seconds
+
+    Usage::
+
+        progress = Progress('backup.tar.gz', total=os.path.getsize(path))
+        progress.update(len(data))
+        progress.finish()
+
+    """
+
+    def __init__(self, name, total=None, interval=DEFAULT_PROGRESS_INTERVAL, callback=None):
+        """
+        Args:
+            name(str): A name of the transfer
+            total(int): A size of the transfer if it's known
+            interval(float): Seconds between messages
+            callback: A callable(progress) which is called with every message
+        """
+        self.name = name
+        self.total = total
+        self.interval = interval
+        self.callback = callback
+        self.done = 0
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+        self._next_report = self.started + interval
+
+    @property
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    @property
+    def rate(self):
+        elapsed = self.elapsed
+        return self.done / elapsed if elapsed > 0 else 0.0
+
+    def update(self, amount):
+        with self._lock:
+            self.done += amount
+            now = time.monotonic()
+            if now < self._next_report:
+                return
+            self._next_report = now + self.interval
+        self.report()
+
+    def report(self):
+        if self.total:
+            logger.info("%s: %d%% of %d bytes, %.1f MB/s" % (
+                self.name, self.done * 100 // self.total, self.total, self.rate / 1024 ** 2))
+        else:
+            logger.info("%s: %d bytes, %.1f MB/s" % (self.name, self.done, self.rate / 1024 ** 2))
+        if self.callback:
+            self.callback(self)
+
+    def finish(self):
+        logger.debug("%s: %d bytes in %.2fs" % (self.name, self.done, self.elapsed))
+
+
+def _zero_copy(src_fd, dst_fd, count):
+    """
+    Copy in the kernel, returns None if the file systems don't support it
+    """
+    for method in ('copy_file_range', 'sendfile'):
+        if not hasattr(os, method):
+            continue
+        try:
+            if method == 'copy_file_range':
+                return os.copy_file_range(src_fd, dst_fd, count)
+            return os.sendfile(dst_fd, src_fd, None, count)
+        except OSError as error:
+            if error.errno not in _ZERO_COPY_ERRORS:
+                raise
+    return None
+
+
+def copy_fd(src_fd, dst_fd, chunk_size=DEFAULT_CHUNK_SIZE, throttle=None, progress=None):
+    """
+    Copy the rest of the src to the dst from current positions, the data
+    doesn't pass through the user space if the platform can do it
+
+    Args:
+        src_fd(int): A file descriptor to read
+        dst_fd(int): A file descriptor to write
+        chunk_size(int): A size of a throttled and counted piece
+        throttle(Throttle)
+        progress(Progress)
+    Returns:
+        size(int): Copied bytes
+    """
+    copied = 0
+    zero_copy = True
+    while True:
+        if throttle:
+            throttle.consume(chunk_size)
+        count = None
+        if zero_copy:
+            count = _zero_copy(src_fd, dst_fd, chunk_size)
+            zero_copy = count is not None
+        if count is None:
+            data = os.read(src_fd, chunk_size)
+            count = len(data)
+            view = memoryview(data)
+            while view:
+                view = view[os.write(dst_fd, view):]
+        if not count:
+            return copied
+        copied += count
+        if progress:
+            progress.update(count)
+
+
+class _Failure(object):
+
+    def __init__(self, error):
+        self.error = error
+
+
+_DONE = object()
+
+
+class _Producer(object):
+    """
+    Runs an iterator in a thread and passes its items through a bounded queue
+    """
+
+    def __init__(self, function, queue_size, stop):
+        self.function = function
+        self.queue = queue.Queue(queue_size)
+        self.stop = stop
+
+    def put(self, item):
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def run(self):
+        try:
+            for item in self.function():
+                if not self.put(item):
+                    return
+        except BaseException as error:
+            self.put(_Failure(error))
+            return
+        self.put(_DONE)
+
+
+def iter_ordered(functions, max_workers=4, queue_size=2):
+    """
+    Yield items of iterators in the order of functions, up to max_workers
+    iterators run ahead in threads and every one keeps at most queue_size
+    items, so the memory doesn't depend on the length of iterators
+
+    Usage::
+
+        pages = iter_ordered([lambda: list_pages('a'), lambda: list_pages('b')])
+
+    Args:
+        functions(iterable): Callables which return iterators
+        max_workers(int)
+        queue_size(int)
+    """
+    functions = iter(functions)
+    running = collections.deque()
+    stop = threading.Event()
+    with ThreadPoolExecutor(max_workers=max(int(max_workers), 1)) as executor:
+
+        def start():
+            function = next(functions, None)
+            if function is None:
+                return
+            producer = _Producer(function, queue_size, stop)
+            executor.submit(producer.run)
+            running.append(producer)
+
+        try:
+            for _ in range(max(int(max_workers), 1)):
+                start()
+            while running:
+                producer = running[0]
+                while True:
+                    item = producer.queue.get()
+                    if item is _DONE:
+                        break
+                    if isinstance(item, _Failure):
+                        raise item.error
+                    yield item
+                running.popleft()
+                start()
+        finally:
+            # An abandoned iteration stops producers which wait for a free place
+            stop.set()
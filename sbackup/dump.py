@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+"""
+Streams of dump commands
+
+A dump is the stdout of one command (``pg_dump``, ``mysqldump``) or of a
+few commands which dump parts of a database (tables) in parallel. Outputs
+are read in the order of commands, so the result is the same stream as
+the one of sequential commands. The output of the current command is
+passed through memory, outputs of commands ahead of it are kept in
+memory up to ``buffer_size`` bytes and then in a temporary file.
+"""
+import collections
+import logging
+import os
+import subprocess
+import tempfile
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from .exception import SBackupException
+
+logger = logging.getLogger(__name__)
+
+READ_SIZE = 1024 * 1024
+DEFAULT_BUFFER_SIZE = 64 * 1024 * 1024
+
+
+class DumpException(SBackupException):
+    """
+    A dump command failed
+    """
+    pass
+
+
+class Spool(object):
+    """
+    A FIFO of the output of one command, a writer thread and a reader thread
+
+    Chunks are kept in memory while they fit into the buffer_size, after
+    that they are appended to a temporary file until the reader catches up.
+    """
+
+    def __init__(self, buffer_size=DEFAULT_BUFFER_SIZE, tmp_dir=None):
+        self.buffer_size = buffer_size
+        self.tmp_dir = tmp_dir
+        self.error = None
+        self.closed = False
+        self.process = None
+        self._chunks = collections.deque()
+        self._memory = 0
+        self._file = None
+        self._reader = None
+        self._written = 0
+        self._read = 0
+        self._done = False
+        self._condition = threading.Condition()
+
+    def write(self, data):
+        with self._condition:
+            if self.closed:
+                raise DumpException('The dump was cancelled')
+            if self._file is None and self._memory + len(data) <= self.buffer_size:
+                self._chunks.append(data)
+                self._memory += len(data)
+            else:
+                if self._file is None:
+                    self._file = tempfile.NamedTemporaryFile(
+                        prefix='sbackup-dump-', dir=self.tmp_dir)
+                    self._reader = open(self._file.name, 'rb')
+                    logger.debug("The dump output is spooled to %s" % self._file.name)
+                self._file.write(data)
+                self._file.flush()
+                self._written += len(data)
+            self._condition.notify()
+
+    def finish(self, error=None):
+        with self._condition:
+            self.error = error
+            self._done = True
+            self._condition.notify()
+
+    def read(self):
+        """
+        Return the next chunk, b'' at the end of the output
+
+        Raises:
+            DumpException: An error occur if the command failed
+        """
+        with self._condition:
+            while True:
+                if self._chunks:
+                    data = self._chunks.popleft()
+                    self._memory -= len(data)
+                    return data
+                if self._read < self._written:
+                    data = os.pread(self._reader.fileno(),
+                                    min(READ_SIZE, self._written - self._read), self._read)
+                    self._read += len(data)
+                    if self._read == self._written and not self._done:
+                        # The reader caught up, new chunks stay in memory again
+                        self._close_file()
+                    return data
+                if self._done:
+                    self._close_file()
+                    if self.error is not None:
+                        raise self.error
+                    return b''
+                self._condition.wait()
+
+    def _close_file(self):
+        if self._file is not None:
+            self._reader.close()
+            self._file.close()
+            self._file = self._reader = None
+            self._written = self._read = 0
+
+    def close(self):
+        with self._condition:
+            self.closed = True
+            self._chunks.clear()
+            self._close_file()
+            if self.process is not None and self.process.poll() is None:
+                self.process.kill()
+
+
+def run_command(command, spool, env=None):
+    """
+    Run the command and write its stdout to the spool
+    """
+    logger.debug("Run the dump command: %s" % ' '.join(command))
+    try:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   env=env)
+    except OSError as error:
+        spool.finish(DumpException("Can't run the %s: %s" % (command[0], error)))
+        return
+    spool.process = process
+    # stderr is read by a thread, a full stderr pipe would block the command
+    stderr = []
+    reader = threading.Thread(target=lambda: stderr.append(process.stderr.read()), daemon=True)
+    reader.start()
+    try:
+        while True:
+            data = process.stdout.read1(READ_SIZE)
+            if not data:
+                break
+            spool.write(data)
+    except BaseException as error:
+        process.kill()
+        process.wait()
+        spool.finish(DumpException("Can't read the output of %s: %s" % (command[0], error)))
+        return
+    process.wait()
+    reader.join()
+    if process.returncode:
+        message = stderr[0].decode('utf-8', 'replace').strip() if stderr else ''
+        spool.finish(DumpException("The %s exited with the code %s: %s" % (
+            command[0], process.returncode, message)))
+    else:
+        spool.finish()
+
+
+class DumpReader(object):
+    """
+    A read-only file object of the outputs of commands in order, up to
+    ``jobs`` commands run at the same time
+
+    Usage::
+
+        commands = [['pg_dump', '--section=pre-data', 'db'],
+                    ['pg_dump', '--section=data', '-t', 'users', 'db'],
+                    ['pg_dump', '--section=data', '-t', 'orders', 'db'],
+                    ['pg_dump', '--section=post-data', 'db']]
+        with DumpReader(commands, jobs=2) as reader:
+            data = reader.read(1024)
+
+    """
+
+    def __init__(self, commands, jobs=1, env=None, buffer_size=DEFAULT_BUFFER_SIZE,
+                 tmp_dir=None):
+        """
+        Args:
+            commands(list): Commands, every command is a list of arguments
+            jobs(int): A number of commands running at the same time
+            env(dict): Environment variables of commands
+            buffer_size(int): Bytes of the output of a command kept in memory
+            tmp_dir(str): A directory of spooled outputs, default is TMPDIR
+        """
+        self.closed = False
+        self.jobs = max(int(jobs), 1)
+        self._spools = collections.deque()
+        self._commands = iter(commands)
+        self._buffer = b''
+        self._position = 0
+        self.env = env
+        self.buffer_size = buffer_size
+        self.tmp_dir = tmp_dir
+        self._executor = ThreadPoolExecutor(max_workers=self.jobs)
+        self._fill()
+
+    def readable(self):
+        return True
+
+    def _fill(self):
+        while len(self._spools) < self.jobs:
+            command = next(self._commands, None)
+            if command is None:
+                return
+            spool = Spool(self.buffer_size, self.tmp_dir)
+            self._executor.submit(run_command, command, spool, self.env)
+            self._spools.append(spool)
+
+    def _next_chunk(self):
+        while self._spools:
+            data = self._spools[0].read()
+            if data:
+                return data
+            self._spools.popleft()
+            self._fill()
+        return b''
+
+    def read(self, size=-1):
+        if self.closed:
+            raise ValueError('I/O operation on closed file.')
+        chunks = []
+        while size != 0:
+            if self._position >= len(self._buffer):
+                self._buffer = self._next_chunk()
+                self._position = 0
+                if not self._buffer:
+                    break
+            end = len(self._buffer) if size < 0 else min(self._position + size, len(self._buffer))
+            chunk = self._buffer[self._position:end]
+            self._position = end
+            chunks.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+        return b''.join(chunks)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        # Unread outputs are dropped, running commands are killed
+        for spool in self._spools:
+            spool.close()
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,464 @@
+# -*- coding: utf-8 -*-
+"""
+Client-side encryption of backups
+
+The compressed stream is encrypted between the compression and the upload,
+no plain data is written to the tmp_dir or sent to the backend. The stream
+is cut into segments of ``segment_size`` bytes, every segment is sealed by
+AES-256-GCM (AES-NI) or ChaCha20-Poly1305 on its own, so the reader decrypts
+the stream as it arrives and a range of the compressed stream (blocks of the
+seekable index) is decrypted from its segments only.
+
+The encrypted object is a header and the segments::
+
+    header: magic, version, cipher, key id, segment size, salt
+    segment: ciphertext of segment_size bytes (shorter for the last one), tag
+
+A key and a nonce prefix of every object are derived from the key of the
+keyfile and the random salt by HKDF-SHA256. The nonce of a segment is the
+prefix, the segment number and the flag of the last segment, the header is
+the associated data of every segment: reordered, truncated or extended
+streams don't decrypt. The last segment is always shorter than the
+segment_size (it may be empty), so a segment of a range is known to be
+the last one by its size.
+
+An object without the header is rejected, a plain object swapped into the
+backend must not be restored as a backup. Backups of the time before the
+encryption are read only with ``allow_plaintext``.
+"""
+import base64
+import binascii
+import hashlib
+import io
+import os
+import struct
+import threading
+
+from .exception import SBackupException, SBackupValidationError
+from .utils import parse_size
+
+try:
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+    from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+except ImportError:  # pragma: no cover
+    AESGCM = ChaCha20Poly1305 = None
+
+MAGIC = b'SBEN'
+VERSION = 1
+# magic, version, cipher, key id, segment size, salt
+HEADER = struct.Struct('>4sBB8sI16s')
+TAG_SIZE = 16
+KEY_SIZE = 32
+NONCE_PREFIX_SIZE = 7
+DEFAULT_SEGMENT_SIZE = 64 * 1024
+MIN_SEGMENT_SIZE = 4 * 1024
+MAX_SEGMENT_SIZE = 16 * 1024 * 1024
+MAX_SEGMENTS = 2 ** 32
+
+
+class EncryptionException(SBackupException):
+    """
+    A backup can't be decrypted
+    """
+    pass
+
+
+_ciphers = (
+    ('aes-256-gcm', 1),
+    ('chacha20-poly1305', 2),
+)
+CIPHERS = dict(_ciphers)
+
+
+def get_aead(cipher_id, key):
+    if cipher_id == CIPHERS['aes-256-gcm']:
+        return AESGCM(key)
+    if cipher_id == CIPHERS['chacha20-poly1305']:
+        return ChaCha20Poly1305(key)
+    raise EncryptionException("Unknown cipher %s of the backup" % cipher_id)
+
+
+def load_key(path):
+    """
+    Read a 256-bit key of the keyfile: 32 raw bytes, hex or base64
+
+    Raises:
+        SBackupValidationError: An error occur if the keyfile has no key
+    """
+    try:
+        with open(path, 'rb') as fileobj:
+            data = fileobj.read(1024)
+    except OSError as error:
+        raise SBackupValidationError("Can't read the keyfile %s: %s" % (path, error))
+    if len(data) == KEY_SIZE:
+        return data
+    text = data.strip()
+    for decode in (binascii.unhexlify, base64.b64decode):
+        try:
+            key = decode(text)
+        except (binascii.Error, ValueError):
+            continue
+        if len(key) == KEY_SIZE:
+            return key
+    raise SBackupValidationError(
+        "The keyfile %s has to contain a 256-bit key: 32 bytes, hex or base64" % path)
+
+
+def get_key_id(key):
+    return hashlib.sha256(b'sbackup key id' + key).digest()[:8]
+
+
+def is_encrypted(data):
+    return data[:len(MAGIC)] == MAGIC
+
+
+class Segments(object):
+    """
+    The cipher of one encrypted object
+    """
+
+    def __init__(self, key, header):
+        magic, version, cipher_id, key_id, segment_size, salt = HEADER.unpack(header)
+        if magic != MAGIC or version != VERSION:
+            raise EncryptionException("Unknown encryption format %s" % version)
+        if key_id != get_key_id(key):
+            raise EncryptionException("The backup was encrypted by another key")
+        material = HKDF(algorithm=hashes.SHA256(), length=KEY_SIZE + NONCE_PREFIX_SIZE, salt=salt,
+                        info=b'sbackup segments').derive(key)
+        self.header = header
+        self.segment_size = segment_size
+        self.aead = get_aead(cipher_id, material[:KEY_SIZE])
+        self.nonce_prefix = material[KEY_SIZE:]
+
+    @classmethod
+    def create(cls, key, cipher, segment_size):
+        header = HEADER.pack(MAGIC, VERSION, CIPHERS[cipher], get_key_id(key), segment_size,
+                             os.urandom(16))
+        return cls(key, header)
+
+    def nonce(self, number, last):
+        if number >= MAX_SEGMENTS:
+            raise EncryptionException("The stream is too long for the segment size")
+        return self.nonce_prefix + struct.pack('>IB', number, last)
+
+    def encrypt(self, number, data, last=False):
+        return self.aead.encrypt(self.nonce(number, last), data, self.header)
+
+    def decrypt(self, number, data, last=False):
+        try:
+            return self.aead.decrypt(self.nonce(number, last), data, self.header)
+        except InvalidTag:
+            raise EncryptionException("The segment %s is damaged" % number)
+
+
+class EncryptWriter(object):
+    """
+    A write-only file object, encrypts data by segments into the fileobj
+    """
+
+    def __init__(self, fileobj, key, cipher='aes-256-gcm', segment_size=DEFAULT_SEGMENT_SIZE):
+        self.fileobj = fileobj
+        self.segments = Segments.create(key, cipher, segment_size)
+        self.segment_size = segment_size
+        self.closed = False
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._number = 0
+        self._buffer = bytearray()
+        self._write(self.segments.header)
+
+    def writable(self):
+        return True
+
+    def _write(self, data):
+        self.fileobj.write(data)
+        self.bytes_out += len(data)
+
+    def _seal(self, data, last=False):
+        self._write(self.segments.encrypt(self._number, data, last))
+        self._number += 1
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('I/O operation on closed file.')
+        view = memoryview(data).cast('B')
+        self.bytes_in += len(view)
+        if self._buffer:
+            rest = self.segment_size - len(self._buffer)
+            self._buffer.extend(view[:rest])
+            view = view[rest:]
+            if len(self._buffer) < self.segment_size:
+                return len(data)
+            self._seal(bytes(self._buffer))
+            self._buffer = bytearray()
+        # Segments are sealed from the data without copies
+        while len(view) >= self.segment_size:
+            self._seal(view[:self.segment_size])
+            view = view[self.segment_size:]
+        self._buffer.extend(view)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        """
+        Seal the last segment, the fileobj stays opened
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self._seal(bytes(self._buffer), last=True)
+        self._buffer = bytearray()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.closed = True
+
+
+class DecryptReader(object):
+    """
+    A read-only file object of the decrypted fileobj, a plain fileobj is read
+    as is only with allow_plaintext
+    """
+
+    def __init__(self, fileobj, key, allow_plaintext=False):
+        self.fileobj = fileobj
+        self.closed = False
+        self.segments = None
+        self._number = 0
+        self._eof = False
+        self._buffer = b''
+        self._position = 0
+        header = self._read_exact(HEADER.size)
+        if is_encrypted(header) and len(header) == HEADER.size:
+            self.segments = Segments(key, header)
+        elif allow_plaintext:
+            # A backup of the time before the encryption
+            self._buffer = header
+        else:
+            raise EncryptionException(
+                "The stream is not encrypted, allow_plaintext reads backups made before the "
+                "encryption")
+
+    def readable(self):
+        return True
+
+    def _read_exact(self, size):
+        chunks = []
+        while size > 0:
+            data = self.fileobj.read(size)
+            if not data:
+                break
+            chunks.append(data)
+            size -= len(data)
+        return b''.join(chunks)
+
+    def _next(self):
+        if self.segments is None:
+            data = self.fileobj.read(io.DEFAULT_BUFFER_SIZE * 16)
+            self._eof = not data
+            return data
+        size = self.segments.segment_size + TAG_SIZE
+        data = self._read_exact(size)
+        if len(data) < TAG_SIZE:
+            raise EncryptionException("The encrypted stream is truncated")
+        last = len(data) < size
+        data = self.segments.decrypt(self._number, data, last)
+        self._number += 1
+        if last and self.fileobj.read(1):
+            raise EncryptionException("The encrypted stream has data after the last segment")
+        self._eof = last
+        return data
+
+    def read(self, size=-1):
+        if self.closed:
+            raise ValueError('I/O operation on closed file.')
+        chunks = []
+        while size != 0:
+            if self._position >= len(self._buffer):
+                if self._eof:
+                    break
+                self._buffer = self._next()
+                self._position = 0
+                continue
+            end = len(self._buffer) if size < 0 else min(self._position + size, len(self._buffer))
+            chunks.append(self._buffer[self._position:end])
+            if size > 0:
+                size -= end - self._position
+            self._position = end
+        return b''.join(chunks)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class DecryptingBackend(object):
+    """
+    A backend which decrypts objects while they are read, other methods
+    are of the backend
+
+    Usage::
+
+        backend = DecryptingBackend(dst_backend, settings)
+        index = load_index(backend, filename)
+        with RangeReader(backend, filename, index, members, codec) as reader:
+            ...
+
+    """
+
+    def __init__(self, backend, settings):
+        self.backend = backend
+        self.settings = settings
+        self._segments = {}
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def __iter__(self):
+        return iter(self.backend)
+
+    def open_reader(self, filename, *args, **kwargs):
+        reader = self.backend.open_reader(filename, *args, **kwargs)
+        try:
+            return self.settings.open_reader(reader)
+        except EncryptionException as error:
+            reader.close()
+            raise EncryptionException("Can't read the %s: %s" % (filename, error))
+
+    def get_object(self, name):
+        return self.settings.decrypt(self.backend.get_object(name))
+
+    def _get_segments(self, name):
+        with self._lock:
+            if name not in self._segments:
+                header = self.backend.read_range(name, 0, HEADER.size)
+                if is_encrypted(header):
+                    self._segments[name] = Segments(self.settings.key, header)
+                elif self.settings.allow_plaintext:
+                    self._segments[name] = None
+                else:
+                    raise EncryptionException("The %s is not encrypted" % name)
+            return self._segments[name]
+
+    def read_range(self, name, start, end):
+        """
+        Return bytes from start to end (exclusive) of the decrypted object
+        """
+        segments = self._get_segments(name)
+        if segments is None or end <= start:
+            return self.backend.read_range(name, start, end)
+        size = segments.segment_size
+        first, last = start // size, (end - 1) // size
+        data = self.backend.read_range(name, HEADER.size + first * (size + TAG_SIZE),
+                                       HEADER.size + (last + 1) * (size + TAG_SIZE))
+        chunks = []
+        for offset in range(0, len(data), size + TAG_SIZE):
+            segment = data[offset:offset + size + TAG_SIZE]
+            chunks.append(segments.decrypt(first + len(chunks), segment,
+                                           len(segment) < size + TAG_SIZE))
+        base = first * size
+        return b''.join(chunks)[start - base:end - base]
+
+    def __repr__(self):
+        return repr(self.backend)
+
+
+class EncryptionSettings(object):
+    """
+    Usage::
+
+        settings = EncryptionSettings(keyfile='/etc/sbackup/site1.key')
+        settings.validate()
+        with settings.open_writer(fileobj) as writer:
+            writer.write(data)
+
+    """
+
+    def __init__(self, keyfile=None, cipher='aes-256-gcm', segment_size=DEFAULT_SEGMENT_SIZE,
+                 allow_plaintext=False):
+        """
+        Args:
+            keyfile(str): A file of the 256-bit key, 32 bytes, hex or base64
+            cipher(str): aes-256-gcm or chacha20-poly1305
+            segment_size(int|str): A size of an authenticated segment
+            allow_plaintext(bool): Read plain backups of the time before the encryption
+        """
+        self.keyfile = keyfile
+        self.cipher = cipher
+        self.segment_size = segment_size
+        self.allow_plaintext = allow_plaintext
+        self._key = None
+
+    def validate(self):
+        if AESGCM is None:
+            raise SBackupValidationError(
+                "The encryption requires an extra package, run: pip install sbackup[encryption]")
+        if self.cipher not in CIPHERS:
+            raise SBackupValidationError(
+                "Unknown cipher %s, use one of: %s" % (self.cipher, ', '.join(CIPHERS)))
+        try:
+            self.segment_size = parse_size(self.segment_size)
+        except Exception:
+            raise SBackupValidationError("Can't parse the segment_size %s" % self.segment_size)
+        if not MIN_SEGMENT_SIZE <= self.segment_size <= MAX_SEGMENT_SIZE:
+            raise SBackupValidationError('The segment_size has to be from 4 KiB to 16 MiB')
+        if not isinstance(self.allow_plaintext, bool):
+            raise SBackupValidationError('The allow_plaintext has to be a boolean')
+        if not self.keyfile:
+            raise SBackupValidationError('The encryption requires a keyfile')
+        self._key = load_key(self.keyfile)
+
+    @property
+    def key(self):
+        if self._key is None:
+            self._key = load_key(self.keyfile)
+        return self._key
+
+    def open_writer(self, fileobj):
+        return EncryptWriter(fileobj, self.key, self.cipher, self.segment_size)
+
+    def open_reader(self, fileobj):
+        return DecryptReader(fileobj, self.key, self.allow_plaintext)
+
+    def open_backend(self, backend):
+        return DecryptingBackend(backend, self)
+
+    def get_encrypted_size(self, size):
+        """
+        Return the size of the encrypted stream of size bytes: the header and
+        a tag of every segment, the last segment is always shorter
+        """
+        return HEADER.size + size + (size // self.segment_size + 1) * TAG_SIZE
+
+    def encrypt(self, data):
+        output = io.BytesIO()
+        with self.open_writer(output) as writer:
+            writer.write(data)
+        return output.getvalue()
+
+    def decrypt(self, data):
+        """
+        Decrypt the data, plain data is returned as is only with allow_plaintext
+        """
+        with self.open_reader(io.BytesIO(data)) as reader:
+            return reader.read()
+
+    def __repr__(self):
+        return "<EncryptionSettings cipher=%s>" % self.cipher
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+The local index of file states for incremental backups
+"""
+import json
+import logging
+import os
+import sqlite3
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_INDEX_DIR = '~/.sbackup/index'
+# The member of an incremental archive with a list of deleted paths
+DELETED_MEMBER = '.sbackup-deleted'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    inode INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pending (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    inode INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+class FileIndex(object):
+    """
+    A SQLite index of (path, size, mtime, inode) of the last backup
+
+    New states are collected in the ``pending`` table and replace the
+    current states only after ``commit()``, so a failed backup doesn't
+    break the next increment.
+
+    Usage::
+
+        with FileIndex('/var/lib/sbackup/site1.sqlite') as index:
+            index.begin(full=False)
+            if index.is_changed('site1/index.html', os.lstat(path)):
+                ...
+            deleted = index.deleted()
+            index.commit('backup-site1-2017-01-11-10-10.incr.tar.gz')
+
+    """
+    batch_size = 1000
+
+    def __init__(self, path):
+        self.path = path
+        self.full = True
+        self._connection = None
+        self._batch = []
+
+    def open(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection = sqlite3.connect(self.path)
+        self._connection.executescript(_SCHEMA)
+        return self
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def get_meta(self, key, default=None):
+        row = self._connection.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set_meta(self, key, value):
+        self._connection.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                                 (key, json.dumps(value)))
+
+    @property
+    def runs_since_full(self):
+        """
+        A number of incremental runs after the last full backup, None if
+        there is no full backup yet
+        """
+        return self.get_meta('runs_since_full')
+
+    def begin(self, full):
+        """
+        Start a new backup
+
+        Args:
+            full(bool): A full backup adds all files regardless of the index
+        """
+        self.full = full
+        self._batch = []
+        self._connection.execute('DELETE FROM pending')
+
+    def is_changed(self, path, stat):
+        """
+        Record the new state of the path and compare it with the last backup
+
+        Args:
+            path(str): An archive name of the file
+            stat(os.stat_result): A result of the os.lstat
+        Returns:
+            bool
+        """
+        state = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+        self._batch.append((path,) + state)
+        if len(self._batch) >= self.batch_size:
+            self._flush()
+        row = self._connection.execute(
+            'SELECT size, mtime, inode FROM files WHERE path = ?', (path,)).fetchone()
+        return row is None or tuple(row) != state
+
+    def _flush(self):
+        self._connection.executemany(
+            'INSERT OR REPLACE INTO pending (path, size, mtime, inode) VALUES (?, ?, ?, ?)',
+            self._batch)
+        self._batch = []
+
+    def deleted(self):
+        """
+        Return paths of the last backup that don't exist anymore
+        """
+        self._flush()
+        cursor = self._connection.execute(
+            'SELECT path FROM files WHERE path NOT IN (SELECT path FROM pending) ORDER BY path')
+        return [row[0] for row in cursor]
+
+    def commit(self, archive_name, force_full=False):
+        """
+        Replace the file states by the pending states
+
+        Args:
+            archive_name(str)
+            force_full(bool): The next backup is full, a destination missed the archive
+        """
+        self._flush()
+        with self._connection:
+            self._connection.execute('DELETE FROM files')
+            self._connection.execute('INSERT INTO files SELECT * FROM pending')
+            self._connection.execute('DELETE FROM pending')
+            if force_full:
+                self.set_meta('runs_since_full', None)
+            else:
+                self.set_meta('runs_since_full',
+                              0 if self.full else (self.runs_since_full or 0) + 1)
+            self.set_meta('last_archive', archive_name)
+        logger.debug("The index %s was updated by %s" % (self.path, archive_name))
+
+    def rollback(self):
+        self._batch = []
+        self._connection.rollback()
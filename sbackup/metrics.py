@@ -0,0 +1,444 @@
+# -*- coding: utf-8 -*-
+"""
+Metrics of backup runs
+
+Every task measures its stages (source_snapshot, archive, upload, stream, dump, verify)
+and counts bytes and files. The executor collects the metrics of a run
+into a report: a JSON file and a file of the Prometheus text format for
+the textfile collector of the node exporter.
+"""
+import cProfile
+import datetime
+import json
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+
+from contextlib import contextmanager
+
+from .exception import SBackupValidationError
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PROFILE_DIR = '~/.sbackup/profiles'
+PROFILERS = ('cpu', 'memory')
+TRACEMALLOC_FRAMES = 10
+TOP_ALLOCATIONS = 50
+
+# Counters of a task and the help of their Prometheus metrics
+_counters = (
+    ('bytes_read', 'Uncompressed bytes of the archive or the dump'),
+    ('bytes_compressed', 'Compressed bytes'),
+    ('bytes_stored', 'Uncompressed bytes of already compressed data which were stored'),
+    ('bytes_uploaded', 'Bytes sent to the backend'),
+    ('files', 'Entries of the source'),
+    ('dirs_skipped', "Directories of the source which can't be read"),
+    ('retries', 'Retried requests to the backend'),
+    ('memory_peak', 'The peak of traced memory, bytes'),
+    ('files_changed', 'Files changed in place while they were archived from the source snapshot'),
+)
+COUNTERS = dict(_counters)
+
+
+class TaskMetrics(object):
+    """
+    Timings of stages and counters of one task run, stages and counters
+    may be updated by a few threads
+
+    Usage::
+
+        metrics = TaskMetrics('site1')
+        with metrics.stage('upload'):
+            backend.upload(path)
+        metrics.add('bytes_uploaded', os.path.getsize(path))
+
+    """
+
+    def __init__(self, name=None):
+        self.name = name
+        self.status = None
+        self.error = None
+        self.backup_file = None
+        self.queue_wait = None
+        self.duration = None
+        self.started = None
+        self.stages = {}
+        self.counters = {}
+        # A destination of a fan-out task -> {'status': 'ok' or 'failed', 'error': ...}
+        self.destinations = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Measure a stage, the time of a repeated stage is summed up
+        """
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - started
+            with self._lock:
+                self.stages[name] = self.stages.get(name, 0.0) + elapsed
+
+    def add(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def update(self, counters):
+        for name, value in counters.items():
+            self.add(name, value)
+
+    def set_destination(self, name, error=None):
+        """
+        Record the status of a destination, a failed destination missed the backup
+        """
+        with self._lock:
+            self.destinations[name] = {
+                'status': 'ok' if error is None else 'failed',
+                'error': None if error is None else '%s' % error,
+            }
+
+    @contextmanager
+    def measure(self):
+        """
+        Measure the whole run and record its status
+        """
+        self.started = datetime.datetime.now()
+        started = time.monotonic()
+        try:
+            yield self
+        except BaseException as error:
+            self.status = 'failed'
+            self.error = '%s' % error
+            raise
+        else:
+            self.status = 'ok'
+        finally:
+            self.duration = time.monotonic() - started
+
+    @property
+    def compression_ratio(self):
+        if not self.counters.get('bytes_compressed'):
+            return None
+        return self.counters.get('bytes_read', 0) / self.counters['bytes_compressed']
+
+    @property
+    def throughput(self):
+        """
+        Uncompressed bytes per second of the run
+        """
+        if not self.duration:
+            return None
+        return self.counters.get('bytes_read', 0) / self.duration
+
+    @property
+    def upload_rate(self):
+        """
+        Uploaded bytes per second of the upload or the stream stage
+        """
+        elapsed = sum(self.stages.get(name, 0.0) for name in ('upload', 'stream', 'dump', 'snapshot'))
+        if not elapsed:
+            return None
+        return self.counters.get('bytes_uploaded', 0) / elapsed
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'status': self.status,
+            'error': self.error,
+            'backup_file': self.backup_file,
+            'started': self.started.isoformat() if self.started else None,
+            'duration': self.duration,
+            'queue_wait': self.queue_wait,
+            'stages': dict(self.stages),
+            'counters': dict(self.counters),
+            'destinations': dict(self.destinations),
+            'compression_ratio': self.compression_ratio,
+            'throughput': self.throughput,
+            'upload_rate': self.upload_rate,
+        }
+
+    def __repr__(self):
+        return "<TaskMetrics %s>" % self.name
+
+
+def _escape(value):
+    return ('%s' % value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _write_atomic(path, data):
+    """
+    Write the file by a rename, a collector never reads a partial file
+    """
+    path = os.path.expanduser(path)
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = '%s.%s.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wt') as fileobj:
+        fileobj.write(data)
+    os.replace(tmp_path, path)
+
+
+class RunReport(object):
+    """
+    Metrics of tasks of one run
+
+    Usage::
+
+        report = RunReport([task.metrics for task in tasks])
+        report.write_json('/var/lib/sbackup/report.json')
+        report.write_prometheus('/var/lib/node_exporter/sbackup.prom')
+
+    """
+
+    def __init__(self, tasks=(), started=None):
+        """
+        Args:
+            tasks(list): TaskMetrics of tasks
+            started(datetime.datetime): The start of the run
+        """
+        self.tasks = list(tasks)
+        self.started = started or datetime.datetime.now()
+        self.finished = datetime.datetime.now()
+
+    def to_dict(self):
+        return {
+            'started': self.started.isoformat(),
+            'finished': self.finished.isoformat(),
+            'duration': (self.finished - self.started).total_seconds(),
+            'tasks': [metrics.to_dict() for metrics in self.tasks],
+        }
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2)
+
+    def to_prometheus(self):
+        """
+        Return the report in the Prometheus text format, all metrics are gauges
+        of the last run
+        """
+        metrics = []
+
+        def gauge(name, description, samples):
+            samples = [(labels, value) for labels, value in samples if value is not None]
+            if not samples:
+                return
+            metrics.append('# HELP sbackup_%s %s' % (name, description))
+            metrics.append('# TYPE sbackup_%s gauge' % name)
+            for labels, value in samples:
+                label = ','.join('%s="%s"' % (key, _escape(item)) for key, item in labels)
+                metrics.append('sbackup_%s{%s} %r' % (name, label, float(value)))
+
+        tasks = [(('task', item.name),) for item in self.tasks]
+        gauge('task_success', 'The last run of the task succeeded',
+              [(labels, item.status == 'ok') for labels, item in zip(tasks, self.tasks)])
+        gauge('task_last_run_timestamp_seconds', 'The start of the last run',
+              [(labels, item.started.timestamp() if item.started else None)
+               for labels, item in zip(tasks, self.tasks)])
+        gauge('task_duration_seconds', 'The duration of the last run',
+              [(labels, item.duration) for labels, item in zip(tasks, self.tasks)])
+        gauge('task_queue_wait_seconds', 'The time in the queue of the scheduler',
+              [(labels, item.queue_wait) for labels, item in zip(tasks, self.tasks)])
+        gauge('stage_duration_seconds', 'The duration of a stage of the last run',
+              [(labels + (('stage', stage),), elapsed)
+               for labels, item in zip(tasks, self.tasks)
+               for stage, elapsed in sorted(item.stages.items())])
+        for counter, description in _counters:
+            gauge('task_%s' % counter, description,
+                  [(labels, item.counters.get(counter)) for labels, item in zip(tasks, self.tasks)])
+        gauge('destination_success', 'The destination received the backup of the last run',
+              [(labels + (('destination', name),), info['status'] == 'ok')
+               for labels, item in zip(tasks, self.tasks)
+               for name, info in sorted(item.destinations.items())])
+        gauge('task_compression_ratio', 'Uncompressed bytes per a compressed byte',
+              [(labels, item.compression_ratio) for labels, item in zip(tasks, self.tasks)])
+        gauge('task_upload_rate_bytes', 'Uploaded bytes per second',
+              [(labels, item.upload_rate) for labels, item in zip(tasks, self.tasks)])
+        return '\n'.join(metrics) + '\n'
+
+    def write_json(self, path):
+        _write_atomic(path, self.to_json())
+
+    def write_prometheus(self, path):
+        _write_atomic(path, self.to_prometheus())
+
+    def log(self):
+        for item in self.tasks:
+            logger.info("Task {name}: {status} in {duration:.2f}s, stages: {stages}, {counters}".format(
+                name=item.name,
+                status=item.status,
+                duration=item.duration or 0.0,
+                stages=', '.join('%s %.2fs' % stage for stage in sorted(item.stages.items())),
+                counters=', '.join('%s %s' % counter for counter in sorted(item.counters.items()))
+            ))
+            for name, info in sorted(item.destinations.items()):
+                if info['status'] != 'ok':
+                    logger.warning("Task {task}: the destination {name} failed: {error}".format(
+                        task=item.name, name=name, error=info['error']))
+
+
+def validate_profile(attr):
+    if attr not in PROFILERS:
+        raise SBackupValidationError('The profile has to be one of: %s' % ', '.join(PROFILERS))
+    return attr
+
+
+# threading.setprofile and tracemalloc are process-wide, profilers of tasks
+# which run at the same time share them, the lock guards their counters
+_profiling_lock = threading.Lock()
+_cpu_profilers = 0
+# (thread, cProfile.Profile) of threads started while a CPU profiler is enabled
+_thread_profiles = []
+_memory_profilers = 0
+# The first memory profiler started tracemalloc, the last one stops it
+_memory_started = False
+# Profilers enabled since the process start, a profiler sees the overlapping ones by them
+_sessions = {'cpu': 0, 'memory': 0}
+
+
+def _start_thread(frame, event, arg):
+    # threading.setprofile calls it in a new thread once, then cProfile takes over
+    sys.setprofile(None)
+    with _profiling_lock:
+        if not _cpu_profilers:
+            return
+        profile = cProfile.Profile()
+        _thread_profiles.append((threading.current_thread(), profile))
+    profile.enable()
+
+
+class ThreadProfiler(object):
+    """
+    cProfile of the current thread and of threads started while it is
+    enabled (compression, walker and upload pools). Profiles of finished
+    threads are merged at the end, a thread which is still alive keeps
+    its profiler until it ends and is left out.
+
+    New threads are profiled process-wide: when profiled tasks overlap,
+    the profile of each of them has threads of the others.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.profile = None
+        self.shared = False
+        self._threads = None
+        self._first = self._last = 0
+        self._session = 0
+
+    def enable(self):
+        global _cpu_profilers, _thread_profiles
+        with _profiling_lock:
+            if not _cpu_profilers:
+                # Profiles of earlier runs are dropped, their profilers keep the old list
+                _thread_profiles = []
+                threading.setprofile(_start_thread)
+            self.shared = _cpu_profilers > 0
+            _cpu_profilers += 1
+            _sessions['cpu'] += 1
+            self._session = _sessions['cpu']
+            self._threads = _thread_profiles
+            self._first = len(self._threads)
+        self.enabled = True
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+
+    def disable(self):
+        global _cpu_profilers
+        self.profile.disable()
+        self.enabled = False
+        with _profiling_lock:
+            _cpu_profilers -= 1
+            self.shared = self.shared or _cpu_profilers > 0 or _sessions['cpu'] != self._session
+            if not _cpu_profilers:
+                threading.setprofile(None)
+            self._last = len(self._threads)
+
+    def dump_stats(self, path):
+        stats = pstats.Stats(self.profile)
+        with _profiling_lock:
+            profiles = self._threads[self._first:self._last]
+        for thread, profile in profiles:
+            if thread.is_alive():
+                continue
+            try:
+                stats.add(profile)
+            except TypeError:
+                # A thread which never called a function has no stats
+                pass
+        stats.dump_stats(path)
+
+
+@contextmanager
+def profiler(name, mode=None, directory=None, metrics=None):
+    """
+    Profile the block by cProfile (cpu) or tracemalloc (memory), the result
+    is stored in the directory as <name>-<time>.prof or <name>-<time>.txt.
+    Both profilers are process-wide: when profiled tasks run at the same
+    time, the memory peak and the threads of the profile are shared.
+
+    Args:
+        name(str): A task name
+        mode(str): cpu, memory or None
+        directory(str): A directory of results, default is ~/.sbackup/profiles
+        metrics(TaskMetrics): Record the memory peak
+    """
+    global _memory_profilers, _memory_started
+    if not mode:
+        yield
+        return
+    directory = os.path.expanduser(directory or DEFAULT_PROFILE_DIR)
+    os.makedirs(directory, exist_ok=True)
+    prefix = os.path.join(directory, '%s-%s' % (
+        name, datetime.datetime.now().strftime('%Y-%m-%d-%H-%M-%S')))
+    if mode == 'cpu':
+        profiler = ThreadProfiler()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(prefix + '.prof')
+            if profiler.shared:
+                logger.warning("The profile of the %s has threads of other profiled tasks "
+                               "which ran at the same time" % name)
+            logger.info("The profile of the %s was saved to %s.prof" % (name, prefix))
+        return
+    with _profiling_lock:
+        if not _memory_profilers:
+            # The peak is reset only when no other task measures it
+            _memory_started = not tracemalloc.is_tracing()
+            if _memory_started:
+                tracemalloc.start(TRACEMALLOC_FRAMES)
+            tracemalloc.reset_peak()
+        shared = _memory_profilers > 0
+        _memory_profilers += 1
+        _sessions['memory'] += 1
+        session = _sessions['memory']
+    try:
+        yield
+    finally:
+        with _profiling_lock:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            shared = shared or _memory_profilers > 1 or _sessions['memory'] != session
+            _memory_profilers -= 1
+            if not _memory_profilers and _memory_started:
+                tracemalloc.stop()
+        if metrics is not None:
+            metrics.add('memory_peak', peak)
+        with open(prefix + '.txt', 'wt') as fileobj:
+            fileobj.write('Peak: %d bytes, current: %d bytes%s\n' % (
+                peak, current, ', process-wide with other profiled tasks' if shared else ''))
+            for stat in snapshot.statistics('lineno')[:TOP_ALLOCATIONS]:
+                fileobj.write('%s\n' % stat)
+        if shared:
+            logger.warning("The memory peak of the %s is shared with other profiled tasks "
+                           "which ran at the same time" % name)
+        logger.info("The memory profile of the %s was saved to %s.txt" % (name, prefix))
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""
+Include and exclude rules of the source
+
+Patterns have the gitignore syntax: a pattern without a slash matches a
+name at any depth, a pattern with a slash matches a path from the source
+root, a trailing slash matches only directories, ``*`` and ``?`` don't
+match a slash, ``**`` matches any directories and ``!`` includes paths
+which a previous pattern excluded. The last matching pattern wins.
+
+Patterns are compiled once: literal names (``node_modules``) and
+extensions (``*.log``) are looked up in sets, the rest is one combined
+regex of every run of patterns with the same sign, so a path costs a few
+lookups and at most one regex match per run. The walker calls the filter
+for every entry, an excluded directory is never listed.
+"""
+import re
+import time
+
+from .exception import SBackupValidationError
+from .utils import parse_size
+from .walker import is_dir
+
+# Characters of globs, a pattern without them is a literal name
+GLOB_CHARS = frozenset('*?[\\')
+DAY = 24 * 60 * 60
+
+
+def translate(pattern):
+    """
+    Convert a gitignore pattern without the ! and the trailing slash to a regex
+
+    Returns:
+        regex(str)
+    """
+    anchored = '/' in pattern
+    pattern = pattern.lstrip('/')
+    parts = []
+    index = 0
+    while index < len(pattern):
+        char = pattern[index]
+        if pattern.startswith('**/', index):
+            parts.append('(?:.*/)?')
+            index += 3
+            continue
+        if pattern.startswith('/**', index) and index + 3 == len(pattern):
+            parts.append('/.*')
+            index += 3
+            continue
+        index += 1
+        if char == '*':
+            parts.append('[^/]*')
+            while pattern.startswith('*', index):
+                index += 1
+        elif char == '?':
+            parts.append('[^/]')
+        elif char == '[':
+            end = pattern.find(']', index + 1)
+            if end == -1:
+                parts.append(re.escape(char))
+                continue
+            chars = pattern[index:end].replace('\\', '\\\\')
+            if chars.startswith('!'):
+                chars = '^' + chars[1:]
+            parts.append('[%s]' % chars)
+            index = end + 1
+        elif char == '\\' and index < len(pattern):
+            parts.append(re.escape(pattern[index]))
+            index += 1
+        else:
+            parts.append(re.escape(char))
+    regex = ''.join(parts)
+    return regex if anchored else '(?:.*/)?' + regex
+
+
+class PatternRun(object):
+    """
+    Consecutive patterns of the same sign, compiled into sets and a regex
+    for directories and for other entries
+    """
+
+    def __init__(self, patterns, negated):
+        self.negated = negated
+        self.names = (set(), set())
+        self.extensions = (set(), set())
+        regexes = ([], [])
+        for pattern in patterns:
+            directory = pattern.endswith('/')
+            pattern = pattern.rstrip('/')
+            # Patterns of directories are in the first, patterns of all entries in both
+            kinds = (0,) if directory else (0, 1)
+            literal = not (GLOB_CHARS & set(pattern))
+            if literal and '/' not in pattern:
+                for kind in kinds:
+                    self.names[kind].add(pattern)
+            elif pattern.startswith('*.') and '/' not in pattern and \
+                    not (GLOB_CHARS & set(pattern[2:])):
+                for kind in kinds:
+                    self.extensions[kind].add(pattern[1:])
+            else:
+                for kind in kinds:
+                    regexes[kind].append(translate(pattern))
+        self.extensions = tuple(tuple(items) for items in self.extensions)
+        self.regexes = tuple(re.compile('|'.join('(?:%s)' % regex for regex in items))
+                             if items else None for items in regexes)
+
+    def matches(self, path, name, directory):
+        kind = 0 if directory else 1
+        if name in self.names[kind]:
+            return True
+        if self.extensions[kind] and name.endswith(self.extensions[kind]):
+            return True
+        regex = self.regexes[kind]
+        return regex is not None and regex.fullmatch(path) is not None
+
+
+class PatternSet(object):
+    """
+    Gitignore patterns, the last matching pattern wins
+
+    Usage::
+
+        patterns = PatternSet(['*.log', '!important.log', 'node_modules/'])
+        patterns.match('app/debug.log')  # True
+        patterns.match('app/important.log')  # False
+
+    """
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        self.runs = []
+        run = []
+        negated = None
+        for pattern in self.patterns:
+            pattern = pattern.strip()
+            if not pattern or pattern.startswith('#'):
+                continue
+            sign = pattern.startswith('!')
+            if sign != negated and run:
+                self.runs.append(PatternRun(run, negated))
+                run = []
+            negated = sign
+            run.append(pattern[1:] if sign else pattern)
+        if run:
+            self.runs.append(PatternRun(run, negated))
+        self.runs.reverse()
+
+    def lookup(self, path, directory=False):
+        """
+        Returns:
+            bool: True if the last matching pattern isn't negated, None if nothing matches
+        """
+        name = path.rpartition('/')[2]
+        for run in self.runs:
+            if run.matches(path, name, directory):
+                return not run.negated
+        return None
+
+    def match(self, path, directory=False):
+        """
+        Args:
+            path(str): A path relative to the source root
+            directory(bool)
+        Returns:
+            bool: True if the last matching pattern isn't negated
+        """
+        return bool(self.lookup(path, directory))
+
+    def match_file(self, path):
+        """
+        Match the file and, if no pattern matches it, its directories from the
+        nearest one, so ``docs/`` matches every file below the docs
+
+        Returns:
+            bool
+        """
+        result = self.lookup(path)
+        while result is None and '/' in path:
+            path = path.rpartition('/')[0]
+            result = self.lookup(path, directory=True)
+        return bool(result)
+
+    def __bool__(self):
+        return bool(self.runs)
+
+
+class PathFilter(object):
+    """
+    The accept function of sbackup.walker.Walker
+
+    Usage::
+
+        path_filter = PathFilter(exclude=['.cache/', '*.log'], max_size='1GB', max_age=30)
+        path_filter.validate()
+        with Walker(accept=path_filter) as walker:
+            ...
+
+    """
+
+    def __init__(self, exclude=None, include=None, max_size=None, max_age=None):
+        """
+        Args:
+            exclude(list): Patterns of excluded entries, a directory is excluded with its subtree
+            include(list): Patterns of files to archive, a pattern of a directory includes
+                the files below it, other files are excluded, directories are walked
+                unless they are excluded
+            max_size(int|str): Files bigger than the size are excluded
+            max_age(int|float): Files modified more than the days ago are excluded
+        """
+        self.exclude = exclude or []
+        self.include = include or []
+        self.max_size = max_size
+        self.max_age = max_age
+        self._excluded = None
+        self._included = None
+        self._min_mtime = None
+
+    def validate(self):
+        for name in ('exclude', 'include'):
+            value = getattr(self, name)
+            if not isinstance(value, list) or not all(isinstance(item, str) for item in value):
+                raise SBackupValidationError('The %s has to be a list of patterns' % name)
+        if self.max_size is not None:
+            try:
+                self.max_size = parse_size(self.max_size)
+            except Exception:
+                raise SBackupValidationError("Can't parse the max_size %s" % self.max_size)
+        if self.max_age is not None and (not isinstance(self.max_age, (int, float)) or
+                                         self.max_age <= 0):
+            raise SBackupValidationError('The max_age has to be a positive number of days')
+        try:
+            self.compile()
+        except re.error as error:
+            raise SBackupValidationError("Can't compile a pattern: %s" % error)
+
+    def compile(self):
+        self._excluded = PatternSet(self.exclude)
+        self._included = PatternSet(self.include)
+        self._min_mtime = time.time() - self.max_age * DAY if self.max_age else None
+
+    def __call__(self, entry):
+        """
+        Args:
+            entry(sbackup.walker.Entry): An entry below the source root
+        Returns:
+            bool: False if the entry is excluded
+        """
+        if self._excluded is None:
+            self.compile()
+        path = entry.arcname.partition('/')[2]
+        directory = is_dir(entry)
+        if self._excluded and self._excluded.match(path, directory):
+            return False
+        if directory:
+            return True
+        if self._included and not self._included.match_file(path):
+            return False
+        if self.max_size is not None and entry.stat.st_size > self.max_size:
+            return False
+        if self._min_mtime is not None and entry.stat.st_mtime < self._min_mtime:
+            return False
+        return True
+
+    def __repr__(self):
+        return "<PathFilter exclude=%s include=%s>" % (len(self.exclude), len(self.include))
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""
+The resource-aware scheduler of backup tasks
+
+Every task declares its demand: CPU slots (compression workers), a share of
+the read bandwidth of the source disk, a space in the tmp dir and a network
+slot. A task starts when its demand fits into the free budgets. Tasks are
+ordered by the priority and then by the runtime of the last run, longest
+first, small tasks fill the gaps between the long ones.
+"""
+import concurrent.futures
+import datetime
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HISTORY_PATH = '~/.sbackup/history.json'
+DEFAULT_HUGE_SIZE = 10 * 1024 ** 3
+# A huge task takes more than half of the disk, so two of them never run together
+HUGE_DISK_SHARE = 0.6
+SMALL_DISK_SHARE = 0.4
+MIN_DISK_SHARE = 0.05
+
+
+class Demand(object):
+    """
+    Resources of a task
+    Attributes:
+       cpu(int): CPU slots
+       device(int): A device of the source, st_dev
+       tmp_space(int): Bytes in the tmp dir
+       network(int): Network slots
+    """
+
+    def __init__(self, cpu=1, device=None, tmp_space=0, network=1):
+        self.cpu = cpu
+        self.device = device
+        self.tmp_space = tmp_space
+        self.network = network
+
+
+class Job(object):
+
+    def __init__(self, name, func, priority=0, expected_size=0, demand=None):
+        self.name = name
+        self.func = func
+        self.priority = priority
+        self.expected_size = expected_size
+        self.demand = demand or Demand()
+        self.disk_share = MIN_DISK_SHARE
+        self.expected_duration = None
+        self.queued = None
+        self.started = None
+        self.finished = None
+
+    @property
+    def queue_wait(self):
+        if self.started is None:
+            return None
+        return self.started - self.queued
+
+    @property
+    def duration(self):
+        if self.finished is None:
+            return None
+        return self.finished - self.started
+
+    def __repr__(self):
+        return "<Job %s>" % self.name
+
+
+class Resources(object):
+    """
+    Budgets of the host
+
+    A job bigger than a budget runs when nothing else uses the budget
+    """
+
+    def __init__(self, cpu=None, network=4, tmp_space=None, workers=None,
+                 huge_size=DEFAULT_HUGE_SIZE):
+        self.cpu = cpu or os.cpu_count() or 1
+        self.network = network
+        self.tmp_space = tmp_space or shutil.disk_usage(tempfile.gettempdir()).free
+        self.workers = workers
+        self.huge_size = huge_size
+        self.used_cpu = 0
+        self.used_network = 0
+        self.used_tmp_space = 0
+        self.used_disk = {}
+        self.running = 0
+
+    def get_disk_share(self, job):
+        if job.expected_size >= self.huge_size:
+            return HUGE_DISK_SHARE
+        return max(SMALL_DISK_SHARE * job.expected_size / self.huge_size, MIN_DISK_SHARE)
+
+    @staticmethod
+    def _fits(used, need, budget):
+        return not used or used + need <= budget
+
+    def fits(self, job):
+        demand = job.demand
+        if self.workers and self.running >= self.workers:
+            return False
+        disk = self.used_disk.get(demand.device, 0)
+        return (self._fits(self.used_cpu, demand.cpu, self.cpu) and
+                self._fits(self.used_network, demand.network, self.network) and
+                self._fits(self.used_tmp_space, demand.tmp_space, self.tmp_space) and
+                (demand.device is None or self._fits(disk, job.disk_share, 1.0)))
+
+    def acquire(self, job):
+        self._update(job, 1)
+
+    def release(self, job):
+        self._update(job, -1)
+
+    def _update(self, job, sign):
+        demand = job.demand
+        self.running += sign
+        self.used_cpu += sign * demand.cpu
+        self.used_network += sign * demand.network
+        self.used_tmp_space += sign * demand.tmp_space
+        if demand.device is not None:
+            self.used_disk[demand.device] = self.used_disk.get(demand.device, 0) + sign * job.disk_share
+
+
+class History(object):
+    """
+    Runtimes of the last runs of tasks
+    """
+
+    def __init__(self, path=None):
+        self.path = os.path.expanduser(path or DEFAULT_HISTORY_PATH)
+        self.data = {}
+        try:
+            with open(self.path, 'rt') as fileobj:
+                self.data = json.load(fileobj)
+        except FileNotFoundError:
+            pass
+        except ValueError:
+            logger.error("The history %s is damaged, it will be rebuilt" % self.path)
+
+    def get_duration(self, name):
+        return self.data.get(name, {}).get('duration')
+
+    def record(self, job):
+        self.data[job.name] = {
+            'duration': job.duration,
+            'queue_wait': job.queue_wait,
+            'finished': datetime.datetime.now().isoformat(),
+        }
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = '%s.%s.tmp' % (self.path, os.getpid())
+        with open(tmp_path, 'wt') as fileobj:
+            json.dump(self.data, fileobj, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+class Scheduler(object):
+    """
+    Usage::
+
+        scheduler = Scheduler(Resources(cpu=4, network=2), History())
+        results = scheduler.run([Job('site1', task.create, priority=1), ...])
+
+    """
+
+    def __init__(self, resources=None, history=None, executor_cls=None):
+        self.resources = resources or Resources()
+        self.history = history
+        self.executor_cls = executor_cls or concurrent.futures.ThreadPoolExecutor
+
+    def get_order(self, jobs):
+        """
+        Higher priority first, then the longest expected runtime first (LPT),
+        jobs without history are the first in their priority
+        """
+        def key(job):
+            duration = job.expected_duration
+            return (-job.priority, -(float('inf') if duration is None else duration),
+                    -job.expected_size, job.name)
+        return sorted(jobs, key=key)
+
+    def prepare(self, job):
+        job.disk_share = self.resources.get_disk_share(job)
+        if self.history is not None:
+            job.expected_duration = self.history.get_duration(job.name)
+
+    def run(self, jobs):
+        """
+        Run jobs, returns a dict name -> result or an exception
+        """
+        for job in jobs:
+            self.prepare(job)
+        pending = self.get_order(jobs)
+        running = {}
+        results = {}
+        queued = time.monotonic()
+        for job in pending:
+            job.queued = queued
+        with self.executor_cls(max_workers=max(len(pending), 1)) as executor:
+            while pending or running:
+                for job in list(pending):
+                    if self.resources.fits(job):
+                        pending.remove(job)
+                        self.resources.acquire(job)
+                        job.started = time.monotonic()
+                        logger.debug("Start the %s after %.2fs in the queue" % (job.name, job.queue_wait))
+                        running[executor.submit(job.func)] = job
+                done, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    job = running.pop(future)
+                    job.finished = time.monotonic()
+                    self.resources.release(job)
+                    try:
+                        results[job.name] = future.result()
+                    except Exception as error:
+                        results[job.name] = error
+                    else:
+                        if self.history is not None:
+                            self.history.record(job)
+        if self.history is not None:
+            self.history.save()
+        return results
@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+"""
+The seekable archive index
+
+Archives are compressed by independent blocks of ``block_size`` bytes
+(see sbackup.compress), so a block can be decompressed without the data
+before it. The index sidecar maps every tar member to its offsets in the
+uncompressed stream and every block to its offset in the archive, a few
+members are restored by ranged reads of their blocks only. The SHA-256 of
+the archive and of every file verify the backup later. The sidecar is
+stored as ``index/<archive>.json.gz``, beside listings of backups.
+"""
+import collections
+import gzip
+import hashlib
+import io
+import json
+import logging
+import tarfile
+
+from concurrent.futures import ThreadPoolExecutor
+
+from .exception import SBackupException
+from .index import DELETED_MEMBER
+
+logger = logging.getLogger(__name__)
+
+INDEX_PREFIX = 'index/'
+INDEX_EXTENSION = '.json.gz'
+INDEX_VERSION = 1
+# A tar archive or a single compressed stream (a database dump)
+FORMAT_TAR = 'tar'
+FORMAT_RAW = 'raw'
+DEFAULT_FETCH_SIZE = 8 * 1024 * 1024
+DEFAULT_MAX_CONCURRENCY = 4
+
+
+def get_index_name(filename):
+    return INDEX_PREFIX + filename + INDEX_EXTENSION
+
+
+class HashingReader(object):
+    """
+    A file object wrapper, hashes data which is read through it
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.hash.update(data)
+        self.size += len(data)
+        return data
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+
+class IndexedTarFile(tarfile.TarFile):
+    """
+    A TarFile which records the offsets and the checksums of written members
+
+    Attributes:
+       spans(list): (name, start, end, sha256) of every member in the tar
+           stream, the span includes extended headers and the padding,
+           the sha256 of the member data is None for members without data
+       compress_writer(sbackup.compress.ParallelCompressWriter): The writer
+           of the stream, it stores data of compressed members
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.spans = []
+        self.compress_writer = kwargs.pop('compress_writer', None)
+        super(IndexedTarFile, self).__init__(*args, **kwargs)
+
+    def addfile(self, tarinfo, fileobj=None):
+        start = self.offset
+        if fileobj is not None:
+            if self.compress_writer is not None:
+                # The data follows a header, extended headers are within the gap of stored ranges
+                self.compress_writer.add_member(tarinfo.name, fileobj, start + tarfile.BLOCKSIZE,
+                                                tarinfo.size)
+            fileobj = HashingReader(fileobj)
+        super(IndexedTarFile, self).addfile(tarinfo, fileobj)
+        self.spans.append((tarinfo.name, start, self.offset,
+                           fileobj.hexdigest() if fileobj is not None else None))
+
+
+class ArchiveIndex(object):
+    """
+    Usage::
+
+        with compressor.open_writer(fileobj) as writer:
+            with IndexedTarFile.open(fileobj=writer, mode='w|', compress_writer=writer) as tar:
+                tar.add(path)
+        index = ArchiveIndex.from_writer(writer, tar)
+        backend.put_object(get_index_name(filename), index.dump())
+
+    """
+
+    def __init__(self, codec, block_size, blocks, members, checksum=None, format=FORMAT_TAR):
+        """
+        Args:
+            codec(str): A codec name
+            block_size(int): A size of an uncompressed block
+            blocks(list): Offsets of blocks in the archive and the archive size
+            members(list): (name, start, end, sha256) in the uncompressed stream,
+                a raw stream has one member
+            checksum(str): The SHA-256 of the archive
+            format(str): tar or raw
+        """
+        self.codec = codec
+        self.block_size = block_size
+        self.blocks = blocks
+        self.members = members
+        self.checksum = checksum
+        self.format = format
+
+    @property
+    def size(self):
+        return self.blocks[-1]
+
+    @classmethod
+    def from_writer(cls, writer, tar):
+        """
+        Args:
+            writer(sbackup.compress.ParallelCompressWriter): A closed writer
+            tar(IndexedTarFile)
+        """
+        return cls(writer.codec.name, writer.block_size, writer.offsets + [writer.bytes_out],
+                   tar.spans, checksum=writer.checksum.hexdigest())
+
+    def dump(self):
+        return gzip.compress(json.dumps({
+            'version': INDEX_VERSION,
+            'codec': self.codec,
+            'block_size': self.block_size,
+            'blocks': self.blocks,
+            'members': self.members,
+            'sha256': self.checksum,
+            'format': self.format,
+        }).encode('utf-8'), mtime=0)
+
+    @classmethod
+    def load(cls, data):
+        data = json.loads(gzip.decompress(data).decode('utf-8'))
+        if data.get('version') != INDEX_VERSION:
+            raise SBackupException("Unsupported index version %s" % data.get('version'))
+        return cls(data['codec'], data['block_size'], data['blocks'],
+                   [tuple(member) for member in data['members']], checksum=data.get('sha256'),
+                   format=data.get('format', FORMAT_TAR))
+
+    def select(self, arcnames):
+        """
+        Return members of the arcnames and their subdirectories, the list
+        of deleted files of an increment is always selected
+        """
+        prefixes = tuple(arcname + '/' for arcname in arcnames)
+        return [member for member in self.members
+                if member[0] in arcnames or member[0].startswith(prefixes) or
+                member[0] == DELETED_MEMBER]
+
+    def get_spans(self, members):
+        """
+        Merge adjacent members into spans of the uncompressed stream
+        """
+        spans = []
+        for _, start, end, _ in sorted(members, key=lambda member: member[1]):
+            if spans and spans[-1][1] >= start:
+                spans[-1][1] = max(spans[-1][1], end)
+            else:
+                spans.append([start, end])
+        return spans
+
+    def get_fetches(self, members, fetch_size=DEFAULT_FETCH_SIZE):
+        """
+        Split spans of the members into ranged reads of whole blocks
+
+        Yields:
+            (first_block, last_block, start, end): Blocks of a read and the
+                part of the uncompressed stream which is needed from them
+        """
+        for start, end in self.get_spans(members):
+            block = start // self.block_size
+            last = (end - 1) // self.block_size
+            while block <= last:
+                stop = block
+                while (stop < last and
+                       self.blocks[stop + 2] - self.blocks[block] <= fetch_size):
+                    stop += 1
+                yield (block, stop, max(start, block * self.block_size),
+                       min(end, (stop + 1) * self.block_size))
+                block = stop + 1
+
+
+class RangeReader(object):
+    """
+    A read-only file object of the tar stream of selected members, blocks
+    are downloaded and decompressed by a thread pool ahead of the consumer
+
+    Usage::
+
+        with RangeReader(backend, filename, index, index.select(['site/etc'])) as fileobj:
+            with tarfile.open(fileobj=fileobj, mode='r|') as tar:
+                tar.extractall(path)
+
+    """
+
+    def __init__(self, backend, filename, index, members, codec,
+                 max_concurrency=DEFAULT_MAX_CONCURRENCY, fetch_size=DEFAULT_FETCH_SIZE):
+        self.backend = backend
+        self.filename = filename
+        self.index = index
+        self.codec = codec
+        self.closed = False
+        self.bytes_fetched = 0
+        self._fetches = index.get_fetches(members, fetch_size)
+        self._futures = collections.deque()
+        self._buffer = b''
+        self._position = 0
+        self.max_concurrency = max(int(max_concurrency), 1)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+
+    def readable(self):
+        return True
+
+    def _fetch(self, first, last, start, end):
+        blocks = self.index.blocks
+        data = self.backend.read_range(self.filename, blocks[first], blocks[last + 1])
+        self.bytes_fetched += len(data)
+        with self.codec.open_reader(io.BytesIO(data)) as reader:
+            data = reader.read()
+        base = first * self.index.block_size
+        return data[start - base:end - base]
+
+    def _fill(self):
+        while len(self._futures) < self.max_concurrency:
+            fetch = next(self._fetches, None)
+            if fetch is None:
+                return
+            self._futures.append(self._executor.submit(self._fetch, *fetch))
+
+    def read(self, size=-1):
+        if self.closed:
+            raise ValueError('I/O operation on closed file.')
+        chunks = []
+        while size != 0:
+            if self._position >= len(self._buffer):
+                self._fill()
+                if not self._futures:
+                    break
+                self._buffer = self._futures.popleft().result()
+                self._position = 0
+                self._fill()
+            end = len(self._buffer) if size < 0 else min(self._position + size, len(self._buffer))
+            chunk = self._buffer[self._position:end]
+            self._position = end
+            chunks.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+        return b''.join(chunks)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._futures.clear()
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def load_index(backend, filename):
+    """
+    Return the index of the archive, None if the archive has no index
+    """
+    try:
+        return ArchiveIndex.load(backend.get_object(get_index_name(filename)))
+    except NotImplementedError:
+        return None
+    except SBackupException as error:
+        logger.debug("Can't load the index of %s: %s" % (filename, error))
+        return None
+
+
+def delete_indexes(backend, names):
+    """
+    Delete sidecars of deleted archives, a missing sidecar is not an error
+    """
+    try:
+        errors = backend.delete_objects([get_index_name(name) for name in names])
+    except NotImplementedError:
+        return
+    for name, error in errors.items():
+        logger.error("Can't delete the index %s: %s" % (name, error))
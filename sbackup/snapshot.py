@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+"""
+Point-in-time copies of the source
+
+The archive is read from a copy of the source, so writers of the source
+don't wait for the archive and the archive doesn't see their later changes.
+A link farm is a tree of hard links or reflinks (copy-on-write clones of
+btrfs, XFS) next to the source, it costs only metadata operations. A hard
+link shares the data with the source, a file rewritten in place (not
+replaced by a rename) changes in the farm too: linking a file sets its
+ctime, so files changed after the farm was made are found by a newer ctime
+(a file removed from the source has only the link of the farm).
+The ``auto`` method clones files when the file system supports reflinks and
+links them otherwise. The ``command`` method runs hooks which create and
+remove a file system snapshot (LVM, btrfs, ZFS).
+"""
+import errno
+import fcntl
+import logging
+import os
+import shlex
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+
+from contextlib import contextmanager
+
+from .exception import SBackupException, SBackupValidationError
+from .walker import Walker, is_dir
+
+logger = logging.getLogger(__name__)
+
+METHODS = ('auto', 'hardlink', 'reflink', 'command')
+# The ioctl of Linux which clones a file
+FICLONE = 0x40049409
+# Errors of file systems without reflinks
+NO_REFLINK_ERRORS = (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EXDEV, errno.ENOSYS)
+REPORT_CHANGED = 10
+
+
+class SnapshotException(SBackupException):
+    """
+    A snapshot can't be created
+    """
+    pass
+
+
+def reflink(src, dst):
+    """
+    Clone the src file as the dst, the data is shared until one of them is written
+    """
+    with open(src, 'rb') as source, open(dst, 'xb') as target:
+        try:
+            fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+        except OSError:
+            target.close()
+            os.remove(dst)
+            raise
+    shutil.copystat(src, dst, follow_symlinks=False)
+    if os.geteuid() == 0:
+        info = os.lstat(src)
+        os.chown(dst, info.st_uid, info.st_gid, follow_symlinks=False)
+
+
+def remove_tree(path):
+    """
+    Remove the tree, directories of the copy keep modes of the source, so a
+    directory which can't be written or listed is made accessible and the
+    removal is retried. Paths which still can't be removed are logged.
+    """
+    def on_error(function, name, error):
+        try:
+            os.chmod(os.path.dirname(name), stat.S_IRWXU)
+            if function in (os.rmdir, os.unlink, os.remove):
+                function(name)
+            else:
+                # The directory itself can't be listed
+                os.chmod(name, stat.S_IRWXU)
+                shutil.rmtree(name, **{handler: on_error})
+        except FileNotFoundError:
+            pass
+        except OSError as retry_error:
+            logger.error("Can't remove the %s of the snapshot: %s" % (name, retry_error))
+
+    # onerror is deprecated since Python 3.12
+    handler = 'onexc' if sys.version_info >= (3, 12) else 'onerror'
+    shutil.rmtree(path, **{handler: on_error})
+
+
+class LinkFarm(object):
+    """
+    A tree of hard links or reflinks of the source
+
+    Attributes:
+       path(str): The copy of the source
+       reflinks(bool): Regular files are cloned, None detects it by the first file
+       created(int): The time of the end of the copy, ns
+       cloned(int): A number of cloned files
+       linked(int): A number of linked files
+    """
+
+    def __init__(self, source, path, reflinks=None, walk_workers=1, accept=None):
+        self.source = source
+        self.path = path
+        self.reflinks = reflinks
+        self.walk_workers = walk_workers
+        self.accept = accept
+        self.created = None
+        self.cloned = 0
+        self.linked = 0
+        # (path, error) of source directories which can't be read
+        self.skipped = []
+
+    def _copy_file(self, entry, target):
+        if stat.S_ISREG(entry.stat.st_mode) and self.reflinks is not False:
+            try:
+                reflink(entry.path, target)
+                self.reflinks = True
+                self.cloned += 1
+                return
+            except OSError as error:
+                if self.reflinks or error.errno not in NO_REFLINK_ERRORS:
+                    raise SnapshotException("Can't clone the %s: %s" % (entry.path, error))
+                logger.debug("The file system doesn't support reflinks: %s" % error)
+                self.reflinks = False
+        try:
+            os.link(entry.path, target, follow_symlinks=False)
+        except OSError as error:
+            if error.errno == errno.EXDEV:
+                raise SnapshotException(
+                    "The snapshot %s isn't on the file system of the source" % self.path)
+            if error.errno not in (errno.EPERM, errno.EACCES) or \
+                    not stat.S_ISREG(entry.stat.st_mode):
+                raise SnapshotException("Can't link the %s: %s" % (entry.path, error))
+            # Protected hard links of files of other users, the file is copied
+            shutil.copy2(entry.path, target)
+        self.linked += 1
+
+    def create(self):
+        dirs = []
+        with Walker(self.walk_workers, accept=self.accept) as walker:
+            for entry in walker.walk(self.source, os.path.basename(self.path)):
+                target = os.path.join(os.path.dirname(self.path), entry.arcname)
+                if is_dir(entry):
+                    os.mkdir(target, 0o700)
+                    dirs.append((target, entry))
+                    continue
+                try:
+                    self._copy_file(entry, target)
+                except FileNotFoundError:
+                    logger.debug("The file %s was deleted" % entry.path)
+        self.skipped = walker.skipped
+        # Directory times change while entries are created, set them at the end
+        for target, entry in reversed(dirs):
+            if os.geteuid() == 0:
+                os.chown(target, entry.stat.st_uid, entry.stat.st_gid)
+            os.chmod(target, stat.S_IMODE(entry.stat.st_mode))
+            os.utime(target, ns=(entry.stat.st_atime_ns, entry.stat.st_mtime_ns))
+        self.created = time.time_ns()
+        logger.debug("The copy {path} of {source} was created, linked: {linked}, "
+                     "cloned: {cloned}".format(path=self.path, source=self.source,
+                                               linked=self.linked, cloned=self.cloned))
+
+    def changed(self):
+        """
+        Return names of linked files which were changed after the copy was created
+        """
+        def is_changed(info):
+            if info.st_ctime_ns <= self.created:
+                return False
+            return info.st_nlink > 1 or info.st_mtime_ns > self.created
+
+        if not self.linked:
+            return []
+        names = []
+        with Walker(self.walk_workers) as walker:
+            for entry in walker.walk(self.path, os.path.basename(self.path)):
+                if stat.S_ISREG(entry.stat.st_mode) and is_changed(entry.stat):
+                    names.append(entry.arcname)
+        return names
+
+    def remove(self):
+        remove_tree(os.path.dirname(self.path))
+
+
+class CommandSnapshot(object):
+    """
+    A file system snapshot of hooks, the create hook makes the snapshot of
+    the source available as the path, the remove hook removes it. Hooks are
+    run by the shell, {source} and {path} are replaced by quoted paths.
+    """
+
+    def __init__(self, source, path, create, remove=None):
+        self.source = source
+        self.path = path
+        self.create_command = create
+        self.remove_command = remove
+
+    def run(self, command):
+        command = command.format(source=shlex.quote(self.source), path=shlex.quote(self.path))
+        logger.debug("Run the snapshot hook: %s" % command)
+        process = subprocess.run(command, shell=True, stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT)
+        if process.returncode:
+            raise SnapshotException("The snapshot hook {command} failed with the code {code}: "
+                                    "{output}".format(
+                                        command=command,
+                                        code=process.returncode,
+                                        output=process.stdout.decode('utf-8', 'replace').strip()))
+
+    def create(self):
+        self.run(self.create_command)
+        if not os.path.exists(self.path):
+            raise SnapshotException("The snapshot hook didn't create the %s" % self.path)
+
+    def changed(self):
+        return []
+
+    def remove(self):
+        if self.remove_command:
+            self.run(self.remove_command)
+        # A snapshot which is still mounted is never removed recursively
+        for directory in (self.path, os.path.dirname(self.path)):
+            try:
+                os.rmdir(directory)
+            except FileNotFoundError:
+                pass
+            except OSError as error:
+                logger.error("Can't remove the snapshot dir %s: %s" % (directory, error))
+                break
+
+
+class SnapshotSettings(object):
+    """
+    Usage::
+
+        settings = SnapshotSettings(method='hardlink')
+        with settings.open('/var/www/site1') as copy:
+            tar.add(copy.path, arcname='site1')
+            changed = copy.changed()
+
+    """
+
+    def __init__(self, method='auto', path=None, create=None, remove=None):
+        """
+        Args:
+            method(str): auto, hardlink, reflink or command
+            path(str): A directory of copies, it has to be on the file system
+                of the source for links, default is the parent of the source
+            create(str): A hook which makes the snapshot as the {path}
+            remove(str): A hook which removes the snapshot
+        """
+        self.method = method
+        self.path = path
+        self.create = create
+        self.remove = remove
+
+    def validate(self):
+        if self.method not in METHODS:
+            raise SBackupValidationError(
+                "Unknown snapshot method %s, use one of: %s" % (self.method, ', '.join(METHODS)))
+        if self.method == 'command' and not self.create:
+            raise SBackupValidationError('The command snapshot requires a create hook')
+        if self.path and not os.path.isdir(self.path):
+            raise SBackupValidationError("Can't find a %s" % self.path)
+
+    @contextmanager
+    def open(self, source, reflinks=None, walk_workers=1, accept=None):
+        """
+        Create a copy of the source and remove it on the exit
+
+        Args:
+            source(str)
+            reflinks(bool): Clone files by the auto method, False if the
+                copy has to keep inodes of the source
+            walk_workers(int)
+            accept: The accept function of the walker, excluded entries are not copied
+        Yields:
+            LinkFarm or CommandSnapshot
+        """
+        parent = self.path or os.path.dirname(os.path.abspath(source))
+        name = os.path.basename(source)
+        tmp_dir = tempfile.mkdtemp(prefix='.%s.snapshot-' % name, dir=parent)
+        path = os.path.join(tmp_dir, name)
+        if self.method == 'command':
+            copy = CommandSnapshot(source, path, self.create, self.remove)
+        else:
+            reflinks = {'hardlink': False, 'reflink': True}.get(self.method, reflinks)
+            copy = LinkFarm(source, path, reflinks=reflinks, walk_workers=walk_workers,
+                            accept=accept)
+        try:
+            copy.create()
+        except BaseException:
+            # The error of the create hook is more useful than the one of the remove hook
+            try:
+                copy.remove()
+            except SnapshotException as error:
+                logger.error("Can't remove the snapshot %s: %s" % (path, error))
+            raise
+        try:
+            yield copy
+        finally:
+            copy.remove()
+
+    def __repr__(self):
+        return "<SnapshotSettings method=%s>" % self.method
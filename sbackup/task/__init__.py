@@ -1,13 +1,20 @@
 # -*- coding: utf-8 -*-
+from .db import CommandDumpTask, MySQLDumpTask, PostgresDumpTask
 from .dir import DirBackupTask
 
 __all__ = (
+    'CommandDumpTask',
     'DirBackupTask',
+    'MySQLDumpTask',
+    'PostgresDumpTask',
     'TASK_CLASSES'
 )
 
 _task_classes = (
     ('dir', DirBackupTask),
+    ('command', CommandDumpTask),
+    ('mysql', MySQLDumpTask),
+    ('postgres', PostgresDumpTask),
 )
 
 TASK_CLASSES = dict(_task_classes)
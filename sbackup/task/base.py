@@ -1,6 +1,22 @@
 # -*- coding: utf-8 -*-
-from sbackup.exception import SBackupValidationError
-from sbackup.dest_backend import get_backend
+import logging
+import os
+
+from contextlib import contextmanager, nullcontext
+
+from sbackup.exception import SBackupException, SBackupValidationError
+from sbackup.compress import Compressor
+from sbackup.dest_backend import get_destination
+from sbackup.dest_backend.fanout import FanOutBackend
+from sbackup.encryption import EncryptionSettings
+from sbackup.metrics import TaskMetrics, profiler, validate_profile
+from sbackup.rules import PathFilter
+from sbackup.scheduler import Demand
+from sbackup.seekable import get_index_name
+from sbackup.snapshot import SnapshotSettings
+from sbackup.verify import verify as verify_file
+
+logger = logging.getLogger(__name__)
 
 
 class Field(object):
@@ -29,10 +45,8 @@ class Backend(Field):
             raise SBackupValidationError(
                 'The %s has to be a dict' % self.__class__.__name__
             )
-        data = value.copy()
-        backend_name, backend_conf = data.popitem()
         try:
-            backend = get_backend(backend_name, backend_conf)
+            backend = get_destination(value)
         except TypeError:
             raise SBackupValidationError('Incorrect a backend configuration')
         if backend is None:
@@ -40,6 +54,62 @@ class Backend(Field):
         setattr(instance, self.internal_name, backend)
 
 
+class Compression(Field):
+
+    def __set__(self, instance, value):
+        if not isinstance(value, dict):
+            raise SBackupValidationError(
+                'The %s has to be a dict' % self.__class__.__name__
+            )
+        try:
+            compressor = Compressor(**value)
+        except TypeError:
+            raise SBackupValidationError('Incorrect a compression configuration')
+        setattr(instance, self.internal_name, compressor)
+
+
+class Snapshot(Field):
+
+    def __set__(self, instance, value):
+        if not isinstance(value, dict):
+            raise SBackupValidationError(
+                'The %s has to be a dict' % self.__class__.__name__
+            )
+        try:
+            settings = SnapshotSettings(**value)
+        except TypeError:
+            raise SBackupValidationError('Incorrect a snapshot configuration')
+        setattr(instance, self.internal_name, settings)
+
+
+class Encryption(Field):
+
+    def __set__(self, instance, value):
+        if not isinstance(value, dict):
+            raise SBackupValidationError(
+                'The %s has to be a dict' % self.__class__.__name__
+            )
+        try:
+            settings = EncryptionSettings(**value)
+        except TypeError:
+            raise SBackupValidationError('Incorrect an encryption configuration')
+        setattr(instance, self.internal_name, settings)
+
+
+class Filters(Field):
+
+    def __set__(self, instance, value):
+        if not isinstance(value, dict):
+            raise SBackupValidationError(
+                'The %s has to be a dict' % self.__class__.__name__
+            )
+        try:
+            path_filter = PathFilter(**value)
+        except TypeError:
+            raise SBackupValidationError('Incorrect a filters configuration')
+        setattr(instance, self.internal_name, path_filter)
+
+
 class TaskMetaclass(type):
     """
         This metaclass sets a list named `_fields` on the class.
@@ -50,22 +120,48 @@ class TaskMetaclass(type):
     """
     def __new__(meta, name, bases, class_dict):
         fields = []
+        for base in bases:
+            fields.extend(field for field in getattr(base, '_fields', ()) if field not in fields)
         for field_name, obj in class_dict.items():
             if isinstance(obj, Field):
                 obj.name = field_name
                 obj.internal_name = '_' + 'hidden_' + field_name
-                fields.append(field_name)
+                if field_name not in fields:
+                    fields.append(field_name)
         class_dict['_fields'] = tuple(fields)
         cls = type.__new__(meta, name, bases, class_dict)
         return cls
 
 
 class Task(object, metaclass=TaskMetaclass):
+    """
+    Attributes:
+       profile(str): Profile the run by cProfile (cpu) or tracemalloc (memory)
+       profile_dir(str): A directory of profiles, default is ~/.sbackup/profiles
+       config(dict): The settings of create_task, worker processes create the task again by them
+       encryption(dict): Encrypt backups by the key of the keyfile (keyfile, cipher, segment_size,
+           allow_plaintext)
+    """
     _fields = ()
+    profile = Field(required=False)
+    profile_dir = Field(required=False)
+    encryption = Encryption(required=False)
 
-    def validate(self):
+    def __init__(self):
+        self.metrics = TaskMetrics()
+        self.config = {}
+
+    @staticmethod
+    def validate_profile(attr):
+        return validate_profile(attr)
+
+    def validate(self, fields=None):
+        """
+        Args:
+            fields(tuple): Validate only these fields, all fields by default
+        """
         errors = dict()
-        for field in self.get_fields():
+        for field in fields or self.get_fields():
             validate_method = getattr(self, 'validate_' + field, None)
             attr = getattr(self, field)
             if attr is not None:
@@ -95,6 +191,7 @@ class Task(object, metaclass=TaskMetaclass):
             attrs(dict): A dict
         """
         obj = cls()
+        obj.config = attrs
         for field in obj.get_fields():
             value = attrs.get(field)
             if not value:
@@ -102,5 +199,135 @@ class Task(object, metaclass=TaskMetaclass):
             setattr(obj, field, value)
         return obj
 
+    def has_archive_stage(self):
+        """
+        Return True if the task creates an archive by make_tarfile(tmp_dir)
+        and uploads it by dst_backend.upload as separate stages
+        """
+        return False
+
+    def get_demand(self, expected_size=0):
+        """
+        Return resources of the task for the scheduler
+
+        Args:
+            expected_size(int): An expected size of the source
+        Returns:
+            sbackup.scheduler.Demand
+        """
+        return Demand()
+
+    def open_encrypted(self, fileobj):
+        """
+        Return a writer which encrypts data into the fileobj, the fileobj
+        itself if the task has no encryption
+        """
+        if self.encryption is None:
+            return nullcontext(fileobj)
+        return self.encryption.open_writer(fileobj)
+
+    def encrypt(self, data):
+        return data if self.encryption is None else self.encryption.encrypt(data)
+
+    def get_uploaded_size(self, size):
+        """
+        Return bytes sent to the backend for the compressed size
+        """
+        return size if self.encryption is None else self.encryption.get_encrypted_size(size)
+
+    def open_decrypted(self, fileobj):
+        if self.encryption is None:
+            return nullcontext(fileobj)
+        return self.encryption.open_reader(fileobj)
+
+    def get_read_backend(self, backend=None):
+        """
+        Return the backend which decrypts backups while they are read
+        """
+        backend = backend or self.dst_backend
+        return backend if self.encryption is None else self.encryption.open_backend(backend)
+
+    def put_index(self, filename, data):
+        """
+        Store the seekable index of the archive, the archive is restorable
+        without the index, so an error is only logged
+        """
+        try:
+            self.dst_backend.put_object(get_index_name(filename), self.encrypt(data))
+        except NotImplementedError:
+            pass
+        except SBackupException as error:
+            logger.error("Can't store the index of {file}: {error}".format(file=filename, error=error))
+
+    @contextmanager
+    def open_backup(self, filename, tmp_dir):
+        """
+        Open the backup, the backup is streamed from the backend when the
+        backend supports it, otherwise it is downloaded in the tmp_dir
+        """
+        try:
+            reader = self.get_read_backend().open_reader(filename)
+        except NotImplementedError:
+            src_file = self.dst_backend.download(filename, tmp_dir)
+            try:
+                with open(src_file, 'rb') as fileobj, self.open_decrypted(fileobj) as reader:
+                    yield reader
+            finally:
+                os.remove(src_file)
+            return
+        with reader:
+            yield reader
+
+    def get_failed_destinations(self):
+        """
+        Return names of destinations of a fan-out task which failed in this run
+        """
+        if not isinstance(self.dst_backend, FanOutBackend):
+            return []
+        return [name for name in self.dst_backend.backends if name in self.dst_backend.failed]
+
+    def verify_backup(self, backup_file):
+        """
+        Read the backup from the backend and compare checksums
+
+        Raises:
+            SBackupException: An error occur if the backup is damaged
+        """
+        if isinstance(self.dst_backend, FanOutBackend):
+            # Every destination which received the backup is read
+            backends = self.dst_backend.get_available()
+        else:
+            backends = {repr(self.dst_backend): self.dst_backend}
+        for name, backend in backends.items():
+            with self.metrics.stage('verify'):
+                result = verify_file(self.get_read_backend(backend), backup_file)
+            if not result.ok:
+                raise SBackupException("The backup %s is damaged in the %s: %s" % (
+                    backup_file, name, '; '.join(result.errors)))
+            logger.info("The {file} was verified in the {backend} in {elapsed:.2f}s".format(
+                file=backup_file,
+                backend=name,
+                elapsed=result.elapsed
+            ))
+
+    def execute(self):
+        """
+        Create a backup, measure the run and profile it if the task has the profile
+
+        Returns:
+            backup_file(str)
+        """
+        self.metrics.name = self.name
+        try:
+            with profiler(self.name, self.profile, self.profile_dir, self.metrics):
+                with self.metrics.measure():
+                    self.metrics.backup_file = self.create()
+        finally:
+            self.metrics.add('retries', self.dst_backend.get_retries())
+            if isinstance(self.dst_backend, FanOutBackend):
+                for name in self.dst_backend.backends:
+                    self.metrics.set_destination(name, self.dst_backend.failed.get(name))
+        return self.metrics.backup_file
+
     def run(self):
         return NotImplementedError
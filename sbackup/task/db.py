@@ -0,0 +1,485 @@
+# -*- coding: utf-8 -*-
+import datetime
+import logging
+import os
+import shlex
+import shutil
+import subprocess
+
+from sbackup.compress import Compressor, get_codec_by_filename
+from sbackup.dump import DumpReader, DumpException, DEFAULT_BUFFER_SIZE, READ_SIZE
+from sbackup.exception import SBackupException, SBackupValidationError
+from sbackup.scheduler import Demand
+from sbackup.seekable import ArchiveIndex, HashingReader, FORMAT_RAW
+from sbackup.utils import get_backup_name, parse_size
+from .base import Task, Field, Backend, Compression
+from .dir import create_temp_dir
+
+logger = logging.getLogger(__name__)
+
+# The member name of a dump in the archive index
+DUMP_MEMBER = 'dump'
+
+
+class DumpTask(Task):
+    """
+    The base task of database dumps
+
+    The stdout of dump commands is compressed and streamed to the backend,
+    the dump isn't written to the disk. Commands of parts of the dump
+    (tables) run in ``jobs`` processes at the same time, their outputs
+    are stored in the order of commands.
+    Attributes:
+       name(str): A task name
+       dst_backend(dict): A backend settings
+       compression(dict): A codec, level and number of workers, default is gz
+       jobs(int): Dump commands running at the same time, default is 1
+       buffer_size(int|str): Output of a command ahead of the stored one kept in memory,
+           the rest is spooled to the tmp_dir, default is 64MB
+       tmp_dir(basestring): A tmp path, default is TMPDIR
+       verify(bool): Read the backup from the backend after the upload and compare checksums
+    """
+    name = Field()
+    dst_backend = Backend()
+    compression = Compression(default=Compressor(), required=False)
+    jobs = Field(default=1, required=False)
+    buffer_size = Field(default=DEFAULT_BUFFER_SIZE, required=False)
+    tmp_dir = Field(required=False)
+    verify = Field(default=False, required=False)
+
+    extension = '.dump'
+
+    @staticmethod
+    def validate_jobs(attr):
+        if not isinstance(attr, int) or attr < 1:
+            raise SBackupValidationError('The jobs has to be a positive number')
+        return attr
+
+    @staticmethod
+    def validate_buffer_size(attr):
+        try:
+            return parse_size(attr)
+        except SBackupException as error:
+            raise SBackupValidationError('Incorrect buffer_size: %s' % error)
+
+    @staticmethod
+    def validate_tmp_dir(attr):
+        if not os.path.isdir(attr):
+            logger.error("Can't find a %s" % attr)
+            raise SBackupValidationError("Can't find a %s" % attr)
+        return attr
+
+    def validate(self, fields=None):
+        super(DumpTask, self).validate(fields)
+        for executable in self.get_executables():
+            if shutil.which(executable) is None:
+                raise SBackupValidationError("Can't find the %s" % executable)
+
+    def get_executables(self):
+        """
+        Return programs of the dump commands
+        """
+        return []
+
+    def get_commands(self):
+        """
+        Return the dump commands, every command is a list of arguments
+        """
+        raise NotImplementedError
+
+    def get_restore_command(self):
+        """
+        Return a command which reads the dump from stdin
+        """
+        raise NotImplementedError
+
+    def get_env(self):
+        """
+        Return environment variables of commands, None to inherit them
+        """
+        return None
+
+    def get_backup_name(self):
+        return get_backup_name(self.name)
+
+    def get_archive_name(self):
+        return "{name}-{time}{ext}{codec}".format(
+            name=self.get_backup_name(),
+            time=datetime.datetime.now().strftime('%Y-%m-%d-%H-%M'),
+            ext=self.extension,
+            codec=self.compression.codec.extension
+        )
+
+    def get_demand(self, expected_size=0):
+        return Demand(cpu=self.compression.workers, network=1)
+
+    def dump(self):
+        """
+        Stream the dump to the backend
+
+        Returns:
+            backup_file(str)
+        """
+        filename = self.get_archive_name()
+        commands = self.get_commands()
+        logger.debug("Start streaming the dump {file} to {backend}, {count} commands".format(
+            file=filename,
+            backend=str(self.dst_backend),
+            count=len(commands)
+        ))
+        with self.metrics.stage('dump'), \
+                DumpReader(commands, jobs=self.jobs, env=self.get_env(),
+                           buffer_size=self.buffer_size, tmp_dir=self.tmp_dir) as reader:
+            reader = HashingReader(reader)
+            with self.dst_backend.open_writer(filename) as fileobj, \
+                    self.open_encrypted(fileobj) as encrypted:
+                with self.compression.open_writer(encrypted) as writer:
+                    shutil.copyfileobj(reader, writer, READ_SIZE)
+        archive_index = ArchiveIndex(
+            writer.codec.name, writer.block_size, writer.offsets + [writer.bytes_out],
+            [(DUMP_MEMBER, 0, reader.size, reader.hexdigest())],
+            checksum=writer.checksum.hexdigest(), format=FORMAT_RAW)
+        self.put_index(filename, archive_index.dump())
+        self.metrics.add('bytes_read', reader.size)
+        self.metrics.add('bytes_compressed', writer.bytes_out)
+        self.metrics.add('bytes_stored', writer.stored_bytes)
+        self.metrics.add('bytes_uploaded', self.get_uploaded_size(writer.bytes_out))
+        logger.info("The dump {file} was streamed to {backend}".format(
+            file=filename,
+            backend=str(self.dst_backend)
+        ))
+        return filename
+
+    def create(self):
+        self.validate()
+        backup_file = self.dump()
+        if self.verify:
+            self.verify_backup(backup_file)
+        return backup_file
+
+    def restore(self, backup_file, paths=None):
+        """
+        Feed the backup, the last one by default, to the restore command
+
+        Args:
+            backup_file(str)
+        """
+        if paths:
+            raise SBackupValidationError("A dump is restored as a whole")
+        if not backup_file:
+            backup_file = self.dst_backend.get_last_backup(name=self.get_backup_name())
+            if not backup_file:
+                raise SBackupValidationError("Backup doesn't exist in the backend")
+        command = self.get_restore_command()
+        codec = get_codec_by_filename(backup_file)
+        logger.debug("Start restore the file {file} by {command}".format(
+            file=backup_file,
+            command=command[0]
+        ))
+        with create_temp_dir(self.tmp_dir) as tmp_dir, \
+                self.open_backup(backup_file, tmp_dir) as fileobj, \
+                codec.open_reader(fileobj) as reader:
+            try:
+                process = subprocess.Popen(command, stdin=subprocess.PIPE, env=self.get_env())
+            except OSError as error:
+                raise DumpException("Can't run the %s: %s" % (command[0], error))
+            try:
+                shutil.copyfileobj(reader, process.stdin, READ_SIZE)
+                process.stdin.close()
+            except BrokenPipeError:
+                # The command exited, its code tells why
+                pass
+            except BaseException:
+                process.kill()
+                raise
+            finally:
+                process.wait()
+        if process.returncode:
+            raise DumpException("The %s exited with the code %s" % (command[0], process.returncode))
+        logger.info("The {file} was restored".format(file=backup_file))
+
+
+class CommandDumpTask(DumpTask):
+    """
+    The task for a dump of any command which writes it to stdout
+    Attributes:
+       command(str|list): A command, a list of commands is dumped in parallel by jobs,
+           their outputs are concatenated
+       restore_command(str): A command which reads the dump from stdin
+       extension(str): An extension of the backup before the codec one, default is .dump
+
+    Usage::
+
+        from sbackup.task import CommandDumpTask
+        data = {
+            'name': 'redis',
+            'command': 'redis-cli --rdb -',
+            'extension': '.rdb',
+            'dst_backend': {
+                'local': {
+                    'path': '/mnt/nas/backups'
+                }
+            }
+        }
+        obj = CommandDumpTask.create_task(data)
+        obj.create()
+
+    """
+    command = Field()
+    restore_command = Field(required=False)
+    extension = Field(default=DumpTask.extension, required=False)
+
+    @staticmethod
+    def validate_command(attr):
+        commands = attr if isinstance(attr, list) else [attr]
+        if not commands or not all(isinstance(item, str) and item.strip() for item in commands):
+            raise SBackupValidationError('The command has to be a string or a list of strings')
+        return commands
+
+    @staticmethod
+    def validate_extension(attr):
+        if not isinstance(attr, str) or not attr.startswith('.'):
+            raise SBackupValidationError('The extension has to start with a dot')
+        return attr
+
+    def get_executables(self):
+        return [shlex.split(command)[0] for command in self.command]
+
+    def get_commands(self):
+        return [shlex.split(command) for command in self.command]
+
+    def get_restore_command(self):
+        if not self.restore_command:
+            raise SBackupValidationError("The task %s has no restore_command" % self.name)
+        return shlex.split(self.restore_command)
+
+
+class DatabaseDumpTask(DumpTask):
+    """
+    A dump of a database server
+    Attributes:
+       database(str): A database name
+       host(str)
+       port(int)
+       user(str)
+       password(str): It is passed to commands by the environment
+       tables(list): Dump only the tables
+       options(list): Extra arguments of the dump command
+    """
+    database = Field()
+    host = Field(required=False)
+    port = Field(required=False)
+    user = Field(required=False)
+    password = Field(required=False)
+    tables = Field(required=False)
+    options = Field(default=[], required=False)
+
+    extension = '.sql'
+    password_env = None
+
+    @staticmethod
+    def validate_database(attr):
+        if not isinstance(attr, str):
+            raise SBackupValidationError('The database has to be a string')
+        return attr
+
+    @staticmethod
+    def validate_tables(attr):
+        if not isinstance(attr, list) or not all(isinstance(item, str) for item in attr):
+            raise SBackupValidationError('The tables has to be a list of names')
+        return attr
+
+    @staticmethod
+    def validate_options(attr):
+        if not isinstance(attr, list) or not all(isinstance(item, str) for item in attr):
+            raise SBackupValidationError('The options has to be a list of arguments')
+        return attr
+
+    def get_env(self):
+        if not self.password:
+            return None
+        return dict(os.environ, **{self.password_env: str(self.password)})
+
+    def list_tables(self):
+        """
+        Return tables of the database
+        """
+        command = self.get_list_command()
+        try:
+            output = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                    env=self.get_env(), check=True).stdout
+        except (OSError, subprocess.CalledProcessError) as error:
+            raise DumpException("Can't list tables of the %s: %s" % (self.database, error))
+        return [line for line in output.decode('utf-8').splitlines() if line]
+
+    def get_list_command(self):
+        raise NotImplementedError
+
+    def get_commands(self):
+        if self.jobs == 1:
+            return [self.get_dump_command()]
+        tables = self.tables or self.list_tables()
+        return self.get_parallel_commands(tables)
+
+    def get_dump_command(self):
+        raise NotImplementedError
+
+    def get_parallel_commands(self, tables):
+        raise NotImplementedError
+
+
+class PostgresDumpTask(DatabaseDumpTask):
+    """
+    The task for pg_dump, a plain SQL dump which psql restores
+
+    With ``jobs`` the schema is dumped before and after the data
+    (``--section``) and the data of every table is dumped by a separate
+    pg_dump, the tables are not dumped in one snapshot.
+
+    Usage::
+
+        from sbackup.task import PostgresDumpTask
+        data = {
+            'name': 'shop',
+            'database': 'shop',
+            'host': 'db1',
+            'user': 'backup',
+            'jobs': 4,
+            'dst_backend': {
+                's3': {
+                    'access_key_id': 'key_id',
+                    'secret_access_key': 'access_key',
+                    'bucket': 'backup'
+                }
+            }
+        }
+        obj = PostgresDumpTask.create_task(data)
+        obj.create()
+
+    """
+    password_env = 'PGPASSWORD'
+
+    def get_executables(self):
+        return ['pg_dump']
+
+    def get_connection(self):
+        args = ['--no-password']
+        if self.host:
+            args.extend(['--host', self.host])
+        if self.port:
+            args.extend(['--port', str(self.port)])
+        if self.user:
+            args.extend(['--username', self.user])
+        return args
+
+    def get_list_command(self):
+        return ['psql'] + self.get_connection() + [
+            '--no-align', '--tuples-only', '--command',
+            "SELECT quote_ident(schemaname) || '.' || quote_ident(tablename) FROM pg_tables "
+            "WHERE schemaname NOT IN ('pg_catalog', 'information_schema') ORDER BY 1",
+            '--dbname', self.database]
+
+    def _pg_dump(self, *args):
+        return ['pg_dump'] + self.get_connection() + self.options + list(args) + [self.database]
+
+    def get_dump_command(self):
+        return self._pg_dump(*self.get_table_args('--table'))
+
+    def get_table_args(self, option, tables=None):
+        args = []
+        for table in (self.tables if tables is None else tables) or ():
+            args.extend([option, table])
+        return args
+
+    def get_parallel_commands(self, tables):
+        selected = self.get_table_args('--table')
+        commands = [self._pg_dump('--section=pre-data', *selected)]
+        commands.extend(self._pg_dump('--section=data', '--table', table) for table in tables)
+        if not self.tables:
+            # Sequences, large objects and tables created after the listing
+            commands.append(self._pg_dump('--section=data',
+                                          *self.get_table_args('--exclude-table', tables)))
+        commands.append(self._pg_dump('--section=post-data', *selected))
+        return commands
+
+    def get_restore_command(self):
+        return ['psql'] + self.get_connection() + [
+            '--quiet', '--set', 'ON_ERROR_STOP=1', '--dbname', self.database]
+
+
+class MySQLDumpTask(DatabaseDumpTask):
+    """
+    The task for mysqldump, InnoDB tables are dumped in a transaction
+
+    With ``jobs`` the schema, the data of every table and the triggers are
+    dumped by separate mysqldump commands, the tables are not dumped in
+    one transaction.
+
+    Usage::
+
+        from sbackup.task import MySQLDumpTask
+        data = {
+            'name': 'app',
+            'database': 'app',
+            'user': 'backup',
+            'password': 'secret',
+            'jobs': 4,
+            'dst_backend': {
+                'local': {
+                    'path': '/mnt/nas/backups'
+                }
+            }
+        }
+        obj = MySQLDumpTask.create_task(data)
+        obj.create()
+
+    """
+    password_env = 'MYSQL_PWD'
+
+    def get_executables(self):
+        return ['mysqldump']
+
+    def get_connection(self):
+        args = []
+        if self.host:
+            args.append('--host=%s' % self.host)
+        if self.port:
+            args.append('--port=%s' % self.port)
+        if self.user:
+            args.append('--user=%s' % self.user)
+        return args
+
+    def get_list_command(self):
+        return ['mysql'] + self.get_connection() + [
+            '--batch', '--skip-column-names', '--execute',
+            "SHOW FULL TABLES WHERE Table_type = 'BASE TABLE'", self.database]
+
+    def list_tables(self):
+        # SHOW FULL TABLES prints the name and the type
+        return [line.split('\t')[0] for line in super(MySQLDumpTask, self).list_tables()]
+
+    def _mysqldump(self, args, tables=()):
+        return ['mysqldump'] + self.get_connection() + self.options + list(args) + \
+            [self.database] + list(tables)
+
+    def get_dump_command(self):
+        return self._mysqldump(['--single-transaction', '--routines', '--events'],
+                               self.tables or ())
+
+    def get_parallel_commands(self, tables):
+        selected = self.tables or ()
+        schema = ['--no-data', '--skip-triggers']
+        if not self.tables:
+            schema.extend(['--routines', '--events'])
+        commands = [self._mysqldump(schema, selected)]
+        commands.extend(
+            self._mysqldump(['--single-transaction', '--no-create-info', '--skip-triggers'],
+                            [table])
+            for table in tables)
+        # Triggers are created after the data, as mysqldump does
+        commands.append(self._mysqldump(['--no-data', '--no-create-info', '--triggers'],
+                                        selected))
+        return commands
+
+    def get_restore_command(self):
+        return ['mysql'] + self.get_connection() + [self.database]
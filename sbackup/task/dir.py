@@ -1,19 +1,105 @@
 # -*- coding: utf-8 -*-
 import datetime
+import io
+import json
 import logging
 import os
+import re
 import shutil
 import tarfile
 import tempfile
 
-from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack, contextmanager
 
 from sbackup.utils import get_backup_name
-from sbackup.exception import SBackupValidationError
-from .base import Task, Field, Backend
+from sbackup.exception import SBackupException, SBackupValidationError
+from sbackup import dedup
+from sbackup.compress import Compressor, get_codec, get_codec_by_filename
+from sbackup.index import FileIndex, DEFAULT_INDEX_DIR, DELETED_MEMBER
+from sbackup.scheduler import Demand
+from sbackup.seekable import (
+    ArchiveIndex,
+    IndexedTarFile,
+    RangeReader,
+    INDEX_EXTENSION,
+    load_index,
+)
+from sbackup.volumes import (
+    SET_EXTENSION,
+    create_dirs,
+    dump_set,
+    get_volume_name,
+    is_volume_set,
+    load_set,
+    plan_volumes,
+    restore_dirs,
+)
+from sbackup.walker import Walker, add_entries, add_entry, is_dir, read_ahead
+from sbackup.snapshot import REPORT_CHANGED
+from .base import Task, Field, Backend, Compression, Filters, Snapshot
 
 logger = logging.getLogger(__name__)
 
+INCREMENT_MARK = '.incr'
+# <backup name>-<time>[.incr].tar.<ext>
+ARCHIVE_PATTERN = re.compile(r'^(.+)-(\d{4}-\d\d-\d\d-\d\d-\d\d)(%s)?\.tar\.' % (
+    re.escape(INCREMENT_MARK)))
+FORMATS = ('tar', 'dedup')
+# Archives whose uploads may be resumed, in the tmp dir
+SPOOL_DIR = 'sbackup-spool'
+
+
+def is_selected(name, arcnames):
+    return arcnames is None or any(name == arcname or name.startswith(arcname + '/')
+                                   for arcname in arcnames)
+
+
+def get_extraction_filter():
+    """
+    Return the extraction filter of tarfile (Python 3.11.4+) which keeps
+    members of a tampered archive inside the destination: ``tar`` for root,
+    which restores owners and special files, ``data`` for other users.
+    None if tarfile has no filters.
+    """
+    if not hasattr(tarfile, 'data_filter'):
+        return None
+    return 'tar' if os.geteuid() == 0 else 'data'
+
+
+def is_safe_member(member):
+    """
+    Check names of the member on Python without extraction filters
+    """
+    parts = member.name.split('/')
+    if os.path.isabs(member.name) or '..' in parts:
+        return False
+    if member.islnk() and (os.path.isabs(member.linkname) or '..' in member.linkname.split('/')):
+        return False
+    return True
+
+
+# Fields which a restore reads, the source may not exist and the backend isn't connected
+RESTORE_FIELDS = ('tmp_dir', 'compression', 'encryption')
+# The task of a worker process of volume_restore
+_restore_task = None
+
+
+def init_restore_worker(task_class, config):
+    """
+    Create the task again by its config in a worker process of volume_restore
+    """
+    global _restore_task
+    _restore_task = task_class.create_task(config)
+    _restore_task.validate(RESTORE_FIELDS)
+
+
+def restore_volume(filename, staging, tmp_dir, arcnames=None):
+    """
+    Extract a volume in a worker process
+    """
+    _restore_task.restore_archive(filename, staging, tmp_dir, arcnames)
+
 
 @contextmanager
 def create_temp_dir(tmp_path=None):
@@ -27,6 +113,38 @@ def create_temp_dir(tmp_path=None):
         shutil.rmtree(tmp_dir)
 
 
+def get_chain_dependencies(names, expired):
+    """
+    Return expired archives which retained increments depend on: the full
+    backup of the chain and the increments between it and the retained one
+
+    Args:
+        names(list): All names of the backend
+        expired(list): Names the retention is going to delete
+    Returns:
+        set
+    """
+    chains = {}
+    for name in names:
+        match = ARCHIVE_PATTERN.match(name)
+        if match:
+            chains.setdefault(match.group(1), []).append(
+                (match.group(2), bool(match.group(3)), name))
+    expired = set(expired)
+    keep = set()
+    for archives in chains.values():
+        chain = []
+        for _, incremental, name in sorted(archives):
+            if not incremental:
+                chain = []
+            chain.append(name)
+            if incremental and name not in expired:
+                keep.update(item for item in chain if item in expired)
+    for name in sorted(keep):
+        logger.info("Keep the expired %s, newer increments depend on it" % name)
+    return keep
+
+
 class DirBackupTask(Task):
     """
     The task for backup dirs
@@ -35,6 +153,22 @@ class DirBackupTask(Task):
        dst_backend(dict): A backend settings
        backup_name(basestring): Default is backup
        tmp_dir(basestring): A tmp path, default is TMPDIR
+       stream(bool): Stream the archive to the backend without a temporary file
+       compression(dict): A codec, level and number of workers, default is gz, already
+           compressed files are stored (skip_compressed), the level may adapt (adaptive)
+       incremental(bool): Archive only files changed after the last backup
+       full_every(int): A number of runs between full backups, default is 7
+       index_path(basestring): A path of the file index, default is ~/.sbackup/index/<name>.sqlite
+       format(basestring): tar (default) or dedup - a chunk store with snapshot manifests
+       walk_workers(int): Threads which scan the source and read small files ahead, default is 1
+       verify(bool): Read the backup from the backend after the upload and compare checksums
+       volumes(int): Split a full tar backup into a set of volumes, they are streamed
+           to the backend and restored in parallel, default is 1
+       restore_workers(int): Processes which extract volumes, default is a number of CPUs
+       snapshot(dict): Archive a point-in-time copy of the source: a method (auto,
+           hardlink, reflink or command), a path of copies and create, remove hooks
+       filters(dict): Gitignore patterns of excluded and included paths (exclude,
+           include), files bigger than max_size or older than max_age days are excluded
 
     Usage::
 
@@ -48,6 +182,11 @@ class DirBackupTask(Task):
                     'bucket': 'backup'
                 }
             },
+            'compression': {
+                'codec': 'zstd',
+                'level': 3,
+                'workers': 4
+            },
             'retention_period': '7'
         }
         obj = DirBackupTask.create_task(data)
@@ -68,6 +207,23 @@ class DirBackupTask(Task):
     dst_backend = Backend()
     name = Field()
     tmp_dir = Field(required=False)
+    stream = Field(default=False, required=False)
+    compression = Compression(default=Compressor(), required=False)
+    incremental = Field(default=False, required=False)
+    full_every = Field(default=7, required=False)
+    index_path = Field(required=False)
+    format = Field(default='tar', required=False)
+    walk_workers = Field(default=1, required=False)
+    verify = Field(default=False, required=False)
+    volumes = Field(default=1, required=False)
+    restore_workers = Field(required=False)
+    snapshot = Snapshot(required=False)
+    filters = Filters(required=False)
+
+    def __init__(self):
+        super(DirBackupTask, self).__init__()
+        # LinkFarm or CommandSnapshot while the source is archived from it
+        self.source_copy = None
 
     @staticmethod
     def validate_source(attr):
@@ -91,68 +247,710 @@ class DirBackupTask(Task):
             raise SBackupValidationError("User don't have access to read a %s" % attr)
         return attr
 
+    @staticmethod
+    def validate_full_every(attr):
+        if not isinstance(attr, int) or attr < 1:
+            raise SBackupValidationError('The full_every has to be a positive number')
+        return attr
+
+    @staticmethod
+    def validate_format(attr):
+        if attr not in FORMATS:
+            raise SBackupValidationError('The format has to be one of: %s' % ', '.join(FORMATS))
+        return attr
+
+    @staticmethod
+    def validate_walk_workers(attr):
+        if not isinstance(attr, int) or attr < 1:
+            raise SBackupValidationError('The walk_workers has to be a positive number')
+        return attr
+
+    @staticmethod
+    def validate_volumes(attr):
+        if not isinstance(attr, int) or attr < 1:
+            raise SBackupValidationError('The volumes has to be a positive number')
+        return attr
+
+    @staticmethod
+    def validate_restore_workers(attr):
+        if not isinstance(attr, int) or attr < 1:
+            raise SBackupValidationError('The restore_workers has to be a positive number')
+        return attr
+
+    def validate(self, fields=None):
+        super(DirBackupTask, self).validate(fields)
+        if self.volumes > 1 and (self.incremental or self.format == 'dedup'):
+            raise SBackupValidationError(
+                message="Can't validate fields: volumes",
+                content={'volumes': 'Volumes are supported only by full tar backups'}
+            )
+        if self.encryption is not None and self.format == 'dedup':
+            raise SBackupValidationError(
+                message="Can't validate fields: encryption",
+                content={'encryption': 'Chunks of deduplicated backups are not encrypted'}
+            )
+        if self.snapshot is not None and self.incremental and self.snapshot.method == 'reflink':
+            raise SBackupValidationError(
+                message="Can't validate fields: snapshot",
+                content={'snapshot': 'Reflinks change inodes which the file index of '
+                                     'incremental backups compares'}
+            )
+
     def get_backup_name(self):
         return get_backup_name(self.name)
 
-    def make_tarfile(self, tar_dir):
+    def has_archive_stage(self):
+        return not (self.stream or self.incremental or self.format == 'dedup' or
+                    self.volumes > 1)
+
+    def get_demand(self, expected_size=0):
+        try:
+            device = os.stat(self.source).st_dev
+        except OSError:
+            device = None
+        uses_tmp_dir = not self.stream and self.format != 'dedup' and self.volumes == 1
+        return Demand(
+            cpu=self.compression.workers,
+            device=device,
+            tmp_space=expected_size if uses_tmp_dir else 0,
+            network=1
+        )
+
+    def get_archive_name(self, incremental=False):
+        return "{name}-{time}{mark}{ext}".format(
+            name=self.get_backup_name(),
+            time=datetime.datetime.now().strftime('%Y-%m-%d-%H-%M'),
+            mark=INCREMENT_MARK if incremental else '',
+            ext=self.get_extension()
+        )
+
+    def get_extension(self):
+        if self.format == 'dedup':
+            return dedup.MANIFEST_EXTENSION
+        if self.volumes > 1:
+            return SET_EXTENSION
+        return self.compression.extension
+
+    def get_index_path(self):
+        if self.index_path:
+            return self.index_path
+        return os.path.join(os.path.expanduser(DEFAULT_INDEX_DIR),
+                            '%s.sqlite' % self.get_backup_name())
+
+    @contextmanager
+    def open_walker(self):
+        """
+        A walker of the source, excluded entries are skipped while directories are listed
+        """
+        with Walker(self.walk_workers, accept=self.filters) as walker:
+            yield walker
+        self.check_skipped(walker.skipped)
+
+    def check_skipped(self, skipped):
+        """
+        Count directories which weren't readable, they are empty in the backup
+        """
+        if not skipped:
+            return
+        self.metrics.add('dirs_skipped', len(skipped))
+        logger.warning("{count} directories of {source} can't be read, they are empty in the "
+                       "backup: {paths}".format(count=len(skipped), source=self.source,
+                                                paths=', '.join(path for path, _ in skipped[:10])))
+
+    def walk_source(self, walker):
+        """
+        Walk the source or its point-in-time copy, yields sbackup.walker.Entry of every entry
+        """
+        path = self.source_copy.path if self.source_copy is not None else self.source
+        return walker.walk(path, os.path.basename(self.source))
+
+    @contextmanager
+    def source_snapshot(self):
+        """
+        Archive a point-in-time copy of the source in the block, if the
+        task has the snapshot settings. Incremental backups use hard links,
+        the file index compares inodes.
+        """
+        if self.snapshot is None or self.source_copy is not None:
+            yield
+            return
+        with ExitStack() as stack:
+            with self.metrics.stage('source_snapshot'):
+                copy = stack.enter_context(self.snapshot.open(
+                    self.source,
+                    reflinks=False if self.incremental else None,
+                    walk_workers=self.walk_workers,
+                    accept=self.filters
+                ))
+            self.check_skipped(getattr(copy, 'skipped', None))
+            self.source_copy = copy
+            try:
+                yield
+            finally:
+                self.source_copy = None
+            changed = copy.changed()
+        if changed:
+            self.metrics.add('files_changed', len(changed))
+            logger.warning("{count} files were changed in place while they were archived, "
+                           "they may be inconsistent: {names}".format(
+                               count=len(changed),
+                               names=', '.join(changed[:REPORT_CHANGED])))
+
+    @staticmethod
+    def filter_changed(entries, index):
+        for entry in entries:
+            changed = index.is_changed(entry.arcname, entry.stat)
+            # Directories are cheap and keep the tree of an increment complete
+            if index.full or changed or is_dir(entry):
+                yield entry
+
+    def add_members(self, tar, index=None):
+        """
+        Add the source to the tar, with the index only changed files are added
+
+        Args:
+            tar(tarfile.TarFile)
+            index(sbackup.index.FileIndex)
+        """
+        with self.open_walker() as walker:
+            entries = self.walk_source(walker)
+            if index is not None:
+                entries = self.filter_changed(entries, index)
+            add_entries(tar, read_ahead(walker, entries))
+        if index is None:
+            return
+        if not index.full:
+            data = json.dumps(index.deleted()).encode('utf-8')
+            info = tarfile.TarInfo(DELETED_MEMBER)
+            info.size = len(data)
+            info.mtime = int(datetime.datetime.now().timestamp())
+            tar.addfile(info, io.BytesIO(data))
+
+    def write_archive(self, fileobj, index=None):
         """
-        Create a tar.gz backup
+        Compress the source into the fileobj
+
+        Args:
+            fileobj: A writable file object
+            index(sbackup.index.FileIndex): An index for an incremental backup
+        Returns:
+            sbackup.seekable.ArchiveIndex
+        """
+        with self.open_encrypted(fileobj) as encrypted, \
+                self.compression.open_writer(encrypted) as writer:
+            with IndexedTarFile.open(fileobj=writer, mode="w|", compress_writer=writer) as tar:
+                self.add_members(tar, index)
+        archive_index = ArchiveIndex.from_writer(writer, tar)
+        self.metrics.add('files', len(archive_index.members))
+        self.metrics.add('bytes_read', writer.bytes_in)
+        self.metrics.add('bytes_compressed', writer.bytes_out)
+        self.metrics.add('bytes_stored', writer.stored_bytes)
+        return archive_index
+
+    def make_tarfile(self, tar_dir, index=None):
+        """
+        Create a compressed tar backup
 
         Args:
             tar_dir(str)
+            index(sbackup.index.FileIndex): An index for an incremental backup
         Returns:
             backup_file(str)
 
         Raises:
             SBackupValidationError: Exception if backup already exists.
         """
-        output_filename = os.path.join(tar_dir, "{name}-{time}.tar.gz".format(
-            name=self.get_backup_name(),
-            time=datetime.datetime.now().strftime('%Y-%m-%d-%H-%M')
-        ))
+        incremental = index is not None and not index.full
+        output_filename = os.path.join(tar_dir, self.get_archive_name(incremental))
         logger.debug("Create a temporary tar file: %s" % output_filename)
         try:
-            with tarfile.open(output_filename, "x:gz") as tar:
-                tar.add(self.source, arcname=os.path.basename(self.source))
+            with open(output_filename, "xb") as fileobj, self.source_snapshot(), \
+                    self.metrics.stage('archive'):
+                archive_index = self.write_archive(fileobj, index)
         except FileExistsError:
             logger.error("Can't create a temporary tar file", exc_info=True)
             raise SBackupValidationError("Can't create a tarfile")
+        with open(output_filename + INDEX_EXTENSION, "wb") as fileobj:
+            fileobj.write(archive_index.dump())
         return output_filename
 
+    def upload_index(self, filename):
+        index_file = filename + INDEX_EXTENSION
+        if os.path.exists(index_file):
+            with open(index_file, 'rb') as fileobj:
+                self.put_index(os.path.basename(filename), fileobj.read())
+
+    def get_spool_dir(self):
+        return os.path.join(self.tmp_dir or tempfile.gettempdir(), SPOOL_DIR,
+                            self.get_backup_name())
+
+    def clean_spool(self, keep=()):
+        """
+        Remove archives of the spool dir except the paths to keep and their indexes
+        """
+        spool = self.get_spool_dir()
+        if not os.path.isdir(spool):
+            return
+        for name in os.listdir(spool):
+            path = os.path.join(spool, name)
+            archive = path[:-len(INDEX_EXTENSION)] if path.endswith(INDEX_EXTENSION) else path
+            if archive not in keep:
+                os.remove(path)
+
+    @contextmanager
+    def archive_dir(self):
+        """
+        A directory of the temporary archive. If the backend resumes uploads,
+        the archive of a failed upload stays in the spool dir for the next run.
+        """
+        if not (self.dst_backend.resumable and self.has_archive_stage()):
+            with create_temp_dir(self.tmp_dir) as tmp_dir:
+                yield tmp_dir
+            return
+        spool = self.get_spool_dir()
+        os.makedirs(spool, exist_ok=True)
+        try:
+            yield spool
+        except BaseException:
+            self.clean_spool(keep=self.dst_backend.get_pending_uploads())
+            raise
+        self.clean_spool()
+
+    def resume_upload(self):
+        """
+        Finish the interrupted upload of the last archive of the task. An
+        increment is never resumed, its index changes were rolled back.
+
+        Returns:
+            backup_file(str): None if the task has no interrupted upload
+        """
+        if not self.dst_backend.resumable:
+            return None
+        spool = self.get_spool_dir()
+        pending = set(self.dst_backend.get_pending_uploads())
+        archives = [os.path.join(spool, name) for name in sorted(os.listdir(spool))
+                    if not name.endswith(INDEX_EXTENSION)] if os.path.isdir(spool) else []
+        archives = [path for path in archives if path in pending]
+        if not archives or not self.has_archive_stage():
+            self.clean_spool()
+            return None
+        path = archives[-1]
+        logger.info("Resume the upload of the %s" % path)
+        try:
+            self.upload_backup(path)
+        except BaseException:
+            self.clean_spool(keep=self.dst_backend.get_pending_uploads())
+            raise
+        self.clean_spool()
+        return os.path.basename(path)
+
     def upload_backup(self, filename):
         logger.debug("Start upload the file {file} to {backend}".format(
             file=filename,
             backend=str(self.dst_backend)
         ))
-        self.dst_backend.upload(filename)
+        with self.metrics.stage('upload'):
+            self.dst_backend.upload(filename)
+            self.upload_index(filename)
+        self.metrics.add('bytes_uploaded', os.path.getsize(filename))
         logger.info("The {file} was uploaded to {backend}".format(
             file=filename,
             backend=str(self.dst_backend)
         ))
 
+    def stream_backup(self, index=None):
+        """
+        Compress the source straight into the backend, the compression
+        and the upload run at the same time without a temporary file
+
+        Args:
+            index(sbackup.index.FileIndex): An index for an incremental backup
+        Returns:
+            backup_file(str)
+        """
+        filename = self.get_archive_name(index is not None and not index.full)
+        logger.debug("Start streaming the file {file} to {backend}".format(
+            file=filename,
+            backend=str(self.dst_backend)
+        ))
+        with self.source_snapshot(), self.metrics.stage('stream'):
+            with self.dst_backend.open_writer(filename) as fileobj:
+                archive_index = self.write_archive(fileobj, index)
+            self.put_index(filename, archive_index.dump())
+        self.metrics.add('bytes_uploaded', self.get_uploaded_size(archive_index.size))
+        logger.info("The {file} was streamed to {backend}".format(
+            file=filename,
+            backend=str(self.dst_backend)
+        ))
+        return filename
+
+    def volume_backup(self):
+        """
+        Split the source into volumes and stream them to the backend at the
+        same time, the set manifest is stored when all volumes are uploaded
+
+        Returns:
+            backup_file(str)
+        """
+        filename = self.get_archive_name()
+        with self.source_snapshot():
+            with self.open_walker() as walker:
+                plan = plan_volumes(self.walk_source(walker), self.volumes)
+            names = [get_volume_name(filename, number, self.compression.extension)
+                     for number in range(plan.volumes)]
+            logger.debug("Start streaming {count} volumes of the {file} to {backend}".format(
+                count=len(names),
+                file=filename,
+                backend=str(self.dst_backend)
+            ))
+            writers = []
+            tars = []
+            with self.metrics.stage('stream'):
+                with ExitStack() as stack:
+                    for name in names:
+                        fileobj = stack.enter_context(self.dst_backend.open_writer(name))
+                        fileobj = stack.enter_context(self.open_encrypted(fileobj))
+                        writers.append(stack.enter_context(self.compression.open_writer(fileobj)))
+                        tars.append(stack.enter_context(
+                            IndexedTarFile.open(fileobj=writers[-1], mode="w|",
+                                                compress_writer=writers[-1])))
+                    with self.open_walker() as walker:
+                        for entry, future in read_ahead(walker, self.walk_source(walker)):
+                            add_entry(tars[plan.get_volume(entry.arcname, is_dir(entry))],
+                                      entry, future)
+                items = []
+                for name, writer, tar in zip(names, writers, tars):
+                    archive_index = ArchiveIndex.from_writer(writer, tar)
+                    self.put_index(name, archive_index.dump())
+                    items.append({'name': name, 'size': archive_index.size,
+                                  'files': len(archive_index.members),
+                                  'checksum': archive_index.checksum})
+                    self.metrics.add('files', len(archive_index.members))
+                    self.metrics.add('bytes_read', writer.bytes_in)
+                    self.metrics.add('bytes_compressed', writer.bytes_out)
+                    self.metrics.add('bytes_stored', writer.stored_bytes)
+                    self.metrics.add('bytes_uploaded', self.get_uploaded_size(archive_index.size))
+                self.dst_backend.put_object(filename, self.encrypt(dump_set(items, plan.dirs)))
+        logger.info("The {file} of {count} volumes was streamed to {backend}".format(
+            file=filename,
+            count=len(names),
+            backend=str(self.dst_backend)
+        ))
+        return filename
+
+    @contextmanager
+    def staging(self):
+        """
+        A temporary directory next to the source, the same file system
+        makes the swap with the source atomic
+        """
+        parent = os.path.dirname(os.path.abspath(self.source))
+        os.makedirs(parent, exist_ok=True)
+        path = tempfile.mkdtemp(prefix='.%s.restore-' % os.path.basename(self.source), dir=parent)
+        try:
+            yield path
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def get_arcnames(self, paths):
+        """
+        Convert paths relative to the source to names of the archive,
+        nested paths are dropped
+        """
+        root = os.path.basename(self.source)
+        arcnames = set()
+        for path in paths:
+            parts = [part for part in path.split('/') if part not in ('', '.')]
+            if '..' in parts:
+                raise SBackupValidationError("The path %s is outside of the source" % path)
+            arcnames.add('/'.join([root] + parts))
+        return sorted(name for name in arcnames
+                      if not any(name.startswith(other + '/') for other in arcnames))
+
+    def swap(self, staging, arcname):
+        """
+        Replace the arcname of the source by the restored one from the staging
+        directory, the old one is removed only when the new one is in place
+        """
+        restored = os.path.join(staging, arcname)
+        target = os.path.join(os.path.dirname(os.path.abspath(self.source)), arcname)
+        if not os.path.lexists(target):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.rename(restored, target)
+            return
+        old = os.path.join(tempfile.mkdtemp(dir=staging), 'old')
+        os.rename(target, old)
+        try:
+            os.rename(restored, target)
+        except OSError:
+            os.rename(old, target)
+            raise
+
+    def swap_source(self, staging, arcnames=None):
+        """
+        Replace the source or only the arcnames by the restored ones
+        """
+        arcnames = arcnames or [os.path.basename(self.source)]
+        for arcname in arcnames:
+            if not os.path.lexists(os.path.join(staging, arcname)):
+                raise SBackupException("The backup doesn't contain %s" % arcname)
+        for arcname in arcnames:
+            self.swap(staging, arcname)
+
+    @staticmethod
+    def extract_tar(fileobj, path, arcnames=None):
+        """
+        Extract an uncompressed tar stream into the path
+
+        Args:
+            fileobj: A readable file object
+            path(str): A destination directory
+            arcnames(list): Extract only these names and their subdirectories
+        Returns:
+            deleted(list): Names deleted since the previous backup, empty for a full backup
+        """
+        deleted = []
+        extraction_filter = get_extraction_filter()
+
+        def members(tar):
+            for member in tar:
+                if member.name == DELETED_MEMBER:
+                    deleted.extend(json.loads(tar.extractfile(member).read().decode('utf-8')))
+                elif not is_selected(member.name, arcnames):
+                    continue
+                elif extraction_filter is None and not is_safe_member(member):
+                    logger.error("Skip the member %s, it is outside of the source" % member.name)
+                else:
+                    yield member
+
+        with tarfile.open(fileobj=fileobj, mode="r|") as tar:
+            if extraction_filter is None:
+                tar.extractall(path=path, members=members(tar))
+                return deleted
+            try:
+                tar.extractall(path=path, members=members(tar), filter=extraction_filter)
+            except tarfile.FilterError as error:
+                raise SBackupException("The archive has an unsafe member: %s" % error)
+        return deleted
+
+    def extract_archive(self, fileobj, codec, path, arcnames=None):
+        """
+        Extract a compressed tar stream into the path
+        """
+        with codec.open_reader(fileobj) as reader:
+            return self.extract_tar(reader, path, arcnames)
+
+    def remove_deleted(self, path, deleted):
+        """
+        Remove files which an increment marks as deleted
+        """
+        root = os.path.basename(self.source)
+        for arcname in sorted(deleted, reverse=True):
+            parts = arcname.split('/')
+            if parts[0] != root or '..' in parts:
+                logger.error("Skip deleting of %s, it is outside of the source" % arcname)
+                continue
+            target = os.path.join(path, arcname)
+            if os.path.isdir(target) and not os.path.islink(target):
+                shutil.rmtree(target)
+            elif os.path.lexists(target):
+                os.remove(target)
+
     def extract(self, src_file):
-        tar = tarfile.open(src_file)
-        shutil.rmtree(self.source)
-        tar.extractall(path=os.path.dirname(self.source))
+        with self.staging() as staging:
+            with open(src_file, 'rb') as fileobj, self.open_decrypted(fileobj) as reader:
+                self.extract_archive(reader, get_codec_by_filename(src_file), staging)
+            self.swap_source(staging)
+
+    def restore_archive(self, filename, staging, tmp_dir, arcnames=None):
+        """
+        Extract the archive into the staging directory, only blocks of the
+        arcnames are downloaded if the archive has the seekable index
+
+        Returns:
+            deleted(list): Names deleted since the previous backup
+        """
+        if arcnames:
+            backend = self.get_read_backend()
+            archive_index = load_index(backend, filename)
+            if archive_index is not None:
+                members = archive_index.select(arcnames)
+                if not members:
+                    return []
+                with RangeReader(backend, filename, archive_index, members,
+                                 get_codec(archive_index.codec)) as reader:
+                    deleted = self.extract_tar(reader, staging, arcnames)
+                logger.debug("Fetched {size} bytes of the {file}".format(
+                    size=reader.bytes_fetched,
+                    file=filename
+                ))
+                return deleted
+        with self.open_backup(filename, tmp_dir) as fileobj:
+            return self.extract_archive(fileobj, get_codec_by_filename(filename), staging, arcnames)
+
+    def dedup_backup(self):
+        """
+        Upload new chunks of the source and the snapshot manifest
+
+        Returns:
+            backup_file(str)
+        """
+        filename = self.get_archive_name()
+        with self.source_snapshot(), self.metrics.stage('snapshot'), \
+                dedup.hold_lock(self.dst_backend, dedup.BACKUP_LOCK):
+            # Chunks which the backup reuses must outlive it
+            if dedup.get_locks(self.dst_backend, dedup.GC_LOCK):
+                raise SBackupException("The garbage collection of {backend} is running".format(
+                    backend=str(self.dst_backend)))
+            with dedup.ChunkStore(self.dst_backend) as store, self.open_walker() as walker:
+                manifest = dedup.create_snapshot(self.walk_source(walker), store)
+            self.dst_backend.put_object(filename, dedup.dump_manifest(manifest))
+            self.dst_backend.flush()
+        self.metrics.add('files', len(manifest['entries']))
+        self.metrics.add('bytes_uploaded', store.uploaded_bytes)
+        logger.info("The snapshot {file} was stored in {backend}, new chunks: {new}, "
+                    "reused chunks: {reused}".format(file=filename,
+                                                     backend=str(self.dst_backend),
+                                                     new=store.uploaded_chunks,
+                                                     reused=store.reused_chunks))
+        return filename
+
+    def dedup_restore(self, backup_file, arcnames=None):
+        manifest = dedup.load_manifest(self.dst_backend.get_object(backup_file))
+        manifest['entries'] = [item for item in manifest['entries']
+                               if is_selected(item['name'], arcnames)]
+        with self.staging() as staging:
+            with dedup.ChunkStore(self.dst_backend) as store:
+                dedup.restore_snapshot(manifest, store, staging)
+            self.swap_source(staging, arcnames)
+
+    def volume_restore(self, backup_file, arcnames=None):
+        """
+        Extract volumes of the set by a pool of restore_workers processes,
+        every process downloads and extracts its volume
+        """
+        # Workers validate the same settings, errors are raised here first
+        self.validate(RESTORE_FIELDS)
+        volume_set = load_set(self.get_read_backend().get_object(backup_file))
+        names = [item['name'] for item in volume_set['volumes']]
+        workers = min(self.restore_workers or os.cpu_count() or 1, len(names))
+        with self.staging() as staging, create_temp_dir(self.tmp_dir) as tmp_dir:
+            create_dirs(staging, volume_set)
+            if workers > 1:
+                with ProcessPoolExecutor(max_workers=workers, initializer=init_restore_worker,
+                                         initargs=(type(self), self.config)) as executor:
+                    futures = [executor.submit(restore_volume, name, staging, tmp_dir, arcnames)
+                               for name in names]
+                    for future in futures:
+                        future.result()
+            else:
+                for name in names:
+                    self.restore_archive(name, staging, tmp_dir, arcnames)
+            restore_dirs(staging, volume_set)
+            self.swap_source(staging, arcnames)
+
+    def get_backup_chain(self, backup_file):
+        """
+        Return a list of archives to restore the backup_file: the last full
+        backup before it and the following increments
+        """
+        pattern = re.compile(r'^%s-(\d{4}-\d\d-\d\d-\d\d-\d\d)(%s)?\.tar\.' % (
+            re.escape(self.get_backup_name()), re.escape(INCREMENT_MARK)))
+        backups = {}
+        for name in self.dst_backend:
+            match = pattern.match(name)
+            if match:
+                backups[name] = (match.group(1), bool(match.group(2)))
+        if backup_file not in backups:
+            return [backup_file]
+        chain = []
+        for name in sorted(backups, key=backups.get):
+            if not backups[name][1]:
+                chain = []
+            chain.append(name)
+            if name == backup_file:
+                break
+        if INCREMENT_MARK in chain[0]:
+            raise SBackupValidationError("Can't find a full backup for %s" % backup_file)
+        return chain
+
+    def backup(self, index=None):
+        """
+        Create a backup and put it in the backend
+
+        Returns:
+            backup_file(str)
+        """
+        if self.format == 'dedup':
+            backup_file = self.dedup_backup()
+        elif self.volumes > 1:
+            backup_file = self.volume_backup()
+        elif self.stream:
+            backup_file = self.stream_backup(index)
+        else:
+            # The interrupted upload is an older backup, the current one is created anyway
+            self.resume_upload()
+            with self.archive_dir() as tmp_dir:
+                backup_file = os.path.basename(self.make_tarfile(tmp_dir, index))
+                self.upload_backup(os.path.join(tmp_dir, backup_file))
+        if self.verify:
+            self.verify_backup(backup_file)
+        return backup_file
 
     def create(self):
         self.validate()
-        with create_temp_dir(self.tmp_dir) as tmp_dir:
-            backup_file = self.make_tarfile(tmp_dir)
-            self.upload_backup(backup_file)
+        if not self.incremental or self.format == 'dedup':
+            return self.backup()
+        with FileIndex(self.get_index_path()) as index:
+            runs = index.runs_since_full
+            full = runs is None or runs + 1 >= self.full_every
+            index.begin(full)
+            try:
+                backup_file = self.backup(index)
+            except Exception:
+                index.rollback()
+                raise
+            missed = self.get_failed_destinations()
+            if missed:
+                logger.warning("The destinations {names} missed the {file}, the next backup "
+                               "is full".format(names=', '.join(missed), file=backup_file))
+            index.commit(backup_file, force_full=bool(missed))
+        return backup_file
 
-    def restore(self, backup_file):
+    def restore(self, backup_file, paths=None):
+        """
+        Restore the backup, the last one by default
+
+        Args:
+            backup_file(str)
+            paths(list): Restore only these paths, relative to the source
+        """
         if not backup_file:
             backup_file = self.dst_backend.get_last_backup(name=self.get_backup_name())
             if not backup_file:
                 raise SBackupValidationError("Backup doesn't exist in the backend")
-        logger.debug("Start download the file {file} to {backend}".format(
+        arcnames = self.get_arcnames(paths) if paths else None
+        if dedup.is_manifest(backup_file):
+            return self.dedup_restore(backup_file, arcnames)
+        if is_volume_set(backup_file):
+            self.volume_restore(backup_file, arcnames)
+            logger.info("The {file} was restored to {source}".format(
+                file=backup_file,
+                source=self.source
+            ))
+            return
+        chain = self.get_backup_chain(backup_file)
+        with self.staging() as staging, create_temp_dir(self.tmp_dir) as tmp_dir:
+            for index, name in enumerate(chain):
+                logger.debug("Start restore the file {file} from {backend}".format(
+                    file=name,
+                    backend=str(self.dst_backend)
+                ))
+                deleted = self.restore_archive(name, staging, tmp_dir, arcnames)
+                if index:
+                    self.remove_deleted(staging, deleted)
+            self.swap_source(staging, arcnames)
+        logger.info("The {file} was restored to {source}".format(
             file=backup_file,
-            backend=str(self.dst_backend)
+            source=self.source
         ))
-        with create_temp_dir(self.tmp_dir) as tmp_dir:
-            src_file = self.dst_backend.download(backup_file, tmp_dir)
-            logger.debug("Extract the file {file}".format(
-                file=backup_file
-            ))
-            self.extract(src_file)
\ No newline at end of file
@@ -1,11 +1,66 @@
 # -*- coding: utf-8 -*-
-import concurrent.futures
 import datetime
-from collections import MutableMapping
+import os
+import shutil
+from collections.abc import MutableMapping
 
 from sbackup.dest_backend import get_backend
+from .dedup import collect_garbage, is_manifest
+from .encryption import EncryptionSettings
 from .exception import SBackupException
+from .metrics import RunReport
+from .seekable import delete_indexes
+from .scheduler import Scheduler, Resources, History, Job, DEFAULT_HUGE_SIZE
 from .task import TASK_CLASSES
+from .task.dir import get_chain_dependencies
+from .utils import get_backup_name, parse_size
+from .verify import verify_backups
+from .volumes import delete_volumes, is_volume_set
+
+
+ENGINES = ('thread', 'async')
+# The executor settings and defaults
+EXECUTOR_SETTINGS = {
+    'engine': 'thread',
+    'max_workers': 2,
+    'max_uploads': 4,
+    'max_archive_jobs': 2,
+    'resources': {},
+    'history_path': None,
+    'metrics': {},
+}
+# Bytes copied at once while a downloaded backup is decrypted
+DOWNLOAD_BUFFER_SIZE = 1024 * 1024
+RESOURCES = ('cpu', 'network', 'tmp_space', 'huge_size')
+# Files of the run report
+REPORTS = ('json', 'prometheus')
+
+
+def split_config(config):
+    """
+    The config is a list of tasks or a dict with the tasks and the executor settings
+
+    Returns:
+        settings(dict), tasks(list)
+    """
+    if isinstance(config, MutableMapping) and 'tasks' in config:
+        settings = config.get('executor') or {}
+        if not isinstance(settings, MutableMapping):
+            raise SBackupException("The executor settings must be a dictionary")
+        unknown = set(settings) - set(EXECUTOR_SETTINGS)
+        if unknown:
+            raise SBackupException("Unknown executor settings: %s" % ', '.join(sorted(unknown)))
+        settings = dict(EXECUTOR_SETTINGS, **settings)
+        if settings['engine'] not in ENGINES:
+            raise SBackupException("The executor engine must be one of: %s" % ', '.join(ENGINES))
+        unknown = set(settings['resources']) - set(RESOURCES)
+        if unknown:
+            raise SBackupException("Unknown resources: %s" % ', '.join(sorted(unknown)))
+        unknown = set(settings['metrics'] or {}) - set(REPORTS)
+        if unknown:
+            raise SBackupException("Unknown metrics settings: %s" % ', '.join(sorted(unknown)))
+        return settings, config['tasks']
+    return dict(EXECUTOR_SETTINGS), config
 
 
 class TaskExecutor:
@@ -13,18 +68,16 @@ class TaskExecutor:
     This is the main worker class for the executor task
     """
 
-    def __init__(self, tasks):
+    def __init__(self, config):
         """
         Args:
-            : An open Bigtable Table instance.
-            : A sequence of strings representing the key of each table row
-                    to fetch.
-        Returns:
-            For example:
-
+            config: A list of tasks or a dict with the `tasks` list and the `executor` settings
         Raises:
-            IOError: An error occurred accessing the bigtable. Table object.
+            SBackupException: An error occurred if the config is incorrect
         """
+        if config is None:
+            raise SBackupException("Can't find a settings")
+        self.settings, tasks = split_config(config)
         if tasks is None:
             raise SBackupException("Can't find a settings")
         elif not isinstance(tasks, list):
@@ -36,7 +89,7 @@ class TaskExecutor:
                 raise SBackupException("Config file must contain either a dictionary of variables, "
                                        "or a list of dictionaries. Got: %s (%s)" % (tasks, type(tasks)))
             self.validate_task(item)
-        self.tasks = tasks
+        self.tasks = data
 
     @staticmethod
     def validate_task(task):
@@ -46,6 +99,17 @@ class TaskExecutor:
             raise SBackupException("Incorrect config, can't find a dst_backend")
         if not isinstance(task['dst_backend'], MutableMapping):
             raise SBackupException("The dst_backend value must be a dictionary")
+        if not isinstance(task.get('priority', 0), int):
+            raise SBackupException("The priority must be a number")
+        parse_size(task.get('expected_size', 0))
+
+    def get_resources(self, max_workers=None):
+        settings = dict(self.settings['resources'])
+        for key in ('tmp_space', 'huge_size'):
+            if key in settings:
+                settings[key] = parse_size(settings[key])
+        settings.setdefault('huge_size', DEFAULT_HUGE_SIZE)
+        return Resources(workers=max_workers, **settings)
 
     @staticmethod
     def get_handler(task_type, logger=None):
@@ -63,47 +127,171 @@ class TaskExecutor:
         except TypeError:
             raise SBackupException('Incorrect a backend configuration')
 
-    def create(self, logger=None, executor_cls=None, max_workers=2):
-        executor_cls = executor_cls or concurrent.futures.ThreadPoolExecutor
-        future_tasks = {}
-        with executor_cls(max_workers=max_workers) as executor:
-            for task in self.tasks:
-                try:
-                    handler = self.get_handler(task['type'], logger)
-                except SBackupException:
-                    continue
-                obj = handler.create_task(task)
-                future_tasks[executor.submit(obj.create)] = task['name']
-            for future in concurrent.futures.as_completed(future_tasks):
-                task_name = future_tasks[future]
-                try:
-                    future.result()
-                except Exception as exc:
-                    print('%s generated an exception: %s' % (task_name, exc))
-                else:
-                    print('Task %s, finished' % task_name)
-
-    def ls(self, backend_name, backend_conf):
-        """
-        Return generator
-        """
-        for item in self.get_backend(backend_name, backend_conf):
-            yield item
-
-    def restore(self, task, backup_file, logger=None):
+    def create(self, logger=None, executor_cls=None, max_workers=None):
+        """
+        Run tasks by the resource-aware scheduler
+
+        Returns:
+            results(dict): A task name -> a backup file or an exception
+        """
+        max_workers = max_workers or self.settings['max_workers']
+        started = datetime.datetime.now()
+        jobs = []
+        metrics = []
+        for task in self.tasks:
+            try:
+                handler = self.get_handler(task['type'], logger)
+            except SBackupException:
+                continue
+            obj = handler.create_task(task)
+            expected_size = parse_size(task.get('expected_size', 0))
+            jobs.append(Job(task['name'], obj.execute,
+                            priority=task.get('priority', 0),
+                            expected_size=expected_size,
+                            demand=obj.get_demand(expected_size)))
+            metrics.append(obj.metrics)
+        scheduler = Scheduler(self.get_resources(max_workers),
+                              History(self.settings['history_path']),
+                              executor_cls)
+        results = scheduler.run(jobs)
+        for job, task_metrics in zip(jobs, metrics):
+            task_metrics.queue_wait = job.queue_wait
+        self.write_report(RunReport(metrics, started))
+        for task_name, result in results.items():
+            if isinstance(result, Exception):
+                print('%s generated an exception: %s' % (task_name, result))
+            else:
+                print('Task %s, finished' % task_name)
+        return results
+
+    def write_report(self, report):
+        """
+        Log the metrics of the run and write the report files of the metrics settings
+        """
+        report.log()
+        settings = self.settings['metrics'] or {}
+        try:
+            if settings.get('json'):
+                report.write_json(settings['json'])
+            if settings.get('prometheus'):
+                report.write_prometheus(settings['prometheus'])
+        except OSError as error:
+            # The backups are done, a report error doesn't fail them
+            print("Can't write the metrics report: %s" % error)
+
+    def ls(self, backend_name, backend_conf, task_name=None):
+        """
+        Return generator, only backups of the task if the task_name is set
+        """
+        backend = self.get_backend(backend_name, backend_conf)
+        if task_name is None:
+            return iter(backend)
+        return backend.list_backups(get_backup_name(task_name) + '-')
+
+    def restore(self, task, backup_file, logger=None, paths=None):
         handler = self.get_handler(task['type'], logger)
         obj = handler.create_task(task)
-        obj.restore(backup_file)
+        obj.restore(backup_file, paths=paths)
 
     def delete(self, backend_name, backend_conf, filename):
         backend = self.get_backend(backend_name, backend_conf)
         backend.delete(filename)
+        if is_manifest(filename):
+            collect_garbage(backend)
+        elif is_volume_set(filename):
+            delete_volumes(backend, [filename])
+        else:
+            delete_indexes(backend, [filename])
+
+    def delete_older(self, backend_name, backend_conf, retention_period, dry_run=False):
+        """
+        Delete backups older than retention_period days, an expired archive
+        stays while a retained increment of its chain depends on it
 
-    def delete_older(self, backend_name, backend_conf, retention_period):
+        Returns:
+            result(DeleteResult), chunks(list): deleted unreferenced chunks
+        """
         retention_date = datetime.date.today() - datetime.timedelta(retention_period)
         backend = self.get_backend(backend_name, backend_conf)
-        backend.delete_older(retention_date)
+        result = backend.delete_older(retention_date, dry_run=dry_run,
+                                      keep=get_chain_dependencies)
+        if not dry_run:
+            delete_indexes(backend, [name for name in result.deleted
+                                     if not is_manifest(name) and not is_volume_set(name)])
+            delete_volumes(backend, [name for name in result.deleted if is_volume_set(name)])
+        # Chunks of deleted snapshots, the dry run doesn't delete snapshots
+        chunks = collect_garbage(backend) if not dry_run else []
+        return result, chunks
+
+    def abort_stale_uploads(self, backend_name, backend_conf, older_than, dry_run=False):
+        """
+        Abort unfinished uploads started more than older_than hours ago
 
-    def download(self, backend_name, backend_conf, backup_file, dst_path):
+        Returns:
+            result(DeleteResult)
+        """
+        since = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=older_than)
         backend = self.get_backend(backend_name, backend_conf)
-        backend.download(backup_file, dst_path)
+        return backend.abort_stale_uploads(since, dry_run=dry_run)
+
+    def verify(self, task, backup_file=None, sample=None, time_budget=None):
+        """
+        Verify backups of the task, all of them by default
+
+        Args:
+            task(dict)
+            backup_file(str): Verify only the backup
+            sample(int): Verify a random subset of the sample size
+            time_budget(float): Don't start new verifications after the seconds
+        Returns:
+            results(dict): A destination name -> a list of sbackup.verify.VerifyResult,
+                every destination of the task is verified
+        """
+        results = {}
+        encryption = None
+        if task.get('encryption'):
+            encryption = EncryptionSettings(**task['encryption'])
+            encryption.validate()
+        for backend_name, backend_conf in task['dst_backend'].items():
+            backend = self.get_backend(backend_name, backend_conf)
+            if encryption is not None:
+                backend = encryption.open_backend(backend)
+            if backup_file:
+                names = [backup_file]
+            else:
+                prefix = get_backup_name(task['name']) + '-'
+                names = [name for name in backend if name.startswith(prefix)]
+            results[backend_name] = verify_backups(backend, names,
+                                                   workers=self.settings['max_uploads'],
+                                                   sample=sample, time_budget=time_budget)
+        return results
+
+    def download(self, backend_name, backend_conf, backup_file, dst_path, encryption=None):
+        """
+        Download the backup to the dst_path directory, a backup of a task
+        with the encryption is decrypted
+
+        Args:
+            encryption(dict): The encryption settings of the task
+        Returns:
+            path(str)
+        """
+        backend = self.get_backend(backend_name, backend_conf)
+        if not encryption:
+            return backend.download(backup_file, dst_path)
+        settings = EncryptionSettings(**encryption)
+        settings.validate()
+        encrypted = backend.download(backup_file, dst_path,
+                                     dst_filename='.%s.encrypted' % backup_file)
+        path = os.path.join(dst_path, backup_file)
+        try:
+            with open(encrypted, 'rb') as fileobj, settings.open_reader(fileobj) as reader, \
+                    open(path, 'wb') as output:
+                shutil.copyfileobj(reader, output, DOWNLOAD_BUFFER_SIZE)
+        except BaseException:
+            if os.path.exists(path):
+                os.remove(path)
+            raise
+        finally:
+            os.remove(encrypted)
+        return path
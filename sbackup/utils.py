@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import os
+import re
 import stat
 
 import yaml
@@ -7,6 +8,36 @@ import yaml
 from .exception import SBackupException
 
 
+SIZE_UNITS = {
+    '': 1,
+    'K': 1024,
+    'M': 1024 ** 2,
+    'G': 1024 ** 3,
+    'T': 1024 ** 4,
+}
+_size_re = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)(?:I?B)?\s*$', re.IGNORECASE)
+
+
+def parse_size(value):
+    """
+    Convert a size like 64MB or 1.5G to bytes, units are powers of 1024
+
+    Args:
+        value(int|str)
+    Returns:
+        size(int)
+    Raises:
+        SBackupException: An error occur if the value has a wrong format
+    """
+    if isinstance(value, int):
+        return value
+    match = _size_re.match(str(value))
+    if not match:
+        raise SBackupException("Can't parse the size %s" % value)
+    number, unit = match.groups()
+    return int(float(number) * SIZE_UNITS[unit.upper()])
+
+
 def get_backup_name(name):
     return 'backup-{name}'.format(name=name)
 
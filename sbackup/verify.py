@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""
+Verification of backups in a backend
+
+An archive is streamed from the backend and checked against the SHA-256
+checksums of its index sidecar: the checksum of the whole archive and of
+every file. Nothing is written to the disk. Archives are verified by a
+pool of threads, hashlib and the decompressors release the GIL on big
+buffers, so the pool uses several cores. A snapshot is verified by the
+checksums of its chunks. A raw stream (a database dump) is checked by the
+checksum of its uncompressed data. Volumes of a set are verified as archives.
+"""
+import hashlib
+import logging
+import random
+import tarfile
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from . import dedup, volumes
+from .compress import get_codec, get_codec_by_filename
+from .exception import SBackupException
+from .seekable import FORMAT_RAW, HashingReader, load_index
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 4
+READ_SIZE = 1024 * 1024
+
+
+class VerifyResult(object):
+    """
+    A result of the verification of a backup
+    Attributes:
+       filename(str)
+       errors(list): Found problems, empty if the backup is intact
+       members(int): A number of verified files or chunks
+       size(int): A number of read bytes
+       checked(bool): False if the backup has no checksums, only
+           the structure of the archive is verified
+       elapsed(float): Seconds
+    """
+
+    def __init__(self, filename, errors=None, members=0, size=0, checked=True, elapsed=0.0):
+        self.filename = filename
+        self.errors = errors or []
+        self.members = members
+        self.size = size
+        self.checked = checked
+        self.elapsed = elapsed
+
+    @property
+    def ok(self):
+        return not self.errors
+
+    def __repr__(self):
+        return "<VerifyResult %s ok=%s>" % (self.filename, self.ok)
+
+
+def hash_member(tar, member):
+    digest = hashlib.sha256()
+    fileobj = tar.extractfile(member)
+    while True:
+        data = fileobj.read(READ_SIZE)
+        if not data:
+            break
+        digest.update(data)
+    return digest.hexdigest()
+
+
+def is_tar(filename):
+    return '.tar.' in filename
+
+
+def verify_stream(backend, filename, archive_index=None):
+    """
+    Stream the compressed file from the backend and compare the checksums
+    of the file and of the uncompressed data
+
+    Returns:
+        VerifyResult
+    """
+    result = VerifyResult(filename, checked=archive_index is not None)
+    if archive_index is None:
+        codec = get_codec_by_filename(filename)
+    else:
+        codec = get_codec(archive_index.codec)
+    digest = hashlib.sha256()
+    size = 0
+    with backend.open_reader(filename) as fileobj:
+        reader = HashingReader(fileobj)
+        with codec.open_reader(reader) as decompressed:
+            while True:
+                data = decompressed.read(READ_SIZE)
+                if not data:
+                    break
+                digest.update(data)
+                size += len(data)
+        while reader.read(READ_SIZE):
+            pass
+    result.members = 1
+    result.size = reader.size
+    if archive_index is not None:
+        _, _, end, checksum = archive_index.members[0]
+        if size != end:
+            result.errors.append("The data size is %s, the index has %s" % (size, end))
+        if checksum is not None and digest.hexdigest() != checksum:
+            result.errors.append("The checksum of the data doesn't match")
+        if archive_index.checksum and reader.hexdigest() != archive_index.checksum:
+            result.errors.append("The checksum of the archive doesn't match")
+    return result
+
+
+def verify_archive(backend, filename):
+    """
+    Stream the archive from the backend and compare checksums
+
+    Returns:
+        VerifyResult
+    """
+    result = VerifyResult(filename)
+    archive_index = load_index(backend, filename)
+    if (archive_index is None and not is_tar(filename)) or \
+            (archive_index is not None and archive_index.format == FORMAT_RAW):
+        return verify_stream(backend, filename, archive_index)
+    if archive_index is None:
+        result.checked = False
+        codec = get_codec_by_filename(filename)
+        expected = None
+    else:
+        codec = get_codec(archive_index.codec)
+        expected = iter(archive_index.members)
+    with backend.open_reader(filename) as fileobj:
+        reader = HashingReader(fileobj)
+        with codec.open_reader(reader) as decompressed:
+            with tarfile.open(fileobj=decompressed, mode='r|') as tar:
+                for member in tar:
+                    result.members += 1
+                    if expected is None:
+                        if member.isreg():
+                            hash_member(tar, member)
+                        continue
+                    name, _, _, checksum = next(expected, (None, None, None, None))
+                    if name != member.name:
+                        result.errors.append("Unexpected member %s, the index has %s" % (
+                            member.name, name))
+                        break
+                    if checksum is not None and hash_member(tar, member) != checksum:
+                        result.errors.append("The checksum of %s doesn't match" % member.name)
+            # The trailing blocks of the tar
+            while decompressed.read(READ_SIZE):
+                pass
+        while reader.read(READ_SIZE):
+            pass
+    result.size = reader.size
+    if archive_index is not None:
+        if next(expected, None) is not None:
+            result.errors.append("The archive is shorter than the index")
+        if archive_index.checksum and reader.hexdigest() != archive_index.checksum:
+            result.errors.append("The checksum of the archive doesn't match")
+        if reader.size != archive_index.size:
+            result.errors.append("The archive size is %s, the index has %s" % (
+                reader.size, archive_index.size))
+    return result
+
+
+def verify_volume_set(backend, filename):
+    """
+    Verify every volume of the set and compare volumes with the set manifest
+    """
+    result = VerifyResult(filename)
+    volume_set = volumes.load_set(backend.get_object(filename))
+    for item in volume_set['volumes']:
+        volume = verify_archive(backend, item['name'])
+        result.members += volume.members
+        result.size += volume.size
+        result.checked = result.checked and volume.checked
+        result.errors.extend('%s: %s' % (item['name'], error) for error in volume.errors)
+        if volume.size != item['size']:
+            result.errors.append("The volume %s size is %s, the set has %s" % (
+                item['name'], volume.size, item['size']))
+    return result
+
+
+def verify_snapshot(backend, filename, workers=DEFAULT_WORKERS):
+    """
+    Check every chunk of the snapshot, the chunk id is its SHA-256
+    """
+    result = VerifyResult(filename)
+    manifest = dedup.load_manifest(backend.get_object(filename))
+    chunk_ids = set(dedup.get_chunk_ids(manifest))
+    store = dedup.ChunkStore(backend)
+
+    def check(chunk_id):
+        try:
+            return len(store.get(chunk_id)), None
+        except SBackupException as error:
+            return 0, error
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for size, error in executor.map(check, chunk_ids):
+            result.members += 1
+            result.size += size
+            if error is not None:
+                result.errors.append("%s" % error)
+    return result
+
+
+def verify(backend, filename):
+    """
+    Verify a backup, an archive or a snapshot
+
+    Returns:
+        VerifyResult
+    """
+    started = time.monotonic()
+    try:
+        if dedup.is_manifest(filename):
+            result = verify_snapshot(backend, filename)
+        elif volumes.is_volume_set(filename):
+            result = verify_volume_set(backend, filename)
+        else:
+            result = verify_archive(backend, filename)
+    except Exception as error:
+        logger.debug("Can't verify the %s" % filename, exc_info=True)
+        result = VerifyResult(filename, errors=["Can't read the backup: %s" % error])
+    result.elapsed = time.monotonic() - started
+    if result.ok:
+        logger.debug("The %s is intact" % filename)
+    else:
+        logger.error("The %s is damaged: %s" % (filename, '; '.join(result.errors)))
+    return result
+
+
+def verify_backups(backend, names, workers=DEFAULT_WORKERS, sample=None, time_budget=None,
+                   seed=None):
+    """
+    Verify backups in parallel
+
+    Args:
+        backend(sbackup.dest_backend.base.BackendWrapper)
+        names(list): Names of backups
+        workers(int): A number of backups verified at the same time
+        sample(int): Verify a random subset of the sample size
+        time_budget(float): Don't start new verifications after the seconds
+        seed: A random seed of the sample
+    Returns:
+        results(list): VerifyResult of verified backups
+    """
+    names = list(names)
+    if sample is not None or time_budget is not None:
+        random.Random(seed).shuffle(names)
+    if sample is not None:
+        names = names[:sample]
+    deadline = None if time_budget is None else time.monotonic() + time_budget
+
+    def run(name):
+        if deadline is not None and time.monotonic() >= deadline:
+            return None
+        return verify(backend, name)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(run, names))
+    return [result for result in results if result is not None]
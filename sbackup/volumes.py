@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""
+Multi-volume archives
+
+A backup is split into independently compressed tar volumes, so it is
+restored by several processes and connections at the same time. The
+source is split by subtrees: a subtree bigger than a volume share is split
+into its sub directories, its biggest files and the rest of its files, the
+biggest files of the source are tracked for it. Then the parts are
+assigned to volumes by their sizes, the biggest part to the smallest
+volume. Volumes are stored as ``volumes/<backup name>-<time>/<number><ext>``
+and the set manifest ``<backup name>-<time>.volumes`` lists them.
+
+Directories which are split between volumes are stored in the first volume,
+they are created before the parallel extraction and their times are set
+when all volumes are extracted.
+"""
+import collections
+import datetime
+import gzip
+import heapq
+import json
+import logging
+import os
+import stat
+
+from .exception import SBackupException
+from .seekable import delete_indexes
+from .walker import is_dir
+
+logger = logging.getLogger(__name__)
+
+VOLUMES_PREFIX = 'volumes/'
+SET_EXTENSION = '.volumes'
+SET_VERSION = 1
+# A tar header of every entry
+ENTRY_SIZE = 512
+# The biggest files of the source which may be volume parts of their own
+LARGE_FILES = 1024
+
+
+def is_volume_set(filename):
+    return filename.endswith(SET_EXTENSION)
+
+
+def get_volume_prefix(filename):
+    """
+    Return the prefix of volumes of the set
+    """
+    return VOLUMES_PREFIX + filename[:-len(SET_EXTENSION)] + '/'
+
+
+def get_volume_name(filename, number, extension):
+    return '{prefix}{number:04d}{ext}'.format(prefix=get_volume_prefix(filename),
+                                              number=number + 1, ext=extension)
+
+
+class VolumePlan(object):
+    """
+    Assignment of the source to volumes
+
+    Attributes:
+       volumes(int): A number of volumes, it is less than the requested
+           number if the source has fewer parts
+       parts(dict): A part -> a volume, a part is a subtree or a file
+           (``site/a``) or the rest of files of a directory (``site/a/``)
+       dirs(dict): Split directories -> (mode, mtime)
+
+    Usage::
+
+        with Walker() as walker:
+            plan = plan_volumes(walker.walk('/var/www/site1', 'site1'), 4)
+        volume = plan.get_volume(entry.arcname, is_dir(entry))
+
+    """
+
+    def __init__(self, volumes, parts, dirs):
+        self.volumes = volumes
+        self.parts = parts
+        self.dirs = dirs
+
+    def get_volume(self, arcname, directory=False):
+        if arcname in self.dirs:
+            return 0
+        if arcname in self.parts:
+            return self.parts[arcname]
+        name = arcname
+        while True:
+            parent = name.rpartition('/')[0]
+            if not parent or parent in self.dirs:
+                break
+            name = parent
+        if parent and name == arcname and not directory:
+            name = parent + '/'
+        return self.parts.get(name, 0)
+
+
+def plan_volumes(entries, volumes):
+    """
+    Split the source into parts of about the same size and assign them to volumes
+
+    Args:
+        entries: An iterable of sbackup.walker.Entry in the walk order
+        volumes(int): A requested number of volumes
+    Returns:
+        VolumePlan
+    """
+    root = None
+    totals = collections.Counter()
+    files = collections.Counter()
+    children = collections.defaultdict(list)
+    stats = {}
+    large = []
+    for entry in entries:
+        if root is None:
+            root = entry.arcname
+        parent = entry.arcname.rpartition('/')[0]
+        if is_dir(entry):
+            stats[entry.arcname] = (stat.S_IMODE(entry.stat.st_mode), entry.stat.st_mtime)
+            if parent:
+                children[parent].append(entry.arcname)
+        elif parent:
+            size = ENTRY_SIZE + (entry.stat.st_size if stat.S_ISREG(entry.stat.st_mode) else 0)
+            files[parent] += size
+            if len(large) < LARGE_FILES:
+                heapq.heappush(large, (size, entry.arcname))
+            elif size > large[0][0]:
+                heapq.heapreplace(large, (size, entry.arcname))
+    if root not in stats:
+        return VolumePlan(1, {root: 0}, {})
+    # Sub directories are deeper than their parents
+    for name in sorted(stats, key=lambda name: name.count('/'), reverse=True):
+        totals[name] = ENTRY_SIZE + files[name] + sum(totals[child] for child in children[name])
+    large_files = collections.defaultdict(list)
+    for size, name in large:
+        large_files[name.rpartition('/')[0]].append((size, name))
+
+    share = totals[root] / volumes
+    parts = {root: totals[root]}
+    dirs = {}
+    largest = [(-totals[root], root)]
+    while largest:
+        size, name = heapq.heappop(largest)
+        if -size <= share:
+            break
+        rest = files[name]
+        if rest > share and large_files[name]:
+            for file_size, file_name in large_files[name]:
+                parts[file_name] = file_size
+                rest -= file_size
+        elif not children[name]:
+            continue
+        del parts[name]
+        dirs[name] = stats[name]
+        if rest:
+            parts[name + '/'] = rest
+        for child in children[name]:
+            parts[child] = totals[child]
+            heapq.heappush(largest, (-totals[child], child))
+
+    loads = [(0, number) for number in range(min(volumes, len(parts)))]
+    assigned = {}
+    for name in sorted(parts, key=lambda name: (-parts[name], name)):
+        load, number = heapq.heappop(loads)
+        assigned[name] = number
+        heapq.heappush(loads, (load + parts[name], number))
+    return VolumePlan(len(loads), assigned, dirs)
+
+
+def dump_set(volumes, dirs):
+    """
+    Args:
+        volumes(list): Dicts with a name, a size, files and a checksum of every volume
+        dirs(dict): Split directories -> (mode, mtime)
+    """
+    return gzip.compress(json.dumps({
+        'version': SET_VERSION,
+        'created': datetime.datetime.now().isoformat(),
+        'volumes': volumes,
+        'dirs': sorted([name, mode, mtime] for name, (mode, mtime) in dirs.items()),
+    }).encode('utf-8'), mtime=0)
+
+
+def load_set(data):
+    volume_set = json.loads(gzip.decompress(data).decode('utf-8'))
+    if volume_set.get('version') != SET_VERSION:
+        raise SBackupException("Unsupported volume set version %s" % volume_set.get('version'))
+    return volume_set
+
+
+def create_dirs(path, volume_set):
+    """
+    Create split directories before volumes are extracted at the same time
+    """
+    for name, _, _ in volume_set['dirs']:
+        parts = name.split('/')
+        if '..' in parts or os.path.isabs(name):
+            logger.error("Skip the %s, it is outside of the destination" % name)
+            continue
+        os.makedirs(os.path.join(path, name), exist_ok=True)
+
+
+def restore_dirs(path, volume_set):
+    """
+    Set modes and times of split directories, files of other volumes changed them
+    """
+    for name, mode, mtime in reversed(volume_set['dirs']):
+        target = os.path.join(path, name)
+        if os.path.isdir(target) and not os.path.islink(target):
+            os.chmod(target, mode)
+            os.utime(target, (mtime, mtime))
+
+
+def delete_volumes(backend, names):
+    """
+    Delete volumes of deleted sets and their indexes
+
+    Returns:
+        deleted(list): Names of deleted volumes
+    """
+    volumes = []
+    for name in names:
+        volumes.extend(backend.list_objects(get_volume_prefix(name)))
+    if not volumes:
+        return []
+    errors = backend.delete_objects(volumes)
+    for name, error in errors.items():
+        logger.error("Can't delete the volume %s: %s" % (name, error))
+    deleted = [name for name in volumes if name not in errors]
+    delete_indexes(backend, deleted)
+    return deleted
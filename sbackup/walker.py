@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+"""
+The parallel directory walker
+
+Directories are listed by ``os.scandir`` and entries are stat'ed in a
+thread pool, small files are read ahead by the same pool. The consumer
+gets entries in the same order as ``tarfile.add`` (sorted, depth-first),
+so the tar writer, the disk and the network are busy at the same time.
+Listings of subdirectories run ahead of the consumer, at most ``max_scans``
+of them are in flight or wait for the consumer.
+"""
+import collections
+import functools
+import grp
+import io
+import logging
+import os
+import pwd
+import stat
+import tarfile
+
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_READ_AHEAD_SIZE = 64 * 1024 * 1024
+DEFAULT_READ_AHEAD_FILES = 1024
+SMALL_FILE_SIZE = 1024 * 1024
+# Directory listings ahead of the consumer per a walker thread
+SCANS_PER_WORKER = 4
+
+Entry = collections.namedtuple('Entry', ('path', 'arcname', 'stat'))
+
+
+def is_dir(entry):
+    return stat.S_ISDIR(entry.stat.st_mode)
+
+
+class Walker(object):
+    """
+    Usage::
+
+        with Walker(workers=8) as walker:
+            for entry in walker.walk('/var/www/site1', 'site1'):
+                print(entry.arcname, entry.stat.st_size)
+
+    """
+
+    def __init__(self, workers=1, accept=None, max_scans=None):
+        """
+        Args:
+            workers(int): A number of threads
+            accept: A callable(entry) -> bool, a directory that isn't
+                accepted is not walked
+            max_scans(int): Directory listings ahead of the consumer,
+                the default is SCANS_PER_WORKER per a thread
+        """
+        self.workers = workers
+        self.accept = accept
+        self.max_scans = max_scans or workers * SCANS_PER_WORKER
+        # (path, error) of directories which can't be read, they are walked as empty
+        self.skipped = []
+        self._scans = 0
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+
+    def close(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def submit(self, func, *args):
+        return self._executor.submit(func, *args)
+
+    def _scan(self, path, arcname):
+        entries = []
+        try:
+            with os.scandir(path) as iterator:
+                items = sorted(iterator, key=lambda item: item.name)
+        except OSError as error:
+            logger.error("Can't read the directory %s: %s" % (path, error))
+            self.skipped.append((path, '%s' % error))
+            return entries
+        for item in items:
+            try:
+                info = item.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+            entry = Entry(item.path, arcname + '/' + item.name, info)
+            if self.accept is None or self.accept(entry):
+                entries.append(entry)
+        return entries
+
+    def walk(self, root, arcname):
+        """
+        Yield entries of the root in the tarfile.add order
+        """
+        entry = Entry(root, arcname, os.lstat(root))
+        yield entry
+        if is_dir(entry):
+            yield from self._walk_dir(self._submit_scan(entry))
+
+    def _submit_scan(self, entry):
+        self._scans += 1
+        return self.submit(self._scan, entry.path, entry.arcname)
+
+    def _walk_dir(self, future):
+        entries = future.result()
+        self._scans -= 1
+        # Sub directories are listed while the consumer handles the entries
+        dirs = collections.deque(entry for entry in entries if is_dir(entry))
+        scans = {}
+        for entry in entries:
+            while dirs and (self._scans < self.max_scans or dirs[0] is entry):
+                item = dirs.popleft()
+                scans[item.path] = self._submit_scan(item)
+            yield entry
+            if entry.path in scans:
+                yield from self._walk_dir(scans.pop(entry.path))
+
+
+def _read_file(path):
+    try:
+        with open(path, 'rb') as fileobj:
+            return fileobj.read()
+    except FileNotFoundError:
+        return None
+
+
+def read_ahead(walker, entries, max_size=DEFAULT_READ_AHEAD_SIZE, max_files=DEFAULT_READ_AHEAD_FILES,
+               small_file_size=SMALL_FILE_SIZE):
+    """
+    Read small regular files in the walker pool ahead of the consumer,
+    at most max_files files and max_size bytes
+
+    Yields:
+        (entry, future), the future is None for other entries, the future
+        result is None if the file was deleted
+    """
+    pending = collections.deque()
+    pending_size = 0
+    for entry in entries:
+        size = entry.stat.st_size
+        if stat.S_ISREG(entry.stat.st_mode) and size <= small_file_size:
+            pending.append((entry, walker.submit(_read_file, entry.path)))
+            pending_size += size
+        else:
+            pending.append((entry, None))
+        while pending and (pending_size > max_size or len(pending) > max_files or
+                           pending[0][1] is None):
+            item = pending.popleft()
+            if item[1] is not None:
+                pending_size -= item[0].stat.st_size
+            yield item
+    while pending:
+        yield pending.popleft()
+
+
+@functools.lru_cache(maxsize=1024)
+def _get_uname(uid):
+    try:
+        return pwd.getpwuid(uid)[0]
+    except KeyError:
+        return ''
+
+
+@functools.lru_cache(maxsize=1024)
+def _get_gname(gid):
+    try:
+        return grp.getgrgid(gid)[0]
+    except KeyError:
+        return ''
+
+
+def get_tarinfo(tar, entry):
+    """
+    Create a TarInfo from the entry stat like TarFile.gettarinfo, but
+    without one more lstat
+    """
+    info = entry.stat
+    mode = info.st_mode
+    tarinfo = tar.tarinfo()
+    tarinfo.tarfile = tar
+    linkname = ''
+    size = 0
+    inode = (info.st_ino, info.st_dev)
+    if stat.S_ISREG(mode):
+        if info.st_nlink > 1 and inode in tar.inodes:
+            # A hard link to a file that is already archived
+            type = tarfile.LNKTYPE
+            linkname = tar.inodes[inode]
+        else:
+            type = tarfile.REGTYPE
+            size = info.st_size
+    elif stat.S_ISDIR(mode):
+        type = tarfile.DIRTYPE
+    elif stat.S_ISFIFO(mode):
+        type = tarfile.FIFOTYPE
+    elif stat.S_ISLNK(mode):
+        type = tarfile.SYMTYPE
+        linkname = os.readlink(entry.path)
+    elif stat.S_ISCHR(mode):
+        type = tarfile.CHRTYPE
+    elif stat.S_ISBLK(mode):
+        type = tarfile.BLKTYPE
+    else:
+        return None
+    tarinfo.name = entry.arcname
+    tarinfo.mode = mode
+    tarinfo.uid = info.st_uid
+    tarinfo.gid = info.st_gid
+    tarinfo.size = size
+    tarinfo.mtime = info.st_mtime
+    tarinfo.type = type
+    tarinfo.linkname = linkname
+    tarinfo.uname = _get_uname(info.st_uid)
+    tarinfo.gname = _get_gname(info.st_gid)
+    if type in (tarfile.CHRTYPE, tarfile.BLKTYPE):
+        tarinfo.devmajor = os.major(info.st_rdev)
+        tarinfo.devminor = os.minor(info.st_rdev)
+    return tarinfo
+
+
+def _add_inode(tar, entry):
+    """
+    Later hard links of the file refer to the entry, it is called once the
+    data is written, a link to a deleted file would refer to a missing member
+    """
+    if entry.stat.st_ino:
+        tar.inodes[(entry.stat.st_ino, entry.stat.st_dev)] = entry.arcname
+
+
+def add_entry(tar, entry, future=None):
+    """
+    Write the entry to the tar, the future is a result of read_ahead
+    """
+    tarinfo = get_tarinfo(tar, entry)
+    if tarinfo is None:
+        logger.debug("Skip the socket %s" % entry.path)
+        return
+    if not tarinfo.isreg():
+        tar.addfile(tarinfo)
+        return
+    if future is not None:
+        data = future.result()
+        if data is None:
+            logger.debug("The file %s was deleted" % entry.path)
+            return
+        tarinfo.size = len(data)
+        tar.addfile(tarinfo, io.BytesIO(data))
+        _add_inode(tar, entry)
+        return
+    try:
+        with open(entry.path, 'rb') as fileobj:
+            tar.addfile(tarinfo, fileobj)
+    except FileNotFoundError:
+        logger.debug("The file %s was deleted" % entry.path)
+        return
+    _add_inode(tar, entry)
+
+
+def add_entries(tar, items):
+    """
+    Write entries to the tar in order
+
+    Args:
+        tar(tarfile.TarFile)
+        items: An iterable of (entry, future) from read_ahead
+    """
+    for entry, future in items:
+        add_entry(tar, entry, future)
@@ -19,6 +19,12 @@ setup(
     description='Simple backup script',
     packages=["sbackup"],
     install_requires=['click', 'PyYAML', 'boto3'],
+    extras_require={
+        'zstd': ['zstandard'],
+        'lz4': ['lz4'],
+        'encryption': ['cryptography'],
+        'dedup': ['numpy'],
+    },
     include_package_data=True,
     entry_points={
         'console_scripts': [
@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+import pytest
+from moto import mock_aws
+
+from sbackup.dest_backend.aws import S3Backend
+
+
+@pytest.fixture
+def s3_backend():
+    with mock_aws():
+        backend = S3Backend('FAKE_KEY_ID', 'FAKE_KEY', 'backup', location='site')
+        backend.bucket.create()
+        yield backend
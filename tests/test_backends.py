@@ -1,12 +1,22 @@
 # -*- coding: utf-8 -*-
+from concurrent.futures import ThreadPoolExecutor
 from unittest import mock
 
 from botocore.exceptions import ClientError
+from moto import mock_aws
 from sbackup.exception import SBackupValidationError
-from sbackup.dest_backend.aws import S3Backend, S3BackendException
+from sbackup.dest_backend.aws import (
+    S3Backend, S3BackendException, S3MultipartWriter, MIN_PART_SIZE
+)
+from sbackup.dest_backend.catalog import Catalog
+from sbackup.dest_backend.fanout import FanOutBackend, FanOutException, TeeWriter
+from sbackup.dest_backend.local import LocalBackend, LocalBackendException
+from sbackup.dest_backend.transfer import Retry, Throttle, copy_fd, iter_ordered
 
+import datetime
 import pytest
 import os
+import time
 
 
 @mock.patch('sbackup.dest_backend.aws.Session.client')
@@ -77,3 +87,405 @@ def test_validate_aws_download(session_mock, resourse_mock):
     with mock.patch("sbackup.dest_backend.aws.Session.resource", side_effect=error):
         with pytest.raises(S3BackendException):
             obj.download('test.txt', '/tmp')
+
+
+def test_aws_stream_small_file(s3_backend):
+    with s3_backend.open_writer('small.txt') as fileobj:
+        fileobj.write(b'data')
+    body = s3_backend.bucket.Object('site/small.txt').get()['Body'].read()
+    assert body == b'data'
+
+
+def test_aws_stream_multipart(s3_backend):
+    chunk = os.urandom(1024 * 1024)
+    with s3_backend.open_writer('big.bin', part_size=MIN_PART_SIZE, max_concurrency=2) as fileobj:
+        for _ in range(12):
+            fileobj.write(chunk)
+        assert fileobj.upload_id is not None
+    body = s3_backend.bucket.Object('site/big.bin').get()['Body'].read()
+    assert body == chunk * 12
+
+
+def test_aws_stream_abort(s3_backend):
+    with pytest.raises(RuntimeError):
+        with s3_backend.open_writer('broken.bin', part_size=MIN_PART_SIZE) as fileobj:
+            fileobj.write(os.urandom(MIN_PART_SIZE + 1))
+            raise RuntimeError
+    client = s3_backend.bucket.meta.client
+    assert not client.list_multipart_uploads(Bucket='backup').get('Uploads')
+    assert list(s3_backend) == []
+
+
+def test_aws_stream_part_limit():
+    client = mock.MagicMock()
+    client.create_multipart_upload.return_value = {'UploadId': 'upload'}
+    client.upload_part.return_value = {'ETag': 'etag'}
+    with mock.patch.multiple('sbackup.dest_backend.aws', MIN_PART_SIZE=1, MAX_PARTS=6,
+                             PART_SIZE_STEP=2):
+        writer = S3MultipartWriter(client, 'backup', 'grow.bin', part_size=1)
+        writer.write(b'x' * 14)
+        sizes = [len(call[1]['Body']) for call in client.upload_part.call_args_list]
+        assert sizes == [1, 1, 2, 2, 4, 4]
+        writer.close()
+        assert client.complete_multipart_upload.called
+
+        writer = S3MultipartWriter(client, 'backup', 'fixed.bin', part_size=1, expected_size=12)
+        assert writer.part_size == 2
+        writer.write(b'x' * 12)
+        with pytest.raises(S3BackendException):
+            writer.write(b'x' * 2)
+        writer.abort()
+
+
+def test_aws_transfer_config():
+    obj = S3Backend('FAKE_KEY_ID', 'FAKE_KEY', 'backup', transfer={
+        'multipart_threshold': '64MB',
+        'multipart_chunksize': '16MiB',
+        'max_concurrency': 8,
+        'max_bandwidth': '1M',
+    })
+    assert obj.transfer_config.multipart_threshold == 64 * 1024 * 1024
+    assert obj.transfer_config.multipart_chunksize == 16 * 1024 * 1024
+    assert obj.transfer_config.max_concurrency == 8
+    assert obj.throttle.rate == 1024 * 1024
+    for transfer in ({'max_concurrency': 0}, {'multipart_chunksize': '1MB'}, {'speed': 1},
+                     {'max_bandwidth': 'fast'}):
+        with pytest.raises(SBackupValidationError):
+            S3Backend('FAKE_KEY_ID', 'FAKE_KEY', 'backup', transfer=transfer)
+
+
+def test_aws_transfer_download(s3_backend, tmpdir):
+    s3_backend.transfer_config = S3Backend.get_transfer_config({
+        'multipart_threshold': '5MB', 'multipart_chunksize': '5MB', 'max_concurrency': 3})
+    data = os.urandom(12 * 1024 * 1024)
+    src = tmpdir.join('src.bin')
+    src.write_binary(data)
+    s3_backend.upload(str(src))
+    dst = s3_backend.download('src.bin', str(tmpdir.mkdir('dst')))
+    with open(dst, 'rb') as fileobj:
+        assert fileobj.read() == data
+
+
+def test_aws_stream_read(s3_backend):
+    data = os.urandom(10000)
+    s3_backend.put_object('src.bin', data)
+    with s3_backend.open_reader('src.bin', part_size=3000, max_concurrency=2) as fileobj:
+        assert fileobj.read(10) == data[:10]
+        assert fileobj.read(5000) == data[10:5010]
+        assert fileobj.read() == data[5010:]
+        assert fileobj.read(1) == b''
+    with pytest.raises(S3BackendException):
+        s3_backend.open_reader('missing.bin')
+
+
+def test_throttle():
+    throttle = Throttle(1000)
+    started = time.monotonic()
+    for _ in range(3):
+        throttle.consume(100)
+    assert time.monotonic() - started >= 0.19
+
+
+def test_aws_catalog(s3_backend, tmpdir):
+    s3_backend.catalog = Catalog(str(tmpdir.join('catalog.json')), ttl=3600)
+    for name in ('backup-site-2017-01-11-10-10.tar.gz', 'backup-site-2017-01-12-10-10.tar.gz',
+                 'backup-site2-2017-01-13-10-10.tar.gz'):
+        s3_backend.bucket.put_object(Key='site/' + name, Body=b'data')
+    s3_backend.bucket.put_object(Key='site/chunks/aa/aabb', Body=b'data')
+    assert s3_backend.get_last_backup('backup-site') == 'backup-site-2017-01-12-10-10.tar.gz'
+
+    with mock.patch.object(S3Backend, '_ls', side_effect=AssertionError('S3 listing')):
+        assert len(list(s3_backend)) == 3
+        s3_backend.put_object('backup-site-2017-01-14-10-10.manifest', b'data')
+        assert s3_backend.get_last_backup('backup-site') == 'backup-site-2017-01-14-10-10.manifest'
+        s3_backend.delete('backup-site-2017-01-14-10-10.manifest')
+        assert s3_backend.get_last_backup('backup-site') == 'backup-site-2017-01-12-10-10.tar.gz'
+        s3_backend.delete_older(datetime.date.today() + datetime.timedelta(1))
+        assert list(s3_backend) == []
+
+    catalog = Catalog(str(tmpdir.join('catalog.json')), ttl=3600)
+    assert catalog.is_fresh()
+    assert list(catalog) == []
+    assert [item.key for item in s3_backend.bucket.objects.all()] == ['site/chunks/aa/aabb']
+
+
+def test_catalog_concurrent_updates(tmpdir):
+    path = str(tmpdir.join('catalog', 'catalog.json'))
+    Catalog(path).replace([])
+    modified = datetime.datetime(2017, 1, 11, tzinfo=datetime.timezone.utc)
+
+    def add(task):
+        catalog = Catalog(path)
+        for number in range(20):
+            catalog.add('backup-%s-2017-01-11-10-%02d.tar.gz' % (task, number), modified, 1)
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        list(executor.map(add, ['site', 'db', 'app', 'www']))
+    assert len(list(Catalog(path))) == 80
+
+    first, second = Catalog(path), Catalog(path)
+    first.remove('backup-site-2017-01-11-10-00.tar.gz')
+    second.add('backup-site-2017-01-12-10-10.tar.gz', modified, 1)
+    assert 'backup-site-2017-01-11-10-00.tar.gz' not in second
+    first.refresh()
+    assert 'backup-site-2017-01-12-10-10.tar.gz' in first
+    assert len(list(Catalog(path))) == 80
+
+
+def test_aws_listing(s3_backend):
+    names = ['README', 'backup-site-2017-01-11-10-10.tar.gz', 'zz.txt']
+    names += ['backup-%s-%s-%02d-01-10-10.tar.gz' % (task, year, month)
+              for task in ('app', 'app-db', 'site2') for year in (2023, 2024) for month in (1, 2, 3)]
+    for name in names:
+        s3_backend.bucket.put_object(Key='site/' + name, Body=b'data')
+    for number in range(30):
+        s3_backend.bucket.put_object(Key='site/chunks/%02x/%02x00' % (number, number), Body=b'c')
+        s3_backend.bucket.put_object(Key='site/index/backup-app-%s.json.gz' % number, Body=b'i')
+    s3_backend.bucket.put_object(Key='other/backup-app-2017-01-11-10-10.tar.gz', Body=b'data')
+
+    with mock.patch('sbackup.dest_backend.aws.LIST_PAGE_SIZE', 4):
+        assert list(s3_backend) == sorted(names)
+        assert list(s3_backend.list_backups('backup-app-')) == sorted(
+            name for name in names if name.startswith('backup-app-'))
+        assert s3_backend.get_last_backup('backup-site2').startswith('backup-site2-')
+        assert sorted(s3_backend.list_objects('chunks/')) == \
+            ['chunks/%02x/%02x00' % (number, number) for number in range(30)]
+
+        # Sub directories and other tasks are not paged through
+        s3_backend.list_requests = 0
+        list(s3_backend.list_backups('backup-site2-'))
+        requests = s3_backend.list_requests
+        for number in range(30, 60):
+            s3_backend.bucket.put_object(Key='site/chunks/%02x/%02x00' % (number, number), Body=b'c')
+            s3_backend.bucket.put_object(Key='site/backup-app-2025-%02d.tar.gz' % number, Body=b'')
+        s3_backend.list_requests = 0
+        list(s3_backend.list_backups('backup-site2-'))
+        assert s3_backend.list_requests == requests
+
+    # An abandoned listing stops the partition threads
+    listing = s3_backend.list_backups('backup-')
+    assert next(listing) == 'backup-app-2023-01-01-10-10.tar.gz'
+    listing.close()
+
+
+def test_iter_ordered():
+    def numbers(start, error=None):
+        def function():
+            for number in range(start, start + 3):
+                time.sleep(0.01 * (3 - start // 3))
+                yield number
+            if error:
+                raise error
+        return function
+
+    assert list(iter_ordered([numbers(start) for start in (0, 3, 6)], max_workers=2,
+                             queue_size=1)) == list(range(9))
+    with pytest.raises(ValueError):
+        list(iter_ordered([numbers(0), numbers(3, ValueError('broken'))], max_workers=2))
+
+
+def test_aws_delete_older(s3_backend):
+    names = ['backup-site-2017-01-%02d-10-10.tar.gz' % day for day in range(1, 26)]
+    for name in names:
+        s3_backend.bucket.put_object(Key='site/' + name, Body=b'data')
+    tomorrow = datetime.date.today() + datetime.timedelta(1)
+
+    result = s3_backend.delete_older(tomorrow, dry_run=True)
+    assert result.dry_run and result.deleted == names
+    assert len(list(s3_backend)) == 25
+
+    with mock.patch('sbackup.dest_backend.aws.DELETE_BATCH_SIZE', 10):
+        with mock.patch.object(S3Backend, '_delete_batch', autospec=True,
+                               side_effect=S3Backend._delete_batch) as delete_batch:
+            result = s3_backend.delete_older(tomorrow, max_workers=2)
+    assert delete_batch.call_count == 3
+    assert result.deleted == names and result.errors == {}
+    assert list(s3_backend) == []
+
+
+def test_aws_delete_older_errors(s3_backend):
+    s3_backend.bucket.put_object(Key='site/backup-site-2017-01-01-10-10.tar.gz', Body=b'data')
+    response = {'Errors': [{'Key': 'site/backup-site-2017-01-01-10-10.tar.gz',
+                            'Code': 'AccessDenied', 'Message': 'Access Denied'}]}
+    with mock.patch.object(s3_backend.bucket.meta.client, 'delete_objects',
+                           return_value=response):
+        result = s3_backend.delete_older(datetime.date.today() + datetime.timedelta(1))
+    assert result.deleted == []
+    assert result.errors == {'backup-site-2017-01-01-10-10.tar.gz': 'Access Denied'}
+
+
+def test_local_backend(tmpdir):
+    backend = LocalBackend(str(tmpdir.mkdir('backups')))
+    backend.validate()
+    src = tmpdir.join('backup-site-2017-01-11-10-10.tar.gz')
+    src.write_binary(b'data' * 1000)
+    backend.upload(str(src))
+    with backend.open_writer('backup-site-2017-01-12-10-10.tar.gz') as fileobj:
+        fileobj.write(b'new')
+    with pytest.raises(RuntimeError):
+        with backend.open_writer('broken.tar.gz') as fileobj:
+            fileobj.write(b'broken')
+            raise RuntimeError
+    backend.put_object('chunks/aa/aabb', b'chunk')
+    os.utime(str(tmpdir.join('backups', 'backup-site-2017-01-11-10-10.tar.gz')), (0, 0))
+
+    assert list(backend) == ['backup-site-2017-01-11-10-10.tar.gz',
+                             'backup-site-2017-01-12-10-10.tar.gz']
+    assert backend.get_last_backup('backup-site') == 'backup-site-2017-01-12-10-10.tar.gz'
+    assert list(backend.list_objects('chunks/')) == ['chunks/aa/aabb']
+    assert backend.get_object('chunks/aa/aabb') == b'chunk'
+    assert backend.read_range('backup-site-2017-01-11-10-10.tar.gz', 4, 8) == b'data'
+    dst = backend.download('backup-site-2017-01-11-10-10.tar.gz', str(tmpdir.mkdir('dst')))
+    assert open(dst, 'rb').read() == b'data' * 1000
+    with pytest.raises(LocalBackendException):
+        backend.get_object('../backup-site-2017-01-11-10-10.tar.gz')
+
+    result = backend.delete_older(datetime.date(2000, 1, 1), dry_run=True)
+    assert result.deleted == ['backup-site-2017-01-11-10-10.tar.gz']
+    result = backend.delete_older(datetime.date(2000, 1, 1))
+    assert result.deleted == ['backup-site-2017-01-11-10-10.tar.gz'] and not result.errors
+    backend.delete('backup-site-2017-01-12-10-10.tar.gz')
+    backend.delete('backup-site-2017-01-12-10-10.tar.gz')
+    assert list(backend) == []
+    assert sorted(os.listdir(str(tmpdir.join('backups')))) == ['chunks']
+
+
+def test_copy_fd_fallback(tmpdir):
+    src = tmpdir.join('src.bin')
+    data = os.urandom(100000)
+    src.write_binary(data)
+    with open(str(src), 'rb') as fileobj, open(str(tmpdir.join('dst.bin')), 'wb') as dst, \
+            mock.patch('os.copy_file_range', side_effect=OSError(18, 'EXDEV')), \
+            mock.patch('os.sendfile', side_effect=OSError(22, 'EINVAL')):
+        assert copy_fd(fileobj.fileno(), dst.fileno(), chunk_size=30000) == len(data)
+    assert tmpdir.join('dst.bin').read_binary() == data
+
+
+def test_retry():
+    func = mock.Mock(side_effect=[OSError('first'), OSError('second'), 'done'])
+    assert Retry(attempts=3, delay=0)(func, 1) == 'done'
+    assert func.call_count == 3
+    func = mock.Mock(side_effect=ValueError('fatal'))
+    with pytest.raises(ValueError):
+        Retry(attempts=3, delay=0, exceptions=(ValueError,), is_retryable=lambda error: False)(func)
+    assert func.call_count == 1
+
+
+def test_tee_writer(tmpdir):
+    first = LocalBackend(str(tmpdir.mkdir('first')))
+    second = LocalBackend(str(tmpdir.mkdir('second')))
+    with TeeWriter({'first': first.open_writer('backup.tar'),
+                    'second': second.open_writer('backup.tar')}, queue_size=1) as fileobj:
+        for _ in range(16):
+            fileobj.write(b'x' * 1024)
+    assert fileobj.errors == {}
+    assert first.get_object('backup.tar') == second.get_object('backup.tar') == b'x' * 16384
+
+    # A failed destination is dropped, the other one completes the upload
+    broken = mock.Mock()
+    broken.write.side_effect = OSError('No space left on device')
+    with TeeWriter({'first': first.open_writer('partial.tar'), 'broken': broken},
+                   queue_size=1) as fileobj:
+        for _ in range(16):
+            fileobj.write(b'y' * 1024)
+    assert list(fileobj.errors) == ['broken']
+    broken.abort.assert_called_once_with()
+    assert first.get_object('partial.tar') == b'y' * 16384
+
+    # The stream fails if every destination failed
+    with pytest.raises(FanOutException):
+        with TeeWriter({'broken': broken}) as fileobj:
+            fileobj.write(b'z')
+            fileobj.close()
+
+    # An error of the producer aborts every upload
+    with pytest.raises(RuntimeError):
+        with TeeWriter({'first': first.open_writer('aborted.tar')}) as fileobj:
+            fileobj.write(b'z')
+            raise RuntimeError()
+    assert 'aborted.tar' not in list(first)
+
+
+def test_fanout_backend(tmpdir):
+    first = LocalBackend(str(tmpdir.mkdir('first')))
+    second = LocalBackend(str(tmpdir.mkdir('second')))
+    backend = FanOutBackend({'first': first, 'second': second})
+    backend.validate()
+    src = tmpdir.join('backup.tar')
+    src.write('data')
+    backend.upload(str(src))
+    assert list(first) == list(second) == ['backup.tar']
+    os.utime(second.get_path('backup.tar'), (0, 0))
+    result = backend.delete_older(datetime.date.today())
+    assert result.deleted == ['backup.tar']
+    assert list(first) == ['backup.tar']
+    assert list(second) == []
+    assert list(backend) == ['backup.tar']
+
+
+def test_aws_resumable_upload(tmpdir):
+    with mock_aws():
+        backend = S3Backend('FAKE_KEY_ID', 'FAKE_KEY', 'backup', location='site',
+                            transfer={'multipart_threshold': '5MB', 'multipart_chunksize': '5MB',
+                                      'max_concurrency': 1},
+                            resume={'path': str(tmpdir.join('journal'))})
+        backend.bucket.create()
+        client = backend.bucket.meta.client
+        src = tmpdir.join('backup.tar.gz')
+        data = os.urandom(MIN_PART_SIZE * 2 + 1024)
+        src.write_binary(data)
+        upload_part = client.upload_part
+
+        def broken_upload_part(**kwargs):
+            if kwargs['PartNumber'] == 2:
+                raise ClientError({'Error': {'Code': 'AccessDenied'}}, 'UploadPart')
+            return upload_part(**kwargs)
+
+        with mock.patch.object(client, 'upload_part', side_effect=broken_upload_part):
+            with pytest.raises(S3BackendException):
+                backend.upload(str(src))
+        assert backend.get_pending_uploads() == [str(src)]
+        record = backend.journal.load('backup', 'site/backup.tar.gz')
+        assert 1 in record['parts'] and 2 not in record['parts']
+
+        # The next upload sends only missing parts
+        with mock.patch.object(client, 'upload_part', side_effect=upload_part) as patched:
+            backend.upload(str(src))
+            assert [call[1]['PartNumber'] for call in patched.call_args_list] == \
+                sorted({1, 2, 3} - set(record['parts']))
+        assert backend.get_object('backup.tar.gz') == data
+        assert backend.get_pending_uploads() == []
+        assert list(backend.journal) == []
+
+
+def test_aws_resumable_part_limit(tmpdir):
+    with mock_aws(), mock.patch('sbackup.dest_backend.aws.MAX_PARTS', 2):
+        backend = S3Backend('FAKE_KEY_ID', 'FAKE_KEY', 'backup', location='site',
+                            transfer={'multipart_threshold': '5MB', 'multipart_chunksize': '5MB'},
+                            resume={'path': str(tmpdir.join('journal'))})
+        backend.bucket.create()
+        src = tmpdir.join('backup.tar.gz')
+        data = os.urandom(MIN_PART_SIZE * 2 + 1024)
+        src.write_binary(data)
+        with mock.patch.object(backend.journal, 'remove'):
+            backend.upload(str(src))
+        record = backend.journal.load('backup', 'site/backup.tar.gz')
+        assert record['part_size'] == MIN_PART_SIZE + 512
+        assert sorted(record['parts']) == [1, 2]
+        assert backend.get_object('backup.tar.gz') == data
+
+
+def test_aws_abort_stale_uploads(s3_backend):
+    client = s3_backend.bucket.meta.client
+    client.create_multipart_upload(Bucket='backup', Key='site/backup.tar.gz')
+    client.create_multipart_upload(Bucket='backup', Key='other/backup.tar.gz')
+    # moto reports the same time of all uploads in 2010
+    initiated = client.list_multipart_uploads(Bucket='backup')['Uploads'][0]['Initiated']
+    assert s3_backend.abort_stale_uploads(initiated).deleted == []
+    older_than = initiated + datetime.timedelta(minutes=1)
+    result = s3_backend.abort_stale_uploads(older_than, dry_run=True)
+    assert len(result.deleted) == 1
+    result = s3_backend.abort_stale_uploads(older_than)
+    assert [name.split()[0] for name in result.deleted] == ['backup.tar.gz']
+    uploads = client.list_multipart_uploads(Bucket='backup').get('Uploads', [])
+    assert [upload['Key'] for upload in uploads] == ['other/backup.tar.gz']
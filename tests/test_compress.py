@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+import gzip
+import io
+import os
+import tarfile
+
+import pytest
+
+from sbackup.compress import (ADAPT_BLOCKS, Compressor, compress_block, get_codec_by_filename,
+                              GzipCodec, is_compressed, is_incompressible, ZstdCodec)
+from sbackup.exception import SBackupValidationError
+from sbackup.seekable import IndexedTarFile
+
+
+@pytest.mark.parametrize('codec', ['gz', 'zstd', 'lz4'])
+@pytest.mark.parametrize('workers', [1, 4])
+def test_compress_round_trip(codec, workers):
+    data = os.urandom(100 * 1024) + b'sbackup' * 100000
+    compressor = Compressor(codec=codec, workers=workers, block_size=64 * 1024)
+    compressor.validate()
+    output = io.BytesIO()
+    with compressor.open_writer(output) as writer:
+        for start in range(0, len(data), 10000):
+            writer.write(data[start:start + 10000])
+    assert writer.bytes_out == len(output.getvalue())
+    assert writer.bytes_out < writer.bytes_in
+    output.seek(0)
+    with compressor.open_reader(output) as reader:
+        assert reader.read() == data
+
+
+def test_compress_empty_stream():
+    compressor = Compressor()
+    output = io.BytesIO()
+    with compressor.open_writer(output):
+        pass
+    output.seek(0)
+    assert compressor.open_reader(output).read() == b''
+
+
+def test_compress_validation():
+    with pytest.raises(SBackupValidationError):
+        Compressor(codec='rar')
+    with pytest.raises(SBackupValidationError):
+        Compressor(codec='gz', level=42).validate()
+    with pytest.raises(SBackupValidationError):
+        Compressor(workers=0).validate()
+    with pytest.raises(SBackupValidationError):
+        Compressor(pool='fork').validate()
+
+
+def test_codec_by_filename():
+    assert get_codec_by_filename('backup-site-2017-01-11-10-10.tar.zst') is ZstdCodec
+    assert get_codec_by_filename('backup-site-2017-01-11-10-10.tar.gz') is GzipCodec
+
+
+def test_is_compressed():
+    assert is_compressed('site/media/photo.JPG')
+    assert is_compressed('site/backup', b'\x1f\x8b\x08\x00')
+    assert is_compressed('site/video', b'\x00\x00\x00\x18ftypmp42')
+    assert not is_compressed('site/index.html', b'<html>')
+    assert is_incompressible(os.urandom(64 * 1024))
+    assert not is_incompressible(b'sbackup' * 10000)
+
+
+@pytest.mark.parametrize('skip_compressed', [True, False])
+def test_skip_compressed(skip_compressed):
+    files = [
+        ('site/index.html', b'<html></html>' * 10000),
+        # Compressible data of a compressed format is stored by the extension
+        ('site/photo.jpg', b'jpeg' * 50000),
+        ('site/random.bin', os.urandom(300 * 1024)),
+        ('site/style.css', b'body {}' * 10000),
+    ]
+    compressor = Compressor(block_size=64 * 1024, skip_compressed=skip_compressed)
+    compressor.validate()
+    output = io.BytesIO()
+    with compressor.open_writer(output) as writer:
+        with IndexedTarFile.open(fileobj=writer, mode='w|', compress_writer=writer) as tar:
+            for name, data in files:
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+    if skip_compressed:
+        stored = 200000 + 300 * 1024
+        assert stored - 64 * 1024 < writer.stored_bytes <= stored
+        assert writer.bytes_out > stored - 64 * 1024
+    else:
+        assert writer.stored_bytes == 0
+        assert writer.bytes_out < 350 * 1024
+    output.seek(0)
+    with tarfile.open(fileobj=compressor.open_reader(output), mode='r|') as tar:
+        assert [(member.name, tar.extractfile(member).read()) for member in tar] == files
+
+
+def test_compress_block_segments():
+    data = b'a' * 100000 + os.urandom(100000) + b'b' * 100000
+    block, stored_size = compress_block('gz', 6, data, [(100000, 200000)])
+    assert stored_size == 100000
+    assert 100000 < len(block) < 110000
+    assert gzip.decompress(block) == data
+    block, stored_size = compress_block('gz', 6, data, detect=True)
+    assert stored_size == 0
+    block, stored_size = compress_block('gz', 6, os.urandom(100000), detect=True)
+    assert stored_size == 100000
+    # Fast levels of zstd store incompressible data themselves
+    assert Compressor(codec='zstd').open_writer(io.BytesIO()).skip_compressed is False
+
+
+def test_adaptive_level():
+    writer = Compressor(level=6, adaptive=True, min_level=2).open_writer(io.BytesIO())
+    for _ in range(ADAPT_BLOCKS * 10):
+        writer._adapt(compress_wait=0.1, write_time=0.01)
+    assert writer.level == 2
+    for _ in range(ADAPT_BLOCKS):
+        writer._adapt(compress_wait=0.01, write_time=0.1)
+    assert writer.level == 3
+    for _ in range(ADAPT_BLOCKS * 10):
+        writer._adapt(compress_wait=0.0, write_time=0.1)
+    assert writer.level == 6
+    writer.close()
+
+    with pytest.raises(SBackupValidationError):
+        Compressor(level=3, min_level=5).validate()
+    with pytest.raises(SBackupValidationError):
+        Compressor(adaptive='yes').validate()
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+
+import pytest
+
+from sbackup import chunker as chunker_module, dedup
+from sbackup.chunker import Chunker
+from sbackup.walker import Walker
+
+
+def test_chunker_boundaries():
+    chunker = Chunker(min_size=1024, avg_size=4096, max_size=16384)
+    data = os.urandom(200 * 1024)
+    chunks = list(chunker.iter_chunks(io.BytesIO(data)))
+    assert b''.join(chunks) == data
+    assert all(len(chunk) <= 16384 for chunk in chunks)
+    assert all(len(chunk) >= 1024 for chunk in chunks[:-1])
+    # An insert at the beginning changes only the first chunks
+    shifted = list(chunker.iter_chunks(io.BytesIO(b'insert' + data)))
+    if chunker_module.numpy is not None:
+        assert len(set(chunks) & set(shifted)) >= len(chunks) - 2
+
+
+def test_chunker_hash():
+    pytest.importorskip('numpy')
+    chunker = Chunker(min_size=1024, avg_size=4096, max_size=16384)
+    data = os.urandom(64 * 1024)
+    # The gear hash of every position, the last 64 bytes make it
+    expected = len(data)
+    value = 0
+    for position, code in enumerate(data):
+        value = ((value << 1) + chunker_module.GEAR[code]) & 0xFFFFFFFFFFFFFFFF
+        if position >= 1024 and not value & chunker._mask:
+            expected = position + 1
+            break
+    assert chunker.cut_point(data) == min(expected, 16384)
+
+
+def test_chunker_fixed_size(monkeypatch):
+    monkeypatch.setattr(chunker_module, 'numpy', None)
+    chunker = Chunker(min_size=1024, avg_size=4096, max_size=16384)
+    data = os.urandom(10000)
+    chunks = list(chunker.iter_chunks(io.BytesIO(data)))
+    assert [len(chunk) for chunk in chunks] == [4096, 4096, 1808]
+
+
+def make_entries(root):
+    with Walker() as walker:
+        yield from walker.walk(root, os.path.basename(root))
+
+
+def test_snapshot_round_trip(s3_backend, tmpdir):
+    source = tmpdir.mkdir('site')
+    source.join('a.bin').write_binary(os.urandom(300 * 1024))
+    source.mkdir('static').join('b.bin').write_binary(b'b' * 1024)
+    chunker = Chunker(min_size=1024, avg_size=4096, max_size=16384)
+
+    with dedup.ChunkStore(s3_backend) as store:
+        manifest = dedup.create_snapshot(make_entries(str(source)), store, chunker)
+    assert store.uploaded_chunks > 0
+    s3_backend.put_object('backup-site-1.manifest', dedup.dump_manifest(manifest))
+
+    with dedup.ChunkStore(s3_backend) as store:
+        dedup.create_snapshot(make_entries(str(source)), store, chunker)
+    assert store.uploaded_chunks == 0
+
+    target = tmpdir.mkdir('restore')
+    manifest = dedup.load_manifest(s3_backend.get_object('backup-site-1.manifest'))
+    dedup.restore_snapshot(manifest, dedup.ChunkStore(s3_backend), str(target))
+    assert target.join('site', 'a.bin').read_binary() == source.join('a.bin').read_binary()
+    assert target.join('site', 'static', 'b.bin').read() == 'b' * 1024
+
+
+def test_collect_garbage(s3_backend, tmpdir):
+    source = tmpdir.mkdir('site')
+    source.join('a.txt').write('first')
+    with dedup.ChunkStore(s3_backend) as store:
+        first = dedup.create_snapshot(make_entries(str(source)), store)
+    s3_backend.put_object('backup-site-1.manifest', dedup.dump_manifest(first))
+    source.join('a.txt').write('second')
+    with dedup.ChunkStore(s3_backend) as store:
+        second = dedup.create_snapshot(make_entries(str(source)), store)
+    s3_backend.put_object('backup-site-2.manifest', dedup.dump_manifest(second))
+
+    assert dedup.collect_garbage(s3_backend) == []
+    s3_backend.delete('backup-site-1.manifest')
+    deleted = dedup.collect_garbage(s3_backend)
+    assert deleted == [dedup.get_chunk_name(next(dedup.get_chunk_ids(first)))]
+    assert len(list(s3_backend.list_objects(dedup.CHUNKS_PREFIX))) == 1
+
+
+def test_collect_garbage_locks(s3_backend, monkeypatch):
+    s3_backend.put_object(dedup.get_chunk_name('aa' * 32), b'chunk')
+    with dedup.hold_lock(s3_backend, dedup.BACKUP_LOCK) as name:
+        assert dedup.get_locks(s3_backend, dedup.BACKUP_LOCK) == [name]
+        assert dedup.collect_garbage(s3_backend) == []
+        # A lock of a crashed process expires
+        monkeypatch.setattr(dedup, 'LOCK_TTL', -1)
+        assert dedup.get_locks(s3_backend, dedup.BACKUP_LOCK) == []
+        monkeypatch.undo()
+    assert list(s3_backend.list_objects(dedup.LOCKS_PREFIX)) == []
+    assert dedup.collect_garbage(s3_backend) == [dedup.get_chunk_name('aa' * 32)]
+    assert list(s3_backend.list_objects(dedup.LOCKS_PREFIX)) == []
@@ -1,10 +1,17 @@
 # -*- coding: utf-8 -*-
+import io
+import os
+import tarfile
 from unittest import mock
 
 import pytest
+from moto import mock_aws
 
-from sbackup.exception import SBackupValidationError
+from sbackup.exception import SBackupException, SBackupValidationError
+from sbackup.index import FileIndex
 from sbackup.task import DirBackupTask
+from sbackup.task.dir import get_chain_dependencies
+from sbackup.task_executor import TaskExecutor
 
 
 @pytest.fixture(scope='session')
@@ -61,3 +68,450 @@ def test_backend_validation(fake_dir):
         })
         obj.validate()
         assert mock_validate.called
+
+
+@mock_aws
+def test_stream_backup(tmpdir):
+    source = tmpdir.mkdir('site')
+    source.join('index.html').write('<html></html>')
+    obj = DirBackupTask.create_task({
+        'type': 'dir',
+        'name': 'site',
+        'source': str(source),
+        'stream': True,
+        'dst_backend': {
+            's3': {
+                'access_key_id': 'asd1123sds',
+                'secret_access_key': 'Sdd3qsdasd',
+                'bucket': 'bucket'
+            }
+        }
+    })
+    obj.dst_backend.bucket.create()
+    with mock.patch('sbackup.dest_backend.aws.S3Backend.validate'):
+        backup_file = obj.create()
+    assert list(obj.dst_backend) == [backup_file]
+    body = obj.dst_backend.bucket.Object(backup_file).get()['Body']
+    with tarfile.open(fileobj=body, mode='r|gz') as tar:
+        assert 'site/index.html' in [member.name for member in tar]
+
+
+def test_make_tarfile_and_extract(tmpdir):
+    source = tmpdir.mkdir('site')
+    source.join('index.html').write('<html></html>')
+    obj = DirBackupTask.create_task({
+        'type': 'dir',
+        'name': 'site',
+        'source': str(source),
+        'compression': {'codec': 'zstd', 'workers': 2},
+        'dst_backend': {
+            's3': {
+                'access_key_id': 'asd1123sds',
+                'secret_access_key': 'Sdd3qsdasd',
+                'bucket': 'bucket'
+            }
+        }
+    })
+    backup_file = obj.make_tarfile(str(tmpdir))
+    assert backup_file.endswith('.tar.zst')
+    source.join('index.html').write('changed')
+    obj.extract(backup_file)
+    assert source.join('index.html').read() == '<html></html>'
+
+
+@mock_aws
+def test_incremental_backup(tmpdir):
+    source = tmpdir.mkdir('site')
+    source.join('index.html').write('<html></html>')
+    source.mkdir('static').join('app.js').write('app')
+    source.join('old.txt').write('old')
+    obj = DirBackupTask.create_task({
+        'type': 'dir',
+        'name': 'site',
+        'source': str(source),
+        'incremental': True,
+        'index_path': str(tmpdir.join('index.sqlite')),
+        'dst_backend': {
+            's3': {
+                'access_key_id': 'asd1123sds',
+                'secret_access_key': 'Sdd3qsdasd',
+                'bucket': 'bucket'
+            }
+        }
+    })
+    obj.dst_backend.bucket.create()
+    names = ['backup-site-2017-01-11-10-10.tar.gz', 'backup-site-2017-01-12-10-10.incr.tar.gz']
+    with mock.patch('sbackup.dest_backend.aws.S3Backend.validate'), \
+            mock.patch.object(DirBackupTask, 'get_archive_name', side_effect=names):
+        assert obj.create() == names[0]
+        source.join('index.html').write('<html>new</html>')
+        source.join('old.txt').remove()
+        assert obj.create() == names[1]
+
+    body = obj.dst_backend.bucket.Object(names[1]).get()['Body']
+    with tarfile.open(fileobj=body, mode='r|gz') as tar:
+        members = [member.name for member in tar if member.isfile()]
+    assert members == ['site/index.html', '.sbackup-deleted']
+
+    assert obj.get_backup_chain(names[1]) == names
+    source.remove()
+    obj.restore(names[1])
+    assert source.join('index.html').read() == '<html>new</html>'
+    assert source.join('static', 'app.js').read() == 'app'
+    assert not source.join('old.txt').exists()
+
+
+@mock_aws
+def test_dedup_backup(tmpdir):
+    source = tmpdir.mkdir('site')
+    source.join('index.html').write('<html></html>')
+    obj = DirBackupTask.create_task({
+        'type': 'dir',
+        'name': 'site',
+        'source': str(source),
+        'format': 'dedup',
+        'dst_backend': {
+            's3': {
+                'access_key_id': 'asd1123sds',
+                'secret_access_key': 'Sdd3qsdasd',
+                'bucket': 'bucket'
+            }
+        }
+    })
+    obj.dst_backend.bucket.create()
+    with mock.patch('sbackup.dest_backend.aws.S3Backend.validate'):
+        backup_file = obj.create()
+    assert backup_file.endswith('.manifest')
+    assert list(obj.dst_backend) == [backup_file]
+    source.remove()
+    obj.restore(None)
+    assert source.join('index.html').read() == '<html></html>'
+
+
+def test_volume_backup(tmpdir):
+    source = tmpdir.mkdir('site')
+    for name in ('media', 'static', 'docs'):
+        directory = source.mkdir(name)
+        for number in range(3):
+            directory.join('%s.bin' % number).write_binary(os.urandom(64 * 1024))
+    source.join('index.html').write('<html></html>')
+    backups = tmpdir.mkdir('backups')
+    task = {
+        'type': 'dir',
+        'name': 'site',
+        'source': str(source),
+        'volumes': 3,
+        'restore_workers': 2,
+        'verify': True,
+        'dst_backend': {'local': {'path': str(backups), 'fsync': False}}
+    }
+    obj = DirBackupTask.create_task(task)
+    backup_file = obj.create()
+    assert backup_file.endswith('.volumes')
+    assert list(obj.dst_backend) == [backup_file]
+    prefix = 'volumes/%s/' % backup_file[:-len('.volumes')]
+    assert sorted(obj.dst_backend.list_objects(prefix)) == [
+        prefix + '%04d.tar.gz' % number for number in (1, 2, 3)]
+    assert obj.metrics.counters['files'] == 14
+
+    expected = {path.relto(source): path.read_binary() for path in source.visit() if path.isfile()}
+    source.join('media', '0.bin').write('changed')
+    source.join('index.html').remove()
+    obj.restore(backup_file)
+    assert {path.relto(source): path.read_binary()
+            for path in source.visit() if path.isfile()} == expected
+
+    source.join('media', '0.bin').write('changed')
+    source.join('static', '0.bin').write('changed')
+    DirBackupTask.create_task(dict(task, restore_workers=1)).restore(None, paths=['media'])
+    assert source.join('media', '0.bin').read_binary() == expected['media/0.bin']
+    assert source.join('static', '0.bin').read() == 'changed'
+
+    with pytest.raises(SBackupValidationError):
+        DirBackupTask.create_task(dict(task, incremental=True)).validate()
+
+    # Settings which workers read are validated before they start
+    keyfile = tmpdir.join('backup.key')
+    keyfile.write(os.urandom(32).hex())
+    encryption = {'keyfile': str(keyfile), 'segment_size': 'big'}
+    with pytest.raises(SBackupValidationError):
+        DirBackupTask.create_task(dict(task, encryption=encryption)).restore(backup_file)
+
+    # Volumes and their indexes are deleted with the set
+    TaskExecutor({'tasks': [task]}).delete('local', task['dst_backend']['local'], backup_file)
+    assert list(obj.dst_backend.list_objects('')) == []
+
+
+@mock_aws
+def test_stream_restore(tmpdir):
+    source = tmpdir.mkdir('site')
+    source.join('index.html').write('<html></html>')
+    obj = DirBackupTask.create_task({
+        'type': 'dir',
+        'name': 'site',
+        'source': str(source),
+        'stream': True,
+        'dst_backend': {
+            's3': {
+                'access_key_id': 'asd1123sds',
+                'secret_access_key': 'Sdd3qsdasd',
+                'bucket': 'bucket'
+            }
+        }
+    })
+    obj.dst_backend.bucket.create()
+    with mock.patch('sbackup.dest_backend.aws.S3Backend.validate'):
+        backup_file = obj.create()
+    source.join('index.html').write('changed')
+    source.join('new.txt').write('new')
+    with mock.patch.object(obj.dst_backend, 'download', side_effect=AssertionError('download')):
+        obj.restore(backup_file)
+    assert source.join('index.html').read() == '<html></html>'
+    assert not source.join('new.txt').exists()
+    assert tmpdir.listdir() == [source]
+
+    # The source is untouched when the archive is broken
+    obj.dst_backend.put_object(backup_file, b'broken')
+    with pytest.raises(Exception):
+        obj.restore(backup_file)
+    assert source.join('index.html').read() == '<html></html>'
+    assert tmpdir.listdir() == [source]
+
+
+@mock_aws
+def test_restore_path(tmpdir):
+    source = tmpdir.mkdir('site')
+    source.mkdir('etc').join('nginx.conf').write('server {}')
+    source.join('index.html').write('<html></html>')
+    source.join('big.bin').write_binary(os.urandom(512 * 1024))
+    obj = DirBackupTask.create_task({
+        'type': 'dir',
+        'name': 'site',
+        'source': str(source),
+        'compression': {'block_size': 64 * 1024},
+        'dst_backend': {
+            's3': {
+                'access_key_id': 'asd1123sds',
+                'secret_access_key': 'Sdd3qsdasd',
+                'bucket': 'bucket'
+            }
+        }
+    })
+    obj.dst_backend.bucket.create()
+    with mock.patch('sbackup.dest_backend.aws.S3Backend.validate'):
+        backup_file = obj.create()
+    assert 'index/%s.json.gz' % backup_file in obj.dst_backend.list_objects('index/')
+    source.join('etc', 'nginx.conf').write('changed')
+    source.join('index.html').write('changed')
+    with mock.patch.object(obj.dst_backend, 'open_reader', side_effect=AssertionError('stream')), \
+            mock.patch.object(obj.dst_backend, 'read_range',
+                              wraps=obj.dst_backend.read_range) as read_range:
+        obj.restore(backup_file, paths=['etc/nginx.conf'])
+    assert source.join('etc', 'nginx.conf').read() == 'server {}'
+    assert source.join('index.html').read() == 'changed'
+    assert sum(end - start for _, start, end in
+               (call.args for call in read_range.call_args_list)) < 64 * 1024
+    assert sorted(item.basename for item in tmpdir.listdir()) == ['site']
+
+
+def test_local_backend(tmpdir):
+    source = tmpdir.mkdir('site')
+    source.mkdir('etc').join('nginx.conf').write('server {}')
+    source.join('index.html').write('<html></html>')
+    obj = DirBackupTask.create_task({
+        'type': 'dir',
+        'name': 'site',
+        'source': str(source),
+        'verify': True,
+        'dst_backend': {
+            'local': {
+                'path': str(tmpdir.mkdir('backups')),
+            }
+        }
+    })
+    backup_file = obj.create()
+    assert list(obj.dst_backend) == [backup_file]
+    source.join('etc', 'nginx.conf').write('changed')
+    source.join('index.html').write('changed')
+    obj.restore(None, paths=['etc'])
+    assert source.join('etc', 'nginx.conf').read() == 'server {}'
+    assert source.join('index.html').read() == 'changed'
+    obj.restore(backup_file)
+    assert source.join('index.html').read() == '<html></html>'
+
+
+@mock_aws
+def test_fanout_backup(tmpdir):
+    source = tmpdir.mkdir('site')
+    source.join('index.html').write('<html></html>')
+    obj = DirBackupTask.create_task({
+        'type': 'dir',
+        'name': 'site',
+        'source': str(source),
+        'stream': True,
+        'verify': True,
+        'dst_backend': {
+            's3': {
+                'access_key_id': 'asd1123sds',
+                'secret_access_key': 'Sdd3qsdasd',
+                'bucket': 'bucket'
+            },
+            'local:nas': {
+                'path': str(tmpdir.mkdir('nas')),
+            },
+            'local:missing': {
+                'path': str(tmpdir.join('missing')),
+            }
+        }
+    })
+    s3 = obj.dst_backend.backends['s3']
+    s3.bucket.create()
+    with mock.patch('sbackup.dest_backend.aws.S3Backend.validate'):
+        backup_file = obj.create()
+    # The unavailable destination doesn't fail the backup
+    assert list(obj.dst_backend.failed) == ['local:missing']
+    assert list(s3) == [backup_file]
+    assert list(obj.dst_backend.backends['local:nas']) == [backup_file]
+    assert obj.dst_backend.backends['local:nas'].get_object(backup_file) == \
+        s3.get_object(backup_file)
+
+    # Reads fall back to the next destination
+    source.join('index.html').write('changed')
+    s3.delete(backup_file)
+    obj.restore(backup_file)
+    assert source.join('index.html').read() == '<html></html>'
+
+
+def test_fanout_missed_increment(tmpdir):
+    source = tmpdir.mkdir('site')
+    source.join('index.html').write('<html></html>')
+    config = {
+        'type': 'dir',
+        'name': 'site',
+        'source': str(source),
+        'incremental': True,
+        'index_path': str(tmpdir.join('index.sqlite')),
+        'dst_backend': {
+            'local:nas': {'path': str(tmpdir.mkdir('nas'))},
+            'local:missing': {'path': str(tmpdir.join('missing'))},
+        }
+    }
+    names = ['backup-site-2017-01-11-10-10.tar.gz', 'backup-site-2017-01-12-10-10.tar.gz']
+    with mock.patch.object(DirBackupTask, 'get_archive_name', side_effect=names):
+        obj = DirBackupTask.create_task(config)
+        assert obj.execute() == names[0]
+        assert obj.metrics.destinations == {
+            'local:nas': {'status': 'ok', 'error': None},
+            'local:missing': {'status': 'failed', 'error': mock.ANY},
+        }
+        # The next backup is full, the missing destination has no chain
+        tmpdir.mkdir('missing')
+        source.join('index.html').write('changed')
+        obj = DirBackupTask.create_task(config)
+        obj.execute()
+    assert obj.metrics.destinations['local:missing']['status'] == 'ok'
+    assert list(obj.dst_backend.backends['local:missing']) == [names[1]]
+    with FileIndex(config['index_path']) as index:
+        assert index.runs_since_full == 0
+
+
+@mock_aws
+def test_resume_upload(tmpdir):
+    from botocore.exceptions import ClientError
+
+    source = tmpdir.mkdir('site')
+    source.join('data.bin').write_binary(os.urandom(12 * 1024 * 1024))
+    obj = DirBackupTask.create_task({
+        'type': 'dir',
+        'name': 'site',
+        'source': str(source),
+        'tmp_dir': str(tmpdir.mkdir('tmp')),
+        'dst_backend': {
+            's3': {
+                'access_key_id': 'asd1123sds',
+                'secret_access_key': 'Sdd3qsdasd',
+                'bucket': 'bucket',
+                'transfer': {'multipart_threshold': '5MB', 'multipart_chunksize': '5MB'},
+                'resume': {'path': str(tmpdir.join('journal'))}
+            }
+        }
+    })
+    obj.dst_backend.bucket.create()
+    client = obj.dst_backend.bucket.meta.client
+    upload_part = client.upload_part
+
+    def broken_upload_part(**kwargs):
+        if kwargs['PartNumber'] == 2:
+            raise ClientError({'Error': {'Code': 'AccessDenied'}}, 'UploadPart')
+        return upload_part(**kwargs)
+
+    names = ['backup-site-2017-01-11-10-10.tar.gz', 'backup-site-2017-01-12-10-10.tar.gz']
+    with mock.patch('sbackup.dest_backend.aws.S3Backend.validate'), \
+            mock.patch.object(DirBackupTask, 'get_archive_name', side_effect=names):
+        with mock.patch.object(client, 'upload_part', side_effect=broken_upload_part):
+            with pytest.raises(Exception):
+                obj.create()
+        spool = obj.get_spool_dir()
+        assert [name for name in os.listdir(spool) if name.endswith('.tar.gz')] == names[:1]
+
+        # The next run finishes the upload and creates the current backup
+        source.join('new.txt').write('new')
+        backup_file = obj.create()
+    assert backup_file == names[1]
+    assert os.listdir(spool) == []
+    assert list(obj.dst_backend) == names
+    source.join('data.bin').write('changed')
+    obj.restore(names[0])
+    assert os.path.getsize(str(source.join('data.bin'))) == 12 * 1024 * 1024
+    assert not source.join('new.txt').exists()
+
+
+def make_tampered(path, *members):
+    with tarfile.open(path, 'w:gz') as tar:
+        for name, linkname in members:
+            info = tarfile.TarInfo(name)
+            if linkname is None:
+                info.size = 4
+                tar.addfile(info, io.BytesIO(b'evil'))
+            else:
+                info.type = tarfile.SYMTYPE
+                info.linkname = linkname
+                tar.addfile(info)
+
+
+@pytest.mark.parametrize('euid', [0, 1000])
+@pytest.mark.parametrize('members', [
+    [('site/index.html', None), ('site/../../evil.txt', None)],
+    [('/evil.txt', None)],
+    [('site/link', '../..'), ('site/link/evil.txt', None)],
+])
+def test_restore_tampered_archive(tmpdir, euid, members):
+    source = tmpdir.mkdir('root').mkdir('site')
+    source.join('index.html').write('<html></html>')
+    backups = tmpdir.mkdir('backups')
+    obj = DirBackupTask.create_task({
+        'type': 'dir',
+        'name': 'site',
+        'source': str(source),
+        'dst_backend': {'local': {'path': str(backups), 'fsync': False}}
+    })
+    backup_file = 'backup-site-2017-01-10-10-10.tar.gz'
+    make_tampered(str(backups.join(backup_file)), *members)
+    with mock.patch('sbackup.task.dir.os.geteuid', return_value=euid), \
+            pytest.raises(SBackupException):
+        obj.restore(backup_file)
+    assert source.join('index.html').read() == '<html></html>'
+    assert not tmpdir.join('evil.txt').exists() and not tmpdir.join('root', 'evil.txt').exists()
+    assert tmpdir.join('root').listdir() == [source]
+
+
+def test_chain_dependencies():
+    names = ['backup-site-2017-01-10-10-10.tar.gz',
+             'backup-site-2017-01-11-10-10.incr.tar.gz',
+             'backup-site-2017-01-12-10-10.tar.gz',
+             'backup-site-2017-01-13-10-10.incr.tar.gz',
+             'backup-db-2017-01-10-10-10.tar.gz',
+             'backup-site-2017-01-14-10-10.incr.tar.gz']
+    assert get_chain_dependencies(names, names[:4]) == {names[2], names[3]}
+    assert get_chain_dependencies(names, names[:2] + names[4:5]) == set()
+    assert get_chain_dependencies(names, names) == set()
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+import gzip
+import shlex
+import sqlite3
+import sys
+
+import pytest
+
+from sbackup.dump import DumpReader, DumpException
+from sbackup.exception import SBackupValidationError
+from sbackup.task import CommandDumpTask, MySQLDumpTask, PostgresDumpTask
+
+
+def python_command(code):
+    return '%s -c %s' % (shlex.quote(sys.executable), shlex.quote(code))
+
+
+def write_command(text, size, delay=0):
+    return [sys.executable, '-c', 'import sys, time; time.sleep(%s); '
+            'sys.stdout.write(%r * %s)' % (delay, text, size)]
+
+
+def test_dump_reader_order(tmpdir):
+    # The later commands finish first, their outputs are spooled to the disk
+    commands = [write_command('a', 300000, delay=0.5),
+                write_command('b', 200000),
+                write_command('c', 100000)]
+    with DumpReader(commands, jobs=3, buffer_size=64 * 1024, tmp_dir=str(tmpdir)) as reader:
+        data = reader.read()
+    assert data == b'a' * 300000 + b'b' * 200000 + b'c' * 100000
+    assert tmpdir.listdir() == []
+
+
+def test_dump_reader_error():
+    commands = [write_command('a', 10),
+                [sys.executable, '-c', 'import sys; sys.stderr.write("no table"); sys.exit(3)'],
+                write_command('c', 10)]
+    with DumpReader(commands, jobs=2) as reader:
+        with pytest.raises(DumpException, match='no table'):
+            reader.read()
+
+
+def test_command_dump(tmpdir):
+    backups = tmpdir.mkdir('backups')
+    restored = tmpdir.join('restored.txt')
+    obj = CommandDumpTask.create_task({
+        'type': 'command',
+        'name': 'parts',
+        'command': [python_command('print("part %s" * 50000)' % number) for number in range(4)],
+        'restore_command': python_command(
+            'import shutil, sys; shutil.copyfileobj(sys.stdin.buffer, open(%r, "wb"))' % str(restored)),
+        'extension': '.txt',
+        'jobs': 3,
+        'buffer_size': '64KB',
+        'verify': True,
+        'dst_backend': {'local': {'path': str(backups)}}
+    })
+    backup_file = obj.create()
+    assert backup_file.startswith('backup-parts-')
+    assert backup_file.endswith('.txt.gz')
+    expected = b''.join(b'part %d' % number * 50000 + b'\n' for number in range(4))
+    with gzip.open(str(backups.join(backup_file))) as fileobj:
+        assert fileobj.read() == expected
+
+    obj.restore(None)
+    assert restored.read_binary() == expected
+    with pytest.raises(SBackupValidationError):
+        obj.restore(backup_file, paths=['users'])
+
+
+def test_failed_dump(tmpdir):
+    backups = tmpdir.mkdir('backups')
+    obj = CommandDumpTask.create_task({
+        'type': 'command',
+        'name': 'broken',
+        'command': [python_command('print("schema")'), python_command('import sys; sys.exit(1)')],
+        'jobs': 2,
+        'dst_backend': {'local': {'path': str(backups)}}
+    })
+    with pytest.raises(DumpException):
+        obj.create()
+    # A partial dump is not stored
+    assert backups.listdir() == []
+
+
+def test_sqlite_dump(tmpdir):
+    backups = tmpdir.mkdir('backups')
+    database = str(tmpdir.join('app.sqlite'))
+    copy = str(tmpdir.join('copy.sqlite'))
+    connection = sqlite3.connect(database)
+    connection.execute('CREATE TABLE users (id INTEGER PRIMARY KEY, name TEXT)')
+    connection.executemany('INSERT INTO users (name) VALUES (?)',
+                           [('user%s' % number,) for number in range(1000)])
+    connection.commit()
+    connection.close()
+
+    obj = CommandDumpTask.create_task({
+        'type': 'command',
+        'name': 'app',
+        'command': python_command(
+            'import sqlite3, sys\n'
+            'for line in sqlite3.connect(%r).iterdump(): print(line)' % database),
+        'restore_command': python_command(
+            'import sqlite3, sys; sqlite3.connect(%r).executescript(sys.stdin.read())' % copy),
+        'extension': '.sql',
+        'compression': {'codec': 'zstd'},
+        'dst_backend': {'local': {'path': str(backups)}}
+    })
+    backup_file = obj.create()
+    assert backup_file.endswith('.sql.zst')
+    obj.restore(backup_file)
+    rows = sqlite3.connect(copy).execute('SELECT count(*), max(name) FROM users').fetchone()
+    assert rows == (1000, 'user999')
+
+
+def test_database_commands():
+    obj = PostgresDumpTask.create_task({
+        'type': 'postgres',
+        'name': 'shop',
+        'database': 'shop',
+        'host': 'db1',
+        'password': 'secret',
+        'jobs': 2,
+        'tables': ['users', 'orders'],
+        'dst_backend': {'local': {'path': '/tmp'}}
+    })
+    commands = obj.get_commands()
+    assert len(commands) == 4
+    assert commands[0][-6:] == ['--section=pre-data', '--table', 'users', '--table', 'orders', 'shop']
+    assert commands[1][-4:] == ['--section=data', '--table', 'users', 'shop']
+    assert commands[3][-6:] == ['--section=post-data', '--table', 'users', '--table', 'orders', 'shop']
+    assert obj.get_env()['PGPASSWORD'] == 'secret'
+
+    obj = MySQLDumpTask.create_task({
+        'type': 'mysql',
+        'name': 'app',
+        'database': 'app',
+        'user': 'backup',
+        'dst_backend': {'local': {'path': '/tmp'}}
+    })
+    assert obj.get_commands() == [['mysqldump', '--user=backup', '--single-transaction',
+                                   '--routines', '--events', 'app']]
+    assert obj.get_env() is None
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import tarfile
+from unittest import mock
+
+import pytest
+from moto import mock_aws
+
+from sbackup.encryption import (EncryptionException, EncryptionSettings, HEADER, TAG_SIZE,
+                                is_encrypted)
+from sbackup.exception import SBackupValidationError
+from sbackup.seekable import get_index_name
+from sbackup.task import DirBackupTask
+from sbackup.task_executor import TaskExecutor
+from sbackup.verify import verify
+
+
+def make_settings(tmpdir, name='backup.key', cipher='aes-256-gcm', segment_size='4KB'):
+    keyfile = tmpdir.join(name)
+    keyfile.write(os.urandom(32).hex() + '\n')
+    settings = EncryptionSettings(keyfile=str(keyfile), cipher=cipher, segment_size=segment_size)
+    settings.validate()
+    return settings
+
+
+class FakeBackend(object):
+    def __init__(self, data):
+        self.data = data
+
+    def read_range(self, name, start, end):
+        return self.data[start:end]
+
+    def get_object(self, name):
+        return self.data
+
+
+@pytest.mark.parametrize('cipher', ['aes-256-gcm', 'chacha20-poly1305'])
+@pytest.mark.parametrize('size', [0, 100, 4096, 3 * 4096, 50000])
+def test_round_trip(tmpdir, cipher, size):
+    settings = make_settings(tmpdir, cipher=cipher)
+    data = os.urandom(size)
+    output = io.BytesIO()
+    with settings.open_writer(output) as writer:
+        for start in range(0, len(data), 3000):
+            writer.write(data[start:start + 3000])
+    encrypted = output.getvalue()
+    assert is_encrypted(encrypted)
+    segments = size // 4096 + 1
+    assert len(encrypted) == HEADER.size + size + segments * TAG_SIZE
+    assert settings.get_encrypted_size(size) == len(encrypted)
+    assert settings.open_reader(io.BytesIO(encrypted)).read() == data
+    with settings.open_reader(io.BytesIO(encrypted)) as reader:
+        assert b''.join(iter(lambda: reader.read(1000), b'')) == data
+    # A plain stream is read as is only with allow_plaintext
+    with pytest.raises(EncryptionException):
+        settings.decrypt(b'plain')
+    settings.allow_plaintext = True
+    assert settings.decrypt(b'plain') == b'plain'
+
+
+def test_damaged_streams(tmpdir):
+    settings = make_settings(tmpdir)
+    encrypted = settings.encrypt(os.urandom(10000))
+    damaged = bytearray(encrypted)
+    damaged[HEADER.size + 5000] ^= 1
+    truncated = encrypted[:HEADER.size + 2 * (4096 + TAG_SIZE)]
+    for data in (bytes(damaged), truncated, encrypted + b'tail'):
+        with pytest.raises(EncryptionException):
+            settings.decrypt(data)
+    with pytest.raises(EncryptionException) as error:
+        make_settings(tmpdir, name='other.key').decrypt(encrypted)
+    assert 'another key' in str(error.value)
+
+
+def test_read_range(tmpdir):
+    settings = make_settings(tmpdir)
+    data = os.urandom(5 * 4096 + 100)
+    backend = settings.open_backend(FakeBackend(settings.encrypt(data)))
+    for start, end in [(0, 10), (4000, 4200), (4096, 8192), (8000, 5 * 4096 + 100),
+                       (5 * 4096, 5 * 4096 + 100), (0, len(data))]:
+        assert backend.read_range('backup', start, end) == data[start:end]
+    with pytest.raises(EncryptionException):
+        settings.open_backend(FakeBackend(data)).read_range('backup', 10, 20)
+    settings.allow_plaintext = True
+    plain = settings.open_backend(FakeBackend(data))
+    assert plain.read_range('backup', 10, 20) == data[10:20]
+
+
+def test_settings_validation(tmpdir):
+    keyfile = tmpdir.join('short.key')
+    keyfile.write('secret')
+    for config in ({'keyfile': str(keyfile)}, {}, {'keyfile': str(tmpdir.join('missing'))}):
+        with pytest.raises(SBackupValidationError):
+            EncryptionSettings(**config).validate()
+    raw = tmpdir.join('raw.key')
+    raw.write_binary(b'\n' * 32)
+    settings = EncryptionSettings(keyfile=str(raw))
+    settings.validate()
+    assert settings.key == b'\n' * 32
+    with pytest.raises(SBackupValidationError):
+        EncryptionSettings(keyfile=str(raw), cipher='des').validate()
+    with pytest.raises(SBackupValidationError):
+        EncryptionSettings(keyfile=str(raw), segment_size='1KB').validate()
+    with pytest.raises(SBackupValidationError):
+        EncryptionSettings(keyfile=str(raw), allow_plaintext='yes').validate()
+
+
+@mock_aws
+def test_encrypted_backup(tmpdir):
+    source = tmpdir.mkdir('site')
+    source.mkdir('etc').join('nginx.conf').write('server {}')
+    source.join('index.html').write('<html></html>')
+    source.join('big.bin').write_binary(os.urandom(512 * 1024))
+    settings = make_settings(tmpdir)
+    task = {
+        'type': 'dir',
+        'name': 'site',
+        'source': str(source),
+        'verify': True,
+        'compression': {'block_size': 64 * 1024},
+        'encryption': {'keyfile': settings.keyfile, 'segment_size': '16KB'},
+        'dst_backend': {
+            's3': {
+                'access_key_id': 'asd1123sds',
+                'secret_access_key': 'Sdd3qsdasd',
+                'bucket': 'bucket'
+            }
+        }
+    }
+    obj = DirBackupTask.create_task(task)
+    obj.dst_backend.bucket.create()
+    obj.validate()
+    with mock.patch('sbackup.dest_backend.aws.S3Backend.validate'):
+        backup_file = obj.create()
+    backend = obj.dst_backend
+    # Neither the archive nor the index are readable without the key
+    assert is_encrypted(backend.get_object(backup_file))
+    assert is_encrypted(backend.get_object(get_index_name(backup_file)))
+    with pytest.raises(tarfile.ReadError):
+        tarfile.open(fileobj=io.BytesIO(backend.get_object(backup_file)))
+    assert not verify(backend, backup_file).ok
+    assert verify(settings.open_backend(backend), backup_file).ok
+
+    source.join('etc', 'nginx.conf').write('changed')
+    source.join('index.html').write('changed')
+    with mock.patch.object(backend, 'open_reader', side_effect=AssertionError('stream')):
+        obj.restore(backup_file, paths=['etc/nginx.conf'])
+    assert source.join('etc', 'nginx.conf').read() == 'server {}'
+    assert source.join('index.html').read() == 'changed'
+    obj.restore(backup_file)
+    assert source.join('index.html').read() == '<html></html>'
+    assert sorted(item.basename for item in tmpdir.listdir()) == ['backup.key', 'site']
+
+    # The download is decrypted
+    executor = TaskExecutor([task])
+    path = executor.download('s3', task['dst_backend']['s3'], backup_file,
+                             str(tmpdir.mkdir('download')), encryption=task['encryption'])
+    with tarfile.open(path) as tar:
+        assert 'site/index.html' in tar.getnames()
+    assert os.listdir(str(tmpdir.join('download'))) == [backup_file]
+
+    # A plain archive swapped into the bucket is rejected
+    fake = io.BytesIO()
+    with tarfile.open(fileobj=fake, mode='w:gz') as tar:
+        tar.add(str(source), arcname='site')
+    plain_file = backup_file.replace('-site-', '-site-plain-')
+    backend.bucket.put_object(Key=plain_file, Body=fake.getvalue())
+    with pytest.raises(EncryptionException):
+        obj.restore(plain_file)
+    assert source.join('index.html').read() == '<html></html>'
+    assert not verify(settings.open_backend(backend), plain_file).ok
+    with pytest.raises(EncryptionException):
+        executor.download('s3', task['dst_backend']['s3'], plain_file,
+                          str(tmpdir.join('download')), encryption=task['encryption'])
+    assert os.listdir(str(tmpdir.join('download'))) == [backup_file]
+
+    with pytest.raises(SBackupValidationError):
+        DirBackupTask.create_task(dict(task, format='dedup')).validate()
+
+
+@pytest.mark.parametrize('options', [{'stream': True}, {'volumes': 2}])
+def test_encrypted_bytes_uploaded(tmpdir, options):
+    source = tmpdir.mkdir('site')
+    source.join('index.html').write('<html></html>')
+    source.mkdir('media').join('big.bin').write_binary(os.urandom(100 * 1024))
+    backups = tmpdir.mkdir('backups')
+    settings = make_settings(tmpdir)
+    obj = DirBackupTask.create_task(dict({
+        'type': 'dir',
+        'name': 'site',
+        'source': str(source),
+        'encryption': {'keyfile': settings.keyfile, 'segment_size': '16KB'},
+        'dst_backend': {'local': {'path': str(backups), 'fsync': False}}
+    }, **options))
+    obj.validate()
+    backup_file = obj.create()
+    # The header and tags of segments are sent too
+    names = list(obj.dst_backend.list_objects('volumes/')) if 'volumes' in options else \
+        [backup_file]
+    assert len(names) == options.get('volumes', 1)
+    assert obj.metrics.counters['bytes_uploaded'] == \
+        sum(backups.join(name).size() for name in names)
+    assert obj.metrics.counters['bytes_uploaded'] > obj.metrics.counters['bytes_compressed']
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import pstats
+import threading
+import tracemalloc
+
+import pytest
+
+from sbackup.exception import SBackupValidationError
+from sbackup.metrics import RunReport, TaskMetrics, profiler
+from sbackup.task import DirBackupTask
+from sbackup.task_executor import TaskExecutor
+
+
+def make_task(name, source, backups, **kwargs):
+    task = {
+        'name': name,
+        'type': 'dir',
+        'source': str(source),
+        'dst_backend': {'local': {'path': str(backups), 'fsync': False}}
+    }
+    task.update(kwargs)
+    return task
+
+
+def test_task_metrics():
+    metrics = TaskMetrics('site')
+    with metrics.measure():
+        with metrics.stage('upload'):
+            pass
+        with metrics.stage('upload'):
+            pass
+        metrics.add('bytes_read', 1000)
+        metrics.update({'bytes_compressed': 250, 'bytes_uploaded': 250})
+    metrics.set_destination('s3')
+    metrics.set_destination('local:nas', OSError('no space'))
+    assert metrics.status == 'ok'
+    assert metrics.to_dict()['destinations']['local:nas'] == {'status': 'failed',
+                                                             'error': 'no space'}
+    assert list(metrics.stages) == ['upload']
+    assert metrics.compression_ratio == 4.0
+    assert metrics.upload_rate > 0
+
+    failed = TaskMetrics('broken')
+    with pytest.raises(ValueError):
+        with failed.measure():
+            raise ValueError('no space')
+    assert failed.status == 'failed' and failed.error == 'no space'
+
+    text = RunReport([metrics, failed]).to_prometheus()
+    assert 'sbackup_task_success{task="site"} 1.0' in text
+    assert 'sbackup_task_success{task="broken"} 0.0' in text
+    assert 'sbackup_task_bytes_read{task="site"} 1000.0' in text
+    assert 'sbackup_stage_duration_seconds{task="site",stage="upload"}' in text
+    assert '# TYPE sbackup_task_compression_ratio gauge' in text
+    assert 'sbackup_task_files' not in text
+    assert 'sbackup_destination_success{task="site",destination="s3"} 1.0' in text
+    assert 'sbackup_destination_success{task="site",destination="local:nas"} 0.0' in text
+
+
+def test_run_report(tmpdir):
+    source = tmpdir.mkdir('site')
+    source.join('index.html').write('<html></html>' * 1000)
+    backups = tmpdir.mkdir('backups')
+    executor = TaskExecutor({
+        'executor': {'metrics': {'json': str(tmpdir.join('report.json')),
+                                 'prometheus': str(tmpdir.join('metrics', 'sbackup.prom'))},
+                     'history_path': str(tmpdir.join('history.json'))},
+        'tasks': [
+            make_task('site', source, backups, tmp_dir=str(tmpdir)),
+            make_task('stream', source, backups, stream=True),
+            make_task('missing', tmpdir.join('missing'), backups),
+        ]
+    })
+    executor.create()
+    report = json.loads(tmpdir.join('report.json').read())
+    tasks = {item['name']: item for item in report['tasks']}
+    assert tasks['site']['status'] == 'ok'
+    assert sorted(tasks['site']['stages']) == ['archive', 'upload']
+    assert tasks['site']['counters']['files'] == 2
+    assert tasks['site']['counters']['bytes_uploaded'] == \
+        os.path.getsize(str(backups.join(tasks['site']['backup_file'])))
+    assert tasks['site']['compression_ratio'] > 1
+    assert tasks['site']['queue_wait'] is not None
+    assert sorted(tasks['stream']['stages']) == ['stream']
+    assert tasks['missing']['status'] == 'failed'
+    text = tmpdir.join('metrics', 'sbackup.prom').read()
+    assert 'sbackup_task_success{task="missing"} 0.0' in text
+
+
+def test_profile(tmpdir):
+    source = tmpdir.mkdir('site')
+    source.join('index.html').write('<html></html>')
+    backups = tmpdir.mkdir('backups')
+    profiles = tmpdir.mkdir('profiles')
+    for mode, extension in (('cpu', '.prof'), ('memory', '.txt')):
+        obj = DirBackupTask.create_task(make_task('site-%s' % mode, source, backups, stream=True,
+                                                  profile=mode, profile_dir=str(profiles)))
+        obj.execute()
+        names = [name for name in os.listdir(str(profiles)) if name.startswith('site-%s' % mode)]
+        assert len(names) == 1 and names[0].endswith(extension)
+    cpu_profile = [name for name in os.listdir(str(profiles)) if name.endswith('.prof')][0]
+    stats = pstats.Stats(str(profiles.join(cpu_profile)))
+    assert any('write_archive' in function for _, _, function in stats.stats)
+    assert obj.metrics.counters['memory_peak'] > 0
+
+    obj = DirBackupTask.create_task(make_task('site', source, backups, profile='gpu'))
+    with pytest.raises(SBackupValidationError):
+        obj.validate()
+
+
+@pytest.mark.parametrize('mode', ['cpu', 'memory'])
+def test_profile_overlapping_tasks(tmpdir, mode):
+    first_started = threading.Event()
+    second_done = threading.Event()
+    metrics = {name: TaskMetrics(name) for name in ('first', 'second')}
+
+    def first():
+        with profiler('first', mode, str(tmpdir), metrics['first']):
+            first_started.set()
+            second_done.wait(5)
+            worker = threading.Thread(target=sorted, args=([1],))
+            worker.start()
+            worker.join()
+
+    thread = threading.Thread(target=first)
+    thread.start()
+    first_started.wait(5)
+    with profiler('second', mode, str(tmpdir), metrics['second']):
+        data = bytearray(1024 * 1024)
+    second_done.set()
+    thread.join()
+    assert len(data) and len(tmpdir.listdir()) == 2
+    assert not tracemalloc.is_tracing()
+    assert threading._profile_hook is None
+    if mode == 'cpu':
+        # The thread started after the second profiler ended is profiled
+        path = [path for path in tmpdir.listdir() if path.basename.startswith('first')][0]
+        stats = pstats.Stats(str(path))
+        assert any(function == "<built-in method builtins.sorted>"
+                   for _, _, function in stats.stats)
+    else:
+        assert metrics['first'].counters['memory_peak'] >= 1024 * 1024
+        for path in tmpdir.listdir():
+            assert 'process-wide' in path.read().splitlines()[0]
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+import os
+import tarfile
+from unittest import mock
+
+import pytest
+
+from sbackup.exception import SBackupValidationError
+from sbackup.rules import PathFilter, PatternSet
+from sbackup.task import DirBackupTask
+from sbackup.walker import Walker
+
+
+@pytest.mark.parametrize('patterns, path, directory, expected', [
+    (['*.log'], 'debug.log', False, True),
+    (['*.log'], 'app/logs/debug.log', False, True),
+    (['*.log'], 'debug.log.gz', False, False),
+    (['node_modules'], 'app/node_modules', True, True),
+    (['cache/'], 'app/cache', True, True),
+    (['cache/'], 'app/cache', False, False),
+    (['/cache'], 'cache', True, True),
+    (['/cache'], 'app/cache', True, False),
+    (['app/*.tmp'], 'app/a.tmp', False, True),
+    (['app/*.tmp'], 'app/sub/a.tmp', False, False),
+    (['app/**/*.tmp'], 'app/sub/deep/a.tmp', False, True),
+    (['**/build'], 'a/b/build', True, True),
+    (['logs/**'], 'logs/a/b.txt', False, True),
+    (['file?.[ch]'], 'src/file1.c', False, True),
+    (['file[!0-9].c'], 'src/file1.c', False, False),
+    (['*.log', '!keep.log'], 'keep.log', False, False),
+    (['*.log', '!keep.log', 'keep*'], 'keep.log', False, True),
+    (['# comment', '', '\\#notes'], '#notes', False, True),
+])
+def test_pattern_set(patterns, path, directory, expected):
+    assert PatternSet(patterns).match(path, directory) is expected
+
+
+def test_walker_prunes_excluded_dirs(tmpdir):
+    source = tmpdir.mkdir('site')
+    source.mkdir('node_modules').mkdir('lib').join('index.js').write('lib')
+    source.mkdir('static').join('app.js').write('app()')
+    source.join('static', 'app.js.map').write('{}')
+    source.join('index.html').write('<html></html>')
+    path_filter = PathFilter(exclude=['node_modules/', '*.map'])
+    path_filter.validate()
+
+    scandir = os.scandir
+    with mock.patch('sbackup.walker.os.scandir', side_effect=scandir) as listed:
+        with Walker(4, accept=path_filter) as walker:
+            names = sorted(entry.arcname for entry in walker.walk(str(source), 'site'))
+    assert names == ['site', 'site/index.html', 'site/static', 'site/static/app.js']
+    assert str(source.join('node_modules')) not in [call[0][0] for call in listed.call_args_list]
+
+
+def test_size_age_include(tmpdir):
+    source = tmpdir.mkdir('site')
+    source.mkdir('docs').join('a.txt').write('a')
+    source.join('docs', 'b.bin').write('b')
+    source.join('big.txt').write('x' * 2048)
+    source.join('old.txt').write('old')
+    os.utime(str(source.join('old.txt')), (1000000000, 1000000000))
+    path_filter = PathFilter(include=['*.txt'], max_size='1K', max_age=30)
+    path_filter.validate()
+    with Walker(accept=path_filter) as walker:
+        names = sorted(entry.arcname for entry in walker.walk(str(source), 'site'))
+    assert names == ['site', 'site/docs', 'site/docs/a.txt']
+
+    for config in ({'max_size': 'big'}, {'max_age': -1}, {'exclude': '*.log'}):
+        with pytest.raises(SBackupValidationError):
+            PathFilter(**config).validate()
+
+
+@pytest.mark.parametrize('include', [['docs/'], ['/docs'], ['docs'], ['docs/**']])
+def test_include_dirs(tmpdir, include):
+    source = tmpdir.mkdir('site')
+    source.mkdir('docs').mkdir('api').join('index.rst').write('api')
+    source.join('docs', 'conf.py').write('conf')
+    source.mkdir('src').join('docs.py').write('docs')
+    source.join('src', 'main.py').write('main')
+    path_filter = PathFilter(include=include)
+    path_filter.validate()
+    with Walker(accept=path_filter) as walker:
+        names = sorted(entry.arcname for entry in walker.walk(str(source), 'site')
+                       if entry.arcname.endswith(('.rst', '.py')))
+    assert names == ['site/docs/api/index.rst', 'site/docs/conf.py']
+
+    # A pattern of the file wins over a pattern of its directory
+    assert not PatternSet(include + ['!conf.py']).match_file('docs/conf.py')
+    assert PatternSet(include + ['!conf.py']).match_file('docs/api/index.rst')
+
+
+def test_task_filters(tmpdir):
+    source = tmpdir.mkdir('site')
+    source.mkdir('.cache').join('page').write('cached')
+    source.join('index.html').write('<html></html>')
+    source.join('debug.log').write('debug')
+    backups = tmpdir.mkdir('backups')
+    task = {
+        'type': 'dir',
+        'name': 'site',
+        'source': str(source),
+        'filters': {'exclude': ['.cache/', '*.log']},
+        'dst_backend': {'local': {'path': str(backups), 'fsync': False}}
+    }
+    obj = DirBackupTask.create_task(task)
+    obj.validate()
+    backup_file = obj.create()
+    with tarfile.open(str(backups.join(backup_file))) as tar:
+        assert sorted(tar.getnames()) == ['site', 'site/index.html']
+
+    with pytest.raises(SBackupValidationError):
+        DirBackupTask.create_task(dict(task, filters={'exclude': ['*.log'], 'size': 1}))
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+from sbackup.scheduler import Demand, History, Job, Resources, Scheduler
+
+GB = 1024 ** 3
+
+
+class Recorder(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = set()
+        self.overlaps = []
+        self.order = []
+
+    def job(self, name, duration=0.05):
+        def run():
+            with self.lock:
+                self.order.append(name)
+                self.overlaps.append((name, set(self.running)))
+                self.running.add(name)
+            time.sleep(duration)
+            with self.lock:
+                self.running.discard(name)
+            return name
+        return run
+
+
+def test_huge_jobs_on_one_disk(tmpdir):
+    recorder = Recorder()
+    resources = Resources(cpu=8, network=8, tmp_space=100 * GB, huge_size=10 * GB)
+    jobs = [
+        Job('huge1', recorder.job('huge1'), expected_size=50 * GB, demand=Demand(device=1)),
+        Job('huge2', recorder.job('huge2'), expected_size=20 * GB, demand=Demand(device=1)),
+        Job('small', recorder.job('small'), expected_size=GB, demand=Demand(device=1)),
+        Job('other', recorder.job('other'), expected_size=50 * GB, demand=Demand(device=2)),
+    ]
+    results = Scheduler(resources, History(str(tmpdir.join('history.json')))).run(jobs)
+    assert results == {name: name for name in ('huge1', 'huge2', 'small', 'other')}
+    for name, running in recorder.overlaps:
+        assert not {'huge1', 'huge2'} <= running | {name}
+    assert dict(recorder.overlaps)['small'] >= {'huge1'}
+
+
+def test_priority_and_history(tmpdir):
+    history = History(str(tmpdir.join('history.json')))
+    history.data = {'short': {'duration': 1}, 'long': {'duration': 100}}
+    recorder = Recorder()
+    resources = Resources(cpu=1, network=1, tmp_space=GB)
+    jobs = [
+        Job('short', recorder.job('short', 0)),
+        Job('long', recorder.job('long', 0)),
+        Job('urgent', recorder.job('urgent', 0), priority=10),
+    ]
+    Scheduler(resources, history).run(jobs)
+    assert recorder.order == ['urgent', 'long', 'short']
+    assert History(str(tmpdir.join('history.json'))).get_duration('short') < 1
+
+
+def test_failed_job(tmpdir):
+    def fail():
+        raise ValueError('error')
+    results = Scheduler(Resources(), History(str(tmpdir.join('history.json')))).run(
+        [Job('fail', fail)])
+    assert isinstance(results['fail'], ValueError)
@@ -0,0 +1,59 @@
+import io
+import os
+import tarfile
+
+from sbackup.compress import Compressor, GzipCodec
+from sbackup.seekable import ArchiveIndex, IndexedTarFile, RangeReader
+
+
+class FakeBackend(object):
+    def __init__(self, data):
+        self.data = data
+        self.reads = []
+
+    def read_range(self, name, start, end):
+        self.reads.append((start, end))
+        return self.data[start:end]
+
+
+def make_archive(block_size=64 * 1024):
+    fileobj = io.BytesIO()
+    compressor = Compressor(block_size=block_size)
+    with compressor.open_writer(fileobj) as writer:
+        with IndexedTarFile.open(fileobj=writer, mode='w|', compress_writer=writer) as tar:
+            for number in range(20):
+                data = os.urandom(30000)
+                info = tarfile.TarInfo('site/dir%d/file.bin' % (number // 5))
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+    # Random files are stored as separate gzip members of blocks
+    assert writer.stored_bytes >= 20 * 30000 - 64 * 1024
+    return fileobj.getvalue(), ArchiveIndex.from_writer(writer, tar)
+
+
+def test_index_dump_and_select():
+    data, index = make_archive()
+    assert index.blocks[-1] == len(data)
+    index = ArchiveIndex.load(index.dump())
+    assert len(index.select(['site/dir1'])) == 5
+    assert index.select(['site/dir']) == []
+    spans = index.get_spans(index.members)
+    assert spans == [[0, index.members[-1][2]]]
+
+
+def test_range_reader():
+    data, index = make_archive()
+    backend = FakeBackend(data)
+    members = index.select(['site/dir3'])
+    with RangeReader(backend, 'backup.tar.gz', index, members, GzipCodec) as reader:
+        with tarfile.open(fileobj=reader, mode='r|') as tar:
+            names = [member.name for member in tar]
+    assert names == ['site/dir3/file.bin'] * 5
+    assert sum(end - start for start, end in backend.reads) < len(data) / 2
+
+    with tarfile.open(fileobj=io.BytesIO(data), mode='r:gz') as tar:
+        expected = [tar.extractfile(member).read() for member in tar
+                    if member.name == 'site/dir3/file.bin']
+    with RangeReader(backend, 'backup.tar.gz', index, members, GzipCodec, fetch_size=1) as reader:
+        with tarfile.open(fileobj=reader, mode='r|') as tar:
+            assert [tar.extractfile(member).read() for member in tar] == expected
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+import errno
+import os
+import stat
+import tarfile
+from unittest import mock
+
+import pytest
+
+from sbackup.exception import SBackupValidationError
+from sbackup.snapshot import SnapshotException, SnapshotSettings
+from sbackup.task import DirBackupTask
+
+
+def make_source(tmpdir):
+    source = tmpdir.mkdir('site')
+    source.mkdir('static').join('app.js').write('app()')
+    source.join('index.html').write('<html></html>')
+    source.join('data.db').write('v1')
+    source.join('current').mksymlinkto('index.html')
+    return source
+
+
+def test_hardlink_farm(tmpdir):
+    source = make_source(tmpdir)
+    with SnapshotSettings(method='hardlink').open(str(source)) as copy:
+        assert os.path.basename(copy.path) == 'site'
+        assert sorted(os.listdir(copy.path)) == ['current', 'data.db', 'index.html', 'static']
+        assert os.readlink(os.path.join(copy.path, 'current')) == 'index.html'
+        assert os.stat(os.path.join(copy.path, 'static', 'app.js')).st_ino == \
+            source.join('static', 'app.js').stat().ino
+        # A replaced file keeps the old data in the copy, a file changed in place is reported
+        source.join('index.html').remove()
+        source.join('index.html').write('new')
+        with open(str(source.join('data.db')), 'r+') as fileobj:
+            fileobj.write('v2')
+        with open(os.path.join(copy.path, 'index.html')) as fileobj:
+            assert fileobj.read() == '<html></html>'
+        assert copy.changed() == ['site/data.db']
+    assert sorted(item.basename for item in tmpdir.listdir()) == ['site']
+
+
+def deny_read_only(function):
+    """
+    Deny removals from directories without the owner write like for a non-root user
+    """
+    def call(path, *, dir_fd=None):
+        parent = os.fstat(dir_fd) if dir_fd is not None else os.stat(os.path.dirname(path))
+        if not parent.st_mode & stat.S_IWUSR:
+            raise PermissionError(errno.EACCES, 'Permission denied', path)
+        return function(path, dir_fd=dir_fd)
+    return call
+
+
+def test_read_only_farm(tmpdir):
+    source = make_source(tmpdir)
+    source.join('static').chmod(0o555)
+    try:
+        with mock.patch('os.unlink', deny_read_only(os.unlink)), \
+                mock.patch('os.rmdir', deny_read_only(os.rmdir)):
+            with SnapshotSettings(method='hardlink').open(str(source)) as copy:
+                assert stat.S_IMODE(os.stat(os.path.join(copy.path, 'static')).st_mode) == 0o555
+            assert sorted(item.basename for item in tmpdir.listdir()) == ['site']
+    finally:
+        source.join('static').chmod(0o755)
+
+
+def test_reflink_detection(tmpdir):
+    source = make_source(tmpdir)
+    unsupported = OSError(errno.EOPNOTSUPP, 'Operation not supported')
+    with mock.patch('sbackup.snapshot.fcntl.ioctl', side_effect=unsupported) as ioctl:
+        with SnapshotSettings().open(str(source)) as copy:
+            assert copy.reflinks is False and copy.linked == 4
+        # The first file detects a file system without reflinks
+        assert ioctl.call_count == 1
+        with pytest.raises(SnapshotException):
+            with SnapshotSettings(method='reflink').open(str(source)):
+                pass
+    assert sorted(item.basename for item in tmpdir.listdir()) == ['site']
+
+
+def test_command_snapshot(tmpdir):
+    source = make_source(tmpdir)
+    settings = SnapshotSettings(method='command', path=str(tmpdir.mkdir('snapshots')),
+                                create='cp -a {source} {path}', remove='rm -r {path}')
+    settings.validate()
+    with settings.open(str(source)) as copy:
+        assert sorted(os.listdir(copy.path)) == ['current', 'data.db', 'index.html', 'static']
+    assert tmpdir.join('snapshots').listdir() == []
+
+    settings = SnapshotSettings(method='command', path=str(tmpdir.join('snapshots')),
+                                create='echo no space; exit 3')
+    with pytest.raises(SnapshotException) as error:
+        with settings.open(str(source)):
+            pass
+    assert 'no space' in str(error.value)
+    assert tmpdir.join('snapshots').listdir() == []
+
+    with pytest.raises(SBackupValidationError):
+        SnapshotSettings(method='command').validate()
+
+
+def test_task_snapshot(tmpdir):
+    source = make_source(tmpdir)
+    backups = tmpdir.mkdir('backups')
+    task = {
+        'type': 'dir',
+        'name': 'site',
+        'source': str(source),
+        'snapshot': {'method': 'hardlink'},
+        'dst_backend': {'local': {'path': str(backups), 'fsync': False}}
+    }
+    obj = DirBackupTask.create_task(task)
+    write_archive = obj.write_archive
+
+    def write_while_changed(fileobj, index=None):
+        # A writer of the source doesn't wait for the archive
+        source.join('index.html').remove()
+        source.join('index.html').write('new')
+        with open(str(source.join('data.db')), 'r+') as db:
+            db.write('v2')
+        return write_archive(fileobj, index)
+
+    with mock.patch.object(obj, 'write_archive', side_effect=write_while_changed):
+        backup_file = obj.create()
+    assert 'source_snapshot' in obj.metrics.stages
+    assert obj.metrics.counters['files_changed'] == 1
+    with tarfile.open(str(backups.join(backup_file))) as tar:
+        assert tar.extractfile('site/index.html').read() == b'<html></html>'
+    assert sorted(item.basename for item in tmpdir.listdir()) == ['backups', 'site']
+
+    with pytest.raises(SBackupValidationError):
+        DirBackupTask.create_task(dict(task, incremental=True,
+                                       snapshot={'method': 'reflink'})).validate()
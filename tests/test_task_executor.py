@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+import os
+
+import pytest
+from moto import mock_aws
+
+from sbackup.async_executor import AsyncTaskExecutor
+from sbackup.exception import SBackupException
+from sbackup.task_executor import TaskExecutor, split_config
+
+
+def make_task(name, source, **kwargs):
+    task = {
+        'name': name,
+        'type': 'dir',
+        'source': str(source),
+        'dst_backend': {
+            's3': {
+                'access_key_id': 'asd1123sds',
+                'secret_access_key': 'Sdd3qsdasd',
+                'bucket': 'backup',
+                'location': name
+            }
+        }
+    }
+    task.update(kwargs)
+    return task
+
+
+def test_split_config(tmpdir):
+    task = make_task('site', tmpdir)
+    assert split_config([task]) == (split_config([])[0], [task])
+    settings, tasks = split_config({'executor': {'max_uploads': 8}, 'tasks': [task]})
+    assert settings['max_uploads'] == 8 and settings['engine'] == 'thread'
+    assert tasks == [task]
+    with pytest.raises(SBackupException):
+        split_config({'executor': {'max_speed': 8}, 'tasks': [task]})
+    with pytest.raises(SBackupException):
+        split_config({'executor': {'engine': 'gevent'}, 'tasks': [task]})
+    assert TaskExecutor(task).tasks == [task]
+
+
+@mock_aws
+def test_async_executor(tmpdir):
+    source = tmpdir.mkdir('site')
+    source.join('index.html').write('<html></html>')
+    executor = AsyncTaskExecutor({
+        'executor': {'engine': 'async', 'max_uploads': 2, 'max_archive_jobs': 1},
+        'tasks': [
+            make_task('site', source),
+            make_task('stream', source, stream=True),
+            make_task('missing', tmpdir.join('missing')),
+        ]
+    })
+    executor.get_backend('s3', executor.tasks[0]['dst_backend']['s3']).bucket.create()
+    results = executor.create()
+    assert results['site'].startswith('backup-site-')
+    assert results['stream'].startswith('backup-stream-')
+    assert isinstance(results['missing'], SBackupException)
+    backend = executor.get_backend('s3', executor.tasks[0]['dst_backend']['s3'])
+    assert list(backend) == [results['site']]
+
+
+def test_delete_older_keeps_chains(tmpdir):
+    location = tmpdir.mkdir('backups')
+    names = ['backup-site-2017-01-10-10-10.tar.gz',
+             'backup-site-2017-01-11-10-10.tar.gz',
+             'backup-site-2017-01-12-10-10.incr.tar.gz',
+             'backup-site-2017-01-13-10-10.incr.tar.gz',
+             'backup-site-2017-01-14-10-10.incr.tar.gz']
+    for name in names:
+        location.join(name).write('data')
+    for name in names[:4]:
+        os.utime(str(location.join(name)), (0, 0))
+    executor = TaskExecutor([])
+    result, _ = executor.delete_older('local', {'path': str(location)}, 30)
+    assert result.deleted == names[:1]
+    assert sorted(os.listdir(str(location))) == names[1:]
+    # The whole chain expires together
+    os.utime(str(location.join(names[4])), (0, 0))
+    result, _ = executor.delete_older('local', {'path': str(location)}, 30)
+    assert result.deleted == names[1:]
@@ -0,0 +1,94 @@
+from unittest import mock
+
+import pytest
+from moto import mock_aws
+
+from sbackup import dedup
+from sbackup.exception import SBackupException
+from sbackup.task import DirBackupTask
+from sbackup.verify import verify, verify_backups
+
+
+def make_task(source, **settings):
+    config = {
+        'type': 'dir',
+        'name': 'site',
+        'source': str(source),
+        'verify': True,
+        'dst_backend': {
+            's3': {
+                'access_key_id': 'asd1123sds',
+                'secret_access_key': 'Sdd3qsdasd',
+                'bucket': 'bucket'
+            }
+        }
+    }
+    config.update(settings)
+    return DirBackupTask.create_task(config)
+
+
+@pytest.mark.parametrize('codec', ['gz', 'zstd', 'lz4'])
+@mock_aws
+def test_verify_archive(tmpdir, codec):
+    source = tmpdir.mkdir('site')
+    source.join('index.html').write('<html></html>')
+    source.mkdir('static').join('app.js').write('app')
+    obj = make_task(source, compression={'codec': codec}, stream=True)
+    obj.dst_backend.bucket.create()
+    with mock.patch('sbackup.dest_backend.aws.S3Backend.validate'):
+        backup_file = obj.create()
+    result = verify(obj.dst_backend, backup_file)
+    assert result.ok and result.checked
+    assert result.members == 4
+
+    # A valid archive with other data
+    source.join('index.html').write('<html>new</html>')
+    other = make_task(source, compression={'codec': codec}, stream=True)
+    with mock.patch.object(DirBackupTask, 'get_archive_name', return_value='other.tar'):
+        other.stream_backup()
+    obj.dst_backend.put_object(backup_file, obj.dst_backend.get_object('other.tar'))
+    result = verify(obj.dst_backend, backup_file)
+    assert "The checksum of site/index.html doesn't match" in result.errors
+    assert "The checksum of the archive doesn't match" in result.errors
+    with pytest.raises(SBackupException):
+        obj.verify_backup(backup_file)
+
+
+@mock_aws
+def test_verify_damaged_archive(tmpdir):
+    source = tmpdir.mkdir('site')
+    source.join('index.html').write('<html></html>' * 1000)
+    obj = make_task(source)
+    obj.dst_backend.bucket.create()
+    with mock.patch('sbackup.dest_backend.aws.S3Backend.validate'):
+        backup_file = obj.create()
+    data = bytearray(obj.dst_backend.get_object(backup_file))
+    data[len(data) // 2] ^= 0xff
+    obj.dst_backend.put_object(backup_file, bytes(data))
+    result = verify(obj.dst_backend, backup_file)
+    assert not result.ok
+    assert result.errors[0].startswith("Can't read the backup")
+
+
+@mock_aws
+def test_verify_snapshot_and_sample(tmpdir):
+    source = tmpdir.mkdir('site')
+    source.join('index.html').write('<html></html>')
+    obj = make_task(source, format='dedup')
+    obj.dst_backend.bucket.create()
+    with mock.patch('sbackup.dest_backend.aws.S3Backend.validate'):
+        backup_file = obj.create()
+    for number in range(3):
+        obj.dst_backend.put_object('copy%d.manifest' % number,
+                                   obj.dst_backend.get_object(backup_file))
+    names = list(obj.dst_backend)
+    results = verify_backups(obj.dst_backend, names, workers=2, sample=2, seed=1)
+    assert len(results) == 2
+    assert all(result.ok for result in results)
+    assert verify_backups(obj.dst_backend, names, time_budget=0) == []
+
+    chunk_id = next(dedup.get_chunk_ids(
+        dedup.load_manifest(obj.dst_backend.get_object(backup_file))))
+    obj.dst_backend.put_object(dedup.get_chunk_name(chunk_id), dedup.zlib.compress(b'broken'))
+    result = verify(obj.dst_backend, backup_file)
+    assert result.errors == ['The chunk %s is damaged' % chunk_id]
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+import os
+
+from sbackup import volumes
+from sbackup.walker import Walker, is_dir
+
+
+def make_plan(root, count):
+    with Walker() as walker:
+        return volumes.plan_volumes(walker.walk(root, os.path.basename(root)), count)
+
+
+def test_plan_volumes(tmpdir):
+    source = tmpdir.mkdir('site')
+    source.mkdir('media').join('a.bin').write_binary(b'a' * 300 * 1024)
+    source.join('media', 'b.bin').write_binary(b'b' * 300 * 1024)
+    source.mkdir('static').join('c.bin').write_binary(b'c' * 200 * 1024)
+    source.join('index.html').write('<html></html>')
+
+    plan = make_plan(str(source), 3)
+    assert plan.volumes == 3
+    # The big subtree is split, its files are in different volumes
+    assert sorted(plan.dirs) == ['site', 'site/media']
+    assert plan.get_volume('site', True) == 0
+    assert plan.get_volume('site/media', True) == 0
+    assert plan.get_volume('site/media/a.bin') != plan.get_volume('site/media/b.bin')
+    assert plan.get_volume('site/static/c.bin') == plan.get_volume('site/static', True)
+    assert plan.get_volume('site/static/new/d.bin') == plan.get_volume('site/static', True)
+
+    # A source of one file is not split
+    assert make_plan(str(source.join('static')), 4).volumes == 1
+    assert make_plan(str(source.join('index.html')), 4).volumes == 1
+
+
+def test_volume_set_dirs(tmpdir):
+    source = tmpdir.mkdir('site')
+    source.mkdir('media')
+    os.utime(str(source.join('media')), (1000000000, 1000000000))
+    with Walker() as walker:
+        entries = [entry for entry in walker.walk(str(source), 'site') if is_dir(entry)]
+    dirs = {entry.arcname: (0o750, entry.stat.st_mtime) for entry in entries}
+    volume_set = volumes.load_set(volumes.dump_set([], dirs))
+
+    staging = tmpdir.mkdir('staging')
+    volumes.create_dirs(str(staging), volume_set)
+    staging.join('site', 'media', 'a.bin').write('a')
+    volumes.restore_dirs(str(staging), volume_set)
+    assert os.path.getmtime(str(staging.join('site', 'media'))) == 1000000000
+    assert os.stat(str(staging.join('site'))).st_mode & 0o777 == 0o750
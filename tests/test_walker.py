@@ -0,0 +1,101 @@
+import io
+import os
+import tarfile
+from unittest import mock
+
+from sbackup.walker import Walker, add_entries, read_ahead
+
+
+def make_tree(root):
+    for directory in ('b', 'a/c', 'a/d'):
+        os.makedirs(os.path.join(root, directory))
+    for name in ('a/c/1.txt', 'a/d/2.txt', 'b/3.txt', 'z.txt'):
+        with open(os.path.join(root, name), 'wt') as fileobj:
+            fileobj.write(name * 100)
+    os.symlink('z.txt', os.path.join(root, 'link'))
+    os.link(os.path.join(root, 'z.txt'), os.path.join(root, 'hard.txt'))
+
+
+def test_walk_order(tmpdir):
+    source = str(tmpdir.mkdir('data'))
+    make_tree(source)
+    with tarfile.open(fileobj=io.BytesIO(), mode='w') as tar:
+        tar.add(source, arcname='data')
+        expected = tar.getnames()
+    for workers in (1, 4):
+        with Walker(workers) as walker:
+            assert [entry.arcname for entry in walker.walk(source, 'data')] == expected
+
+
+def test_walk_bounded_scans(tmpdir):
+    source = tmpdir.mkdir('data')
+    for number in range(50):
+        source.mkdir('%02d' % number).mkdir('sub').join('file.txt').write('data')
+    expected = ['data'] + ['data/%02d%s' % (number, name) for number in range(50)
+                           for name in ('', '/sub', '/sub/file.txt')]
+    with Walker(2, max_scans=3) as walker:
+        names = []
+        for entry in walker.walk(str(source), 'data'):
+            names.append(entry.arcname)
+            assert walker._scans <= 4
+    assert names == expected
+
+
+def test_walk_skipped(tmpdir):
+    source = str(tmpdir.mkdir('data'))
+    make_tree(source)
+    scandir = os.scandir
+
+    def fake_scandir(path):
+        if path.endswith('/c'):
+            raise PermissionError(13, 'Permission denied')
+        return scandir(path)
+
+    with mock.patch('sbackup.walker.os.scandir', side_effect=fake_scandir), \
+            Walker(2) as walker:
+        names = [entry.arcname for entry in walker.walk(source, 'data')]
+    assert 'data/a/c' in names and 'data/a/c/1.txt' not in names
+    assert [path for path, _ in walker.skipped] == [os.path.join(source, 'a', 'c')]
+
+
+def test_walk_accept(tmpdir):
+    source = str(tmpdir.mkdir('data'))
+    make_tree(source)
+    with Walker(2, accept=lambda entry: not entry.arcname.startswith('data/a')) as walker:
+        names = [entry.arcname for entry in walker.walk(source, 'data')]
+    assert names == ['data', 'data/b', 'data/b/3.txt', 'data/hard.txt', 'data/link', 'data/z.txt']
+
+
+def test_add_entries(tmpdir):
+    source = str(tmpdir.mkdir('data'))
+    make_tree(source)
+    fileobj = io.BytesIO()
+    with tarfile.open(fileobj=fileobj, mode='w') as tar, Walker(4) as walker:
+        add_entries(tar, read_ahead(walker, walker.walk(source, 'data'), max_files=2))
+    fileobj.seek(0)
+    with tarfile.open(fileobj=fileobj) as tar:
+        assert tar.getmember('data/link').linkname == 'z.txt'
+        assert tar.getmember('data/hard.txt').size == len('z.txt' * 100)
+        assert tar.getmember('data/z.txt').islnk()
+        assert tar.extractfile('data/a/c/1.txt').read() == b'a/c/1.txt' * 100
+
+
+def test_add_entries_deleted_link(tmpdir):
+    source = str(tmpdir.mkdir('data'))
+    make_tree(source)
+    for max_files in (0, 2):
+        with Walker(2) as walker:
+            entries = list(walker.walk(source, 'data'))
+            # The first link is deleted after the walk, the second one keeps the data
+            os.remove(os.path.join(source, 'hard.txt'))
+            fileobj = io.BytesIO()
+            with tarfile.open(fileobj=fileobj, mode='w') as tar:
+                items = read_ahead(walker, entries, max_files=max_files) if max_files else \
+                    ((entry, None) for entry in entries)
+                add_entries(tar, items)
+        os.link(os.path.join(source, 'z.txt'), os.path.join(source, 'hard.txt'))
+        fileobj.seek(0)
+        with tarfile.open(fileobj=fileobj) as tar:
+            assert 'data/hard.txt' not in tar.getnames()
+            assert tar.getmember('data/z.txt').isreg()
+            assert tar.extractfile('data/z.txt').read() == b'z.txt' * 100